@@ -630,11 +630,56 @@ class UnifiedFileResponseDTO(BaseModel):
     # sequential ids from exposing every clinic's imaging. Absent for reports,
     # which have no thumbnail endpoint.
     thumbnail_token: Optional[str] = None
+    # Presigned URLs of the upload-time WebP renders, when they exist. Clients
+    # use these directly and fall back to the thumbnail endpoint when absent.
+    thumbnail_url: Optional[str] = None
+    preview_url: Optional[str] = None
 
     class Config:
         from_attributes = True
 
 
+# Direct-to-R2 upload DTOs
+class DirectUploadInitiateDTO(BaseModel):
+    file_name: str = Field(..., min_length=1, max_length=255)
+    content_type: Optional[str] = "application/octet-stream"
+    file_size: int = Field(..., gt=0)
+    kind: str = Field(default="document", pattern="^(document|xray)$")
+
+class DirectUploadPartURLDTO(BaseModel):
+    part_number: int
+    url: str
+
+class DirectUploadInitiateResponseDTO(BaseModel):
+    upload_id: str
+    key: str
+    part_size: int
+    expires_in: int
+    parts: List[DirectUploadPartURLDTO]
+
+class DirectUploadPartDTO(BaseModel):
+    part_number: int = Field(..., ge=1, le=10000)
+    etag: str = Field(..., min_length=1)
+
+class DirectUploadCompleteDTO(BaseModel):
+    key: str
+    upload_id: str
+    parts: List[DirectUploadPartDTO] = Field(..., min_length=1)
+    kind: str = Field(default="document", pattern="^(document|xray)$")
+    file_name: str = Field(..., min_length=1, max_length=255)
+    # document only
+    case_paper_id: Optional[int] = None
+    # xray only
+    image_type: Optional[str] = None
+    capture_date: Optional[date] = None
+    appointment_id: Optional[int] = None
+    notes: Optional[str] = None
+
+class DirectUploadAbortDTO(BaseModel):
+    key: str
+    upload_id: str
+
+
 # Prescription DTOs
 class PrescriptionItemDTO(BaseModel):
     medicine_name: str
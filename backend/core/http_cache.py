@@ -0,0 +1,45 @@
+"""Conditional GET helpers.
+
+Screens that poll (the calendar, the public booking page) mostly ask for data
+that has not changed since they last asked. Answering with an ETag lets the
+client send it back as If-None-Match, and an unchanged answer costs a 304 with
+no body instead of the full payload again.
+
+The tag is a hash of the JSON body itself, so it changes exactly when the
+response would, including for deletes, which a max(updated_at) tag misses.
+"""
+import hashlib
+import json
+from typing import Optional
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """RFC 9110 weak comparison: W/ prefixes are ignored, "*" matches anything."""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+
+def conditional_json(
+    payload,
+    if_none_match: Optional[str],
+    cache_control: str = "private, no-cache",
+) -> Response:
+    """`payload` as JSON with an ETag, or an empty 304 if the client has it.
+
+    The default Cache-Control keeps a copy in the browser but makes it
+    revalidate every time, which is what a polled view wants."""
+    body = json.dumps(jsonable_encoder(payload), separators=(",", ":")).encode()
+    etag = etag_for(body)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -28,6 +28,11 @@ def _ist_now() -> dt.datetime:
     return dt.datetime.now(IST).replace(tzinfo=None)
 
 
+def _utc_now() -> dt.datetime:
+    """Return current time in UTC as a naive datetime (matches `utcnow` columns)."""
+    return dt.datetime.utcnow()
+
+
 async def run_platform_automation_job() -> None:
     """Hourly: run trial nudges and lab-due-tomorrow reminders.
 
@@ -546,7 +551,7 @@ async def weekly_summary_broadcast_job() -> None:
     from database import SessionLocal
     from sqlalchemy import or_
     from models import Clinic, User, NotificationLog
-    from domains.notification.services.report_stats_service import get_weekly_stats
+    from domains.notification.services.report_stats_service import get_weekly_stats, prepare_weekly_stats
 
     db = SessionLocal()
     try:
@@ -559,6 +564,10 @@ async def weekly_summary_broadcast_job() -> None:
             .filter(or_(Clinic.status.is_(None), ~Clinic.status.in_(["suspended", "cancelled"])))
             .all()
         )
+        # Usually already stored by report_period_stats_job; anything missing
+        # is computed here for all clinics at once rather than one by one.
+        prepare_weekly_stats(db, [c.id for c in clinics], today)
+        db.commit()
 
         sent_wa = 0
         sent_email = 0
@@ -635,7 +644,7 @@ async def monthly_summary_broadcast_job() -> None:
     from sqlalchemy import or_
     from models import Clinic, User, NotificationLog
     from domains.notification.services.report_stats_service import (
-        get_monthly_stats, get_review_stats,
+        get_monthly_stats, get_review_stats, prepare_monthly_stats,
     )
 
     db = SessionLocal()
@@ -649,6 +658,8 @@ async def monthly_summary_broadcast_job() -> None:
             .filter(or_(Clinic.status.is_(None), ~Clinic.status.in_(["suspended", "cancelled"])))
             .all()
         )
+        prepare_monthly_stats(db, [c.id for c in clinics], today)
+        db.commit()
 
         sent_monthly_wa = 0
         sent_monthly_email = 0
@@ -739,6 +750,44 @@ async def monthly_summary_broadcast_job() -> None:
         db.close()
 
 
+async def report_period_stats_job() -> None:
+    """00:30 UTC: store the week and month that just ended, top up the current ones.
+
+    Weeks run Sunday to Sunday, the window the Sunday weekly broadcast
+    reports on, so by the time it runs its figures are already stored.
+    Everything here is UTC: the rows are stamped with `utcnow`, and a period
+    closed at 00:30 IST would miss its last 5.5 hours.
+    """
+    from database import SessionLocal
+    from sqlalchemy import or_
+    from models import Clinic
+    from domains.notification.services import report_period_stats as stats
+
+    db = SessionLocal()
+    try:
+        now = _utc_now()
+        today = now.date()
+        this_week = today - dt.timedelta(days=(today.weekday() + 1) % 7)  # last Sunday
+        this_month = today.replace(day=1)
+        periods = [
+            stats.week(this_week - dt.timedelta(days=7)), stats.week(this_week),
+            stats.month(this_month - dt.timedelta(days=1)), stats.month(this_month),
+        ]
+        clinic_ids = [
+            cid for (cid,) in db.query(Clinic.id)
+            .filter(or_(Clinic.status.is_(None), ~Clinic.status.in_(["suspended", "cancelled"])))
+            .all()
+        ]
+        rows = stats.ensure(db, clinic_ids, periods, now)
+        db.commit()
+        logger.info("report_period_stats: rows=%d clinics=%d", len(rows), len(clinic_ids))
+    except Exception as exc:
+        db.rollback()
+        logger.error("report_period_stats fatal: %s", exc)
+    finally:
+        db.close()
+
+
 # ── Daily motivation push notifications ──────────────────────────────────────
 
 MORNING_MESSAGES = [
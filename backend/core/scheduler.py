@@ -56,6 +56,7 @@ def _register_jobs(sched: AsyncIOScheduler) -> None:
         daily_summary_broadcast_job,
         weekly_summary_broadcast_job,
         monthly_summary_broadcast_job,
+        report_period_stats_job,
         morning_motivation_push_job,
         evening_motivation_push_job,
         clinic_morning_digest_job,
@@ -159,6 +160,17 @@ def _register_jobs(sched: AsyncIOScheduler) -> None:
         replace_existing=True,
     )
 
+    # Report figures: store the period that just ended, top up the current one.
+    # 06:00 IST is 00:30 UTC, just after the UTC day the figures are cut on.
+    sched.add_job(
+        report_period_stats_job,
+        trigger="cron",
+        hour=6,
+        minute=0,
+        id="report_period_stats",
+        replace_existing=True,
+    )
+
     # Morning motivation push — 9:00 AM IST daily
     sched.add_job(
         morning_motivation_push_job,
@@ -0,0 +1,227 @@
+"""
+Per-clinic cache for the dashboard home screen.
+
+/dashboard/today and /dashboard/metrics run on every open and every refresh,
+and /metrics alone is a dozen and more aggregate queries, yet what they show
+only moves when something the clinic owns is written: an appointment, a
+payment or invoice, a patient, a lab case or a stock line. So each payload is
+cached under a key that carries the clinic's version:
+
+    dashboard:{clinic_id}:{name}:{all}.{clinic}:{utc date}
+
+`clinic` counts the commits that touched that clinic's watched rows, `all`
+counts the bulk statements whose clinic can't be known (query(...).delete()
+and friends), and the date rolls "today" over at midnight. Reads are one
+version lookup plus one GET until something actually changes.
+
+The versions are bumped by the session itself, so every write path in the
+scheduling, finance and patient domains is covered without each remembering
+to: after a flush the clinics of the watched rows it wrote are noted on the
+session, and after the commit their versions go up. A rollback drops them.
+A read that raced a commit can therefore return what it saw before that one
+commit, never anything older.
+
+Without Redis (the desktop build, or Redis down) versions and payloads live
+in this process, which is exact for a single process. If bumping in Redis
+fails, this process stops trusting Redis for REDIS_BACKOFF_S and serves from
+its own copy. Payloads also expire after DASHBOARD_CACHE_TTL_S, since "overdue"
+and "today" move with the clock as well as with writes.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import redis
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import (Appointment, CasePaper, InventoryItem, Invoice, InvoicePayment, LabOrder,
+                    MedicationStock, Patient, Payment)
+from domains.infrastructure.services.cache_service import cache_service
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+DASHBOARD_CACHE_TTL_S = int(os.getenv("DASHBOARD_CACHE_TTL_S", "300"))
+# How long this process keeps to its own copy after a Redis bump failed.
+REDIS_BACKOFF_S = 30
+# Payloads held in-process when Redis isn't there: a few periods per clinic.
+LOCAL_MAX_ENTRIES = 512
+
+# Everything /today and /metrics read that a clinic's staff can change.
+WATCHED = (Appointment, Patient, Payment, Invoice, InvoicePayment, LabOrder, CasePaper,
+           InventoryItem, MedicationStock)
+ALL = "all"
+
+_DIRTY = "dashboard_cache_dirty"
+
+
+def version_key(clinic_id) -> str:
+    return f"dashboard:{clinic_id}:version"
+
+
+def cache_key(clinic_id: int, name: str, versions: Tuple[int, int], on: str) -> str:
+    return f"dashboard:{clinic_id}:{name}:{versions[0]}.{versions[1]}:{on}"
+
+
+# ── Versions ─────────────────────────────────────────────────────────────────
+
+_client: Optional[redis.Redis] = None
+_client_lock = threading.Lock()
+_down_until = 0.0
+
+_local_lock = threading.Lock()
+_local_versions: Dict[object, int] = {}
+_local_values: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+
+def _redis() -> redis.Redis:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.from_url(REDIS_URL, socket_connect_timeout=1, socket_timeout=1)
+    return _client
+
+
+def _use_redis() -> bool:
+    return cache_service.redis_client is not None and time.monotonic() >= _down_until
+
+
+def bump(clinic_ids: Iterable) -> None:
+    """Make every cached payload of these clinics (or ALL) unreachable."""
+    global _down_until
+    ids = set(clinic_ids)
+    if not ids:
+        return
+    with _local_lock:
+        for cid in ids:
+            _local_versions[cid] = _local_versions.get(cid, 0) + 1
+    if cache_service.redis_client is None or time.monotonic() < _down_until:
+        return
+    try:
+        pipe = _redis().pipeline(transaction=False)
+        for cid in ids:
+            pipe.incr(version_key(cid))
+        pipe.execute()
+    except Exception as e:
+        _down_until = time.monotonic() + REDIS_BACKOFF_S
+        logger.warning(f"Dashboard cache: Redis version bump failed, serving locally: {e}")
+
+
+async def versions(clinic_id: int) -> Tuple[int, int]:
+    """(all, clinic) as the cache keys should carry them right now."""
+    global _down_until
+    if _use_redis():
+        try:
+            raw = await cache_service.redis_client.mget(version_key(ALL), version_key(clinic_id))
+            return tuple(int(v or 0) for v in raw)
+        except Exception as e:
+            _down_until = time.monotonic() + REDIS_BACKOFF_S
+            logger.warning(f"Dashboard cache: Redis unreachable, serving locally: {e}")
+    with _local_lock:
+        return _local_versions.get(ALL, 0), _local_versions.get(clinic_id, 0)
+
+
+# ── Payloads ─────────────────────────────────────────────────────────────────
+
+async def _get(key: str) -> Optional[dict]:
+    if _use_redis():
+        return await cache_service.get(key)
+    with _local_lock:
+        hit = _local_values.get(key)
+        if hit is None:
+            return None
+        if hit[0] < time.monotonic():
+            del _local_values[key]
+            return None
+        _local_values.move_to_end(key)
+        return hit[1]
+
+
+async def _set(key: str, value: dict) -> None:
+    if _use_redis():
+        await cache_service.set(key, value, DASHBOARD_CACHE_TTL_S)
+        return
+    with _local_lock:
+        _local_values[key] = (time.monotonic() + DASHBOARD_CACHE_TTL_S, value)
+        _local_values.move_to_end(key)
+        while len(_local_values) > LOCAL_MAX_ENTRIES:
+            _local_values.popitem(last=False)
+
+
+async def cached(clinic_id: int, name: str, compute: Callable[[], dict]) -> dict:
+    """`compute()`'s payload for this clinic, from the cache while no watched
+    write has landed since it was stored. A miss runs `compute` off the event
+    loop, since it is plain blocking SQL."""
+    key = cache_key(clinic_id, name, await versions(clinic_id), datetime.utcnow().date().isoformat())
+    hit = await _get(key)
+    if hit is not None:
+        return hit
+    value = await run_in_threadpool(compute)
+    # Stored under the version read before computing: if a write landed in
+    # between, the key is already stale and nobody will read it.
+    await _set(key, value)
+    return value
+
+
+def reset_local() -> None:
+    """Forget this process's versions and payloads (tests, benchmarks)."""
+    with _local_lock:
+        _local_versions.clear()
+        _local_values.clear()
+
+
+# ── Invalidation ─────────────────────────────────────────────────────────────
+
+def _clinics_of(obj) -> set:
+    state = inspect(obj)
+    # Read from the instance dict: a deleted row can't be loaded any more.
+    ids = {state.dict.get("clinic_id")}
+    ids.update(v for v in state.attrs.clinic_id.history.deleted or () if v is not None)
+    return {ALL} if None in ids and len(ids) == 1 else ids - {None}
+
+
+@event.listens_for(Session, "after_flush")
+def _note_dirty_clinics(session, flush_context):
+    dirty = set()
+    for obj in session.new:
+        if isinstance(obj, WATCHED):
+            dirty |= _clinics_of(obj)
+    for obj in session.deleted:
+        if isinstance(obj, WATCHED):
+            dirty |= _clinics_of(obj)
+    for obj in session.dirty:
+        if isinstance(obj, WATCHED) and session.is_modified(obj, include_collections=False):
+            dirty |= _clinics_of(obj)
+    if dirty:
+        session.info.setdefault(_DIRTY, set()).update(dirty)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _note_bulk_writes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and issubclass(mapper.class_, WATCHED):
+        orm_execute_state.session.info.setdefault(_DIRTY, set()).add(ALL)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_committed(session):
+    dirty = session.info.pop(_DIRTY, None)
+    if dirty:
+        bump(dirty)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_dirty(session, previous_transaction):
+    # A savepoint rolling back keeps what the outer transaction noted; at
+    # worst that bumps a version for nothing.
+    if previous_transaction.parent is None:
+        session.info.pop(_DIRTY, None)
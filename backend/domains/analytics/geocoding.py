@@ -0,0 +1,190 @@
+"""
+Patient locations resolved to real coordinates, from an offline gazetteer.
+
+The patient map used to load every patient with a village, group them in
+Python by the raw text, and plot each group at a point looked up in a
+hard-coded city table, or made up from a hash of the name when the city was
+not in it. It was slow on large clinics and placed many of the markers in
+the wrong state.
+
+`geocodes` is now a table of real places keyed by a normalised name
+("navi mumbai") or a 6-digit pincode ("400703"). It is filled from the
+gazetteer bundled in config/gazetteer_in.csv, one row per place and one per
+alias ("bombay" → Mumbai). A GeoNames India postal file can be loaded on top
+for pincode coverage:
+
+    python scripts/load_gazetteer.py --geonames IN.txt
+
+Each patient's `geocode_key` is the entry their village text resolves to.
+The session sets it whenever a patient is created or their village changes.
+The first startup against an empty `geocodes` table loads the bundled file
+and backfills patients saved before the table existed; later boots skip
+both, and scripts/load_gazetteer.py reloads after the gazetteer changes. The map is
+then one grouped count over (clinic_id, geocode_key). A village that
+matches nothing is counted in an "Unlocated" entry rather than given
+invented coordinates.
+"""
+import csv
+import os
+import re
+import weakref
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import Geocode, Patient
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                              "config", "gazetteer_in.csv")
+BATCH = 5000
+
+_PINCODE = re.compile(r"(?<!\d)[1-9]\d{5}(?!\d)")
+_PARTS = re.compile(r"[,/;|\n]+")
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+# Engines whose database has the table; see appointment_facts._has_table.
+_has_table: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+Row = Tuple[str, str, float, float, str]  # key, label, latitude, longitude, source
+
+
+def normalise(text: Optional[str]) -> str:
+    """Lower case, punctuation to spaces, runs of spaces collapsed."""
+    return _NON_WORD.sub(" ", (text or "").lower()).strip()
+
+
+def candidates(text: Optional[str]) -> List[str]:
+    """The keys `text` could resolve to, most specific first: any pincode in
+    it, the whole text, then its comma-separated parts from the last (the
+    town usually ends an address) to the first."""
+    if not text or not text.strip():
+        return []
+    out = _PINCODE.findall(text)
+    out.append(normalise(text))
+    parts = [normalise(_PINCODE.sub(" ", p)) for p in _PARTS.split(text)]
+    out.extend(reversed(parts))
+    seen = set()
+    return [k for k in out if k and not (k in seen or seen.add(k))]
+
+
+def pick(text: Optional[str], known) -> Optional[str]:
+    """The first of `candidates(text)` that is in `known`."""
+    return next((k for k in candidates(text) if k in known), None)
+
+
+# ── Gazetteer ────────────────────────────────────────────────────────────────
+
+def bundled_rows(path: str = GAZETTEER_PATH) -> Iterator[Row]:
+    """Rows of the bundled gazetteer: place,latitude,longitude,aliases
+    (aliases separated by ';')."""
+    with open(path, newline="", encoding="utf-8") as f:
+        for rec in csv.DictReader(f):
+            lat, lon = float(rec["latitude"]), float(rec["longitude"])
+            names = [rec["place"], *(rec.get("aliases") or "").split(";")]
+            for name in names:
+                if normalise(name):
+                    yield normalise(name), rec["place"], lat, lon, "bundled"
+
+
+def geonames_rows(path: str) -> Iterator[Row]:
+    """Pincode rows from a GeoNames postal dump (IN.txt, tab separated).
+
+    A pincode covers several post offices; it is placed at their centroid
+    and labelled with its district."""
+    points: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+    labels: Dict[str, str] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) < 11 or not _PINCODE.fullmatch(cols[1]):
+                continue
+            try:
+                points[cols[1]].append((float(cols[9]), float(cols[10])))
+            except ValueError:
+                continue
+            labels.setdefault(cols[1], cols[5] or cols[2])
+    for pincode, pts in points.items():
+        yield (pincode, labels[pincode], round(sum(p[0] for p in pts) / len(pts), 4),
+               round(sum(p[1] for p in pts) / len(pts), 4), "geonames")
+
+
+def load(db: Session, rows: Iterable[Row]) -> int:
+    """Upsert gazetteer rows into `geocodes`. Runs in the caller's
+    transaction and does not commit. Returns the number of rows written."""
+    conn = db.connection()
+    dialect = postgresql if conn.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(Geocode.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["key"],
+        set_={c: stmt.excluded[c] for c in ("label", "latitude", "longitude", "source")},
+    )
+    batch, n = {}, 0
+    for key, label, lat, lon, source in rows:
+        batch[key] = {"key": key, "label": label, "latitude": lat, "longitude": lon, "source": source}
+        if len(batch) >= BATCH:
+            conn.execute(stmt, list(batch.values()))
+            n += len(batch)
+            batch = {}
+    if batch:
+        conn.execute(stmt, list(batch.values()))
+        n += len(batch)
+    return n
+
+
+def backfill(db: Session, clinic_id: Optional[int] = None, redo: bool = False) -> int:
+    """Set `geocode_key` on patients that have a village but no key yet,
+    for example after a gazetteer load. With `redo`, every patient is
+    resolved again (a pincode file loaded later is more specific than the
+    town a patient already matched). One update per distinct village.
+    Does not commit. Returns the number of patients given a key."""
+    if redo:
+        reset = update(Patient).where(Patient.geocode_key.isnot(None))
+        if clinic_id is not None:
+            reset = reset.where(Patient.clinic_id == clinic_id)
+        db.execute(reset.values(geocode_key=None), execution_options={"synchronize_session": False})
+    known = set(db.execute(select(Geocode.key)).scalars())
+    villages = select(Patient.village).where(Patient.village.isnot(None),
+                                             Patient.geocode_key.is_(None)).distinct()
+    if clinic_id is not None:
+        villages = villages.where(Patient.clinic_id == clinic_id)
+    n = 0
+    for village in db.execute(villages).scalars().all():
+        key = pick(village, known)
+        if key is None:
+            continue
+        stmt = update(Patient).where(Patient.village == village, Patient.geocode_key.is_(None))
+        if clinic_id is not None:
+            stmt = stmt.where(Patient.clinic_id == clinic_id)
+        n += db.execute(stmt.values(geocode_key=key),
+                        execution_options={"synchronize_session": False}).rowcount
+    return n
+
+
+# ── Keeping patients current ─────────────────────────────────────────────────
+
+def _enabled(conn) -> bool:
+    engine = conn.engine
+    known = _has_table.get(engine)
+    if known is None:
+        known = _has_table[engine] = inspect(conn).has_table(Geocode.__tablename__)
+    return known
+
+
+@event.listens_for(Session, "before_flush")
+def _geocode_patients(session, flush_context, instances):
+    touched = [o for o in session.new if isinstance(o, Patient)]
+    touched += [o for o in session.dirty
+                if isinstance(o, Patient) and inspect(o).attrs.village.history.has_changes()]
+    if not touched:
+        return
+    wanted = {k for o in touched for k in candidates(o.village)}
+    known = set()
+    if wanted:
+        conn = session.connection()
+        if not _enabled(conn):
+            return
+        known = set(conn.execute(select(Geocode.key).where(Geocode.key.in_(wanted))).scalars())
+    for o in touched:
+        o.geocode_key = pick(o.village, known)
@@ -1,15 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, Response
 from sqlalchemy.orm import Session
 from sqlalchemy import func, and_, extract, case
+from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import Optional
-import csv
-import io
 from database import get_db
-from models import Patient, Report, Payment, User, TreatmentType, Appointment, Clinic, Invoice, LabOrder, InventoryItem, MedicationStock, CasePaper, InvoicePayment
+from models import Patient, Report, Payment, User, TreatmentType, Appointment, AppointmentStatsFact as Fact, Clinic, GooglePlaceLink, Invoice, LabOrder, InventoryItem, MedicationStock, CasePaper, InvoicePayment, Geocode
 from core.auth_utils import get_current_user
 from core.clinic_time import clinic_today
-from domains.scheduling.appointment_status import ARRIVED
+from domains.analytics import dashboard_cache
+from domains.scheduling import appointment_facts
+from domains.scheduling.appointment_status import ARRIVED, CANCELLED, COMPLETED, NO_SHOW
+from domains.scheduling.availability_engine import ClinicAvailability
 
 router = APIRouter()
 
@@ -55,7 +57,7 @@ def period_range(period: str, now: datetime = None):
 
 
 @router.get("/metrics")
-def get_dashboard_metrics(
+async def get_dashboard_metrics(
     period: str = "month",  # today, yesterday, 7days, month
     clinic_id: Optional[int] = None,
     db: Session = Depends(get_db),
@@ -64,7 +66,12 @@ def get_dashboard_metrics(
     """Get main dashboard metrics with period filtering - Dental clinic specific"""
     # Use provided clinic_id if owner, else default to user's clinic
     final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
+    return await dashboard_cache.cached(final_clinic_id, f"metrics:{period}",
+                                        lambda: dashboard_metrics(db, final_clinic_id, period))
 
+
+def dashboard_metrics(db: Session, final_clinic_id: int, period: str = "month") -> dict:
+    """The /metrics payload, read straight from the database."""
     # Calculate date ranges
     now = datetime.utcnow()
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -362,6 +369,10 @@ def all_time_months(db, clinic_id, now):
         cur = nxt
     return buckets
 
+# Session.info key under which a session may memoise period_buckets.
+BUCKET_MEMO = "period_buckets"
+
+
 def period_buckets(period: str, db, clinic_id: int, now: datetime = None):
     """The x-axis for a chart at this period → [(label, start, end)].
 
@@ -372,6 +383,18 @@ def period_buckets(period: str, db, clinic_id: int, now: datetime = None):
     now = now or datetime.utcnow()
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
 
+    # A snapshot session (see dashboard_export) can't see new data, so the
+    # charts built in it share one set of buckets instead of each querying.
+    memo = getattr(db, "info", {}).get(BUCKET_MEMO)
+    if memo is not None:
+        key = (period, clinic_id, today_start)
+        if key not in memo:
+            memo[key] = _period_buckets(period, db, clinic_id, now, today_start)
+        return memo[key]
+    return _period_buckets(period, db, clinic_id, now, today_start)
+
+
+def _period_buckets(period, db, clinic_id, now, today_start):
     if period == "all":
         return all_time_months(db, clinic_id, now)
 
@@ -408,6 +431,47 @@ def _bucket_index(buckets, when):
     return None
 
 
+# SQLite has no date_trunc; strftime to the start of the bucket gives the same
+# key as text, which _bucket_start parses back.
+_SQLITE_TRUNCATE = {
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d 00:00:00",
+    "month": "%Y-%m-01 00:00:00",
+}
+
+
+def bucket_grain(period: str) -> str:
+    """The unit period_buckets steps in for this period."""
+    if period in ("today", "yesterday"):
+        return "hour"
+    return "month" if period == "all" else "day"
+
+
+def sql_bucket(db, column, period: str):
+    """`column` truncated to the start of its period_buckets bucket, in SQL.
+
+    date_trunc on Postgres, strftime on SQLite, so a chart series can be one
+    GROUP BY instead of every row fetched and placed by _bucket_index."""
+    grain = bucket_grain(period)
+    if db.get_bind().dialect.name == "postgresql":
+        return func.date_trunc(grain, column).label("bucket")
+    return func.strftime(_SQLITE_TRUNCATE[grain], column).label("bucket")
+
+
+def _bucket_start(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def bucketed(buckets, rows):
+    """(bucket index, *values) for grouped rows whose first column is a
+    sql_bucket; rows outside the chart are dropped."""
+    index = {start: i for i, (_, start, _) in enumerate(buckets)}
+    for bucket, *values in rows:
+        i = index.get(_bucket_start(bucket))
+        if i is not None:
+            yield (i, *values)
+
+
 @router.get("/patient-stats")
 def get_patient_statistics(
     period: str = "month",  # today, yesterday, 7days, month, all
@@ -421,11 +485,10 @@ def get_patient_statistics(
     - returning: existing patients (registered earlier) who had an appointment
                  in the bucket
 
-    Two queries total, bucketed in Python. This used to run two queries *per
-    bucket*, which was 48 round-trips for all-time and 62 for a full month — on
-    the first screen anyone opens, and now the default. Bucketing in Python
-    rather than SQL `date_trunc` keeps it working on both Postgres (server) and
-    SQLite (bundled desktop build).
+    Two grouped queries total, bucketed in SQL (sql_bucket). This used to run
+    two queries *per bucket*, which was 48 round-trips for all-time and 62 for
+    a full month — on the first screen anyone opens, and now the default —
+    and then fetched every row to bucket in Python.
     """
     final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
     now = datetime.utcnow()
@@ -436,39 +499,38 @@ def get_patient_statistics(
 
     range_start, range_end = buckets[0][1], buckets[-1][2]
     new_counts = [0] * len(buckets)
-    returning_sets = [set() for _ in buckets]
+    returning = [0] * len(buckets)
 
     # 1. New registrations.
-    for created_at, in db.query(Patient.created_at).filter(
+    registered = sql_bucket(db, Patient.created_at, period)
+    for i, count in bucketed(buckets, db.query(registered, func.count(Patient.id)).filter(
         and_(
             Patient.clinic_id == final_clinic_id,
             Patient.created_at >= range_start,
             Patient.created_at < range_end,
         )
-    ).all():
-        idx = _bucket_index(buckets, created_at)
-        if idx is not None:
-            new_counts[idx] += 1
+    ).group_by(registered).all()):
+        new_counts[i] = count
 
     # 2. Returning visits. "Returning" is per-bucket (registered before *this*
-    # bucket began), so the comparison has to happen after bucketing — hence
-    # carrying created_at along rather than filtering in SQL. Distinct patients
-    # per bucket, so a patient with three visits in a month counts once.
-    for appt_date, patient_id, created_at in db.query(
-        Appointment.appointment_date, Appointment.patient_id, Patient.created_at
+    # bucket began), so the comparison is against the bucket key itself.
+    # Distinct patients per bucket, so a patient with three visits in a month
+    # counts once.
+    visited = sql_bucket(db, Appointment.appointment_date, period)
+    for i, count in bucketed(buckets, db.query(
+        visited, func.count(func.distinct(Appointment.patient_id))
     ).join(Patient, Patient.id == Appointment.patient_id).filter(
         and_(
             Appointment.clinic_id == final_clinic_id,
             Appointment.appointment_date >= range_start,
             Appointment.appointment_date < range_end,
+            Patient.created_at < visited,
         )
-    ).all():
-        idx = _bucket_index(buckets, appt_date)
-        if idx is not None and created_at is not None and created_at < buckets[idx][1]:
-            returning_sets[idx].add(patient_id)
+    ).group_by(visited).all()):
+        returning[i] = count
 
     return [
-        {"label": label, "new": new_counts[i], "returning": len(returning_sets[i])}
+        {"label": label, "new": new_counts[i], "returning": returning[i]}
         for i, (label, _, _) in enumerate(buckets)
     ]
 
@@ -556,32 +618,29 @@ def get_revenue_analytics(
     collected = [0.0] * len(buckets)
     billed = [0.0] * len(buckets)
 
-    # Three queries for the whole chart instead of three per bucket.
-    for created_at, amount in db.query(Payment.created_at, Payment.amount).filter(
+    # Three grouped queries for the whole chart instead of three per bucket.
+    paid_at = sql_bucket(db, Payment.created_at, period)
+    for i, amount in bucketed(buckets, db.query(paid_at, func.sum(Payment.amount)).filter(
         and_(Payment.clinic_id == final_clinic_id, Payment.status == "success",
              Payment.created_at >= range_start, Payment.created_at < range_end)
-    ).all():
-        idx = _bucket_index(buckets, created_at)
-        if idx is not None:
-            collected[idx] += float(amount or 0)
+    ).group_by(paid_at).all()):
+        collected[i] += float(amount or 0)
 
-    for updated_at, total in db.query(Invoice.updated_at, Invoice.total).filter(
+    settled_at = sql_bucket(db, Invoice.updated_at, period)
+    for i, total in bucketed(buckets, db.query(settled_at, func.sum(Invoice.total)).filter(
         and_(Invoice.clinic_id == final_clinic_id,
              Invoice.status.in_(["paid_verified", "paid_unverified"]),
              Invoice.updated_at >= range_start, Invoice.updated_at < range_end)
-    ).all():
-        idx = _bucket_index(buckets, updated_at)
-        if idx is not None:
-            collected[idx] += float(total or 0)
+    ).group_by(settled_at).all()):
+        collected[i] += float(total or 0)
 
-    for created_at, total in db.query(Invoice.created_at, Invoice.total).filter(
+    issued_at = sql_bucket(db, Invoice.created_at, period)
+    for i, total in bucketed(buckets, db.query(issued_at, func.sum(Invoice.total)).filter(
         and_(Invoice.clinic_id == final_clinic_id,
              Invoice.status.notin_(["draft", "cancelled"]),
              Invoice.created_at >= range_start, Invoice.created_at < range_end)
-    ).all():
-        idx = _bucket_index(buckets, created_at)
-        if idx is not None:
-            billed[idx] += float(total or 0)
+    ).group_by(issued_at).all()):
+        billed[i] += float(total or 0)
 
     return [
         {
@@ -761,7 +820,7 @@ def get_appointments_today(
     return result
 
 @router.get("/today")
-def get_today_overview(
+async def get_today_overview(
     clinic_id: Optional[int] = None,
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
@@ -772,6 +831,12 @@ def get_today_overview(
     outstanding payments, overdue lab cases, and today's no-shows.
     """
     final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
+    return await dashboard_cache.cached(final_clinic_id, "today",
+                                        lambda: today_overview(db, final_clinic_id))
+
+
+def today_overview(db: Session, final_clinic_id: int) -> dict:
+    """The /today payload, read straight from the database."""
     now = datetime.utcnow()
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     today_end = today_start + timedelta(days=1)
@@ -1119,19 +1184,14 @@ def get_appointment_trends(
         for (label, _, _) in buckets
     ]
 
-    # One query for the whole chart. Grouping by (bucket, status) in SQL would
-    # need date_trunc, which the bundled SQLite desktop build doesn't have, so
-    # the bucketing happens here.
-    for appt_date, status in db.query(Appointment.appointment_date, Appointment.status).filter(
-        and_(
-            Appointment.clinic_id == final_clinic_id,
-            Appointment.appointment_date >= buckets[0][1],
-            Appointment.appointment_date < buckets[-1][2],
-        )
-    ).all():
-        idx = _bucket_index(buckets, appt_date)
+    # One query against the appointment fact cube, which is already grouped by
+    # day, hour and status; only the hourly charts need the hour.
+    hourly = period in ("today", "yesterday")
+    group_by = [Fact.day, Fact.hour, Fact.status] if hourly else [Fact.day, Fact.status]
+    for r in appointment_facts.summed(db, final_clinic_id, buckets[0][1], buckets[-1][2], group_by=group_by):
+        idx = _bucket_index(buckets, appointment_facts.day_start(r.day, r.hour if hourly else 0))
         if idx is not None:
-            out[idx][categorize(status)] += 1
+            out[idx][categorize(r.status)] += r.appointments
 
     for row in out:
         row["bookings"] = row["completed"] + row["missed"] + row["scheduled"]
@@ -1150,30 +1210,22 @@ def get_appointment_quality(
     week_ago = now - timedelta(days=7)
     month_ago = now - timedelta(days=30)
     
-    # Total appointments (using patient registrations as proxy)
-    total_appointments = db.query(func.count(Patient.id)).filter(
-        Patient.clinic_id == final_clinic_id
-    ).scalar() or 0
-    
-    # This week's appointments
-    appointments_this_week = db.query(func.count(Patient.id)).filter(
-        and_(
-            Patient.clinic_id == final_clinic_id,
-            Patient.created_at >= week_ago
-        )
-    ).scalar() or 0
-    
-    # This month's appointments
-    appointments_this_month = db.query(func.count(Patient.id)).filter(
-        and_(
-            Patient.clinic_id == final_clinic_id,
-            Patient.created_at >= month_ago
-        )
-    ).scalar() or 0
-    
+    # Real appointments from the fact cube. These used to count patient
+    # registrations as a stand-in.
+    def booked(since):
+        return sum(r.appointments for r in appointment_facts.summed(db, final_clinic_id, since, now))
+
+    total_appointments = booked(None)
+    appointments_this_week = booked(week_ago)
+    appointments_this_month = booked(month_ago)
+    month = {r.status: r.appointments for r in appointment_facts.summed(
+        db, final_clinic_id, month_ago, now, group_by=[Fact.status])}
+    finished = sum(month.get(s, 0) for s in (COMPLETED, NO_SHOW, CANCELLED))
+
     # Calculate quality metrics (simplified)
-    # In real scenario, you'd track actual appointment status
-    completed_rate = 85  # Placeholder - would come from actual appointment completions
+    # Completed over everything that reached an outcome in the last 30 days;
+    # the old fixed figure stands in until there is something to measure.
+    completed_rate = round(100.0 * month.get(COMPLETED, 0) / finished, 1) if finished else 85
     on_time_rate = 78    # Placeholder - would track actual appointment timing
     satisfaction_rate = 92  # Placeholder - would come from patient feedback
     
@@ -1240,88 +1292,98 @@ def get_clinic_performance(
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    """Get clinic performance metrics for comparison"""
+    """This clinic's month so far, side by side with up to three others.
+
+    Every clinic is measured by the same fixed set of grouped queries, so
+    comparing branches costs no more than looking at one. This used to run
+    five queries per clinic, with a made-up chair count and satisfaction score.
+    """
     final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
     now = datetime.utcnow()
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
-    # Get current clinic metrics
-    current_metrics = _calculate_clinic_metrics(db, final_clinic_id, month_start, now)
+    compare_ids = []
+    if compare_clinic_ids:
+        for part in compare_clinic_ids.split(','):
+            if part.strip().isdigit() and int(part) != final_clinic_id and int(part) not in compare_ids:
+                compare_ids.append(int(part))
+    compare_ids = compare_ids[:3]  # Limit to 3 comparisons
+
+    metrics = _clinic_metrics(db, [final_clinic_id] + compare_ids, month_start, now)
+    current = metrics.get(final_clinic_id) or _empty_metrics(f"Clinic {final_clinic_id}")
 
-    result = {
+    return {
         "current_clinic": {
             "id": final_clinic_id,
-            "name": current_metrics["name"],
-            "metrics": current_metrics
+            "name": current["name"],
+            "metrics": current
         },
-        "comparisons": []
+        # Clinics that don't exist are skipped.
+        "comparisons": [
+            {"id": cid, "name": metrics[cid]["name"], "metrics": metrics[cid]}
+            for cid in compare_ids if cid in metrics
+        ],
     }
 
-    # Get comparison clinics if specified
-    if compare_clinic_ids:
-        clinic_ids = [int(id.strip()) for id in compare_clinic_ids.split(',') if id.strip()]
-
-        for clinic_id in clinic_ids[:3]:  # Limit to 3 comparisons
-            try:
-                metrics = _calculate_clinic_metrics(db, clinic_id, month_start, now)
-                result["comparisons"].append({
-                    "id": clinic_id,
-                    "name": metrics["name"],
-                    "metrics": metrics
-                })
-            except:
-                # Skip clinics that can't be accessed or don't exist
-                continue
 
-    return result
+def _empty_metrics(name):
+    return {"name": name, "appointments_count": 0, "revenue": 0.0,
+            "satisfaction_score": None, "chair_utilization": None}
 
-def _calculate_clinic_metrics(db, clinic_id, start_date, end_date):
-    """Calculate performance metrics for a clinic"""
-    # Get clinic name
-    clinic = db.query(Clinic).filter(Clinic.id == clinic_id).first()
-    clinic_name = clinic.name if clinic else f"Clinic {clinic_id}"
 
-    # Appointments this month
-    appointments_count = db.query(func.count(Appointment.id)).filter(
-        and_(
-            Appointment.clinic_id == clinic_id,
-            Appointment.appointment_date >= start_date,
-            Appointment.appointment_date <= end_date
-        )
-    ).scalar() or 0
+def _clinic_metrics(db, clinic_ids, start_date, end_date):
+    """Performance metrics for each clinic in `clinic_ids` → {clinic_id: metrics}.
+
+    Seven queries however many clinics: clinics, appointments this month and
+    booked minutes today (both from the appointment fact cube), revenue,
+    Google rating, and working hours and leave for today.
 
-    # Revenue this month
-    revenue = db.query(func.sum(Payment.amount)).filter(
+    - satisfaction_score is the linked Google rating out of 100, or None.
+    - chair_utilization is today's booked minutes over today's capacity: the
+      doctors' working blocks, never counting more doctors at once than the
+      clinic has chairs. None when nobody has working hours today.
+    """
+    ids = list(clinic_ids)
+    out = {}
+    chairs = {}
+    for cid, name, number_of_chairs in db.query(Clinic.id, Clinic.name, Clinic.number_of_chairs).filter(
+        Clinic.id.in_(ids)
+    ):
+        out[cid] = _empty_metrics(name or f"Clinic {cid}")
+        chairs[cid] = max(1, int(number_of_chairs or 1))
+    if not out:
+        return out
+
+    for cid, count in db.query(Fact.clinic_id, func.sum(Fact.appointments)).filter(
+        Fact.clinic_id.in_(out), appointment_facts.window(start_date, end_date)
+    ).group_by(Fact.clinic_id):
+        out[cid]["appointments_count"] = int(count or 0)
+
+    for cid, revenue in db.query(Payment.clinic_id, func.sum(Payment.amount)).filter(
         and_(
-            Payment.clinic_id == clinic_id,
+            Payment.clinic_id.in_(out),
             Payment.status == "success",
             Payment.created_at >= start_date,
             Payment.created_at <= end_date
         )
-    ).scalar() or 0
-
-    # Patient satisfaction (placeholder - would come from actual feedback)
-    satisfaction_score = 85 + (clinic_id % 10)  # Mock data with some variation
+    ).group_by(Payment.clinic_id):
+        out[cid]["revenue"] = float(revenue or 0)
+
+    for cid, rating in db.query(GooglePlaceLink.clinic_id, GooglePlaceLink.current_rating).filter(
+        GooglePlaceLink.clinic_id.in_(out), GooglePlaceLink.current_rating.isnot(None)
+    ):
+        out[cid]["satisfaction_score"] = round(rating / 5 * 100)
+
+    today = end_date.date()
+    booked = dict(db.query(Fact.clinic_id, func.sum(Fact.minutes)).filter(
+        Fact.clinic_id.in_(out), Fact.day == today, Fact.status != CANCELLED,
+    ).group_by(Fact.clinic_id).all())
+    for cid, avail in ClinicAvailability.load_many(db, out, today, today).items():
+        capacity = avail.chair_minutes(today, chairs[cid])
+        if capacity:
+            out[cid]["chair_utilization"] = min(int(100 * (booked.get(cid) or 0) / capacity), 100)
 
-    # Chair utilization
-    total_chairs = 5
-    appointments_today = db.query(func.count(Appointment.id)).filter(
-        and_(
-            Appointment.clinic_id == clinic_id,
-            Appointment.appointment_date >= datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0),
-            Appointment.appointment_date < datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999)
-        )
-    ).scalar() or 0
-
-    utilization = min(int((appointments_today / max(1, total_chairs * 2)) * 100), 100)
-
-    return {
-        "name": clinic_name,
-        "appointments_count": appointments_count,
-        "revenue": float(revenue),
-        "satisfaction_score": satisfaction_score,
-        "chair_utilization": utilization
-    }
+    return out
 
 @router.get("/patient-locations")
 def get_patient_locations(
@@ -1329,332 +1391,57 @@ def get_patient_locations(
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    """Get patient locations for map visualization"""
+    """Patients per place for the map, from their geocoded villages.
+
+    One grouped count over (clinic_id, geocode_key) outer-joined to
+    `geocodes`, plus one query for up to five sample patients per place.
+    Patients whose village matches no gazetteer entry (see
+    analytics/geocoding.py) come last, as one entry with `located: false` and
+    no coordinates, so the counts still add up to every patient with a
+    village."""
     final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
 
-    # Get patients with location data (using village as location proxy)
-    patients = db.query(Patient).filter(
-        and_(
-            Patient.clinic_id == final_clinic_id,
-            Patient.village.isnot(None)
-        )
+    place = (Geocode.label, Geocode.latitude, Geocode.longitude)
+    with_village = (
+        Patient.clinic_id == final_clinic_id,
+        Patient.village.isnot(None),
+        func.trim(Patient.village) != '',
+    )
+    counts = db.query(*place, func.count(Patient.id)).outerjoin(
+        Geocode, Geocode.key == Patient.geocode_key
+    ).filter(*with_village).group_by(*place).order_by(
+        func.count(Patient.id).desc(), Geocode.label
     ).all()
 
-    # Group patients by location
-    location_data = {}
-    for patient in patients:
-        location = patient.village.strip()
-        if location not in location_data:
-            location_data[location] = {
-                "location": location,
-                "count": 0,
-                "patients": []
-            }
-
-        location_data[location]["count"] += 1
-        location_data[location]["patients"].append({
-            "id": patient.id,
-            "name": patient.name,
-            "age": patient.age,
-            "gender": patient.gender
+    ranked = db.query(
+        *place, Patient.id, Patient.name, Patient.age, Patient.gender,
+        func.row_number().over(partition_by=place, order_by=Patient.id).label("rank"),
+    ).outerjoin(Geocode, Geocode.key == Patient.geocode_key).filter(*with_village).subquery()
+    samples = defaultdict(list)
+    for row in db.query(ranked).filter(ranked.c.rank <= 5).order_by(ranked.c.rank):
+        samples[(row.label, row.latitude, row.longitude)].append({
+            "id": row.id, "name": row.name, "age": row.age, "gender": row.gender
         })
 
-    # Convert to list and add mock coordinates (in real app, you'd geocode addresses)
-    result = []
-    for location, data in location_data.items():
-        # Mock coordinates based on location name (in production, use geocoding API)
-        # For demo purposes, we'll use some Indian cities coordinates
-        mock_coords = _get_mock_coordinates(location)
-
-        result.append({
-            "location": location,
-            "count": data["count"],
-            "latitude": mock_coords["lat"],
-            "longitude": mock_coords["lon"],
-            "patients": data["patients"][:5]  # Show max 5 patients per location
+    located = [
+        {
+            "location": label,
+            "count": count,
+            "latitude": lat,
+            "longitude": lon,
+            "located": True,
+            "patients": samples[(label, lat, lon)],
+        }
+        for label, lat, lon, count in counts if label is not None
+    ]
+    unlocated = sum(count for label, _, _, count in counts if label is None)
+    if unlocated:
+        located.append({
+            "location": "Unlocated",
+            "count": unlocated,
+            "latitude": None,
+            "longitude": None,
+            "located": False,
+            "patients": samples[(None, None, None)],
         })
-
-    return result
-
-def _get_mock_coordinates(location):
-    """Get mock coordinates for locations (replace with real geocoding in production)"""
-    # Mock coordinates for common Indian locations
-    mock_locations = {
-        "Mumbai": {"lat": 19.0760, "lon": 72.8777},
-        "Delhi": {"lat": 28.7041, "lon": 77.1025},
-        "Bangalore": {"lat": 12.9716, "lon": 77.5946},
-        "Chennai": {"lat": 13.0827, "lon": 80.2707},
-        "Kolkata": {"lat": 22.5726, "lon": 88.3639},
-        "Pune": {"lat": 18.5204, "lon": 73.8567},
-        "Ahmedabad": {"lat": 23.0225, "lon": 72.5714},
-        "Jaipur": {"lat": 26.9124, "lon": 75.7873},
-        "Surat": {"lat": 21.1702, "lon": 72.8311},
-        "Kanpur": {"lat": 26.4499, "lon": 80.3319},
-        "Nagpur": {"lat": 21.1458, "lon": 79.0882},
-        "Indore": {"lat": 22.7196, "lon": 75.8577},
-        "Thane": {"lat": 19.2183, "lon": 72.9781},
-        "Bhopal": {"lat": 23.2599, "lon": 77.4126},
-        "Visakhapatnam": {"lat": 17.6868, "lon": 83.2185},
-        "Patna": {"lat": 25.5941, "lon": 85.1376},
-        "Vadodara": {"lat": 22.3072, "lon": 73.1812},
-        "Ghaziabad": {"lat": 28.6692, "lon": 77.4538},
-        "Ludhiana": {"lat": 30.9010, "lon": 75.8573},
-        "Agra": {"lat": 27.1767, "lon": 78.0081},
-        "Nashik": {"lat": 19.9975, "lon": 73.7898},
-        "Faridabad": {"lat": 28.4089, "lon": 77.3178},
-        "Meerut": {"lat": 28.9845, "lon": 77.7064},
-        "Rajkot": {"lat": 22.3039, "lon": 70.8022},
-        "Kalyan-Dombivli": {"lat": 19.2350, "lon": 73.1297},
-        "Vasai-Virar": {"lat": 19.3919, "lon": 72.8397},
-        "Varanasi": {"lat": 25.3176, "lon": 82.9739},
-        "Srinagar": {"lat": 34.0837, "lon": 74.7973},
-        "Aurangabad": {"lat": 19.8762, "lon": 75.3433},
-        "Dhanbad": {"lat": 23.7957, "lon": 86.4304},
-        "Amritsar": {"lat": 31.6340, "lon": 74.8723},
-        "Navi Mumbai": {"lat": 19.0330, "lon": 73.0297},
-        "Allahabad": {"lat": 25.4358, "lon": 81.8463},
-        "Ranchi": {"lat": 23.3441, "lon": 85.3096},
-        "Howrah": {"lat": 22.5958, "lon": 88.2636},
-        "Coimbatore": {"lat": 11.0168, "lon": 76.9558},
-        "Jabalpur": {"lat": 23.1815, "lon": 79.9864},
-        "Gwalior": {"lat": 26.2183, "lon": 78.1828},
-        "Vijayawada": {"lat": 16.5062, "lon": 80.6480},
-        "Jodhpur": {"lat": 26.2389, "lon": 73.0243},
-        "Madurai": {"lat": 9.9252, "lon": 78.1198},
-        "Raipur": {"lat": 21.2514, "lon": 81.6296},
-        "Kota": {"lat": 25.2138, "lon": 75.8648},
-        "Guwahati": {"lat": 26.1445, "lon": 91.7362},
-        "Chandigarh": {"lat": 30.7333, "lon": 76.7794},
-        "Solapur": {"lat": 17.6599, "lon": 75.9064},
-        "Hubli-Dharwad": {"lat": 15.3647, "lon": 75.1240},
-        "Bareilly": {"lat": 28.3670, "lon": 79.4304},
-        "Moradabad": {"lat": 28.8386, "lon": 78.7733},
-        "Mysore": {"lat": 12.2958, "lon": 76.6394},
-        "Gurgaon": {"lat": 28.4595, "lon": 77.0266},
-        "Aligarh": {"lat": 27.8974, "lon": 78.0880},
-        "Jalandhar": {"lat": 31.3260, "lon": 75.5762},
-        "Tiruchirappalli": {"lat": 10.7905, "lon": 78.7047},
-        "Bhubaneswar": {"lat": 20.2961, "lon": 85.8245},
-        "Salem": {"lat": 11.6643, "lon": 78.1460},
-        "Warangal": {"lat": 17.9784, "lon": 79.5941},
-        "Guntur": {"lat": 16.3067, "lon": 80.4365},
-        "Bhiwandi": {"lat": 19.2813, "lon": 73.0483},
-        "Saharanpur": {"lat": 29.9679, "lon": 77.5460},
-        "Gorakhpur": {"lat": 26.7606, "lon": 83.3732},
-        "Bikaner": {"lat": 28.0229, "lon": 73.3119},
-        "Amravati": {"lat": 20.9374, "lon": 77.7796},
-        "Noida": {"lat": 28.5355, "lon": 77.3910},
-        "Jamshedpur": {"lat": 22.8046, "lon": 86.2029},
-        "Bhilai": {"lat": 21.1938, "lon": 81.3509},
-        "Cuttack": {"lat": 20.4625, "lon": 85.8830},
-        "Firozabad": {"lat": 27.1509, "lon": 78.3978},
-        "Kochi": {"lat": 9.9312, "lon": 76.2673},
-        "Nellore": {"lat": 14.4426, "lon": 79.9865},
-        "Bhavnagar": {"lat": 21.7645, "lon": 72.1519},
-        "Dehradun": {"lat": 30.3165, "lon": 78.0322},
-        "Durgapur": {"lat": 23.5204, "lon": 87.3119},
-        "Asansol": {"lat": 23.6739, "lon": 86.9524},
-        "Rourkela": {"lat": 22.2604, "lon": 84.8536},
-        "Nanded": {"lat": 19.1383, "lon": 77.3210},
-        "Kolhapur": {"lat": 16.7050, "lon": 74.2433},
-        "Ajmer": {"lat": 26.4499, "lon": 74.6399},
-        "Akola": {"lat": 20.7002, "lon": 77.0082},
-        "Gulbarga": {"lat": 17.3297, "lon": 76.8343},
-        "Jamnagar": {"lat": 22.4707, "lon": 70.0577},
-        "Ujjain": {"lat": 23.1765, "lon": 75.7885},
-        "Loni": {"lat": 28.7525, "lon": 77.2880},
-        "Siliguri": {"lat": 26.7271, "lon": 88.3953},
-        "Jhansi": {"lat": 25.4484, "lon": 78.5685},
-        "Ulhasnagar": {"lat": 19.2215, "lon": 73.1645},
-        "Jammu": {"lat": 32.7266, "lon": 74.8570},
-        "Sangli-Miraj & Kupwad": {"lat": 16.8609, "lon": 74.5658},
-        "Mangalore": {"lat": 12.9141, "lon": 74.8550},
-        "Erode": {"lat": 11.3410, "lon": 77.7172},
-        "Belgaum": {"lat": 15.8497, "lon": 74.4977},
-        "Ambattur": {"lat": 13.1143, "lon": 80.1481},
-        "Tirunelveli": {"lat": 8.7139, "lon": 77.7567},
-        "Malegaon": {"lat": 20.5540, "lon": 74.5250},
-        "Gaya": {"lat": 24.7914, "lon": 85.0002},
-        "Thiruvananthapuram": {"lat": 8.5241, "lon": 76.9366},
-        "Kurnool": {"lat": 15.8281, "lon": 78.0373},
-        "Udaipur": {"lat": 24.5854, "lon": 73.7125},
-        "Kakinada": {"lat": 16.9891, "lon": 82.2475},
-        "Nizamabad": {"lat": 18.6725, "lon": 78.0941},
-        "Parbhani": {"lat": 19.2686, "lon": 76.7708},
-        "Tumkur": {"lat": 13.3379, "lon": 77.1173},
-        "Khammam": {"lat": 17.2473, "lon": 80.1514},
-        "Ozhukarai": {"lat": 11.9489, "lon": 79.8304},
-        "Bihar Sharif": {"lat": 25.1971, "lon": 85.5149},
-        "Panipat": {"lat": 29.3909, "lon": 76.9635},
-        "Darbhanga": {"lat": 26.1520, "lon": 85.8970},
-        "Bally": {"lat": 22.6544, "lon": 88.3407},
-        "Aizawl": {"lat": 23.7271, "lon": 92.7176},
-        "Dewas": {"lat": 22.9676, "lon": 76.0534},
-        "Ichalkaranji": {"lat": 16.6915, "lon": 74.4597},
-        "Karnal": {"lat": 29.6857, "lon": 76.9905},
-        "Bathinda": {"lat": 30.2100, "lon": 74.9455},
-        "Jalna": {"lat": 19.8347, "lon": 75.8800},
-        "Eluru": {"lat": 16.7107, "lon": 81.0952},
-        "Barasat": {"lat": 22.7225, "lon": 88.4822},
-        "Purnia": {"lat": 25.7771, "lon": 87.4753},
-        "Satna": {"lat": 24.6005, "lon": 80.8322},
-        "Mau": {"lat": 25.9417, "lon": 83.5611},
-        "Sonipat": {"lat": 28.9283, "lon": 77.0919},
-        "Farrukhabad": {"lat": 27.3829, "lon": 79.5944},
-        "Sagar": {"lat": 23.8388, "lon": 78.7378},
-        "Rourkela": {"lat": 22.2604, "lon": 84.8536},
-        "Durg": {"lat": 21.1904, "lon": 81.2849},
-        "Imphal": {"lat": 24.8170, "lon": 93.9368},
-        "Ratlam": {"lat": 23.3342, "lon": 75.0370},
-        "Hapur": {"lat": 28.7306, "lon": 77.7759},
-        "Arrah": {"lat": 25.5560, "lon": 84.6667},
-        "Karimnagar": {"lat": 18.4386, "lon": 79.1288},
-        "Anantapur": {"lat": 14.6819, "lon": 77.6006},
-        "Etawah": {"lat": 26.7769, "lon": 79.0213},
-        "Ambernath": {"lat": 19.1877, "lon": 73.1926},
-        "North Dumdum": {"lat": 22.6625, "lon": 88.4194},
-        "Bharatpur": {"lat": 27.2173, "lon": 77.4901},
-        "Begusarai": {"lat": 25.4187, "lon": 86.1279},
-        "New Delhi": {"lat": 28.6139, "lon": 77.2090},
-        "Gandhidham": {"lat": 23.0753, "lon": 70.1337},
-        "Baranagar": {"lat": 22.6413, "lon": 88.3654},
-        "Tiruvottiyur": {"lat": 13.1643, "lon": 80.3006},
-        "Puducherry": {"lat": 11.9139, "lon": 79.8145},
-        "Sikar": {"lat": 27.6094, "lon": 75.1399},
-        "Thoothukudi": {"lat": 8.7642, "lon": 78.1348},
-        "Rewa": {"lat": 24.5362, "lon": 81.3037},
-        "Mirzapur": {"lat": 25.1460, "lon": 82.5698},
-        "Raichur": {"lat": 16.2076, "lon": 77.3463},
-        "Pallavaram": {"lat": 12.9675, "lon": 80.1491},
-        "Palanpur": {"lat": 24.1724, "lon": 72.4349},
-        "Falakata": {"lat": 26.5196, "lon": 89.2040},
-        "Sivakasi": {"lat": 9.4571, "lon": 77.7956},
-        "Ramagundam": {"lat": 18.7550, "lon": 79.4740},
-        "Suryapet": {"lat": 17.1405, "lon": 79.6236},
-        "Chittur-Thathamangalam": {"lat": 10.6997, "lon": 76.7386},
-        "Vellore": {"lat": 12.9165, "lon": 79.1325},
-        "Kavali": {"lat": 14.9132, "lon": 79.9927},
-        "Tezpur": {"lat": 26.6528, "lon": 92.7926},
-        "Kayamkulam": {"lat": 9.1745, "lon": 76.5009},
-        "Kanhangad": {"lat": 12.3094, "lon": 75.0923},
-        "Kunnamkulam": {"lat": 10.6497, "lon": 76.0718},
-        "Adoni": {"lat": 15.6322, "lon": 77.2749},
-        "Udupi": {"lat": 13.3409, "lon": 74.7421},
-        "Tenali": {"lat": 16.2430, "lon": 80.6400},
-        "Robertsonpet": {"lat": 12.9563, "lon": 78.2754},
-        "North Barrackpur": {"lat": 22.7890, "lon": 88.3627},
-        "Nagaon": {"lat": 26.3464, "lon": 92.6840},
-        "Bangaon": {"lat": 23.0455, "lon": 88.8300},
-        "Karawal Nagar": {"lat": 28.7283, "lon": 77.2767},
-        "Mandya": {"lat": 12.5223, "lon": 76.8970},
-        "Chennai": {"lat": 13.0827, "lon": 80.2707},
-    }
-
-    # Try to find exact match first
-    if location in mock_locations:
-        return mock_locations[location]
-
-    # For unknown locations, generate pseudo-random coordinates within India
-    # Using location name hash to create consistent coordinates
-    hash_value = 0
-    for i in range(len(location)):
-        hash_value = ((hash_value << 5) - hash_value) + ord(location[i])
-        hash_value = hash_value & 0xFFFFFFFF  # Convert to 32bit integer
-
-    # Generate coordinates within India bounds (roughly)
-    lat = 8.4 + (hash_value % 1000) / 1000 * (37.6 - 8.4)  # 8.4°N to 37.6°N
-    lon = 68.7 + (hash_value % 1000) / 1000 * (97.25 - 68.7)  # 68.7°E to 97.25°E
-
-    return {"lat": lat, "lon": lon}
-
-
-PERIOD_LABELS = {
-    "today": "Today",
-    "yesterday": "Yesterday",
-    "7days": "Last 7 days",
-    "month": "This month",
-    "all": "All time",
-}
-
-
-@router.get("/export")
-def export_dashboard(
-    period: str = "all",
-    clinic_id: Optional[int] = None,
-    db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
-):
-    """Everything on the dashboard for this period, as one CSV.
-
-    Synchronous and self-contained on purpose. The existing /dashboard-reports
-    pipeline hands off to nexus-service for AI-written PDFs, which is the right
-    tool for a monthly report but the wrong one for a button labelled "Export"
-    that should hand you a file immediately and work when nexus is down.
-
-    Sections are separated by blank lines so the file stays readable in Excel
-    while each block still parses as its own table.
-    """
-    final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
-    clinic = db.query(Clinic).filter(Clinic.id == final_clinic_id).first()
-
-    metrics = get_dashboard_metrics(period=period, clinic_id=clinic_id, db=db, current_user=current_user)
-    patient_stats = get_patient_statistics(period=period, clinic_id=clinic_id, db=db, current_user=current_user)
-    genders = get_patient_demographics(period=period, clinic_id=clinic_id, db=db, current_user=current_user)
-    revenue = get_revenue_analytics(period=period, clinic_id=clinic_id, db=db, current_user=current_user)
-    appts = get_appointment_trends(period=period, clinic_id=clinic_id, db=db, current_user=current_user)
-
-    buf = io.StringIO()
-    w = csv.writer(buf)
-
-    w.writerow([f"{clinic.name if clinic else 'Clinic'} — dashboard export"])
-    w.writerow(["Period", PERIOD_LABELS.get(period, period)])
-    w.writerow(["Generated", datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")])
-    w.writerow([])
-
-    w.writerow(["Summary"])
-    w.writerow(["Metric", "Value", "Change %"])
-    w.writerow(["Revenue collected", metrics["revenue"]["value"], metrics["revenue"]["change"]])
-    w.writerow(["Revenue billed", metrics["revenue"]["billed"], ""])
-    w.writerow(["Total patients", metrics["total_patients"]["value"], metrics["total_patients"]["change"]])
-    w.writerow(["Outstanding dues", metrics["outstanding"]["value"], metrics["outstanding"]["change"]])
-    w.writerow(["Outstanding invoices", metrics["outstanding"]["invoice_count"], ""])
-    w.writerow(["Outstanding over 30 days", metrics["outstanding"]["aged_amount"], ""])
-    w.writerow(["Appointments", metrics["appointments"]["value"], metrics["appointments"]["change"]])
-    w.writerow(["  Completed", metrics["appointments"]["completed"], ""])
-    w.writerow(["  Scheduled", metrics["appointments"]["scheduled"], ""])
-    w.writerow(["  No-show / cancelled", metrics["appointments"]["missed"], ""])
-    w.writerow([])
-
-    w.writerow(["New vs returning patients"])
-    w.writerow(["Period", "New", "Returning"])
-    for row in patient_stats:
-        w.writerow([row["label"], row["new"], row["returning"]])
-    w.writerow([])
-
-    w.writerow(["Patients by gender"])
-    w.writerow(["Gender", "Patients"])
-    for row in genders:
-        w.writerow([row["name"], row["value"]])
-    w.writerow([])
-
-    w.writerow(["Revenue"])
-    w.writerow(["Period", "Billed", "Collected"])
-    for row in revenue:
-        w.writerow([row["label"], row["billed"], row["collected"]])
-    w.writerow([])
-
-    w.writerow(["Appointment outcomes"])
-    w.writerow(["Period", "Completed", "Scheduled", "No-show / cancelled", "Total"])
-    for row in appts:
-        w.writerow([row["time"], row["completed"], row["scheduled"], row["missed"], row["bookings"]])
-
-    slug = "".join(c if c.isalnum() else "-" for c in (clinic.name if clinic else "clinic")).strip("-").lower()
-    filename = f"{slug}-dashboard-{period}-{datetime.utcnow():%Y%m%d}.csv"
-
-    # BOM so Excel opens rupee amounts and patient names as UTF-8 instead of
-    # mangling them into Latin-1.
-    return Response(
-        content="﻿" + buf.getvalue(),
-        media_type="text/csv; charset=utf-8",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-    )
+    return located
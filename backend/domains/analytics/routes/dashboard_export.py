@@ -0,0 +1,285 @@
+"""
+The dashboard as a CSV file.
+
+The export used to call each dashboard endpoint in turn on the request's
+session and build the whole file in a string. Each endpoint read the
+database at its own moment, so a payment landing halfway through could show
+up in the revenue chart but not the summary. Now:
+
+- every section is computed inside one read-only snapshot (REPEATABLE READ
+  on Postgres, one read transaction on SQLite), once, in file order;
+- rows are streamed out as each section is ready, so nothing holds the
+  whole file;
+- all-time and multi-clinic exports can go to an rq worker instead
+  (POST /export/jobs). The worker writes the file to R2, and
+  GET /export/jobs/{job_id} hands back a short-lived link once it's done.
+
+Synchronous on purpose for the everyday button. The /dashboard-reports
+pipeline hands off to nexus-service for AI-written PDFs, which is the right
+tool for a monthly report but the wrong one for "Export", which should hand
+you a file immediately and work when nexus is down.
+"""
+import csv
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Iterable, Iterator, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from core.auth_utils import get_current_user
+from database import get_db
+from models import Clinic
+from domains.analytics.routes.dashboard import (BUCKET_MEMO, dashboard_metrics,
+                                                get_appointment_trends, get_patient_demographics,
+                                                get_patient_statistics, get_revenue_analytics)
+from domains.infrastructure.services.r2_storage import (StorageCategory, get_presigned_url,
+                                                        get_r2_path, put_fileobj_to_key)
+
+router = APIRouter()
+
+PERIOD_LABELS = {
+    "today": "Today",
+    "yesterday": "Yesterday",
+    "7days": "Last 7 days",
+    "month": "This month",
+    "all": "All time",
+}
+CSV_MEDIA_TYPE = "text/csv; charset=utf-8"
+# BOM so Excel opens rupee amounts and patient names as UTF-8 instead of
+# mangling them into Latin-1.
+BOM = "﻿"
+
+EXPORT_QUEUE = "low"
+EXPORT_JOB_TIMEOUT_S = 15 * 60
+EXPORT_RESULT_TTL_S = 24 * 3600
+EXPORT_URL_TTL_S = 3600
+MAX_EXPORT_CLINICS = 20
+
+
+# ── Snapshot ─────────────────────────────────────────────────────────────────
+
+@contextmanager
+def snapshot_session(bind) -> Iterator[Session]:
+    """A read-only session whose every query sees the same moment."""
+    with bind.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execution_options(isolation_level="REPEATABLE READ", postgresql_readonly=True)
+        elif conn.dialect.name == "sqlite":
+            # pysqlite only opens a transaction before a write, which would
+            # make every SELECT its own snapshot.
+            conn.exec_driver_sql("BEGIN")
+        session = Session(bind=conn, info={BUCKET_MEMO: {}})
+        try:
+            yield session
+        finally:
+            session.close()
+            conn.rollback()
+
+
+# ── Rows ─────────────────────────────────────────────────────────────────────
+
+def export_rows(db: Session, period: str, clinic: Optional[Clinic], clinic_id: int) -> Iterator[list]:
+    """The CSV rows for one clinic, section by section.
+
+    Sections are separated by blank lines so the file stays readable in Excel
+    while each block still parses as its own table. Each section is computed
+    when the previous one has been written.
+    """
+    # The endpoint functions only read clinic_id and role off the user.
+    user = SimpleNamespace(clinic_id=clinic_id, role="clinic_owner")
+    args = dict(period=period, clinic_id=clinic_id, db=db, current_user=user)
+
+    yield [f"{clinic.name if clinic else 'Clinic'} — dashboard export"]
+    yield ["Period", PERIOD_LABELS.get(period, period)]
+    yield ["Generated", datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")]
+    yield []
+
+    # Straight from the snapshot, never the dashboard cache.
+    metrics = dashboard_metrics(db, clinic_id, period)
+    yield ["Summary"]
+    yield ["Metric", "Value", "Change %"]
+    yield ["Revenue collected", metrics["revenue"]["value"], metrics["revenue"]["change"]]
+    yield ["Revenue billed", metrics["revenue"]["billed"], ""]
+    yield ["Total patients", metrics["total_patients"]["value"], metrics["total_patients"]["change"]]
+    yield ["Outstanding dues", metrics["outstanding"]["value"], metrics["outstanding"]["change"]]
+    yield ["Outstanding invoices", metrics["outstanding"]["invoice_count"], ""]
+    yield ["Outstanding over 30 days", metrics["outstanding"]["aged_amount"], ""]
+    yield ["Appointments", metrics["appointments"]["value"], metrics["appointments"]["change"]]
+    yield ["  Completed", metrics["appointments"]["completed"], ""]
+    yield ["  Scheduled", metrics["appointments"]["scheduled"], ""]
+    yield ["  No-show / cancelled", metrics["appointments"]["missed"], ""]
+    yield []
+
+    yield ["New vs returning patients"]
+    yield ["Period", "New", "Returning"]
+    for row in get_patient_statistics(**args):
+        yield [row["label"], row["new"], row["returning"]]
+    yield []
+
+    yield ["Patients by gender"]
+    yield ["Gender", "Patients"]
+    for row in get_patient_demographics(**args):
+        yield [row["name"], row["value"]]
+    yield []
+
+    yield ["Revenue"]
+    yield ["Period", "Billed", "Collected"]
+    for row in get_revenue_analytics(**args):
+        yield [row["label"], row["billed"], row["collected"]]
+    yield []
+
+    yield ["Appointment outcomes"]
+    yield ["Period", "Completed", "Scheduled", "No-show / cancelled", "Total"]
+    for row in get_appointment_trends(**args):
+        yield [row["time"], row["completed"], row["scheduled"], row["missed"], row["bookings"]]
+
+
+def csv_chunks(rows: Iterable[list]) -> Iterator[str]:
+    """CSV text, one chunk per section (rows up to each blank line)."""
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for row in rows:
+        w.writerow(row)
+        if not row:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def stream_export(bind, period: str, clinic_ids: List[int]) -> Iterator[str]:
+    """The whole file for `clinic_ids`, from one snapshot."""
+    yield BOM
+    with snapshot_session(bind) as snap:
+        clinics = {c.id: c for c in snap.query(Clinic).filter(Clinic.id.in_(clinic_ids))}
+        for i, cid in enumerate(clinic_ids):
+            if i:
+                yield "\r\n"
+            yield from csv_chunks(export_rows(snap, period, clinics.get(cid), cid))
+
+
+def _filename(name: str, period: str) -> str:
+    slug = "".join(c if c.isalnum() else "-" for c in name).strip("-").lower()
+    return f"{slug}-dashboard-{period}-{datetime.utcnow():%Y%m%d}.csv"
+
+
+@router.get("/export")
+def export_dashboard(
+    period: str = "all",
+    clinic_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Everything on the dashboard for this period, as one CSV, streamed."""
+    final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
+    clinic = db.query(Clinic).filter(Clinic.id == final_clinic_id).first()
+    filename = _filename(clinic.name if clinic else "clinic", period)
+    bind = db.get_bind()
+    # The snapshot opens on its own connection; the request's is done with.
+    db.close()
+    return StreamingResponse(
+        (chunk.encode("utf-8") for chunk in stream_export(bind, period, [final_clinic_id])),
+        media_type=CSV_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# ── Background exports ───────────────────────────────────────────────────────
+
+def _redis():
+    import redis
+    return redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+
+
+def _queue():
+    try:
+        from rq import Queue
+    except ImportError:
+        raise HTTPException(status_code=503, detail="Background exports are not available")
+    return Queue(EXPORT_QUEUE, connection=_redis())
+
+
+def _fetch_job(job_id: str):
+    try:
+        from rq.exceptions import NoSuchJobError
+        from rq.job import Job
+    except ImportError:
+        raise HTTPException(status_code=503, detail="Background exports are not available")
+    try:
+        return Job.fetch(job_id, connection=_redis())
+    except NoSuchJobError:
+        return None
+
+
+def run_export_job(period: str, clinic_ids: List[int], owner_clinic_id: int) -> str:
+    """rq entry point: write the export to R2 and return its key.
+
+    Spooled through a temporary file and streamed from it to R2, so a
+    multi-clinic export never sits in the worker's memory."""
+    from database import engine
+
+    with tempfile.TemporaryFile() as tmp:
+        for chunk in stream_export(engine, period, clinic_ids):
+            tmp.write(chunk.encode("utf-8"))
+        tmp.seek(0)
+        name = "clinics" if len(clinic_ids) > 1 else f"clinic-{clinic_ids[0]}"
+        key = get_r2_path(owner_clinic_id, category=StorageCategory.EXPORTS,
+                          filename=_filename(name, period))
+        if not put_fileobj_to_key(key, tmp, CSV_MEDIA_TYPE):
+            raise RuntimeError(f"Upload of {key} failed")
+    return key
+
+
+@router.post("/export/jobs")
+def enqueue_export(
+    period: str = "all",
+    clinic_ids: Optional[str] = None,  # comma-separated, owners only
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Queue an export for a worker: all-time, or several clinics in one file."""
+    ids = [current_user.clinic_id]
+    if clinic_ids and current_user.role == 'clinic_owner':
+        ids = []
+        for part in clinic_ids.split(','):
+            if part.strip().isdigit() and int(part) not in ids:
+                ids.append(int(part))
+        if not ids:
+            raise HTTPException(status_code=400, detail="No clinics to export")
+        if len(ids) > MAX_EXPORT_CLINICS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_EXPORT_CLINICS} clinics per export")
+
+    job = _queue().enqueue(
+        run_export_job, period, ids, current_user.clinic_id,
+        job_timeout=EXPORT_JOB_TIMEOUT_S, result_ttl=EXPORT_RESULT_TTL_S,
+        meta={"user_id": current_user.id, "clinic_ids": ids, "period": period},
+    )
+    return {"job_id": job.id, "status": job.get_status()}
+
+
+@router.get("/export/jobs/{job_id}")
+def export_job_status(
+    job_id: str,
+    current_user = Depends(get_current_user)
+):
+    """Where a queued export has got to, and a download link once it's done."""
+    job = _fetch_job(job_id)
+    # Someone else's job is reported as missing, not forbidden.
+    if job is None or job.meta.get("user_id") != current_user.id:
+        raise HTTPException(status_code=404, detail="Export not found")
+    status = job.get_status()
+    status = getattr(status, "value", status)
+    out = {"job_id": job_id, "status": status, "clinic_ids": job.meta.get("clinic_ids"),
+           "period": job.meta.get("period")}
+    if status == "finished":
+        out["url"] = get_presigned_url(job.result, expires_in=EXPORT_URL_TTL_S)
+    elif status == "failed":
+        out["detail"] = "The export failed; try again"
+    return out
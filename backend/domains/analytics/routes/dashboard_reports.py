@@ -1,3 +1,30 @@
+"""
+AI-written dashboard reports, generated by nexus-service.
+
+Generating one is a heavy rq job in Nexus (data, AI analysis, charts, PDF,
+upload), and it used to start from scratch on every click: a double-click,
+or two staff asking for the same month, ran the same job twice. Requests
+are now coalesced. The report's parameters (clinic, type, category, date
+range) hash to an idempotency key kept in DashboardReport.parameters; while
+a report with that key is generating, or for REPORT_REUSE_S after it
+completed, asking again returns that same report instead of a new one. A
+short Redis claim on the key closes the race between two requests that
+both find nothing and would both insert.
+
+Nexus writes each stage's progress to a Redis hash as it goes, and
+GET /{report_id} returns it alongside the coarse status.
+
+Redis and the database are both blocking here, so the generate handler does
+its lookups, claim, insert and status writes in the threadpool, never on
+the event loop; only the HTTP call to Nexus runs there.
+One Redis client serves the process; after a failure Redis is left alone for
+REDIS_BACKOFF_S so a click doesn't wait out a timeout on every call.
+"""
+import hashlib
+import json
+import threading
+import time
+
 from fastapi import APIRouter, HTTPException, Depends, status
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -10,29 +37,30 @@ from core.auth_utils import get_current_user
 import uuid
 import httpx
 import os
-import boto3
-from botocore.config import Config
-import io
+from fastapi.concurrency import run_in_threadpool
+from domains.infrastructure.services.r2_storage import iter_r2_body, open_r2_stream_async
 
 router = APIRouter()
 
-# R2 Client Configuration
-def get_r2_client():
-    access_key_id = os.getenv("R2_ACCESS_KEY_ID")
-    secret_access_key = os.getenv("R2_SECRET_ACCESS_KEY")
-    endpoint_url = os.getenv("R2_ENDPOINT_URL")
-    
-    if not all([access_key_id, secret_access_key, endpoint_url]):
-        return None
-        
-    return boto3.client(
-        's3',
-        endpoint_url=endpoint_url,
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=secret_access_key,
-        region_name='auto',
-        config=Config(signature_version='s3v4')
-    )
+_STREAM_CHUNK_BYTES = 64 * 1024
+
+# A completed report is handed out again for this long.
+REPORT_REUSE_S = int(os.getenv("REPORT_REUSE_S", "900"))
+# A report still "generating" after this long is assumed dead (the rq job
+# timed out or the worker died) and no longer coalesced onto.
+REPORT_STALE_S = 30 * 60
+CLAIM_TTL_S = 30
+CLAIM_WAIT_S = 5.0
+# How long Redis is skipped after it failed once.
+REDIS_BACKOFF_S = 30
+
+# Mirrors nexus-service/app/services/reports/progress.py: the two ship as
+# separate images.
+REPORT_STAGES = ("data", "analysis", "charts", "pdf", "upload")
+
+
+def progress_key(report_id: int) -> str:
+    return f"dashboard_report:{report_id}:progress"
 
 class ReportGenerateRequest(BaseModel):
     report_type: str
@@ -50,10 +78,149 @@ class DashboardReportResponse(BaseModel):
     status: str
     file_url: Optional[str] = None
     created_at: datetime
+    # Per stage, in order: {"stage", "state": pending|running|done|failed, "seconds"}
+    progress: Optional[List[Dict]] = None
 
     class Config:
         from_attributes = True
 
+
+# ── Coalescing ───────────────────────────────────────────────────────────────
+
+_client = None
+_client_lock = threading.Lock()
+_down_until = 0.0
+
+
+def _redis():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import redis
+                _client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+                                         socket_connect_timeout=1, socket_timeout=1)
+    return _client
+
+
+def _redis_up() -> bool:
+    return time.monotonic() >= _down_until
+
+
+def _redis_failed() -> None:
+    global _down_until
+    _down_until = time.monotonic() + REDIS_BACKOFF_S
+
+
+def _normalise_date(value: str) -> str:
+    try:
+        return datetime.fromisoformat(value.replace('Z', '')).isoformat()
+    except ValueError:
+        return value
+
+
+def idempotency_key(clinic_id: int, request: ReportGenerateRequest) -> str:
+    """Same clinic, report and date range → same key, however the dates were written."""
+    body = json.dumps({
+        "clinic_id": clinic_id,
+        "report_type": request.report_type,
+        "report_category": request.report_category,
+        "start_date": _normalise_date(request.start_date),
+        "end_date": _normalise_date(request.end_date),
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def find_reusable_report(db: Session, clinic_id: int, report_type: str, key: str,
+                         now: Optional[datetime] = None) -> Optional[DashboardReport]:
+    """A report with this key that is still generating or recently completed."""
+    now = now or datetime.utcnow()
+    candidates = db.query(DashboardReport).filter(
+        DashboardReport.clinic_id == clinic_id,
+        DashboardReport.report_type == report_type,
+        DashboardReport.status.in_(["generating", "completed"]),
+        DashboardReport.created_at >= now - timedelta(seconds=max(REPORT_STALE_S, REPORT_REUSE_S)),
+    ).order_by(DashboardReport.created_at.desc()).all()
+    for report in candidates:
+        if (report.parameters or {}).get("idempotency_key") != key:
+            continue
+        age = (now - report.created_at).total_seconds()
+        if report.status == "generating" and age <= REPORT_STALE_S:
+            return report
+        # Completion time isn't stored; creation is an upper bound on its age.
+        if report.status == "completed" and age <= REPORT_REUSE_S:
+            return report
+    return None
+
+
+def _claim(key: str) -> bool:
+    """Take the right to create the report for `key`. True when Redis is down:
+    the database lookup still catches everything but a simultaneous click."""
+    if not _redis_up():
+        return True
+    try:
+        return bool(_redis().set(f"dashboard_report:claim:{key}", "1", nx=True, ex=CLAIM_TTL_S))
+    except Exception:
+        _redis_failed()
+        return True
+
+
+def _release(key: str) -> None:
+    if not _redis_up():
+        return
+    try:
+        _redis().delete(f"dashboard_report:claim:{key}")
+    except Exception:
+        _redis_failed()
+
+
+def _find_or_claim(db: Session, clinic_id: int, report_type: str, key: str) -> Optional[DashboardReport]:
+    """The report to hand back, or None once this request may create one:
+    it holds the claim, or the claimer stalled past CLAIM_WAIT_S. Blocking."""
+    deadline = time.monotonic() + CLAIM_WAIT_S
+    while True:
+        existing = find_reusable_report(db, clinic_id, report_type, key)
+        if existing:
+            return existing
+        if _claim(key):
+            return None
+        if time.monotonic() >= deadline:
+            return None  # the claimer stalled; start our own rather than hang
+        # Someone else is creating it right now; their row is a moment away.
+        time.sleep(0.2)
+
+
+# ── Progress ─────────────────────────────────────────────────────────────────
+
+def report_progress(report: DashboardReport) -> List[Dict]:
+    """What Nexus has recorded for each stage; stages it hasn't reached are pending."""
+    recorded = {}
+    if _redis_up():
+        try:
+            raw = _redis().hgetall(progress_key(report.id)) or {}
+            recorded = {
+                (k.decode() if isinstance(k, bytes) else k): json.loads(v)
+                for k, v in raw.items()
+            }
+        except Exception:
+            _redis_failed()
+    out = []
+    for stage in REPORT_STAGES:
+        entry = recorded.get(stage) or {}
+        state = entry.get("state", "pending")
+        if report.status == "completed":
+            state = "done"
+        elif report.status == "failed" and state == "running":
+            state = "failed"  # the job died inside this stage
+        out.append({"stage": stage, "state": state, "seconds": entry.get("seconds")})
+    return out
+
+
+def _with_progress(report: DashboardReport) -> DashboardReportResponse:
+    out = DashboardReportResponse.model_validate(report)
+    out.progress = report_progress(report)
+    return out
+
 @router.get("/history", response_model=List[DashboardReportResponse])
 def get_report_history(
     category: Optional[str] = None,
@@ -101,27 +268,21 @@ async def download_report(
     else:
         key = url_parts[1]
 
-    client = get_r2_client()
-    if not client:
-        raise HTTPException(status_code=500, detail="Storage service not configured")
-
-    try:
-        bucket_name = os.getenv("R2_BUCKET_NAME")
-        response = client.get_object(Bucket=bucket_name, Key=key)
-        
-        # Stream the file content back to the client directly from R2 response body
-        return StreamingResponse(
-            response['Body'], 
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": f'attachment; filename="{report.title.replace(" ", "_")}.pdf"',
-                "Access-Control-Expose-Headers": "Content-Disposition"
-            }
-        )
-    except Exception as e:
-        print(f"Download error: {str(e)}")
+    # Shared pooled client (r2_storage), so this counts in the storage metrics
+    body = await open_r2_stream_async(key)
+    if body is None:
         raise HTTPException(status_code=500, detail="Failed to retrieve file from storage")
 
+    # Stream the file content back to the client directly from R2 response body
+    return StreamingResponse(
+        iter_r2_body(body, _STREAM_CHUNK_BYTES),
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{report.title.replace(" ", "_")}.pdf"',
+            "Access-Control-Expose-Headers": "Content-Disposition"
+        }
+    )
+
 @router.get("/{report_id}", response_model=DashboardReportResponse)
 def get_report_status(
     report_id: int,
@@ -137,7 +298,7 @@ def get_report_status(
     if not report:
         raise HTTPException(status_code=404, detail="Report not found")
         
-    return report
+    return _with_progress(report)
 
 @router.post("/generate", response_model=DashboardReportResponse)
 async def generate_dashboard_report(
@@ -145,85 +306,108 @@ async def generate_dashboard_report(
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    """Trigger generation of a dashboard report via nexus-service"""
-    # Create the report record in database with 'generating' status
-    new_report = DashboardReport(
-        clinic_id=current_user.clinic_id,
-        report_category=request.report_category,
-        report_type=request.report_type,
-        title=request.title,
-        parameters={
-            "start_date": request.start_date,
-            "end_date": request.end_date,
-            "generated_by": f"{current_user.first_name} {current_user.last_name}"
-        },
-        status="generating",
-        file_url=None,
-        created_by=current_user.id
-    )
-    
-    db.add(new_report)
-    db.commit()
-    db.refresh(new_report)
-    
+    """Trigger generation of a dashboard report via nexus-service.
+
+    An identical request that is still generating, or completed in the last
+    REPORT_REUSE_S, is returned instead of starting another job.
+    """
+    key = idempotency_key(current_user.clinic_id, request)
+    existing = await run_in_threadpool(_find_or_claim, db, current_user.clinic_id, request.report_type, key)
+    if existing:
+        return await run_in_threadpool(_with_progress, existing)
+    new_report, clinic_name = await run_in_threadpool(_create_report, db, current_user, request, key)
+
     try:
-        # Call nexus-service for AI-powered report generation
-        nexus_url = os.getenv("NEXUS_SERVICES_URL", os.getenv("NEXUS_URL", "http://nexus:8001"))
-        
-        # Get clinic information
-        clinic = db.query(Clinic).filter(Clinic.id == current_user.clinic_id).first()
-        clinic_name = clinic.name if clinic else "Unknown Clinic"
-        
-        # Map report_type to specific Nexus URL
-        nexus_url_map = {
-            "monthly_revenue": "/api/v1/reports/financial/revenue",
-            "outstanding_invoices": "/api/v1/reports/financial/revenue",
-            "expense_summary": "/api/v1/reports/financial/revenue",
-            "patient_flow": "/api/v1/reports/operational/flow",
-            "appointment_utilization": "/api/v1/reports/operational/flow",
-            "treatment_plans": "/api/v1/reports/clinical/treatment",
-            "procedure_breakdown": "/api/v1/reports/clinical/treatment"
-        }
-        
-        target_path = nexus_url_map.get(request.report_type, "/api/v1/reports/generate")
-        
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                f"{nexus_url}{target_path}",
-                json={
-                    "report_type": request.report_type,
-                    "report_category": request.report_category,
-                    "title": request.title,
-                    "start_date": request.start_date,
-                    "end_date": request.end_date,
-                    "clinic_id": current_user.clinic_id,
-                    "clinic_name": clinic_name,
-                    "report_db_id": new_report.id
-                }
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("success"):
-                    return new_report
-                else:
-                    new_report.status = "failed"
-                    db.commit()
-                    raise HTTPException(status_code=500, detail=result.get("message", "Report enqueuing failed"))
-            else:
-                new_report.status = "failed"
-                db.commit()
-                raise HTTPException(status_code=500, detail=f"Nexus service error: {response.status_code}")
-                
+        await send_to_nexus(new_report, request, clinic_name)
+        return await run_in_threadpool(_with_progress, new_report)
+    except HTTPException:
+        await run_in_threadpool(_mark_failed, db, new_report)
+        raise
     except httpx.RequestError as e:
-        new_report.status = "failed"
-        db.commit()
+        await run_in_threadpool(_mark_failed, db, new_report)
         raise HTTPException(status_code=500, detail=f"Failed to connect to nexus service: {str(e)}")
     except Exception as e:
-        new_report.status = "failed"
-        db.commit()
+        await run_in_threadpool(_mark_failed, db, new_report)
         raise HTTPException(status_code=500, detail=f"Report generation failed: {str(e)}")
 
+
+def _create_report(db: Session, current_user, request: ReportGenerateRequest, key: str):
+    """Insert the 'generating' row, give the claim back and look up the
+    clinic's name for Nexus. Blocking; returns (report, clinic_name)."""
+    try:
+        new_report = DashboardReport(
+            clinic_id=current_user.clinic_id,
+            report_category=request.report_category,
+            report_type=request.report_type,
+            title=request.title,
+            parameters={
+                "start_date": request.start_date,
+                "end_date": request.end_date,
+                "generated_by": f"{current_user.first_name} {current_user.last_name}",
+                "idempotency_key": key,
+            },
+            status="generating",
+            file_url=None,
+            created_by=current_user.id
+        )
+
+        db.add(new_report)
+        db.commit()
+        db.refresh(new_report)
+    finally:
+        # Committed (or failed): later requests find the row, or start over.
+        _release(key)
+    clinic = db.query(Clinic).filter(Clinic.id == new_report.clinic_id).first()
+    return new_report, clinic.name if clinic else "Unknown Clinic"
+
+
+def _mark_failed(db: Session, report: DashboardReport) -> None:
+    """Blocking."""
+    report.status = "failed"
+    db.commit()
+
+
+async def send_to_nexus(new_report: DashboardReport, request: ReportGenerateRequest, clinic_name: str) -> None:
+    """Enqueue the report's job in nexus-service. Only HTTP, no database:
+    raises HTTPException if Nexus refuses, and the caller marks the row failed."""
+    # Call nexus-service for AI-powered report generation
+    nexus_url = os.getenv("NEXUS_SERVICES_URL", os.getenv("NEXUS_URL", "http://nexus:8001"))
+
+    # Map report_type to specific Nexus URL
+    nexus_url_map = {
+        "monthly_revenue": "/api/v1/reports/financial/revenue",
+        "outstanding_invoices": "/api/v1/reports/financial/revenue",
+        "expense_summary": "/api/v1/reports/financial/revenue",
+        "patient_flow": "/api/v1/reports/operational/flow",
+        "appointment_utilization": "/api/v1/reports/operational/flow",
+        "treatment_plans": "/api/v1/reports/clinical/treatment",
+        "procedure_breakdown": "/api/v1/reports/clinical/treatment"
+    }
+
+    target_path = nexus_url_map.get(request.report_type, "/api/v1/reports/generate")
+
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        response = await client.post(
+            f"{nexus_url}{target_path}",
+            json={
+                "report_type": request.report_type,
+                "report_category": request.report_category,
+                "title": request.title,
+                "start_date": request.start_date,
+                "end_date": request.end_date,
+                "clinic_id": new_report.clinic_id,
+                "clinic_name": clinic_name,
+                "report_db_id": new_report.id
+            }
+        )
+
+    if response.status_code == 200:
+        result = response.json()
+        if result.get("success"):
+            return
+        raise HTTPException(status_code=500, detail=result.get("message", "Report enqueuing failed"))
+    raise HTTPException(status_code=500, detail=f"Nexus service error: {response.status_code}")
+
 @router.post("/send")
 async def send_report(
     report_id: int,
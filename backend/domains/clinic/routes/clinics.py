@@ -20,6 +20,7 @@ from models import Clinic, User, user_clinics, generate_clinic_code, Subscriptio
 from sqlalchemy import select, func
 import datetime
 from core.audit import record_audit, CLINIC_UPDATED
+from domains.scheduling import public_availability
 
 router = APIRouter()
 
@@ -463,6 +464,8 @@ async def update_my_clinic(
                 detail="Clinic not found"
             )
 
+        # The booking page caches name and hours; make it see the change.
+        await public_availability.forget_clinic(clinic.clinic_code)
         return ClinicResponseDTO.from_orm(clinic)
 
     except HTTPException:
@@ -531,6 +534,8 @@ async def update_clinic(
                 detail="Clinic not found"
             )
 
+        # The booking page caches name and hours; make it see the change.
+        await public_availability.forget_clinic(clinic.clinic_code)
         return ClinicResponseDTO.from_orm(clinic)
 
     except HTTPException:
@@ -0,0 +1,225 @@
+"""
+Direct-to-R2 uploads for patient documents and X-rays.
+
+The older upload routes move every byte through an API worker: patient_files
+and X-rays are copied to local disk with shutil.copyfileobj, and
+documents.upload_document reads the whole file into memory before pushing it
+on to R2. A large intraoral scan ties up a worker for the entire transfer.
+
+Here the worker only brokers the transfer:
+
+  1. POST /{patient_id}/initiate opens an R2 multipart upload at a key we
+     choose and returns one presigned PUT URL per part.
+  2. The client PUTs each part straight to R2 and keeps the returned ETags.
+  3. POST /{patient_id}/complete stitches the parts together, registers the
+     PatientDocument or XrayImage row, and queues preview rendering.
+
+POST /{patient_id}/abort discards an upload the client gave up on.
+"""
+import datetime
+import math
+import os
+import uuid
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from core.auth_utils import get_current_user
+from core.dtos import (
+    DirectUploadAbortDTO,
+    DirectUploadCompleteDTO,
+    DirectUploadInitiateDTO,
+    DirectUploadInitiateResponseDTO,
+    DirectUploadPartURLDTO,
+    PatientDocumentResponseDTO,
+)
+from database import get_db
+from domains.document.routes.documents import _queue_previews, _scoped_patient
+from domains.document.services.previews import build_xray_previews
+from domains.infrastructure.services.r2_storage import (
+    StorageCategory,
+    abort_multipart_upload,
+    complete_multipart_upload,
+    create_multipart_upload,
+    get_r2_path,
+    head_r2_object,
+    presign_upload_part,
+)
+from models import Appointment, PatientDocument, User, XrayImage
+from schemas import XrayImageOut
+
+router = APIRouter()
+
+# R2 (like S3) needs every part but the last to be at least 5 MiB and allows at
+# most 10,000 parts. Parts grow past the default only for very large files.
+MIN_PART_BYTES = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_BYTES = max(int(os.environ.get("DIRECT_UPLOAD_PART_BYTES", str(16 * 1024 * 1024))), MIN_PART_BYTES)
+MAX_UPLOAD_BYTES = int(os.environ.get("DIRECT_UPLOAD_MAX_BYTES", str(5 * 1024 ** 3)))
+PART_URL_EXPIRES_S = int(os.environ.get("DIRECT_UPLOAD_URL_EXPIRES_S", "3600"))
+
+_CATEGORY = {"document": StorageCategory.DOCUMENTS, "xray": StorageCategory.XRAYS}
+
+
+def plan_parts(file_size: int) -> tuple:
+    """(part_size, part_count) for a file of this size."""
+    part_size = max(DEFAULT_PART_BYTES, math.ceil(file_size / MAX_PARTS))
+    return part_size, max(math.ceil(file_size / part_size), 1)
+
+
+def _upload_prefix(clinic_id: int, patient_id: int, kind: str) -> str:
+    return get_r2_path(clinic_id, patient_id, _CATEGORY[kind]) + "/"
+
+
+def _check_key(key: str, clinic_id: int, patient_id: int, kind: str) -> None:
+    """The key must be one initiate could have issued for this patient.
+
+    Without this, complete would register any object in the bucket against
+    the caller's patient, and the list endpoint would then presign it."""
+    if not key.startswith(_upload_prefix(clinic_id, patient_id, kind)) or ".." in key:
+        raise HTTPException(status_code=400, detail="Upload key does not belong to this patient")
+
+
+@router.post("/{patient_id}/initiate", response_model=DirectUploadInitiateResponseDTO)
+async def initiate_direct_upload(
+    patient_id: int,
+    req: DirectUploadInitiateDTO,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Open a multipart upload and sign a PUT URL for every part."""
+    patient = _scoped_patient(db, patient_id, current_user)
+    if req.file_size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+    if req.kind == "xray" and not req.file_name.lower().endswith(".dcm"):
+        raise HTTPException(status_code=400, detail="Only DICOM (.dcm) files are supported")
+
+    # Unique per upload, so two files with the same name never overwrite each
+    # other; the original name is kept for people browsing the bucket.
+    safe_name = os.path.basename(req.file_name).replace(" ", "_")
+    key = _upload_prefix(patient.clinic_id, patient_id, req.kind) + f"{uuid.uuid4().hex[:12]}_{safe_name}"
+
+    upload_id = await run_in_threadpool(create_multipart_upload, key, req.content_type or "application/octet-stream")
+    if not upload_id:
+        raise HTTPException(status_code=503, detail="Storage unavailable")
+
+    part_size, part_count = plan_parts(req.file_size)
+    parts = []
+    for part_number in range(1, part_count + 1):
+        url = presign_upload_part(key, upload_id, part_number, PART_URL_EXPIRES_S)
+        if not url:
+            await run_in_threadpool(abort_multipart_upload, key, upload_id)
+            raise HTTPException(status_code=503, detail="Storage unavailable")
+        parts.append(DirectUploadPartURLDTO(part_number=part_number, url=url))
+
+    return DirectUploadInitiateResponseDTO(
+        upload_id=upload_id,
+        key=key,
+        part_size=part_size,
+        expires_in=PART_URL_EXPIRES_S,
+        parts=parts,
+    )
+
+
+@router.post("/{patient_id}/complete")
+async def complete_direct_upload(
+    patient_id: int,
+    req: DirectUploadCompleteDTO,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Finish the upload, register its row and queue preview rendering.
+
+    Returns the new document (as the legacy upload route does) or X-ray."""
+    patient = _scoped_patient(db, patient_id, current_user)
+    _check_key(req.key, patient.clinic_id, patient_id, req.kind)
+
+    if req.kind == "xray":
+        if not req.image_type:
+            raise HTTPException(status_code=400, detail="image_type is required for X-rays")
+        if req.appointment_id:
+            appointment = db.query(Appointment).filter(
+                Appointment.id == req.appointment_id,
+                Appointment.patient_id == patient_id,
+            ).first()
+            if not appointment:
+                raise HTTPException(status_code=404, detail="Appointment not found")
+
+    parts = [
+        {"PartNumber": p.part_number, "ETag": p.etag}
+        for p in sorted(req.parts, key=lambda p: p.part_number)
+    ]
+    if not await run_in_threadpool(complete_multipart_upload, req.key, req.upload_id, parts):
+        raise HTTPException(status_code=400, detail="Could not complete upload")
+
+    meta = await run_in_threadpool(head_r2_object, req.key)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Uploaded file not found in storage")
+
+    if req.kind == "xray":
+        capture = req.capture_date or datetime.date.today()
+        xray = XrayImage(
+            clinic_id=patient.clinic_id,
+            patient_id=patient_id,
+            appointment_id=req.appointment_id,
+            file_path=req.key,
+            file_name=req.file_name,
+            file_size=meta["size"],
+            image_type=req.image_type,
+            capture_date=datetime.datetime.combine(capture, datetime.time()),
+            notes=req.notes,
+            created_by=current_user.id,
+        )
+        db.add(xray)
+        db.commit()
+        db.refresh(xray)
+        background_tasks.add_task(build_xray_previews, xray.id)
+        return XrayImageOut(
+            id=xray.id,
+            patient_id=xray.patient_id,
+            appointment_id=xray.appointment_id,
+            file_name=xray.file_name,
+            file_path=xray.file_path,
+            file_size=xray.file_size,
+            image_type=xray.image_type,
+            capture_date=xray.capture_date,
+            notes=xray.notes,
+            created_by=xray.created_by,
+            created_at=xray.created_at,
+            updated_at=xray.updated_at or xray.created_at,
+            patient_name=patient.name,
+        )
+
+    file_type = req.file_name.split('.')[-1] if '.' in req.file_name else "unknown"
+    document = PatientDocument(
+        patient_id=patient_id,
+        clinic_id=patient.clinic_id,
+        case_paper_id=req.case_paper_id,
+        file_name=req.file_name,
+        file_path=req.key,
+        file_size=meta["size"],
+        file_type=file_type,
+        uploaded_by=current_user.id,
+    )
+    db.add(document)
+    db.commit()
+    db.refresh(document)
+    _queue_previews(background_tasks, document.id, file_type)
+    return PatientDocumentResponseDTO.from_orm(document)
+
+
+@router.post("/{patient_id}/abort")
+async def abort_direct_upload(
+    patient_id: int,
+    req: DirectUploadAbortDTO,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Discard an upload the client gave up on, so its parts stop costing storage."""
+    patient = _scoped_patient(db, patient_id, current_user)
+    if not any(req.key.startswith(_upload_prefix(patient.clinic_id, patient_id, kind)) for kind in _CATEGORY):
+        raise HTTPException(status_code=400, detail="Upload key does not belong to this patient")
+    await run_in_threadpool(abort_multipart_upload, req.key, req.upload_id)
+    return {"message": "Upload aborted"}
@@ -1,20 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Response, Header
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, UploadFile, File, Response, Header
 from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from sqlalchemy.exc import ProgrammingError
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from database import get_db
 from models import PatientDocument, Patient, User, Report
 from core.dtos import PatientDocumentResponseDTO, ExternalDocumentRequestDTO, UnifiedFileResponseDTO
 from core.auth_utils import get_current_user
 from domains.infrastructure.services.r2_storage import (
     upload_bytes_to_r2, StorageCategory, get_presigned_url, download_bytes_from_r2,
-    put_bytes_to_key, delete_file_from_r2,
+    delete_file_from_r2, head_r2_object, open_r2_stream, iter_r2_body,
 )
+from domains.document.services.previews import (
+    build_document_previews, generate_document_previews, is_previewable,
+    preview_key, PREVIEW_SIZES,
+)
+import asyncio
 import hashlib
 import hmac
-import io
 import os
 
 router = APIRouter()
@@ -89,9 +94,16 @@ def _ensure_case_paper_column(db: Session):
     declared in models.py; future schema changes go through deploy.sh."""
     return
 
+def _queue_previews(background_tasks: BackgroundTasks, document_id: int, file_type: Optional[str]) -> None:
+    """Render list/viewer previews once the upload response has been sent, so
+    the first visit to the patient's files finds them already in R2."""
+    if is_previewable(file_type):
+        background_tasks.add_task(build_document_previews, document_id)
+
 @router.post("/upload/{patient_id}", response_model=PatientDocumentResponseDTO)
 async def upload_document(
     patient_id: int,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     case_paper_id: Optional[int] = None,
     db: Session = Depends(get_db),
@@ -133,6 +145,7 @@ async def upload_document(
     try:
         db.commit()
         db.refresh(document)
+        _queue_previews(background_tasks, document.id, file_type)
         return PatientDocumentResponseDTO.from_orm(document)
     except ProgrammingError as e:
         if "case_paper_id" not in str(e):
@@ -159,6 +172,7 @@ async def upload_document(
             }
         ).mappings().first()
         db.commit()
+        _queue_previews(background_tasks, inserted["id"], file_type)
         return PatientDocumentResponseDTO(
             id=inserted["id"],
             patient_id=inserted["patient_id"],
@@ -176,6 +190,7 @@ async def upload_document(
 async def register_external_document(
     patient_id: int,
     req: ExternalDocumentRequestDTO,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     x_internal_auth: Optional[str] = Header(None),
 ):
@@ -212,6 +227,7 @@ async def register_external_document(
     try:
         db.commit()
         db.refresh(document)
+        _queue_previews(background_tasks, document.id, file_type)
         return PatientDocumentResponseDTO.from_orm(document)
     except ProgrammingError as e:
         if "case_paper_id" not in str(e):
@@ -237,6 +253,7 @@ async def register_external_document(
             }
         ).mappings().first()
         db.commit()
+        _queue_previews(background_tasks, inserted["id"], file_type)
         return PatientDocumentResponseDTO(
             id=inserted["id"],
             patient_id=inserted["patient_id"],
@@ -250,6 +267,22 @@ async def register_external_document(
             created_at=inserted["created_at"],
         )
 
+def _uploader_names(db: Session, user_ids) -> dict:
+    """Display names for every uploader on the page, in one query rather than
+    one per document."""
+    user_ids = [uid for uid in user_ids if uid]
+    if not user_ids:
+        return {}
+    rows = (
+        db.query(User.id, User.first_name, User.last_name)
+        .filter(User.id.in_(user_ids))
+        .all()
+    )
+    return {uid: f"{first} {last}" for uid, first, last in rows}
+
+def _preview_url(key: Optional[str]) -> Optional[str]:
+    return get_presigned_url(key) if key else None
+
 @router.get("/patient/{patient_id}", response_model=List[UnifiedFileResponseDTO])
 async def list_documents(
     patient_id: int,
@@ -307,14 +340,14 @@ async def list_documents(
     
     # Enrich with uploader name and category
     result = []
+    uploader_names = _uploader_names(db, {doc_get(doc, 'uploaded_by') for doc in documents})
     
     # Process general documents
     for doc in documents:
         uploader_name = "System"
         uploaded_by = doc_get(doc, 'uploaded_by')
         if uploaded_by:
-            uploader = db.query(User).filter(User.id == uploaded_by).first()
-            uploader_name = f"{uploader.first_name} {uploader.last_name}" if uploader else "Unknown"
+            uploader_name = uploader_names.get(uploaded_by, "Unknown")
             
         # Generate presigned URL for the key stored in file_path
         doc_file_path = doc_get(doc, 'file_path')
@@ -333,6 +366,8 @@ async def list_documents(
             created_at=doc_get(doc, 'created_at'),
             category="document",
             thumbnail_token=thumbnail_token(doc_get(doc, 'id')),
+            thumbnail_url=_preview_url(doc_get(doc, 'thumbnail_key')),
+            preview_url=_preview_url(doc_get(doc, 'preview_key')),
         ))
         
     # Process reports
@@ -358,104 +393,179 @@ async def list_documents(
     result.sort(key=lambda x: x.created_at, reverse=True)
     return result
 
+# ─── Raw streaming ────────────────────────────────────────────────────────────
+# CBCT and multi-frame DICOM studies run to hundreds of MB. Buffering one whole
+# object per request spiked worker memory and held the viewer's first byte
+# until the last one had arrived from R2, so the proxy streams in chunks and
+# honours single byte ranges, which lets the viewer fetch frames lazily.
+
+_STREAM_CHUNK_BYTES = 256 * 1024
+
+# Transfers above this size take one of a small, fixed number of slots per
+# worker. A handful of parallel full-study downloads otherwise monopolises the
+# worker's threadpool and R2 bandwidth while ordinary page loads queue behind.
+_LARGE_TRANSFER_BYTES = int(os.environ.get("DOCUMENT_LARGE_TRANSFER_BYTES", str(32 * 1024 * 1024)))
+_LARGE_TRANSFER_SLOTS = int(os.environ.get("DOCUMENT_LARGE_TRANSFER_SLOTS", "4"))
+_LARGE_TRANSFER_WAIT_S = float(os.environ.get("DOCUMENT_LARGE_TRANSFER_WAIT_S", "10"))
+_large_transfers = asyncio.Semaphore(_LARGE_TRANSFER_SLOTS)
+
+
+def _parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """The inclusive (start, end) a `Range` header asks for, or None to serve
+    the whole object.
+
+    Only a single `bytes=` range is honoured. Multi-range and malformed headers
+    are ignored, which RFC 9110 permits, and the full body is sent instead. A
+    well-formed range that starts past the end of the object is a 416."""
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if first == "":
+            # Suffix form, "bytes=-N": the last N bytes.
+            suffix = int(last)
+            if suffix <= 0 or size == 0:
+                raise _range_not_satisfiable(size)
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        raise _range_not_satisfiable(size)
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def _range_not_satisfiable(size: int) -> HTTPException:
+    return HTTPException(
+        status_code=416,
+        detail="Requested range not satisfiable",
+        headers={"Content-Range": f"bytes */{size}"},
+    )
+
+
+class _TransferSlot:
+    """One of the `_large_transfers` slots, given back exactly once. Whoever
+    sees the response end first releases it: the body generator, the
+    response itself, or the handler when it fails before the hand-off."""
+
+    def __init__(self):
+        self.held = False
+
+    async def acquire(self) -> None:
+        try:
+            await asyncio.wait_for(_large_transfers.acquire(), timeout=_LARGE_TRANSFER_WAIT_S)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many large downloads in progress, please retry",
+                headers={"Retry-After": "5"},
+            )
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            _large_transfers.release()
+
+
+class _SlotStreamingResponse(StreamingResponse):
+    """A StreamingResponse that runs `on_close` however it ends, including a
+    client that leaves before the first chunk, when the body generator never
+    starts and so never reaches its own `finally`."""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._on_close()
+
+
 @router.get("/{document_id}/raw")
 async def get_document_raw(
     document_id: int,
+    range_header: Optional[str] = Header(None, alias="Range"),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
     """Stream a document's bytes from R2 through our own (CORS-enabled) origin.
 
     Needed for clients that fetch via XHR — e.g. the in-app DICOM viewer — which
-    a direct R2 presigned URL blocks with CORS.
+    a direct R2 presigned URL blocks with CORS. Supports `Range` so the viewer
+    can pull individual frames instead of the whole study.
 
     This is the endpoint the DICOM viewer streams through, and it had auth but
     no clinic filter — so any signed-in user of any clinic could pull any
     radiograph in the system by id."""
     document = _scoped_document(db, document_id, current_user)
 
-    data = download_bytes_from_r2(document.file_path)
-    if data is None:
+    meta = await run_in_threadpool(head_r2_object, document.file_path)
+    if meta is None:
         raise HTTPException(status_code=404, detail="File not found in storage")
+    size = meta["size"]
 
-    ext = (document.file_type or "").lower()
-    media_type = "application/dicom" if ext in ("dcm", "dicom") else "application/octet-stream"
-    return Response(
-        content=data,
-        media_type=media_type,
-        headers={"Content-Disposition": f'inline; filename="{document.file_name}"'},
-    )
-
-def _dicom_to_png(raw: bytes) -> Optional[bytes]:
-    """Render a DICOM's first frame to a downscaled greyscale PNG.
+    byte_range = _parse_range(range_header, size)
+    start, end = byte_range if byte_range else (0, size - 1)
+    length = end - start + 1 if size else 0
 
-    Applies Modality LUT (rescale) and inverts MONOCHROME1. Without the
-    inversion, MONOCHROME1 studies — which some intraoral sensors produce —
-    render as photographic negatives: bone dark, air bright. On a radiograph
-    that is not a cosmetic difference, it is the opposite of the image the
-    dentist is meant to read."""
-    try:
-        import pydicom
-        import numpy as np
-        from PIL import Image
-        from pydicom.pixel_data_handlers.util import apply_modality_lut
-
-        ds = pydicom.dcmread(io.BytesIO(raw))
-        arr = ds.pixel_array
-        # Multi-frame -> first frame; leave RGB(A) frames as-is.
-        if arr.ndim == 3 and arr.shape[-1] not in (3, 4):
-            arr = arr[0]
-
-        # Rescale slope/intercept, where present.
-        try:
-            arr = apply_modality_lut(arr, ds)
-        except Exception:
-            pass  # not all files carry a modality LUT; raw values are fine
-
-        arr = arr.astype(np.float32)
-        lo, hi = float(arr.min()), float(arr.max())
-        if hi > lo:
-            arr = (arr - lo) / (hi - lo)
-        # MONOCHROME1 means "0 is white". Normalising above always maps low to
-        # black, so this class of file has to be flipped back.
-        if str(getattr(ds, "PhotometricInterpretation", "")).strip() == "MONOCHROME1":
-            arr = 1.0 - arr
-        arr = (arr * 255).astype(np.uint8)
-        img = Image.fromarray(arr)
-        if img.mode not in ("L", "RGB"):
-            img = img.convert("L")
-        img.thumbnail((480, 480))
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        return buf.getvalue()
-    except Exception as e:
-        print(f"DICOM thumbnail failed: {e}")
-        return None
+    slot = _TransferSlot()
+    if length >= _LARGE_TRANSFER_BYTES:
+        await slot.acquire()
 
-
-def _pdf_to_png(raw: bytes) -> Optional[bytes]:
-    """Render a PDF's first page to a PNG (pypdfium2, same as template thumbnails)."""
+    # From here until the response owns the slot, any way out (a 404, an R2
+    # error, the request being cancelled mid-await) must give it back.
     try:
-        import pypdfium2 as pdfium
-
-        pdf = pdfium.PdfDocument(raw)
-        if len(pdf) == 0:
-            return None
-        pil_image = pdf[0].render(scale=1.4).to_pil()
-        buf = io.BytesIO()
-        pil_image.save(buf, format="PNG")
-        return buf.getvalue()
-    except Exception as e:
-        print(f"PDF thumbnail failed: {e}")
-        return None
-
+        if byte_range:
+            body = await run_in_threadpool(open_r2_stream, document.file_path, start, end)
+        else:
+            body = await run_in_threadpool(open_r2_stream, document.file_path)
+        if body is None:
+            raise HTTPException(status_code=404, detail="File not found in storage")
+
+        ext = (document.file_type or "").lower()
+        media_type = "application/dicom" if ext in ("dcm", "dicom") else "application/octet-stream"
+        headers = {
+            "Content-Disposition": f'inline; filename="{document.file_name}"',
+            "Content-Length": str(length),
+            "Accept-Ranges": "bytes",
+        }
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+        def close():
+            body.close()
+            slot.release()
+
+        return _SlotStreamingResponse(
+            iter_r2_body(body, _STREAM_CHUNK_BYTES, on_close=slot.release),
+            on_close=close,
+            status_code=206 if byte_range else 200,
+            media_type=media_type,
+            headers=headers,
+        )
+    except BaseException:
+        slot.release()
+        raise
 
 @router.get("/{document_id}/thumbnail")
 async def get_document_thumbnail(document_id: int, t: str = "", db: Session = Depends(get_db)):
-    """Return a small PNG preview for a DICOM or PDF document.
+    """Return the small WebP preview for a DICOM, PDF or image document.
 
-    Generated on first request and cached in R2 next to the source so repeat
-    loads are cheap.
+    Normally rendered at upload time (see domains/document/services/previews.py)
+    and only read back here. Rows uploaded before that pipeline existed, or
+    whose background render failed, are rendered on this first request and the
+    keys recorded, so it happens once per document.
 
     Stays header-less because it is used directly as an <img> src, which cannot
     send an Authorization header. Access is instead gated on `t`, the per-
@@ -470,32 +580,24 @@ async def get_document_thumbnail(document_id: int, t: str = "", db: Session = De
     if not document or not document.file_path:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    ext = (document.file_type or "").lower()
-    if ext not in ("dcm", "dicom", "pdf"):
+    if not is_previewable(document.file_type):
         raise HTTPException(status_code=415, detail="No thumbnail for this file type")
 
     # private, not public: this is patient imaging and must not sit in a shared
     # or CDN cache keyed only by URL.
-    png_headers = {"Cache-Control": "private, max-age=86400"}
-    thumb_key = f"{document.file_path}.thumb.png"
+    headers = {"Cache-Control": "private, max-age=86400"}
 
-    cached = download_bytes_from_r2(thumb_key)
-    if cached:
-        return Response(content=cached, media_type="image/png", headers=png_headers)
-
-    raw = download_bytes_from_r2(document.file_path)
-    if raw is None:
-        raise HTTPException(status_code=404, detail="File not found in storage")
+    if document.thumbnail_key:
+        cached = await run_in_threadpool(download_bytes_from_r2, document.thumbnail_key)
+        if cached:
+            return Response(content=cached, media_type="image/webp", headers=headers)
 
     # Rendering is CPU-bound (pydicom/numpy/PIL, or pypdfium2). Run it off the
     # event loop or one slow DICOM stalls every other request in the worker.
-    renderer = _dicom_to_png if ext in ("dcm", "dicom") else _pdf_to_png
-    png = await run_in_threadpool(renderer, raw)
-    if png is None:
+    previews = await run_in_threadpool(generate_document_previews, db, document)
+    if "thumb" not in previews:
         raise HTTPException(status_code=422, detail="Could not generate thumbnail")
-
-    put_bytes_to_key(thumb_key, png, "image/png")  # cache for next time
-    return Response(content=png, media_type="image/png", headers=png_headers)
+    return Response(content=previews["thumb"], media_type="image/webp", headers=headers)
 
 
 @router.delete("/{document_id}")
@@ -520,7 +622,9 @@ async def delete_document(
     if file_path:
         try:
             delete_file_from_r2(file_path)
-            delete_file_from_r2(f"{file_path}.thumb.png")
+            delete_file_from_r2(f"{file_path}.thumb.png")  # pre-WebP lazy thumbnail
+            for size in PREVIEW_SIZES:
+                delete_file_from_r2(preview_key(file_path, size))
         except Exception as exc:
             print(f"R2 cleanup failed for document {document_id}: {exc}")
 
@@ -0,0 +1,239 @@
+"""
+Upload-time preview pipeline for patient documents and X-rays.
+
+Thumbnails used to be rendered on the first view: the thumbnail endpoint pulled
+the whole study from R2, ran pydicom/pypdfium2 in the request's threadpool and
+cached a PNG. The first visit to a patient's files therefore waited on every
+render at once. The upload routes now hand the new row to this module as a
+background task, which renders the source once, writes every size in WebP next
+to it, and records the keys on the row. The list endpoints return those keys
+directly, and the thumbnail endpoint only renders for rows that predate this.
+
+Every entry point here is best-effort. A preview that cannot be produced leaves
+the keys NULL, and the upload it follows has already succeeded.
+"""
+import io
+import os
+from typing import Callable, Dict, Optional
+
+from models import PatientDocument, XrayImage
+from domains.infrastructure.services.r2_storage import download_bytes_from_r2, is_r2_key, put_bytes_to_key
+
+# Longest edge in pixels. "thumb" is the file-list tile, "preview" what the
+# viewer shows while the full study streams in behind it.
+PREVIEW_SIZES = {"thumb": 480, "preview": 1600}
+WEBP_QUALITY = 80
+
+DICOM_TYPES = ("dcm", "dicom")
+IMAGE_TYPES = ("jpg", "jpeg", "png", "gif", "bmp", "tiff", "tif", "webp")
+PREVIEWABLE_TYPES = DICOM_TYPES + ("pdf",) + IMAGE_TYPES
+
+
+def preview_key(source_key: str, size: str) -> str:
+    """Where a preview of `source_key` lives: next to it, so deleting by prefix
+    or by the document's own key finds it."""
+    return f"{source_key}.{size}.webp"
+
+
+def is_previewable(file_type: Optional[str]) -> bool:
+    return (file_type or "").lower().lstrip(".") in PREVIEWABLE_TYPES
+
+
+# ─── Rendering ───────────────────────────────────────────────────────────────
+
+def _dicom_to_image(raw: bytes):
+    """A DICOM's first frame as an 8-bit PIL image.
+
+    Applies Modality LUT (rescale) and inverts MONOCHROME1. Without the
+    inversion, MONOCHROME1 studies — which some intraoral sensors produce —
+    render as photographic negatives: bone dark, air bright. On a radiograph
+    that is not a cosmetic difference, it is the opposite of the image the
+    dentist is meant to read."""
+    import pydicom
+    import numpy as np
+    from PIL import Image
+    from pydicom.pixel_data_handlers.util import apply_modality_lut
+
+    ds = pydicom.dcmread(io.BytesIO(raw))
+    arr = ds.pixel_array
+    # Multi-frame -> first frame; leave RGB(A) frames as-is.
+    if arr.ndim == 3 and arr.shape[-1] not in (3, 4):
+        arr = arr[0]
+
+    # Rescale slope/intercept, where present.
+    try:
+        arr = apply_modality_lut(arr, ds)
+    except Exception:
+        pass  # not all files carry a modality LUT; raw values are fine
+
+    arr = arr.astype(np.float32)
+    lo, hi = float(arr.min()), float(arr.max())
+    if hi > lo:
+        arr = (arr - lo) / (hi - lo)
+    # MONOCHROME1 means "0 is white". Normalising above always maps low to
+    # black, so this class of file has to be flipped back.
+    if str(getattr(ds, "PhotometricInterpretation", "")).strip() == "MONOCHROME1":
+        arr = 1.0 - arr
+    arr = (arr * 255).astype(np.uint8)
+    img = Image.fromarray(arr)
+    if img.mode not in ("L", "RGB"):
+        img = img.convert("L")
+    return img
+
+
+def _pdf_to_image(raw: bytes):
+    """A PDF's first page (pypdfium2, same as template thumbnails)."""
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(raw)
+    if len(pdf) == 0:
+        return None
+    # Scale so the page's long edge comfortably covers the largest size.
+    page = pdf[0]
+    scale = max(PREVIEW_SIZES.values()) / max(page.get_size())
+    return page.render(scale=max(scale, 1.0)).to_pil()
+
+
+def _raster_to_image(raw: bytes):
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(raw))
+    img.load()
+    return img
+
+
+def render_previews(raw: bytes, file_type: Optional[str]) -> Dict[str, bytes]:
+    """Every size in PREVIEW_SIZES as WebP bytes, or {} when the source cannot
+    be rendered. CPU-bound: call from a worker thread, never the event loop."""
+    ext = (file_type or "").lower().lstrip(".")
+    try:
+        if ext in DICOM_TYPES:
+            img = _dicom_to_image(raw)
+        elif ext == "pdf":
+            img = _pdf_to_image(raw)
+        elif ext in IMAGE_TYPES:
+            img = _raster_to_image(raw)
+        else:
+            return {}
+        if img is None:
+            return {}
+        if img.mode not in ("L", "RGB", "RGBA"):
+            img = img.convert("RGB")
+
+        out = {}
+        for size, edge in PREVIEW_SIZES.items():
+            scaled = img.copy()
+            scaled.thumbnail((edge, edge))
+            buf = io.BytesIO()
+            scaled.save(buf, format="WEBP", quality=WEBP_QUALITY, method=4)
+            out[size] = buf.getvalue()
+        return out
+    except Exception as e:
+        print(f"Preview rendering failed ({ext}): {e}")
+        return {}
+
+
+# ─── Pipeline ────────────────────────────────────────────────────────────────
+
+def _session_factory():
+    from database import SessionLocal
+    return SessionLocal
+
+
+def _store_r2(key: str, data: bytes) -> bool:
+    return put_bytes_to_key(key, data, "image/webp")
+
+
+def _store_local(path: str, data: bytes) -> bool:
+    try:
+        with open(path, "wb") as fh:
+            fh.write(data)
+        return True
+    except OSError as e:
+        print(f"Error writing preview {path}: {e}")
+        return False
+
+
+def store_previews(source_key: str, previews: Dict[str, bytes], store: Callable[[str, bytes], bool]) -> Dict[str, str]:
+    """Write each rendered size next to its source; the keys that landed."""
+    return {
+        size: preview_key(source_key, size)
+        for size, data in previews.items()
+        if store(preview_key(source_key, size), data)
+    }
+
+
+def generate_document_previews(db, document: PatientDocument) -> Dict[str, bytes]:
+    """Render, store and record previews for a PatientDocument held in R2.
+
+    Returns the rendered bytes by size so a caller that is already waiting on
+    them (the thumbnail endpoint backfilling an old row) need not read them
+    back from storage. {} when nothing could be produced."""
+    if not document.file_path or not is_previewable(document.file_type):
+        return {}
+    raw = download_bytes_from_r2(document.file_path)
+    if raw is None:
+        return {}
+    previews = render_previews(raw, document.file_type)
+    keys = store_previews(document.file_path, previews, _store_r2)
+    if keys:
+        document.thumbnail_key = keys.get("thumb")
+        document.preview_key = keys.get("preview")
+        db.commit()
+    return previews
+
+
+def build_document_previews(document_id: int, session_factory=None) -> Dict[str, str]:
+    """Background-task entry point for generate_document_previews. Runs after
+    the upload response has gone out, so it opens its own session."""
+    db = (session_factory or _session_factory())()
+    try:
+        document = db.query(PatientDocument).filter(PatientDocument.id == document_id).first()
+        if not document:
+            return {}
+        generate_document_previews(db, document)
+        return {
+            size: key
+            for size, key in (("thumb", document.thumbnail_key), ("preview", document.preview_key))
+            if key
+        }
+    except Exception as e:
+        db.rollback()
+        print(f"Preview pipeline failed for document {document_id}: {e}")
+        return {}
+    finally:
+        db.close()
+
+
+def build_xray_previews(xray_id: int, session_factory=None) -> Dict[str, str]:
+    """Same as build_document_previews for an XrayImage. Legacy X-rays live on
+    the API host's disk, direct uploads in R2; previews are written alongside
+    the source file in either case."""
+    db = (session_factory or _session_factory())()
+    try:
+        xray = db.query(XrayImage).filter(XrayImage.id == xray_id).first()
+        if not xray or not xray.file_path:
+            return {}
+        file_type = xray.file_name.rsplit(".", 1)[-1] if "." in xray.file_name else "dcm"
+        if is_r2_key(xray.file_path):
+            raw, store = download_bytes_from_r2(xray.file_path), _store_r2
+        elif os.path.exists(xray.file_path):
+            with open(xray.file_path, "rb") as fh:
+                raw = fh.read()
+            store = _store_local
+        else:
+            return {}
+        if not raw:
+            return {}
+        keys = store_previews(xray.file_path, render_previews(raw, file_type), store)
+        if keys:
+            xray.thumbnail_key = keys.get("thumb")
+            xray.preview_key = keys.get("preview")
+            db.commit()
+        return keys
+    except Exception as e:
+        db.rollback()
+        print(f"Preview pipeline failed for X-ray {xray_id}: {e}")
+        return {}
+    finally:
+        db.close()
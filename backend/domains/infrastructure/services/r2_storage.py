@@ -1,15 +1,45 @@
+import asyncio
 import os
+import threading
+import time
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
-from typing import Optional
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Optional
 import urllib.parse
 
-# Initialize R2 client
+# One client per process, shared by every caller (routes, background tasks,
+# rq jobs). boto3 clients are thread-safe; building one per call costs a fresh
+# credentials resolution and a fresh connection pool, so TLS to R2 is
+# renegotiated on every upload. The pool must be at least as large as the
+# number of threads that talk to R2 at once (the request threadpool plus the
+# async facade below), otherwise urllib3 discards connections it can't park.
+R2_MAX_POOL_CONNECTIONS = int(os.getenv("R2_MAX_POOL_CONNECTIONS", "50"))
+R2_MAX_ATTEMPTS = int(os.getenv("R2_MAX_ATTEMPTS", "5"))
+R2_CONNECT_TIMEOUT_S = float(os.getenv("R2_CONNECT_TIMEOUT_S", "5"))
+R2_READ_TIMEOUT_S = float(os.getenv("R2_READ_TIMEOUT_S", "60"))
+
 _r2_client = None
+_r2_client_lock = threading.Lock()
+
+
+def r2_client_config() -> Config:
+    """Pool size, retry policy and timeouts for the shared client."""
+    return Config(
+        signature_version='s3v4',
+        max_pool_connections=R2_MAX_POOL_CONNECTIONS,
+        # "standard" retries throttling, 5xx and connection errors with
+        # jittered backoff; the legacy default retried far fewer cases.
+        retries={'max_attempts': R2_MAX_ATTEMPTS, 'mode': 'standard'},
+        connect_timeout=R2_CONNECT_TIMEOUT_S,
+        read_timeout=R2_READ_TIMEOUT_S,
+    )
+
 
 def _get_r2_client():
-    """Initialize and return R2 S3 client"""
+    """Initialize and return the process-wide R2 S3 client"""
     global _r2_client
     
     if _r2_client is not None:
@@ -26,19 +56,75 @@ def _get_r2_client():
         print(f"Missing: access_key_id={bool(access_key_id)}, secret_access_key={bool(secret_access_key)}, bucket_name={bool(bucket_name)}, endpoint_url={bool(endpoint_url)}")
         return None
     
-    # Create S3 client with R2 configuration
-    _r2_client = boto3.client(
-        's3',
-        endpoint_url=endpoint_url,
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=secret_access_key,
-        region_name='auto',  # R2 uses 'auto' as region
-        config=Config(signature_version='s3v4')
-    )
+    # Threads racing on first use would each build (and leak) a pool
+    with _r2_client_lock:
+        if _r2_client is None:
+            _r2_client = boto3.client(
+                's3',
+                endpoint_url=endpoint_url,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                region_name='auto',  # R2 uses 'auto' as region
+                config=r2_client_config()
+            )
     
     return _r2_client
 
 
+class StorageMetrics:
+    """Per-operation call counts, failures, bytes moved and latency.
+
+    Kept in-process (one set per worker); GET /health/storage exposes them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}
+
+    def record(self, op: str, nbytes: int, seconds: float, ok: bool) -> None:
+        with self._lock:
+            stat = self._ops.setdefault(op, {"count": 0, "errors": 0, "bytes": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stat["count"] += 1
+            stat["errors"] += 0 if ok else 1
+            stat["bytes"] += nbytes
+            stat["seconds"] += seconds
+            stat["max_seconds"] = max(stat["max_seconds"], seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                op: {
+                    "count": s["count"],
+                    "errors": s["errors"],
+                    "bytes": s["bytes"],
+                    "avg_ms": round(s["seconds"] * 1000 / s["count"], 2),
+                    "max_ms": round(s["max_seconds"] * 1000, 2),
+                }
+                for op, s in self._ops.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._ops.clear()
+
+
+storage_metrics = StorageMetrics()
+
+
+@contextmanager
+def _timed(op: str, nbytes: int = 0):
+    """Record one storage call. The body may set stat["bytes"] once it knows
+    the size (downloads); an exception counts as an error and propagates."""
+    stat = {"bytes": nbytes}
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield stat
+        ok = True
+    finally:
+        storage_metrics.record(op, stat["bytes"], time.perf_counter() - started, ok)
+
+
 class StorageCategory:
     CONSENTS = "consents"
     MEDICAL_REPORTS = "medical-reports"
@@ -48,6 +134,8 @@ class StorageCategory:
     EXPENSES = "expenses"
     STAFF = "staff"
     BRANDING = "branding"
+    XRAYS = "xrays"
+    EXPORTS = "exports"
 
 def get_r2_path(clinic_id: int, patient_id: Optional[int] = None, category: str = StorageCategory.DOCUMENTS, filename: str = "") -> str:
     """
@@ -67,6 +155,11 @@ def get_r2_path(clinic_id: int, patient_id: Optional[int] = None, category: str
             
     return f"{base}/{filename}" if filename else base
 
+def is_r2_key(path: Optional[str]) -> bool:
+    """True for a bucket key laid out by get_r2_path, as opposed to a path on
+    the API host's disk (the older X-ray and patient-file uploads)."""
+    return bool(path) and path.startswith("clinics/")
+
 def extract_r2_key(key_or_url: str) -> Optional[str]:
     """The bucket-relative object key behind a stored value.
 
@@ -104,15 +197,42 @@ def extract_r2_key(key_or_url: str) -> Optional[str]:
     return key or None
 
 
+# Presigned URLs are reused rather than re-signed on every call. The list
+# endpoints sign once per file per page load, so a patient with a few hundred
+# radiographs paid a few hundred signing operations each visit — and a fresh
+# signature also gave the same object a new URL every time, which defeats the
+# browser cache. A signature is reused for a quarter of its lifetime, so every
+# URL handed out still has at least three quarters of the requested validity.
+PRESIGN_REUSE_FRACTION = 4
+
+
+def presign_bucket(expires_in: int, now: Optional[float] = None) -> int:
+    """The reuse window `now` falls in for signatures of this lifetime."""
+    window = max(expires_in // PRESIGN_REUSE_FRACTION, 1)
+    return int((time.time() if now is None else now) // window)
+
+
+@lru_cache(maxsize=8192)
+def _signed_get_url(key: str, expires_in: int, bucket: int) -> str:
+    # `bucket` is only part of the cache key: moving to the next window is
+    # what forces a new signature.
+    return _get_r2_client().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': os.getenv("R2_BUCKET_NAME"), 'Key': key},
+        ExpiresIn=expires_in
+    )
+
+
 def get_presigned_url(key_or_url: str, expires_in: int = 604800) -> Optional[str]:
-    """Generate a presigned GET URL for an R2 object (key or full API URL)"""
+    """Generate a presigned GET URL for an R2 object (key or full API URL).
+
+    Cached per (key, lifetime, reuse window); see PRESIGN_REUSE_FRACTION."""
     if not key_or_url: return None
 
     try:
         client = _get_r2_client()
         if not client: return key_or_url
 
-        bucket_name = os.getenv("R2_BUCKET_NAME")
         r2_public_url = os.getenv("R2_PUBLIC_URL")
 
         # If it's already a public URL, just return it
@@ -123,12 +243,8 @@ def get_presigned_url(key_or_url: str, expires_in: int = 604800) -> Optional[str
 
         if r2_public_url:
             return f"{r2_public_url.rstrip('/')}/{key}"
-            
-        return client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket_name, 'Key': key},
-            ExpiresIn=expires_in
-        )
+
+        return _signed_get_url(key, expires_in, presign_bucket(expires_in))
     except Exception as e:
         print(f"Error generating presigned URL: {e}")
         return key_or_url
@@ -151,7 +267,7 @@ def upload_pdf_to_r2(file_path: str, filename: str, clinic_id: Optional[int] = N
             storage_path = f"legacy/{category}/{filename}"
         
         print(f"Uploading {filename} to R2: {storage_path}")
-        with open(file_path, 'rb') as file:
+        with open(file_path, 'rb') as file, _timed("upload", os.path.getsize(file_path)):
             client.upload_fileobj(
                 file,
                 bucket_name,
@@ -182,12 +298,13 @@ def upload_bytes_to_r2(data: bytes, filename: str, content_type: str, clinic_id:
         else:
             storage_path = f"legacy/{category}/{filename}"
             
-        client.put_object(
-            Body=data,
-            Bucket=bucket_name,
-            Key=storage_path,
-            ContentType=content_type
-        )
+        with _timed("upload", len(data)):
+            client.put_object(
+                Body=data,
+                Bucket=bucket_name,
+                Key=storage_path,
+                ContentType=content_type
+            )
         
         # Return the relative path (key)
         return storage_path
@@ -201,7 +318,8 @@ def delete_file_from_r2(storage_path: str) -> bool:
     try:
         client = _get_r2_client()
         if not client: return False
-        client.delete_object(Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path)
+        with _timed("delete"):
+            client.delete_object(Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path)
         return True
     except Exception as e:
         print(f"Error deleting from R2: {e}")
@@ -214,12 +332,32 @@ def put_bytes_to_key(storage_path: str, data: bytes, content_type: str = "applic
         client = _get_r2_client()
         if not client:
             return False
-        client.put_object(Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path, Body=data, ContentType=content_type)
+        with _timed("upload", len(data)):
+            client.put_object(Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path, Body=data, ContentType=content_type)
         return True
     except Exception as e:
         print(f"Error writing to R2: {e}")
         return False
 
+def put_fileobj_to_key(storage_path: str, fileobj, content_type: str = "application/octet-stream") -> bool:
+    """Stream an open binary file to an explicit R2 key without reading it
+    into memory. boto3's managed transfer switches to a multipart upload for
+    large files. Reads from the file's current position to its end."""
+    try:
+        client = _get_r2_client()
+        if not client:
+            return False
+        start = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END) - start
+        fileobj.seek(start)
+        with _timed("upload", size):
+            client.upload_fileobj(fileobj, os.getenv("R2_BUCKET_NAME"), storage_path,
+                                  ExtraArgs={"ContentType": content_type})
+        return True
+    except Exception as e:
+        print(f"Error streaming to R2: {e}")
+        return False
+
 def download_bytes_from_r2(storage_path: str) -> Optional[bytes]:
     """Fetch an object's raw bytes from R2 server-side.
 
@@ -229,12 +367,127 @@ def download_bytes_from_r2(storage_path: str) -> Optional[bytes]:
         client = _get_r2_client()
         if not client:
             return None
-        resp = client.get_object(Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path)
-        return resp["Body"].read()
+        with _timed("download") as stat:
+            resp = client.get_object(Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path)
+            data = resp["Body"].read()
+            stat["bytes"] = len(data)
+        return data
     except Exception as e:
         print(f"Error downloading from R2: {e}")
         return None
 
+def head_r2_object(storage_path: str) -> Optional[dict]:
+    """Size and content type of an object, without fetching its body.
+
+    Returns {"size": int, "content_type": str | None}, or None when the object
+    is missing or storage is not configured."""
+    try:
+        client = _get_r2_client()
+        if not client:
+            return None
+        with _timed("head"):
+            resp = client.head_object(Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path)
+        return {"size": int(resp["ContentLength"]), "content_type": resp.get("ContentType")}
+    except Exception as e:
+        print(f"Error reading R2 object metadata: {e}")
+        return None
+
+def open_r2_stream(storage_path: str, start: Optional[int] = None, end: Optional[int] = None):
+    """Open an object for streaming, optionally limited to the inclusive byte
+    range [start, end].
+
+    Returns botocore's StreamingBody (iterate with `iter_chunks`) without
+    reading it, so a multi-hundred-MB study never has to sit in worker memory.
+    The caller owns the body and must close it. None on failure. Metrics
+    count the bytes R2 agreed to send and the time to the first byte."""
+    try:
+        client = _get_r2_client()
+        if not client:
+            return None
+        params = {"Bucket": os.getenv("R2_BUCKET_NAME"), "Key": storage_path}
+        if start is not None:
+            params["Range"] = f"bytes={start}-{'' if end is None else end}"
+        with _timed("stream") as stat:
+            resp = client.get_object(**params)
+            stat["bytes"] = int(resp.get("ContentLength") or 0)
+        return resp["Body"]
+    except Exception as e:
+        print(f"Error opening R2 stream: {e}")
+        return None
+
+# ─── Direct (browser-to-R2) multipart uploads ────────────────────────────────
+# The API only brokers these: it opens the upload, signs one URL per part and
+# completes it. The bytes go from the client straight to R2. The bucket's CORS
+# policy must allow PUT from the app origins and expose the ETag header, which
+# the client reads back from each part response.
+
+def create_multipart_upload(storage_path: str, content_type: str) -> Optional[str]:
+    """Open a multipart upload at an explicit key; returns its UploadId."""
+    try:
+        client = _get_r2_client()
+        if not client:
+            return None
+        resp = client.create_multipart_upload(
+            Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path, ContentType=content_type
+        )
+        return resp["UploadId"]
+    except Exception as e:
+        print(f"Error creating R2 multipart upload: {e}")
+        return None
+
+def presign_upload_part(storage_path: str, upload_id: str, part_number: int, expires_in: int = 3600) -> Optional[str]:
+    """Presigned PUT URL for one part of a multipart upload."""
+    try:
+        client = _get_r2_client()
+        if not client:
+            return None
+        return client.generate_presigned_url(
+            'upload_part',
+            Params={
+                'Bucket': os.getenv("R2_BUCKET_NAME"),
+                'Key': storage_path,
+                'UploadId': upload_id,
+                'PartNumber': part_number,
+            },
+            ExpiresIn=expires_in
+        )
+    except Exception as e:
+        print(f"Error presigning R2 upload part: {e}")
+        return None
+
+def complete_multipart_upload(storage_path: str, upload_id: str, parts: list) -> bool:
+    """Stitch uploaded parts into the final object.
+
+    `parts` is [{"PartNumber": int, "ETag": str}, ...] in ascending order."""
+    try:
+        client = _get_r2_client()
+        if not client:
+            return False
+        client.complete_multipart_upload(
+            Bucket=os.getenv("R2_BUCKET_NAME"),
+            Key=storage_path,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        return True
+    except Exception as e:
+        print(f"Error completing R2 multipart upload: {e}")
+        return False
+
+def abort_multipart_upload(storage_path: str, upload_id: str) -> bool:
+    """Discard an unfinished multipart upload and any parts already stored."""
+    try:
+        client = _get_r2_client()
+        if not client:
+            return False
+        client.abort_multipart_upload(
+            Bucket=os.getenv("R2_BUCKET_NAME"), Key=storage_path, UploadId=upload_id
+        )
+        return True
+    except Exception as e:
+        print(f"Error aborting R2 multipart upload: {e}")
+        return False
+
 def list_files_in_prefix(prefix: str) -> list:
     """List files in R2 by prefix"""
     try:
@@ -257,3 +510,48 @@ def create_bucket_if_not_exists(bucket_name: str = None) -> bool:
     except Exception:
         return False
 
+
+# ─── Async facade ────────────────────────────────────────────────────────────
+# boto3 blocks, so async callers used to either stall the event loop or build
+# their own client inside run_in_executor. These run the functions above on a
+# worker thread instead: same pooled client, same retries, same metrics.
+
+async def upload_bytes_to_r2_async(data: bytes, filename: str, content_type: str, clinic_id: Optional[int] = None, patient_id: Optional[int] = None, category: str = StorageCategory.DOCUMENTS) -> Optional[str]:
+    return await asyncio.to_thread(upload_bytes_to_r2, data, filename, content_type, clinic_id, patient_id, category)
+
+async def upload_pdf_to_r2_async(file_path: str, filename: str, clinic_id: Optional[int] = None, patient_id: Optional[int] = None, category: str = StorageCategory.MEDICAL_REPORTS) -> Optional[str]:
+    return await asyncio.to_thread(upload_pdf_to_r2, file_path, filename, clinic_id, patient_id, category)
+
+async def put_bytes_to_key_async(storage_path: str, data: bytes, content_type: str = "application/octet-stream") -> bool:
+    return await asyncio.to_thread(put_bytes_to_key, storage_path, data, content_type)
+
+async def put_fileobj_to_key_async(storage_path: str, fileobj, content_type: str = "application/octet-stream") -> bool:
+    return await asyncio.to_thread(put_fileobj_to_key, storage_path, fileobj, content_type)
+
+async def download_bytes_from_r2_async(storage_path: str) -> Optional[bytes]:
+    return await asyncio.to_thread(download_bytes_from_r2, storage_path)
+
+async def head_r2_object_async(storage_path: str) -> Optional[dict]:
+    return await asyncio.to_thread(head_r2_object, storage_path)
+
+async def delete_file_from_r2_async(storage_path: str) -> bool:
+    return await asyncio.to_thread(delete_file_from_r2, storage_path)
+
+async def open_r2_stream_async(storage_path: str, start: Optional[int] = None, end: Optional[int] = None):
+    return await asyncio.to_thread(open_r2_stream, storage_path, start, end)
+
+async def iter_r2_body(body, chunk_bytes: int, on_close: Optional[Callable[[], None]] = None):
+    """Yield a body from `open_r2_stream` in chunks, each read on a worker
+    thread, then close it and call `on_close`, also when the consumer stops
+    early (a client that disconnects half way through a download)."""
+    chunks = body.iter_chunks(chunk_bytes)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        body.close()
+        if on_close is not None:
+            on_close()
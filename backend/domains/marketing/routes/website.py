@@ -259,8 +259,9 @@ def og_image(slug: str, db: Session = Depends(get_db)):
     The Open Graph tag cannot point at a presigned R2 URL: those expire, so
     every WhatsApp and Facebook share would render a broken image a few hours
     after it was posted, which is precisely the failure the tag exists to
-    prevent. This URL never changes and redirects to a freshly signed one on
-    each request.
+    prevent. This URL never changes and redirects to a signed one, which the
+    presigned-URL cache reuses across requests (crawlers hit this hard when a
+    link is shared), so the redirect itself can be cached for a while.
 
     Public on purpose. It resolves a published clinic's first photo and
     nothing else, which is already visible to anyone who opens the site.
@@ -280,7 +281,11 @@ def og_image(slug: str, db: Session = Depends(get_db)):
     target = get_presigned_url(photo.file_path) if photo else (clinic.logo_url or "")
     if not target:
         raise HTTPException(status_code=404, detail="No image")
-    return RedirectResponse(url=target, status_code=302)
+    # An hour is far inside the signature's remaining life, which the cache
+    # keeps above three quarters of the default week.
+    return RedirectResponse(
+        url=target, status_code=302, headers={"Cache-Control": "public, max-age=3600"}
+    )
 
 
 @router.get("/preview", response_class=Response)
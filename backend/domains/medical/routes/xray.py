@@ -1,9 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, status, UploadFile, File, Form
 from sqlalchemy.orm import Session
 from database import get_db
 from models import XrayImage, Patient, Appointment, User
 from schemas import XrayImageCreate, XrayImageOut
 from core.auth_utils import get_current_user
+from domains.document.services.previews import build_xray_previews, PREVIEW_SIZES
+from domains.infrastructure.services.r2_storage import delete_file_from_r2, get_presigned_url, is_r2_key
 from typing import List, Optional
 import os
 import shutil
@@ -18,6 +20,7 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 @router.post("/upload", response_model=XrayImageOut, status_code=status.HTTP_201_CREATED)
 async def upload_xray_image(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     patient_id: int = Form(...),
     appointment_id: Optional[int] = Form(None),
@@ -91,6 +94,8 @@ async def upload_xray_image(
         db.add(xray_image)
         db.commit()
         db.refresh(xray_image)
+        # Thumbnail and viewer preview are rendered after the response is sent.
+        background_tasks.add_task(build_xray_previews, xray_image.id)
         
         # Enrich with patient name
         result = XrayImageOut(
@@ -156,6 +161,8 @@ def get_patient_xrays(
             updated_at=getattr(xray, 'updated_at', xray.created_at),
             synced_at=getattr(xray, 'synced_at', None),
             sync_status=getattr(xray, 'sync_status', 'local'),
+            thumbnail_key=xray.thumbnail_key,
+            preview_key=xray.preview_key,
             patient_name=patient.name
         ))
     
@@ -208,6 +215,8 @@ def get_appointment_xrays(
             updated_at=getattr(xray, 'updated_at', xray.created_at),
             synced_at=getattr(xray, 'synced_at', None),
             sync_status=getattr(xray, 'sync_status', 'local'),
+            thumbnail_key=xray.thumbnail_key,
+            preview_key=xray.preview_key,
             patient_name=patient.name
         ))
     
@@ -229,9 +238,12 @@ def delete_xray_image(
         raise HTTPException(status_code=404, detail="X-ray image not found")
     
     try:
-        # Delete file from filesystem
-        if os.path.exists(xray_image.file_path):
-            os.remove(xray_image.file_path)
+        # Delete file (and its rendered previews) from R2 or the filesystem
+        for path in (xray_image.file_path, xray_image.thumbnail_key, xray_image.preview_key):
+            if path and is_r2_key(path):
+                delete_file_from_r2(path)
+            elif path and os.path.exists(path):
+                os.remove(path)
         
         # Delete database record
         db.delete(xray_image)
@@ -250,7 +262,7 @@ def download_xray_image(
     current_user = Depends(get_current_user)
 ):
     """Download an X-ray image file"""
-    from fastapi.responses import FileResponse
+    from fastapi.responses import FileResponse, RedirectResponse
     
     xray_image = db.query(XrayImage).filter(
         XrayImage.id == xray_id,
@@ -260,6 +272,10 @@ def download_xray_image(
     if not xray_image:
         raise HTTPException(status_code=404, detail="X-ray image not found")
     
+    # Direct uploads live in R2; send the client there instead of proxying
+    if is_r2_key(xray_image.file_path):
+        return RedirectResponse(get_presigned_url(xray_image.file_path, expires_in=3600))
+
     if not os.path.exists(xray_image.file_path):
         raise HTTPException(status_code=404, detail="X-ray file not found on server")
     
@@ -269,6 +285,39 @@ def download_xray_image(
         media_type='application/dicom'
     )
 
+@router.get("/{xray_id}/preview/{size}")
+def get_xray_preview(
+    xray_id: int,
+    size: str,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Serve the WebP thumbnail or viewer preview rendered at upload time"""
+    from fastapi.responses import FileResponse, RedirectResponse
+
+    if size not in PREVIEW_SIZES:
+        raise HTTPException(status_code=404, detail="Unknown preview size")
+
+    xray_image = db.query(XrayImage).filter(
+        XrayImage.id == xray_id,
+        XrayImage.clinic_id == current_user.clinic_id
+    ).first()
+
+    if not xray_image:
+        raise HTTPException(status_code=404, detail="X-ray image not found")
+
+    path = xray_image.thumbnail_key if size == "thumb" else xray_image.preview_key
+    if path and is_r2_key(path):
+        return RedirectResponse(get_presigned_url(path, expires_in=3600))
+    if not path or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Preview not generated yet")
+
+    return FileResponse(
+        path=path,
+        media_type='image/webp',
+        headers={"Cache-Control": "private, max-age=86400"}
+    )
+
 @router.get("/{xray_id}", response_model=XrayImageOut)
 def get_xray_image(
     xray_id: int,
@@ -300,5 +349,7 @@ def get_xray_image(
         notes=xray_image.notes,
         created_by=xray_image.created_by,
         created_at=xray_image.created_at,
+        thumbnail_key=xray_image.thumbnail_key,
+        preview_key=xray_image.preview_key,
         patient_name=patient.name if patient else None
     )
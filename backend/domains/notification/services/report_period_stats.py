@@ -0,0 +1,296 @@
+"""
+Weekly and monthly report figures, stored per clinic and period.
+
+The weekly and monthly broadcasts (core/scheduled_jobs.py) asked
+report_stats_service for each clinic in turn. Each call re-read two periods
+of raw appointments, patients, invoices and reviews, about twenty queries
+per clinic, with every clinic handled in the same hour. A period that has
+ended does not change, so its figures now live in `report_period_stats`.
+There is one row per clinic × kind ('week' | 'month') × period start:
+
+- A period that has ended is computed once from the raw tables and stored as
+  `closed`. A whole batch of clinics is done in a handful of grouped queries.
+  After that the row is only read.
+- The period still running is stored as a tally through `computed_through`.
+  Each top-up adds just the rows dated after that. When the period closes it
+  is computed again in full. So an edit to a row already tallied (a visit
+  later marked no-show) reaches the running figures late, but never a
+  closed one.
+
+`report_period_stats_job` closes the week and month that just ended and tops
+up the current ones every night. The broadcasts `ensure` all their clinics
+before the per-clinic loop, so anything the job has not reached yet is still
+computed in one batch. To recompute a period after a restore or a data fix,
+delete its rows; the next read computes them again.
+
+Period bounds are UTC midnights and `now` is UTC, like the `utcnow` stamps on
+the rows measured. A period closes only once UTC has passed its end, and a
+tally's `computed_through` is a UTC watermark, so rows stamped after a top-up
+are always above it.
+"""
+import datetime as dt
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from sqlalchemy import case, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import Appointment, GoogleReview, Invoice, InvoiceLineItem, Patient, ReportPeriodStat
+from domains.scheduling.appointment_status import CANCELLED, NO_SHOW
+
+WEEK = "week"
+MONTH = "month"
+UNBILLED = ("draft", "cancelled")
+CLINIC_BATCH = 500
+
+POSITIVE_THEMES = [
+    ("Friendly staff", ["friendly", "staff", "team", "helpful", "polite", "kind"]),
+    ("Clean clinic", ["clean", "hygienic", "neat", "tidy", "sanitized"]),
+    ("Quick service", ["quick", "fast", "prompt", "efficient", "wait"]),
+    ("Painless treatment", ["painless", "comfortable", "gentle", "no pain"]),
+    ("Good doctor", ["doctor", "dentist", "expertise", "skilled", "knowledgeable"]),
+    ("Affordable", ["affordable", "price", "cost", "value", "cheap"]),
+]
+
+NEGATIVE_THEMES = [
+    ("Waiting time", ["wait", "slow", "late", "delay", "long"]),
+    ("Communication", ["communication", "response", "inform", "update"]),
+    ("Billing", ["billing", "bill", "overcharge", "expensive"]),
+]
+
+Key = Tuple[int, str, dt.date]
+_CLOSED = "report_period_stats_closed"
+
+
+@dataclass(frozen=True)
+class Period:
+    kind: str
+    start: dt.date
+    end: dt.date  # exclusive
+
+    def bounds(self) -> Tuple[dt.datetime, dt.datetime]:
+        return dt.datetime.combine(self.start, dt.time.min), dt.datetime.combine(self.end, dt.time.min)
+
+
+def week(start: dt.date) -> Period:
+    """The seven days from `start`."""
+    return Period(WEEK, start, start + dt.timedelta(days=7))
+
+
+def month(day: dt.date) -> Period:
+    """The calendar month `day` falls in."""
+    start = day.replace(day=1)
+    return Period(MONTH, start, (start + dt.timedelta(days=32)).replace(day=1))
+
+
+def match_themes(reviews: Iterable[str], themes: list) -> List[str]:
+    """The theme labels any of `reviews` mentions, in `themes` order."""
+    texts = [r.lower() for r in reviews]
+    return [label for label, keywords in themes
+            if any(kw in t for t in texts for kw in keywords)]
+
+
+# ── Measuring ────────────────────────────────────────────────────────────────
+
+def _empty(kind: str) -> dict:
+    figures = {"appointments": 0, "noshows": 0, "new_patients": 0, "revenue": 0.0}
+    if kind == MONTH:
+        figures.update(visited_patients=0, treatments=[], new_reviews=0, loved=[], watch=[])
+    return figures
+
+
+def _visited(db: Session, clinic_ids: Sequence[int], start: dt.datetime, end: dt.datetime) -> Dict[int, int]:
+    return dict(
+        db.query(Appointment.clinic_id, func.count(func.distinct(Appointment.patient_id)))
+        .filter(Appointment.clinic_id.in_(clinic_ids), Appointment.appointment_date >= start,
+                Appointment.appointment_date < end, Appointment.status != CANCELLED,
+                Appointment.patient_id.isnot(None))
+        .group_by(Appointment.clinic_id).all()
+    )
+
+
+def measure(db: Session, clinic_ids: Sequence[int], kind: str,
+            start: dt.datetime, end: dt.datetime) -> Dict[int, dict]:
+    """The figures of [start, end) for each clinic, from the raw tables, in
+    one grouped query per measure whatever the number of clinics."""
+    out = {cid: _empty(kind) for cid in clinic_ids}
+
+    for cid, appointments, noshows in (
+        db.query(Appointment.clinic_id, func.count(Appointment.id),
+                 func.sum(case((Appointment.status == NO_SHOW, 1), else_=0)))
+        .filter(Appointment.clinic_id.in_(clinic_ids), Appointment.appointment_date >= start,
+                Appointment.appointment_date < end, Appointment.status != CANCELLED)
+        .group_by(Appointment.clinic_id)
+    ):
+        out[cid]["appointments"], out[cid]["noshows"] = appointments, int(noshows or 0)
+
+    for cid, n in (
+        db.query(Patient.clinic_id, func.count(Patient.id))
+        .filter(Patient.clinic_id.in_(clinic_ids), Patient.created_at >= start, Patient.created_at < end)
+        .group_by(Patient.clinic_id)
+    ):
+        out[cid]["new_patients"] = n
+
+    billed = (Invoice.clinic_id.in_(clinic_ids), Invoice.finalized_at >= start,
+              Invoice.finalized_at < end, Invoice.status.notin_(UNBILLED))
+    for cid, revenue in (
+        db.query(Invoice.clinic_id, func.sum(Invoice.total)).filter(*billed).group_by(Invoice.clinic_id)
+    ):
+        out[cid]["revenue"] = float(revenue or 0.0)
+
+    if kind != MONTH:
+        return out
+
+    for cid, n in _visited(db, clinic_ids, start, end).items():
+        out[cid]["visited_patients"] = n
+
+    treatments: Dict[int, Counter] = {cid: Counter() for cid in clinic_ids}
+    for cid, description, n in (
+        db.query(Invoice.clinic_id, InvoiceLineItem.description, func.count(InvoiceLineItem.id))
+        .join(Invoice, Invoice.id == InvoiceLineItem.invoice_id).filter(*billed)
+        .group_by(Invoice.clinic_id, InvoiceLineItem.description)
+    ):
+        if description:
+            treatments[cid][description] += n
+    for cid, counts in treatments.items():
+        out[cid]["treatments"] = _ranked(counts)
+
+    praise: Dict[int, List[str]] = {cid: [] for cid in clinic_ids}
+    complaints: Dict[int, List[str]] = {cid: [] for cid in clinic_ids}
+    for cid, rating, text in (
+        db.query(GoogleReview.clinic_id, GoogleReview.rating, GoogleReview.text)
+        .filter(GoogleReview.clinic_id.in_(clinic_ids), GoogleReview.review_time >= start,
+                GoogleReview.review_time < end)
+    ):
+        out[cid]["new_reviews"] += 1
+        if rating >= 4:
+            praise[cid].append(text or "")
+        elif rating <= 3:
+            complaints[cid].append(text or "")
+    for cid in clinic_ids:
+        out[cid]["loved"] = match_themes(praise[cid], POSITIVE_THEMES)
+        out[cid]["watch"] = match_themes(complaints[cid], NEGATIVE_THEMES)
+    return out
+
+
+def _ranked(counts: Counter) -> List[list]:
+    return [[name, n] for name, n in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))]
+
+
+def _themes_union(a: List[str], b: List[str], themes: list) -> List[str]:
+    both = set(a) | set(b)
+    return [label for label, _ in themes if label in both]
+
+
+def combine(total: dict, part: dict) -> dict:
+    """`total` with the figures of a later slice added. `visited_patients`
+    (distinct patients) does not add up and is left for the caller."""
+    out = dict(total)
+    for k in ("appointments", "noshows", "new_patients", "revenue", "new_reviews"):
+        if k in part:
+            out[k] = total.get(k, 0) + part[k]
+    if "treatments" in part:
+        counts = Counter(dict(total.get("treatments") or []))
+        counts.update(dict(part["treatments"]))
+        out["treatments"] = _ranked(counts)
+        out["loved"] = _themes_union(total.get("loved") or [], part["loved"], POSITIVE_THEMES)
+        out["watch"] = _themes_union(total.get("watch") or [], part["watch"], NEGATIVE_THEMES)
+    return out
+
+
+# ── Storing ──────────────────────────────────────────────────────────────────
+
+def _write(db: Session, rows: List[dict]) -> None:
+    if not rows:
+        return
+    conn = db.connection()
+    dialect = postgresql if conn.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(ReportPeriodStat.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["clinic_id", "kind", "period_start"],
+        set_={c: stmt.excluded[c] for c in ("period_end", "measures", "closed", "computed_through", "computed_at")},
+    )
+    conn.execute(stmt, rows)
+
+
+def _row(cid: int, period: Period, figures: dict, closed: bool, through: dt.datetime) -> dict:
+    return {"clinic_id": cid, "kind": period.kind, "period_start": period.start, "period_end": period.end,
+            "measures": figures, "closed": closed, "computed_through": through,
+            "computed_at": dt.datetime.utcnow()}
+
+
+def ensure(db: Session, clinic_ids: Sequence[int], periods: Sequence[Period],
+           now: dt.datetime) -> Dict[Key, ReportPeriodStat]:
+    """The rows for every clinic × period, as of `now` (naive UTC).
+
+    Missing rows and rows for periods that have ended since they were
+    tallied are computed in full; open rows are topped up from their
+    `computed_through`. Runs in the caller's transaction and does not commit.
+    """
+    found: Dict[Key, ReportPeriodStat] = {}
+    clinic_ids = list(dict.fromkeys(clinic_ids))
+    for i in range(0, len(clinic_ids), CLINIC_BATCH):
+        batch = clinic_ids[i:i + CLINIC_BATCH]
+        for period in periods:
+            found.update(_ensure_batch(db, batch, period, now))
+    # Closed figures never change: keep them on the session so the per-clinic
+    # reads that follow (even after a commit has expired the rows) are free.
+    db.info.setdefault(_CLOSED, {}).update(
+        {key: dict(row.measures) for key, row in found.items() if row.closed})
+    return found
+
+
+def _ensure_batch(db: Session, clinic_ids: List[int], period: Period,
+                  now: dt.datetime) -> Dict[Key, ReportPeriodStat]:
+    def load():
+        return {
+            (r.clinic_id, r.kind, r.period_start): r
+            for r in db.query(ReportPeriodStat).populate_existing().filter(
+                ReportPeriodStat.clinic_id.in_(clinic_ids), ReportPeriodStat.kind == period.kind,
+                ReportPeriodStat.period_start == period.start)
+        }
+
+    rows = load()
+    start, end = period.bounds()
+    closed = end <= now
+    # A period that has not started yet is an empty tally from its start, so
+    # the first top-up does not reach back into the period before it.
+    through = max(start, min(end, now))
+
+    fresh, topped = [], {}
+    for cid in clinic_ids:
+        row = rows.get((cid, period.kind, period.start))
+        if row is None or (closed and not row.closed):
+            fresh.append(cid)
+        elif not row.closed and row.computed_through < through:
+            topped.setdefault(row.computed_through, []).append(row)
+
+    writes = []
+    if fresh:
+        for cid, figures in measure(db, fresh, period.kind, start, through).items():
+            writes.append(_row(cid, period, figures, closed, through))
+    for since, stale in topped.items():
+        ids = [r.clinic_id for r in stale]
+        slices = measure(db, ids, period.kind, since, through)
+        visited = _visited(db, ids, start, through) if period.kind == MONTH else {}
+        for r in stale:
+            figures = combine(r.measures, slices[r.clinic_id])
+            if period.kind == MONTH:
+                figures["visited_patients"] = visited.get(r.clinic_id, 0)
+            writes.append(_row(r.clinic_id, period, figures, False, through))
+    if not writes:
+        return rows
+    _write(db, writes)
+    return load()
+
+
+def stored(db: Session, clinic_id: int, period: Period, now: dt.datetime) -> dict:
+    """One clinic's figures for `period`: from the session when a broadcast
+    has already ensured them, else through `ensure`."""
+    key = (clinic_id, period.kind, period.start)
+    figures = db.info.get(_CLOSED, {}).get(key)
+    if figures is None:
+        figures = ensure(db, [clinic_id], [period], now)[key].measures
+    return dict(figures)
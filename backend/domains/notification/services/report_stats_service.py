@@ -3,16 +3,20 @@ Report stats service — computes real DB stats for weekly/monthly/review WA rep
 
 Each function returns a dict whose keys map 1-to-1 to the template body params.
 All date arithmetic uses UTC; caller passes `today` as a date object.
+
+The figures themselves are read from `report_period_stats`
+(report_period_stats.py), which keeps them per clinic and period; this module
+only picks the periods and formats them. A broadcast should `prepare_*` all
+its clinics first so the per-clinic calls are answered from the session.
 """
 
 import datetime as dt
-from collections import Counter
-from typing import Optional
+from typing import Optional, Sequence
 
-from sqlalchemy import func
 from sqlalchemy.orm import Session
 
-from models import Appointment, Invoice, InvoiceLineItem, Patient, GooglePlaceLink, GoogleReview
+from models import GooglePlaceLink
+from domains.notification.services import report_period_stats as stats
 
 
 def _fmt_change(current: float, previous: float) -> str:
@@ -54,6 +58,38 @@ def _month_bounds(month_offset: int, today: dt.date) -> tuple[dt.datetime, dt.da
     return start, end
 
 
+# ─── Periods ──────────────────────────────────────────────────────────────────
+
+def _as_of(today: dt.date) -> dt.datetime:
+    """Midnight of `today`, but never later than UTC now.
+
+    The broadcasts pass an IST date, whose midnight is 5.5 h ahead of UTC;
+    a period must not close before UTC has actually reached its end.
+    """
+    return min(dt.datetime.combine(today, dt.time.min), dt.datetime.utcnow())
+
+
+def _weeks(today: dt.date) -> tuple[stats.Period, stats.Period]:
+    """The week `_week_bounds` reports on and the week before it."""
+    w_start = _week_bounds(today)[0].date()
+    return stats.week(w_start), stats.week(w_start - dt.timedelta(days=7))
+
+
+def _months(today: dt.date) -> tuple[stats.Period, stats.Period]:
+    """Last completed month and the month before that."""
+    return stats.month(_month_bounds(1, today)[0].date()), stats.month(_month_bounds(2, today)[0].date())
+
+
+def prepare_weekly_stats(db: Session, clinic_ids: Sequence[int], today: dt.date) -> None:
+    """Compute whatever weekly figures these clinics are missing, in batch."""
+    stats.ensure(db, clinic_ids, _weeks(today), _as_of(today))
+
+
+def prepare_monthly_stats(db: Session, clinic_ids: Sequence[int], today: dt.date) -> None:
+    """Compute whatever monthly and review figures these clinics are missing, in batch."""
+    stats.ensure(db, clinic_ids, _months(today), _as_of(today))
+
+
 # ─── Weekly stats ─────────────────────────────────────────────────────────────
 
 def get_weekly_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
@@ -62,64 +98,13 @@ def get_weekly_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
       week_date, appointments, appt_change, new_patients, patients_change,
       revenue, revenue_change, noshows, insight
     """
-    w_start, w_end = _week_bounds(today)
-    pw_start = w_start - dt.timedelta(days=7)
-    pw_end = w_start
-
-    def appt_count(start, end):
-        return (
-            db.query(func.count(Appointment.id))
-            .filter(
-                Appointment.clinic_id == clinic_id,
-                Appointment.appointment_date >= start,
-                Appointment.appointment_date < end,
-                Appointment.status != "cancelled",
-            )
-            .scalar() or 0
-        )
-
-    def noshow_count(start, end):
-        return (
-            db.query(func.count(Appointment.id))
-            .filter(
-                Appointment.clinic_id == clinic_id,
-                Appointment.appointment_date >= start,
-                Appointment.appointment_date < end,
-                Appointment.status == "no-show",
-            )
-            .scalar() or 0
-        )
-
-    def new_patient_count(start, end):
-        return (
-            db.query(func.count(Patient.id))
-            .filter(
-                Patient.clinic_id == clinic_id,
-                Patient.created_at >= start,
-                Patient.created_at < end,
-            )
-            .scalar() or 0
-        )
-
-    def revenue_sum(start, end):
-        return (
-            db.query(func.coalesce(func.sum(Invoice.total), 0.0))
-            .filter(
-                Invoice.clinic_id == clinic_id,
-                Invoice.finalized_at >= start,
-                Invoice.finalized_at < end,
-                Invoice.status.notin_(["draft", "cancelled"]),
-            )
-            .scalar() or 0.0
-        )
-
-    appts = appt_count(w_start, w_end)
-    prev_appts = appt_count(pw_start, pw_end)
-    new_pts = new_patient_count(w_start, w_end)
-    prev_new_pts = new_patient_count(pw_start, pw_end)
-    rev = revenue_sum(w_start, w_end)
-    prev_rev = revenue_sum(pw_start, pw_end)
-    noshows = noshow_count(w_start, w_end)
+    this_week, last_week = _weeks(today)
+    cur = stats.stored(db, clinic_id, this_week, _as_of(today))
+    prev = stats.stored(db, clinic_id, last_week, _as_of(today))
+
+    appts, prev_appts = cur["appointments"], prev["appointments"]
+    new_pts, prev_new_pts = cur["new_patients"], prev["new_patients"]
+    rev, prev_rev = cur["revenue"], prev["revenue"]
 
     # Simple insight string
     if appts >= prev_appts and rev >= prev_rev:
@@ -129,7 +114,7 @@ def get_weekly_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
     else:
         insight = "Mixed results — check details."
 
-    week_label = w_start.strftime("%d %b %Y")
+    week_label = this_week.start.strftime("%d %b %Y")
 
     return {
         "week_date": week_label,
@@ -139,7 +124,7 @@ def get_weekly_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
         "patients_change": _fmt_change(new_pts, prev_new_pts),
         "revenue": f"{rev:,.0f}",
         "revenue_change": _fmt_change(rev, prev_rev),
-        "noshows": str(noshows),
+        "noshows": str(cur["noshows"]),
         "insight": insight,
     }
 
@@ -152,95 +137,23 @@ def get_monthly_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
       month, total_patients, new_patients, returning_patients, total_revenue,
       avg_revenue, change, top_treatments, noshows, noshows_pct
     """
-    m_start, m_end = _month_bounds(1, today)   # last completed month
-    pm_start, pm_end = _month_bounds(2, today)  # month before that
-    month_label = m_start.strftime("%B %Y")
-
-    total_appts = (
-        db.query(func.count(Appointment.id))
-        .filter(
-            Appointment.clinic_id == clinic_id,
-            Appointment.appointment_date >= m_start,
-            Appointment.appointment_date < m_end,
-            Appointment.status != "cancelled",
-        )
-        .scalar() or 0
-    )
-
-    noshows = (
-        db.query(func.count(Appointment.id))
-        .filter(
-            Appointment.clinic_id == clinic_id,
-            Appointment.appointment_date >= m_start,
-            Appointment.appointment_date < m_end,
-            Appointment.status == "no-show",
-        )
-        .scalar() or 0
-    )
-
-    new_pts = (
-        db.query(func.count(Patient.id))
-        .filter(
-            Patient.clinic_id == clinic_id,
-            Patient.created_at >= m_start,
-            Patient.created_at < m_end,
-        )
-        .scalar() or 0
-    )
-
+    this_month, last_month = _months(today)
+    cur = stats.stored(db, clinic_id, this_month, _as_of(today))
+    prev = stats.stored(db, clinic_id, last_month, _as_of(today))
+    month_label = this_month.start.strftime("%B %Y")
+
+    total_appts = cur["appointments"]
+    noshows = cur["noshows"]
+    new_pts = cur["new_patients"]
     # Total unique patients who had an appointment this month
-    total_pts_rows = (
-        db.query(Appointment.patient_id)
-        .filter(
-            Appointment.clinic_id == clinic_id,
-            Appointment.appointment_date >= m_start,
-            Appointment.appointment_date < m_end,
-            Appointment.status != "cancelled",
-            Appointment.patient_id.isnot(None),
-        )
-        .distinct()
-        .count()
-    )
+    total_pts_rows = cur["visited_patients"]
     returning_pts = max(0, total_pts_rows - new_pts)
-
-    rev = (
-        db.query(func.coalesce(func.sum(Invoice.total), 0.0))
-        .filter(
-            Invoice.clinic_id == clinic_id,
-            Invoice.finalized_at >= m_start,
-            Invoice.finalized_at < m_end,
-            Invoice.status.notin_(["draft", "cancelled"]),
-        )
-        .scalar() or 0.0
-    )
-
-    prev_rev = (
-        db.query(func.coalesce(func.sum(Invoice.total), 0.0))
-        .filter(
-            Invoice.clinic_id == clinic_id,
-            Invoice.finalized_at >= pm_start,
-            Invoice.finalized_at < pm_end,
-            Invoice.status.notin_(["draft", "cancelled"]),
-        )
-        .scalar() or 0.0
-    )
+    rev = cur["revenue"]
 
     avg_rev = round(rev / total_pts_rows) if total_pts_rows else 0
 
     # Top 3 treatments by line item frequency
-    line_items = (
-        db.query(InvoiceLineItem.description)
-        .join(Invoice, Invoice.id == InvoiceLineItem.invoice_id)
-        .filter(
-            Invoice.clinic_id == clinic_id,
-            Invoice.finalized_at >= m_start,
-            Invoice.finalized_at < m_end,
-            Invoice.status.notin_(["draft", "cancelled"]),
-        )
-        .all()
-    )
-    counts = Counter(r[0] for r in line_items if r[0])
-    top3 = [name for name, _ in counts.most_common(3)]
+    top3 = [name for name, _ in cur["treatments"][:3]]
     top_treatments = ", ".join(top3) if top3 else "—"
 
     noshows_pct = round(noshows / total_appts * 100) if total_appts else 0
@@ -252,7 +165,7 @@ def get_monthly_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
         "returning_patients": str(returning_pts),
         "total_revenue": f"{rev:,.0f}",
         "avg_revenue": f"{avg_rev:,.0f}",
-        "change": _fmt_change(rev, prev_rev),
+        "change": _fmt_change(rev, prev["revenue"]),
         "top_treatments": top_treatments,
         "noshows": str(noshows),
         "noshows_pct": str(noshows_pct),
@@ -261,39 +174,17 @@ def get_monthly_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
 
 # ─── Review stats ─────────────────────────────────────────────────────────────
 
-_POSITIVE_KEYWORDS = [
-    ("Friendly staff", ["friendly", "staff", "team", "helpful", "polite", "kind"]),
-    ("Clean clinic", ["clean", "hygienic", "neat", "tidy", "sanitized"]),
-    ("Quick service", ["quick", "fast", "prompt", "efficient", "wait"]),
-    ("Painless treatment", ["painless", "comfortable", "gentle", "no pain"]),
-    ("Good doctor", ["doctor", "dentist", "expertise", "skilled", "knowledgeable"]),
-    ("Affordable", ["affordable", "price", "cost", "value", "cheap"]),
-]
-
-_NEGATIVE_KEYWORDS = [
-    ("Waiting time", ["wait", "slow", "late", "delay", "long"]),
-    ("Communication", ["communication", "response", "inform", "update"]),
-    ("Billing", ["billing", "bill", "overcharge", "expensive"]),
-]
-
-
-def _match_themes(reviews: list[str], theme_list: list[tuple]) -> list[str]:
-    matched = []
-    for label, keywords in theme_list:
-        if any(kw in r.lower() for r in reviews for kw in keywords):
-            matched.append(label)
-    return matched
-
-
 def get_review_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
     """
     Returns dict for molarplus_review_report_mk body params:
       month, rating, new_reviews, change, loved1, loved2, area_to_watch
     """
-    m_start, m_end = _month_bounds(1, today)
-    pm_start, pm_end = _month_bounds(2, today)
-    month_label = m_start.strftime("%B %Y")
+    this_month, last_month = _months(today)
+    cur = stats.stored(db, clinic_id, this_month, _as_of(today))
+    prev = stats.stored(db, clinic_id, last_month, _as_of(today))
+    month_label = this_month.start.strftime("%B %Y")
 
+    # The rating is the profile's live one, not a figure of the month.
     place_link: Optional[GooglePlaceLink] = (
         db.query(GooglePlaceLink)
         .filter(GooglePlaceLink.clinic_id == clinic_id)
@@ -302,27 +193,7 @@ def get_review_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
 
     current_rating = f"{place_link.current_rating:.1f}" if place_link and place_link.current_rating else "—"
 
-    new_reviews = (
-        db.query(func.count(GoogleReview.id))
-        .filter(
-            GoogleReview.clinic_id == clinic_id,
-            GoogleReview.review_time >= m_start,
-            GoogleReview.review_time < m_end,
-        )
-        .scalar() or 0
-    )
-
-    prev_reviews = (
-        db.query(func.count(GoogleReview.id))
-        .filter(
-            GoogleReview.clinic_id == clinic_id,
-            GoogleReview.review_time >= pm_start,
-            GoogleReview.review_time < pm_end,
-        )
-        .scalar() or 0
-    )
-
-    change = _fmt_change(new_reviews, prev_reviews)
+    new_reviews, prev_reviews = cur["new_reviews"], prev["new_reviews"]
     if new_reviews > prev_reviews:
         diff = new_reviews - prev_reviews
         change = f"▲{diff} vs last month"
@@ -332,35 +203,12 @@ def get_review_stats(db: Session, clinic_id: int, today: dt.date) -> dict:
     else:
         change = "Same as last month"
 
-    # Positive + negative theme extraction from this month's review texts
-    review_texts = [
-        r[0] or ""
-        for r in db.query(GoogleReview.text)
-        .filter(
-            GoogleReview.clinic_id == clinic_id,
-            GoogleReview.review_time >= m_start,
-            GoogleReview.review_time < m_end,
-            GoogleReview.rating >= 4,
-        )
-        .all()
-    ]
-
-    pos_themes = _match_themes(review_texts, _POSITIVE_KEYWORDS)
+    # Positive + negative themes from this month's review texts
+    pos_themes = cur["loved"]
     loved1 = pos_themes[0] if len(pos_themes) > 0 else "Overall experience"
     loved2 = pos_themes[1] if len(pos_themes) > 1 else "Treatment quality"
 
-    neg_texts = [
-        r[0] or ""
-        for r in db.query(GoogleReview.text)
-        .filter(
-            GoogleReview.clinic_id == clinic_id,
-            GoogleReview.review_time >= m_start,
-            GoogleReview.review_time < m_end,
-            GoogleReview.rating <= 3,
-        )
-        .all()
-    ]
-    neg_themes = _match_themes(neg_texts, _NEGATIVE_KEYWORDS)
+    neg_themes = cur["watch"]
     area_to_watch = neg_themes[0] if neg_themes else "No issues flagged"
 
     return {
@@ -1,8 +1,8 @@
 """
 Patient Files routes for managing documents, images, X-rays, and DICOM files
 """
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Query, Request
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, UploadFile, File, Form, Query, Request
+from fastapi.responses import FileResponse, RedirectResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from pydantic import BaseModel
@@ -15,6 +15,8 @@ from pathlib import Path
 from database import get_db
 from core.auth_utils import get_current_user, get_jwt_secret, require_patients_view, require_patients_edit
 from models import User, Patient, XrayImage
+from domains.document.services.previews import build_xray_previews
+from domains.infrastructure.services.r2_storage import delete_file_from_r2, get_presigned_url, is_r2_key
 
 router = APIRouter()
 
@@ -45,6 +47,8 @@ class XrayImageResponse(BaseModel):
     contrast: float = None
     notes: str = None
     created_at: datetime
+    thumbnail_key: Optional[str] = None
+    preview_key: Optional[str] = None
 
     class Config:
         from_attributes = True
@@ -295,6 +299,7 @@ async def delete_patient_file(
 @router.post("/{patient_id}/xrays", response_model=XrayImageResponse, status_code=status.HTTP_201_CREATED)
 async def upload_xray_image(
     patient_id: int,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     image_type: str = Form(...),
     capture_date: str = Form(...),
@@ -351,6 +356,7 @@ async def upload_xray_image(
         db.add(xray_image)
         db.commit()
         db.refresh(xray_image)
+        background_tasks.add_task(build_xray_previews, xray_image.id)
         
         return xray_image
         
@@ -424,6 +430,10 @@ async def download_xray_image(
     if not xray:
         raise HTTPException(status_code=404, detail="X-ray not found")
 
+    # Direct uploads live in R2; send the client there instead of proxying
+    if xray.file_path and is_r2_key(xray.file_path):
+        return RedirectResponse(get_presigned_url(xray.file_path, expires_in=3600))
+
     if not xray.file_path or not os.path.exists(xray.file_path):
         raise HTTPException(status_code=404, detail="X-ray file not found")
 
@@ -453,9 +463,12 @@ async def delete_xray_image(
                 detail="X-ray not found"
             )
         
-        # Delete file
-        if os.path.exists(xray.file_path):
-            os.remove(xray.file_path)
+        # Delete file and its rendered previews
+        for path in (xray.file_path, xray.thumbnail_key, xray.preview_key):
+            if path and is_r2_key(path):
+                delete_file_from_r2(path)
+            elif path and os.path.exists(path):
+                os.remove(path)
         
         # Delete database record
         db.delete(xray)
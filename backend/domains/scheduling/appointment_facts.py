@@ -0,0 +1,268 @@
+"""
+Appointment counts kept pre-aggregated for the stats pages and dashboard charts.
+
+The appointment-stats endpoints and the dashboard's trend and quality cards
+each re-read raw appointments for every render, with their own queries, and
+their cost grew with the clinic's history. `appointment_stats_facts` holds one
+row per clinic × day × doctor × status × hour of day, with the count, the
+booked minutes and the lead-time sums. Readers sum a few hundred small rows
+instead of scanning thousands of appointments.
+
+The cube is kept current by the session itself. Before a flush, the stored
+cell of every changed or deleted Appointment is read back, FOR UPDATE, and
+taken off. After the flush, the cell of every new one is added from the
+object and of every changed one from the row as now stored. Both steps run
+in the flush's transaction, so a rollback undoes them too. The lock makes a
+second concurrent edit of the same appointment wait and then read the first
+one's result, and re-reading after the UPDATE counts columns another
+session changed meanwhile, so concurrent edits never retract a cell twice
+or add a stale one. Bulk `query(Appointment)...delete()` and `.update()`
+(and their `delete(Appointment)` / `update(Appointment)` forms) skip the
+flush, so a do_orm_execute hook handles them: the matching rows are taken
+off before the statement runs and, for an update, added back as stored
+after it. No caller has to remember to. If the cube ever drifts, `rebuild`
+recomputes it:
+
+    python scripts/backfill_appointment_facts.py [--clinic-id N]
+
+Windows are resolved to the hour: a cell counts if its hour starts inside
+[start, end).
+"""
+import weakref
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, event, func, inspect, or_, select, true
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import Appointment, AppointmentStatsFact
+from domains.scheduling.availability import stored_minutes
+
+F = AppointmentStatsFact
+KEY = ("clinic_id", "day", "doctor_id", "status", "hour")
+MEASURES = ("appointments", "minutes", "lead_days", "lead_count", "same_day")
+# The Appointment columns a cell is derived from; a change to any other column
+# (notes, chair, patient details) leaves the cube alone.
+SOURCE = (Appointment.clinic_id, Appointment.appointment_date, Appointment.doctor_id,
+          Appointment.status, Appointment.start_minute, Appointment.start_time,
+          Appointment.duration, Appointment.created_at)
+TRACKED = ("clinic_id", "appointment_date", "doctor_id", "status", "start_time",
+           "duration", "created_at")
+BATCH = 5000
+
+_PENDING = "appointment_facts_pending"
+# Engines whose database has the table. An older database that has not been
+# through startup's create_all yet must still take appointment writes.
+_has_table: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+Key = Tuple[int, date, int, str, int]
+
+
+def cell(clinic_id, appointment_date, doctor_id, status, start_minute, start_time,
+         duration, created_at) -> Tuple[Key, Tuple[int, ...]]:
+    """The cell one appointment counts in, and what it adds to it."""
+    if start_minute is None and not start_time:
+        minute = appointment_date.hour * 60
+    else:
+        minute = stored_minutes(start_minute, start_time)
+    lead = None
+    if created_at is not None:
+        lead = (appointment_date.date() - created_at.date()).days
+        if lead < 0:
+            lead = None
+    key = (clinic_id, appointment_date.date(), doctor_id or 0, status or "",
+           max(0, min(23, minute // 60)))
+    return key, (1, duration or 0, lead or 0, 0 if lead is None else 1, 1 if lead == 0 else 0)
+
+
+class Deltas:
+    """Signed changes per cell, merged before they are written."""
+
+    def __init__(self):
+        self._cells: Dict[Key, List[int]] = defaultdict(lambda: [0] * len(MEASURES))
+
+    def add(self, values: Sequence, sign: int = 1) -> None:
+        key, measures = cell(*values)
+        acc = self._cells[key]
+        for i, m in enumerate(measures):
+            acc[i] += sign * m
+
+    def rows(self) -> List[dict]:
+        return [
+            {**dict(zip(KEY, key)), **dict(zip(MEASURES, acc))}
+            for key, acc in self._cells.items() if any(acc)
+        ]
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+
+def apply(conn, deltas: Deltas) -> None:
+    """Add `deltas` to the cube: insert new cells, increment existing ones."""
+    rows = deltas.rows()
+    if not rows:
+        return
+    dialect = postgresql if conn.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(F.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(KEY),
+        set_={m: F.__table__.c[m] + stmt.excluded[m] for m in MEASURES},
+    )
+    for i in range(0, len(rows), BATCH):
+        conn.execute(stmt, rows[i:i + BATCH])
+
+
+def _enabled(conn) -> bool:
+    engine = conn.engine
+    known = _has_table.get(engine)
+    if known is None:
+        known = _has_table[engine] = inspect(conn).has_table(F.__tablename__)
+    return known
+
+
+def _changed(obj: Appointment) -> bool:
+    attrs = inspect(obj).attrs
+    return any(attrs[name].history.has_changes() for name in TRACKED)
+
+
+# ── Keeping it current ───────────────────────────────────────────────────────
+
+@event.listens_for(Session, "before_flush")
+def _take_off_old_cells(session, flush_context, instances):
+    session.info.pop(_PENDING, None)
+    changed = [o for o in session.dirty if isinstance(o, Appointment) and _changed(o)]
+    gone = [o for o in session.deleted if isinstance(o, Appointment)]
+    new = [o for o in session.new if isinstance(o, Appointment)]
+    if not (changed or gone or new):
+        return
+    conn = session.connection()
+    if not _enabled(conn):
+        return
+    deltas = Deltas()
+    ids = [o.id for o in changed + gone if o.id is not None]
+    if ids:
+        # Locked until commit: a concurrent edit of these rows waits here,
+        # then reads what this one stored.
+        for row in conn.execute(select(*SOURCE).where(Appointment.id.in_(ids)).with_for_update()):
+            deltas.add(row, -1)
+    session.info[_PENDING] = (deltas, new, [o.id for o in changed if o.id is not None])
+
+
+@event.listens_for(Session, "after_flush")
+def _add_new_cells(session, flush_context):
+    pending = session.info.pop(_PENDING, None)
+    if pending is None:
+        return
+    deltas, new, changed_ids = pending
+    for o in new:
+        deltas.add([getattr(o, c.key) for c in SOURCE])
+    conn = session.connection()
+    if changed_ids:
+        # The stored row, not the object: this session may hold stale values
+        # for columns another one changed since it loaded them.
+        for row in conn.execute(select(*SOURCE).where(Appointment.id.in_(changed_ids))):
+            deltas.add(row)
+    apply(conn, deltas)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _around_bulk_writes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or not issubclass(mapper.class_, Appointment):
+        return None
+    session = orm_execute_state.session
+    if not _enabled(session.connection()):
+        return None
+    where = orm_execute_state.statement.whereclause
+    criteria = () if where is None else (where,)
+    if orm_execute_state.is_delete:
+        retract(session, *criteria)
+        return None
+    # An update: the rows it matches now may not match its WHERE afterwards,
+    # so they are re-read by id.
+    ids = retract(session, *criteria)
+    result = orm_execute_state.invoke_statement()
+    if ids:
+        conn = session.connection()
+        deltas = Deltas()
+        for row in conn.execute(select(*SOURCE).where(Appointment.id.in_(ids))):
+            deltas.add(row)
+        apply(conn, deltas)
+    return result
+
+
+def retract(db: Session, *criteria) -> List[int]:
+    """Take the matching appointments out of the cube. Runs ahead of every
+    bulk delete or update on Appointment; returns the ids retracted."""
+    conn = db.connection()
+    if not _enabled(conn):
+        return []
+    deltas, ids = Deltas(), []
+    for row in conn.execute(select(Appointment.id, *SOURCE).where(*criteria).with_for_update()):
+        ids.append(row[0])
+        deltas.add(row[1:], -1)
+    apply(conn, deltas)
+    return ids
+
+
+def rebuild(db: Session, clinic_id: Optional[int] = None) -> int:
+    """Recompute the cube from appointments, for one clinic or all of them.
+
+    Runs in the caller's transaction and does not commit. Returns the number
+    of cells written.
+    """
+    conn = db.connection()
+    wipe = F.__table__.delete()
+    source = select(*SOURCE)
+    if clinic_id is not None:
+        wipe = wipe.where(F.clinic_id == clinic_id)
+        source = source.where(Appointment.clinic_id == clinic_id)
+    conn.execute(wipe)
+    deltas = Deltas()
+    for row in conn.execute(source.execution_options(yield_per=BATCH)):
+        deltas.add(row)
+    apply(conn, deltas)
+    return len(deltas)
+
+
+# ── Reading it ───────────────────────────────────────────────────────────────
+
+def window(start: Optional[datetime], end: Optional[datetime]):
+    """Cells whose hour starts in [start, end); either bound may be None."""
+    clauses = []
+    # The plain day bounds are what lets the primary key (clinic, day, ...)
+    # narrow the scan; the OR terms then trim the first and last day by hour.
+    if start is not None:
+        clauses.append(F.day >= start.date())
+        clauses.append(or_(F.day > start.date(), and_(F.day == start.date(), F.hour >= start.hour)))
+    if end is not None:
+        partial = end.minute or end.second or end.microsecond
+        clauses.append(F.day <= end.date())
+        clauses.append(or_(F.day < end.date(), and_(F.day == end.date(),
+                                                    F.hour < end.hour + (1 if partial else 0))))
+    return and_(true(), *clauses)
+
+
+def summed(
+    db: Session, clinic_id: int, start: Optional[datetime], end: Optional[datetime],
+    group_by: Iterable = (), where: Iterable = (),
+):
+    """The measures summed over [start, end), one row per `group_by` group.
+
+    Rows carry the group columns by name, then appointments, minutes,
+    lead_days, lead_count and same_day as ints."""
+    group_by = list(group_by)
+    return (
+        db.query(*group_by, *(func.coalesce(func.sum(getattr(F, m)), 0).label(m) for m in MEASURES))
+        .filter(F.clinic_id == clinic_id, window(start, end), *where)
+        .group_by(*group_by)
+        .all()
+    )
+
+
+def day_start(day: date, hour: int = 0) -> datetime:
+    return datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
@@ -9,10 +9,13 @@ page must not be able to put a patient in front of a dentist who is on leave.
 from datetime import date, datetime, time
 from typing import Iterable, List, Optional, Tuple
 
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
 
 from models import Appointment, DoctorAvailability, DoctorTimeOff
 from domains.scheduling.appointment_status import OPEN_STATUSES
+from domains.scheduling.minutes import to_hhmm, to_minutes
+from domains.scheduling.slot_search import BusyIntervals, free_starts
 
 # The lattice the whole calendar snaps to. 15 is the grid, not a rule: the
 # booking form still accepts any start and any duration, so a 20 minute review
@@ -20,27 +23,18 @@ from domains.scheduling.appointment_status import OPEN_STATUSES
 SLOT_MINUTES = 15
 
 
-def to_minutes(hhmm: str | None) -> int:
-    """"09:30" -> 570. Tolerant of junk, because this is fed by stored strings."""
-    if not hhmm:
-        return 0
-    try:
-        parts = str(hhmm).split(":")
-        return int(parts[0]) * 60 + (int(parts[1]) if len(parts) > 1 else 0)
-    except (ValueError, IndexError):
-        return 0
-
-
-def to_hhmm(minutes: int) -> str:
-    minutes = max(0, min(24 * 60 - 1, int(minutes)))
-    return f"{minutes // 60:02d}:{minutes % 60:02d}"
-
-
 def snap(minutes: int, step: int = SLOT_MINUTES) -> int:
     """Round to the nearest lattice line."""
     return int(round(minutes / step) * step)
 
 
+def stored_minutes(minute: Optional[int], hhmm: Optional[str]) -> int:
+    """An appointment's start_minute/end_minute column, falling back to its
+    string for rows written before the column existed that the startup
+    backfill could not parse."""
+    return minute if minute is not None else to_minutes(hhmm)
+
+
 def overlaps(a_start: int, a_end: int, b_start: int, b_end: int) -> bool:
     """Half-open intervals: an appointment ending at 10:00 does not clash with
     one starting at 10:00, which is the whole point of back-to-back booking."""
@@ -64,12 +58,20 @@ def working_blocks(db: Session, clinic_id: int, doctor_id: int, on: date) -> Lis
         )
         .all()
     )
-    blocks = sorted((to_minutes(r.start_time), to_minutes(r.end_time)) for r in rows)
-    blocks = [(s, e) for s, e in blocks if e > s]
+    blocks = hour_blocks(rows)
     if not blocks:
         return []
+    return remove_leave(blocks, time_off_on(db, clinic_id, doctor_id, on))
 
-    for off in time_off_on(db, clinic_id, doctor_id, on):
+
+def hour_blocks(rows: Iterable[DoctorAvailability]) -> List[Tuple[int, int]]:
+    """One weekday's DoctorAvailability rows as sorted, non-empty minute ranges."""
+    blocks = sorted((to_minutes(r.start_time), to_minutes(r.end_time)) for r in rows)
+    return [(s, e) for s, e in blocks if e > s]
+
+
+def remove_leave(blocks: List[Tuple[int, int]], leave: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    for off in leave:
         blocks = _subtract(blocks, off)
     return blocks
 
@@ -86,16 +88,17 @@ def time_off_on(db: Session, clinic_id: int, doctor_id: int, on: date) -> List[T
         )
         .all()
     )
-    out = []
-    for r in rows:
-        # No times means the whole day. A part-day range only applies to its own
-        # first and last day; the days in between are off entirely.
-        if not r.start_time and not r.end_time:
-            out.append((0, 24 * 60))
-        else:
-            out.append((to_minutes(r.start_time) if r.start_time else 0,
-                        to_minutes(r.end_time) if r.end_time else 24 * 60))
-    return out
+    return [leave_range(r) for r in rows]
+
+
+def leave_range(row: DoctorTimeOff) -> Tuple[int, int]:
+    """The minutes one DoctorTimeOff row takes out of each day it touches."""
+    # No times means the whole day. A part-day range only applies to its own
+    # first and last day; the days in between are off entirely.
+    if not row.start_time and not row.end_time:
+        return (0, 24 * 60)
+    return (to_minutes(row.start_time) if row.start_time else 0,
+            to_minutes(row.end_time) if row.end_time else 24 * 60)
 
 
 def _subtract(blocks: List[Tuple[int, int]], cut: Tuple[int, int]) -> List[Tuple[int, int]]:
@@ -139,10 +142,21 @@ def check_available(
     if not has_availability(db, clinic_id, doctor_id):
         return None  # Nobody has said when this doctor works, so we do not guess.
 
-    s, e = to_minutes(start), to_minutes(end)
     blocks = working_blocks(db, clinic_id, doctor_id, on)
+    return unavailable_reason(
+        blocks, time_off_on(db, clinic_id, doctor_id, on) if not blocks else (), start, end,
+    )
+
+
+def unavailable_reason(
+    blocks: List[Tuple[int, int]], leave: Iterable[Tuple[int, int]], start: str, end: str,
+) -> Optional[str]:
+    """check_available's verdict given the day's working blocks and leave.
+
+    `leave` is only consulted when there are no blocks, to say why."""
+    s, e = to_minutes(start), to_minutes(end)
     if not blocks:
-        for off in time_off_on(db, clinic_id, doctor_id, on):
+        for off in leave:
             if off == (0, 24 * 60):
                 return "That doctor is away on this date"
         return "That doctor does not work on this day"
@@ -163,7 +177,10 @@ def find_conflict(
     """An existing open appointment for the same doctor that overlaps this one.
 
     Cancelled and completed appointments never block a slot, which is what
-    makes a freed-up cancellation reusable.
+    makes a freed-up cancellation reusable. One indexed query: the overlap
+    test runs in SQL on the minute columns rather than over the whole day's
+    rows in Python. Old rows whose minute columns are still NULL come back
+    too and are tested on their strings, so they cannot be double-booked.
     """
     s, e = to_minutes(start), to_minutes(end)
     q = (
@@ -183,10 +200,29 @@ def find_conflict(
     if exclude_id:
         q = q.filter(Appointment.id != exclude_id)
 
-    for appt in q.all():
-        if overlaps(s, e, to_minutes(appt.start_time), to_minutes(appt.end_time)):
-            return appt
-    return None
+    # Half-open, as in `overlaps`.
+    candidates = q.filter(or_(
+        and_(Appointment.start_minute < e, Appointment.end_minute > s),
+        Appointment.start_minute.is_(None),
+        Appointment.end_minute.is_(None),
+    )).all()
+    clashes = [
+        (stored_minutes(a.start_minute, a.start_time), a.id, a) for a in candidates
+        if overlaps(s, e, stored_minutes(a.start_minute, a.start_time),
+                    stored_minutes(a.end_minute, a.end_time))
+    ]
+    return min(clashes, key=lambda c: c[:2])[2] if clashes else None
+
+
+# Name of the optional Postgres exclusion constraint (see main.py) that
+# refuses overlapping open bookings for one doctor at the database level.
+DOUBLE_BOOKING_CONSTRAINT = "ex_appointments_doctor_overlap"
+
+
+def is_double_booking(exc: Exception) -> bool:
+    """Whether a failed write was refused by DOUBLE_BOOKING_CONSTRAINT, i.e.
+    somebody else booked the slot between our clash check and our commit."""
+    return DOUBLE_BOOKING_CONSTRAINT in str(getattr(exc, "orig", exc))
 
 
 def free_slots(
@@ -197,9 +233,9 @@ def free_slots(
     if not blocks:
         return []
 
-    taken = []
     rows = (
-        db.query(Appointment)
+        db.query(Appointment.start_minute, Appointment.end_minute,
+                 Appointment.start_time, Appointment.end_time)
         .filter(
             Appointment.clinic_id == clinic_id,
             Appointment.doctor_id == doctor_id,
@@ -209,16 +245,11 @@ def free_slots(
         )
         .all()
     )
-    for a in rows:
-        taken.append((to_minutes(a.start_time), to_minutes(a.end_time)))
+    taken = [(stored_minutes(sm, st), stored_minutes(em, et)) for sm, em, st, et in rows]
+    return fit_slots(blocks, taken, duration)
 
-    out = []
-    for bs, be in blocks:
-        cursor = snap(bs)
-        if cursor < bs:
-            cursor += SLOT_MINUTES
-        while cursor + duration <= be:
-            if not any(overlaps(cursor, cursor + duration, ts, te) for ts, te in taken):
-                out.append(to_hhmm(cursor))
-            cursor += SLOT_MINUTES
-    return out
+
+def fit_slots(blocks: List[Tuple[int, int]], taken: Iterable[Tuple[int, int]] | BusyIntervals, duration: int) -> List[str]:
+    """Lattice-aligned starts inside `blocks` where `duration` avoids `taken`."""
+    busy = taken if isinstance(taken, BusyIntervals) else BusyIntervals(taken)
+    return [to_hhmm(m) for m in free_starts(blocks, busy, duration, SLOT_MINUTES)]
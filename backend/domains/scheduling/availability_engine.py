@@ -0,0 +1,322 @@
+"""
+A clinic's availability for a date range, loaded once and answered from memory.
+
+The functions in `availability` each run fresh queries for one doctor on one
+day. That is right for a single booking, and ruinous in a loop: the day view
+ran three queries per doctor, utilisation ran `working_blocks` for every
+doctor on every day of a 90 day window, and a recurring series paid four or
+more per visit.
+
+`ClinicAvailability.load` reads the clinic's working hours, the leave that
+touches the range and the open appointments inside it in three queries, and
+every question after that is a dictionary lookup. The verdicts and messages
+are the same as the single-shot functions give, because both go through the
+same helpers in `availability`.
+
+A loaded snapshot is only as fresh as the moment it was read. Use one per
+request, and `add` anything the request books so later checks in the same
+request see it. `ClinicAvailability.for_request` does the "one per request"
+part: it keeps loaded snapshots on the session until its next commit or
+rollback, so several endpoints' worth of questions in one request share a
+single load.
+"""
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Appointment, DoctorAvailability, DoctorTimeOff
+from domains.scheduling.appointment_status import OPEN_STATUSES
+from domains.scheduling.availability import (SLOT_MINUTES, fit_slots, hour_blocks,
+                                             leave_range, overlaps, remove_leave,
+                                             stored_minutes, to_minutes, unavailable_reason)
+from domains.scheduling.slot_search import BusyIntervals, free_starts, search_days
+
+Interval = Tuple[int, int]
+
+# Session.info key for the per-request memo.
+_MEMO_KEY = "clinic_availability"
+
+
+def _forget_memo(session: Session, *args) -> None:
+    session.info.pop(_MEMO_KEY, None)
+
+
+def _span(appt: Appointment) -> Interval:
+    return (stored_minutes(appt.start_minute, appt.start_time),
+            stored_minutes(appt.end_minute, appt.end_time))
+
+
+class ClinicAvailability:
+    """Working hours, leave and open bookings for one clinic over [start, end]."""
+
+    def __init__(
+        self,
+        clinic_id: int,
+        start: date,
+        end: date,
+        hours: Iterable[DoctorAvailability],
+        leave: Iterable[DoctorTimeOff],
+        appointments: Iterable[Appointment] = (),
+    ):
+        self.clinic_id = clinic_id
+        self.start = start
+        self.end = end
+        self.with_appointments = True
+
+        by_day = defaultdict(list)
+        for r in hours:
+            by_day[(r.doctor_id, r.weekday)].append(r)
+        # (doctor, weekday) -> sorted blocks, before leave
+        self._hours: Dict[Tuple[int, int], List[Interval]] = {
+            k: hour_blocks(rows) for k, rows in by_day.items()
+        }
+        self._configured = {doctor_id for doctor_id, _ in by_day}
+
+        self._leave: Dict[int, List[Tuple[date, date, Interval]]] = defaultdict(list)
+        for r in leave:
+            self._leave[r.doctor_id].append((r.start_date, r.end_date, leave_range(r)))
+
+        # Derived per (doctor, date) on first use
+        self._blocks: Dict[Tuple[int, date], List[Interval]] = {}
+        self._busy: Dict[Tuple[Optional[int], date], BusyIntervals] = {}
+
+        # (doctor or None, date) -> open appointments on that day
+        self._booked: Dict[Tuple[Optional[int], date], List[Appointment]] = defaultdict(list)
+        for a in appointments:
+            self.add(a)
+
+    @classmethod
+    def load(
+        cls, db: Session, clinic_id: int, start: date, end: date,
+        with_appointments: bool = True,
+    ) -> "ClinicAvailability":
+        """Three queries for the whole clinic and range, two without bookings."""
+        hours = (
+            db.query(DoctorAvailability)
+            .filter(DoctorAvailability.clinic_id == clinic_id)
+            .all()
+        )
+        leave = (
+            db.query(DoctorTimeOff)
+            .filter(
+                DoctorTimeOff.clinic_id == clinic_id,
+                DoctorTimeOff.start_date <= end,
+                DoctorTimeOff.end_date >= start,
+            )
+            .all()
+        )
+        appointments = []
+        if with_appointments:
+            appointments = (
+                db.query(Appointment)
+                .filter(
+                    Appointment.clinic_id == clinic_id,
+                    Appointment.status.in_(OPEN_STATUSES),
+                    Appointment.appointment_date >= datetime.combine(start, time.min),
+                    Appointment.appointment_date <= datetime.combine(end, time.max),
+                )
+                .all()
+            )
+        snap = cls(clinic_id, start, end, hours, leave, appointments)
+        snap.with_appointments = with_appointments
+        return snap
+
+    @classmethod
+    def load_many(
+        cls, db: Session, clinic_ids: Iterable[int], start: date, end: date,
+    ) -> Dict[int, "ClinicAvailability"]:
+        """Hours and leave, no bookings, for several clinics in two queries."""
+        ids = list(clinic_ids)
+        hours, leave = defaultdict(list), defaultdict(list)
+        for r in db.query(DoctorAvailability).filter(DoctorAvailability.clinic_id.in_(ids)):
+            hours[r.clinic_id].append(r)
+        for r in db.query(DoctorTimeOff).filter(
+            DoctorTimeOff.clinic_id.in_(ids),
+            DoctorTimeOff.start_date <= end,
+            DoctorTimeOff.end_date >= start,
+        ):
+            leave[r.clinic_id].append(r)
+        out = {}
+        for cid in ids:
+            out[cid] = snap = cls(cid, start, end, hours[cid], leave[cid])
+            snap.with_appointments = False
+        return out
+
+    @classmethod
+    def for_request(
+        cls, db: Session, clinic_id: int, start: date, end: date,
+        with_appointments: bool = True,
+    ) -> "ClinicAvailability":
+        """`load`, remembered on the session until its next commit or rollback.
+
+        A snapshot already loaded in this session that covers [start, end]
+        (and has bookings, if they are wanted) is reused as is, so asking
+        again costs no queries. Bookings `add`ed to it stay counted.
+        """
+        memo = db.info.get(_MEMO_KEY)
+        if memo is None:
+            memo = db.info[_MEMO_KEY] = []
+            if not event.contains(db, "after_commit", _forget_memo):
+                event.listen(db, "after_commit", _forget_memo)
+                event.listen(db, "after_rollback", _forget_memo)
+        for snap in memo:
+            if (snap.clinic_id == clinic_id and snap.start <= start and end <= snap.end
+                    and (snap.with_appointments or not with_appointments)):
+                return snap
+        snap = cls.load(db, clinic_id, start, end, with_appointments=with_appointments)
+        memo.append(snap)
+        return snap
+
+    def add(self, appt: Appointment) -> None:
+        """Count a booking made after the load, so it blocks later checks."""
+        key = (appt.doctor_id, appt.appointment_date.date())
+        self._booked[key].append(appt)
+        self._busy.pop(key, None)
+
+    def discard(self, appt: Appointment) -> None:
+        """Stop counting a loaded booking, e.g. one that is about to move."""
+        key = (appt.doctor_id, appt.appointment_date.date())
+        self._booked[key] = [a for a in self._booked.get(key, ()) if a.id != appt.id]
+        self._busy.pop(key, None)
+
+    def _check_range(self, on: date) -> None:
+        # Outside the loaded range the answer would be silently wrong
+        # ("no leave", "no bookings"), so refuse instead.
+        if not self.start <= on <= self.end:
+            raise ValueError(f"{on} is outside the loaded range {self.start} to {self.end}")
+
+    # ── Hours and leave ──────────────────────────────────────────────────────
+
+    def has_availability(self, doctor_id: int) -> bool:
+        return doctor_id in self._configured
+
+    def time_off_on(self, doctor_id: int, on: date) -> List[Interval]:
+        self._check_range(on)
+        return [rng for first, last, rng in self._leave.get(doctor_id, ()) if first <= on <= last]
+
+    def working_blocks(self, doctor_id: int, on: date) -> List[Interval]:
+        key = (doctor_id, on)
+        if key not in self._blocks:
+            blocks = self._hours.get((doctor_id, on.weekday()), [])
+            self._blocks[key] = remove_leave(blocks, self.time_off_on(doctor_id, on)) if blocks else []
+        return self._blocks[key]
+
+    def working_grid(
+        self, doctor_ids: Optional[Iterable[int]] = None,
+        start: Optional[date] = None, end: Optional[date] = None,
+    ) -> Dict[int, Dict[date, List[Interval]]]:
+        """Working blocks, leave removed, per doctor per date.
+
+        Covers every doctor with configured hours (or just `doctor_ids`) and
+        every date in [start, end], the loaded range by default. Days off are
+        present with no blocks, so callers can index without checking.
+        """
+        first, last = start or self.start, end or self.end
+        self._check_range(first)
+        self._check_range(last)
+        ids = sorted(self._configured) if doctor_ids is None else list(doctor_ids)
+        days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        return {d: {day: self.working_blocks(d, day) for day in days} for d in ids}
+
+    def chair_minutes(self, on: date, chairs: int) -> int:
+        """Minutes of doctor time on `on` that a chair can take: every
+        configured doctor's working blocks, but never more than `chairs`
+        doctors counted at once."""
+        edges = []
+        for doctor_id in self._configured:
+            for s, e in self.working_blocks(doctor_id, on):
+                edges += [(s, 1), (e, -1)]
+        total, working, last = 0, 0, None
+        for minute, step in sorted(edges):
+            if last is not None:
+                total += (minute - last) * min(working, chairs)
+            working += step
+            last = minute
+        return total
+
+    def available_minutes(self, doctor_id: int, start: date, end: date) -> int:
+        """Working minutes across [start, end], leave removed."""
+        total, cursor = 0, start
+        while cursor <= end:
+            total += sum(e - s for s, e in self.working_blocks(doctor_id, cursor))
+            cursor += timedelta(days=1)
+        return total
+
+    def check_available(
+        self, doctor_id: Optional[int], on: date, start: str, end: str,
+    ) -> Optional[str]:
+        """Same verdict as availability.check_available."""
+        if not doctor_id or not self.has_availability(doctor_id):
+            return None
+        blocks = self.working_blocks(doctor_id, on)
+        return unavailable_reason(blocks, self.time_off_on(doctor_id, on) if not blocks else (), start, end)
+
+    # ── Bookings ─────────────────────────────────────────────────────────────
+
+    def booked(self, doctor_id: Optional[int], on: date) -> List[Appointment]:
+        self._check_range(on)
+        return self._booked.get((doctor_id, on), [])
+
+    def find_conflict(
+        self, doctor_id: Optional[int], on: date, start: str, end: str,
+        exclude_id: Optional[int] = None,
+    ) -> Optional[Appointment]:
+        """Same answer as availability.find_conflict."""
+        s, e = to_minutes(start), to_minutes(end)
+        for appt in self.booked(doctor_id or None, on):
+            if exclude_id and appt.id == exclude_id:
+                continue
+            if overlaps(s, e, *_span(appt)):
+                return appt
+        return None
+
+    def busy(self, doctor_id: Optional[int], on: date) -> BusyIntervals:
+        """This doctor's bookings on this date as merged busy ranges."""
+        key = (doctor_id, on)
+        if key not in self._busy:
+            self._busy[key] = BusyIntervals(_span(a) for a in self.booked(doctor_id, on))
+        return self._busy[key]
+
+    def free_slots(self, doctor_id: int, on: date, duration: int) -> List[str]:
+        """Same answer as availability.free_slots."""
+        blocks = self.working_blocks(doctor_id, on)
+        if not blocks:
+            return []
+        return fit_slots(blocks, self.busy(doctor_id, on), duration)
+
+    def next_available(
+        self, doctor_id: int, duration: int, limit: int = 1,
+        earliest: Optional[Tuple[date, int]] = None,
+    ) -> List[Tuple[date, int]]:
+        """The first `limit` free (date, minute) starts across the loaded range.
+
+        `earliest` is (date, minute) to skip the part of today already gone."""
+        def starts_on(day: date, remaining: Optional[int]) -> List[int]:
+            if earliest and day < earliest[0]:
+                return []
+            floor = earliest[1] if earliest and day == earliest[0] else 0
+            return free_starts(self.working_blocks(doctor_id, day), self.busy(doctor_id, day),
+                               duration, SLOT_MINUTES, earliest=floor, limit=remaining)
+
+        days = (self.end - self.start).days + 1
+        return search_days(self.start, days, starts_on, limit)
+
+    def nearest_free(
+        self, doctor_id: int, on: date, minute: int, duration: int,
+        window_days: int, not_before: Optional[date] = None,
+    ) -> Optional[Tuple[date, int]]:
+        """The free start closest to `minute` on `on`, else on the nearest day
+        within `window_days` either side (later first on a tie). Days outside
+        the loaded range or before `not_before` are not considered."""
+        for offset in range(window_days + 1):
+            for day in ((on,) if offset == 0 else (on + timedelta(days=offset), on - timedelta(days=offset))):
+                if not self.start <= day <= self.end or (not_before and day < not_before):
+                    continue
+                starts = free_starts(self.working_blocks(doctor_id, day), self.busy(doctor_id, day),
+                                     duration, SLOT_MINUTES)
+                if starts:
+                    return day, min(starts, key=lambda s: (abs(s - minute), s))
+        return None
@@ -0,0 +1,370 @@
+"""
+Per-clinic calendar change feed.
+
+The web calendar, the mobile app and the today view used to find out about a
+new booking or a cancellation by re-reading the whole range every few
+seconds. Instead, every appointment write publishes a small event on a Redis
+channel per clinic, and each API process keeps ONE pattern subscription that
+fans those events out to its connected clients (GET /appointments/changes,
+server-sent events). A client applies the deltas to what it already holds and
+only re-reads the range when it is told to resync.
+
+Events look like
+
+    {"type": "created" | "updated" | "deleted" | "resync",
+     "clinic_id": 1, "id": 42, "seq": 17, "at": "...", "row": {...} | null}
+
+`seq` counts up per clinic. Pub/sub delivers at most once, so a client that
+sees a gap in `seq`, or a "resync" (after the hub lost Redis, or the client
+fell too far behind), should refetch the range rather than trust its copy.
+
+Events are published from the Session's after_commit hook, not by the
+routes: every flushed insert, update or delete of an Appointment is noted
+(its row as flushed) and published once the transaction commits, so no
+writer (treatment plans, patient deletion, a future script) can forget.
+A bulk `query(Appointment)...update()/delete()` is noted too: a delete
+publishes one "deleted" per row it matched, an update a "resync" for each
+clinic it touched. A rollback publishes nothing.
+
+The committing thread never talks to Redis: it may be the event loop, in an
+async route. after_commit hands the commit's events to one publisher thread
+per process, which sends them in a single pipelined round trip (a Lua
+INCR-and-PUBLISH per event, so each event still carries its own seq).
+
+Publishing never breaks a write. If Redis is unreachable the event is handed
+straight to this process's subscribers, which is exact for a single-process
+deployment and best effort otherwise, and Redis is left alone for a while
+rather than being retried on every booking.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import redis
+import redis.asyncio as aioredis
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from models import Appointment
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+CHANNEL_PREFIX = "calendar:clinic:"
+# How long publishing skips Redis after it failed once.
+REDIS_BACKOFF_S = 30
+# Events a subscriber may have waiting before it is told to resync instead.
+QUEUE_SIZE = 256
+
+CREATED, UPDATED, DELETED, RESYNC = "created", "updated", "deleted", "resync"
+
+# The calendar's own columns, minus the doctor's name: the client already has
+# the doctor list, and looking a name up here would cost a query per write.
+ROW_FIELDS = (
+    "id", "patient_id", "patient_name", "patient_phone", "doctor_id", "treatment",
+    "date", "start_time", "end_time", "status", "chair_number", "series_id",
+)
+
+
+def channel(clinic_id: int) -> str:
+    return f"{CHANNEL_PREFIX}{clinic_id}"
+
+
+def seq_key(clinic_id: int) -> str:
+    return f"{CHANNEL_PREFIX}{clinic_id}:seq"
+
+
+def appointment_row(appt) -> dict:
+    row = {f: getattr(appt, f, None) for f in ROW_FIELDS if f != "date"}
+    row["date"] = appt.appointment_date.strftime("%Y-%m-%d") if appt.appointment_date else None
+    return row
+
+
+# ── Publishing (sync, on the publisher thread below) ────────────────────────
+
+_client: Optional[redis.Redis] = None
+_client_lock = threading.Lock()
+_down_until = 0.0
+
+# INCR the clinic's seq and PUBLISH the event carrying it, as one command, so
+# a batch of events pipelines into one round trip. ARGV[1] is the event's JSON
+# without its opening brace; the seq is spliced in front.
+_INCR_AND_PUBLISH = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', KEYS[2], '{"seq": ' .. seq .. ', ' .. ARGV[1])
+return seq
+"""
+
+Change = Tuple[int, str, Optional[int], Optional[dict]]  # clinic_id, type, id, row
+
+
+def _redis() -> redis.Redis:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.from_url(REDIS_URL, socket_connect_timeout=1, socket_timeout=1)
+    return _client
+
+
+def publish_many(changes: Iterable[Change]) -> List[dict]:
+    """Tell every subscriber of each change's clinic about it, in one Redis
+    round trip for the lot. Blocking; returns the events as sent."""
+    global _down_until
+    at = datetime.utcnow().isoformat()
+    events = [
+        {"type": event_type, "clinic_id": clinic_id, "id": appointment_id, "seq": None, "at": at, "row": row}
+        for clinic_id, event_type, appointment_id, row in changes
+    ]
+    if not events:
+        return events
+    if time.monotonic() >= _down_until:
+        try:
+            pipe = _redis().pipeline(transaction=False)
+            for e in events:
+                body = {k: v for k, v in e.items() if k != "seq"}
+                pipe.eval(_INCR_AND_PUBLISH, 2, seq_key(e["clinic_id"]), channel(e["clinic_id"]),
+                          json.dumps(body, default=str)[1:])
+            for e, seq in zip(events, pipe.execute()):
+                e["seq"] = seq
+            return events
+        except Exception as e:
+            _down_until = time.monotonic() + REDIS_BACKOFF_S
+            logger.warning(f"Calendar change feed: Redis publish failed, delivering locally: {e}")
+    for e in events:
+        hub.deliver_local(e["clinic_id"], e)
+    return events
+
+
+def publish(clinic_id: int, event_type: str, appointment_id: Optional[int], row: Optional[dict] = None) -> dict:
+    """Tell every subscriber of this clinic about one appointment change."""
+    return publish_many([(clinic_id, event_type, appointment_id, row)])[0]
+
+
+def publish_appointment(appt, event_type: str = UPDATED) -> dict:
+    """publish() for an Appointment row; a delete carries no row."""
+    row = None if event_type == DELETED else appointment_row(appt)
+    return publish(appt.clinic_id, event_type, appt.id, row)
+
+
+class Publisher:
+    """One daemon thread per process that sends committed changes, in commit
+    order, so the thread that committed never waits on Redis."""
+
+    def __init__(self):
+        self._queue: "queue.Queue[List[Change]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, changes: List[Change]) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+                    self._thread.start()
+        self._queue.put(changes)
+
+    def join(self) -> None:
+        """Wait until everything submitted so far has been sent."""
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            changes = self._queue.get()
+            try:
+                publish_many(changes)
+            except Exception:
+                logger.exception("Calendar change feed: publishing failed")
+            finally:
+                self._queue.task_done()
+
+
+publisher = Publisher()
+
+
+# ── Noting writes, publishing on commit ──────────────────────────────────────
+
+_PENDING = "change_feed_pending"
+
+
+def _note(session, appointment_id: int, clinic_id: int, event_type: str, row: Optional[dict]) -> None:
+    pending = session.info.setdefault(_PENDING, {})
+    earlier = pending.get(appointment_id)
+    if earlier is not None and earlier[1] == CREATED and event_type == UPDATED:
+        event_type = CREATED  # still new to every subscriber
+    pending[appointment_id] = (clinic_id, event_type, row)
+
+
+@event.listens_for(Session, "after_flush")
+def _note_appointment_writes(session, flush_context):
+    # Rows are taken now: after the commit every attribute is a fresh query.
+    for obj in session.new:
+        if isinstance(obj, Appointment):
+            _note(session, obj.id, obj.clinic_id, CREATED, appointment_row(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Appointment) and session.is_modified(obj, include_collections=False):
+            _note(session, obj.id, obj.clinic_id, UPDATED, appointment_row(obj))
+    for obj in session.deleted:
+        if isinstance(obj, Appointment):
+            _note(session, obj.id, obj.clinic_id, DELETED, None)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _note_bulk_appointment_writes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or not issubclass(mapper.class_, Appointment):
+        return
+    session = orm_execute_state.session
+    where = orm_execute_state.statement.whereclause
+    matched = select(Appointment.id, Appointment.clinic_id)
+    if where is not None:
+        matched = matched.where(where)
+    # Which rows the statement is about to touch: it reports none of them.
+    rows = session.execute(matched).all()
+    if orm_execute_state.is_delete:
+        for appointment_id, clinic_id in rows:
+            _note(session, appointment_id, clinic_id, DELETED, None)
+    else:
+        for clinic_id in {clinic_id for _, clinic_id in rows}:
+            session.info.setdefault(_PENDING, {})[("resync", clinic_id)] = (clinic_id, RESYNC, None)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed(session):
+    pending = session.info.pop(_PENDING, None)
+    if pending:
+        publisher.submit([
+            (clinic_id, event_type, None if event_type == RESYNC else key, row)
+            for key, (clinic_id, event_type, row) in pending.items()
+        ])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_pending(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING, None)
+
+
+# ── Fan-out (async, one per process) ─────────────────────────────────────────
+
+class ChangeFeedHub:
+    """One Redis pattern subscription per process, fanned out to local queues."""
+
+    def __init__(self, redis_factory: Optional[Callable[[], aioredis.Redis]] = None):
+        self._factory = redis_factory or (lambda: aioredis.from_url(REDIS_URL))
+        self._queues: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Set once the subscription is live; tests wait on it.
+        self.ready = asyncio.Event()
+
+    async def subscribe(self, clinic_id: int) -> asyncio.Queue:
+        self._loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self.ready = asyncio.Event()
+            self._task = asyncio.create_task(self._listen())
+        queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        self._queues[clinic_id].add(queue)
+        return queue
+
+    def unsubscribe(self, clinic_id: int, queue: asyncio.Queue) -> None:
+        subscribers = self._queues.get(clinic_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._queues[clinic_id]
+
+    def subscriber_count(self, clinic_id: Optional[int] = None) -> int:
+        if clinic_id is not None:
+            return len(self._queues.get(clinic_id, ()))
+        return sum(len(q) for q in self._queues.values())
+
+    def _fan_out(self, clinic_id: int, event: dict) -> None:
+        for queue in list(self._queues.get(clinic_id, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # This client cannot catch up from deltas any more; swap its
+                # backlog for one instruction to refetch.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": RESYNC, "clinic_id": clinic_id})
+
+    def _resync_all(self) -> None:
+        for clinic_id in list(self._queues):
+            self._fan_out(clinic_id, {"type": RESYNC, "clinic_id": clinic_id})
+
+    def deliver_local(self, clinic_id: int, event: dict) -> None:
+        """Hand an event to this process's subscribers, from any thread."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._fan_out, clinic_id, event)
+        except RuntimeError:
+            pass  # loop shut down between the check and the call
+
+    async def _listen(self) -> None:
+        connected_before = False
+        while True:
+            client = None
+            try:
+                client = self._factory()
+                pubsub = client.pubsub()
+                await pubsub.psubscribe(CHANNEL_PREFIX + "*")
+                if connected_before:
+                    # Whatever was published while we were away is gone.
+                    self._resync_all()
+                connected_before = True
+                self.ready.set()
+                async for message in pubsub.listen():
+                    if message.get("type") != "pmessage":
+                        continue
+                    name = message["channel"]
+                    name = name.decode() if isinstance(name, bytes) else name
+                    suffix = name[len(CHANNEL_PREFIX):]
+                    if not suffix.isdigit():
+                        continue  # not a clinic channel
+                    self._fan_out(int(suffix), json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Calendar change feed: subscription lost, retrying: {e}")
+                await asyncio.sleep(5)
+            finally:
+                if client is not None:
+                    try:
+                        await client.aclose()
+                    except Exception:
+                        pass
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+
+hub = ChangeFeedHub()
+
+
+def format_sse(event: dict) -> str:
+    """One server-sent event. The seq doubles as the SSE id."""
+    lines = []
+    if event.get("seq") is not None:
+        lines.append(f"id: {event['seq']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event, default=str)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,25 @@
+"""
+"HH:MM" strings to minutes from midnight and back.
+
+Appointments store their times as strings and, alongside, as the integer
+start_minute/end_minute columns the clash check queries. Both the ORM
+listener in models.py that fills those columns and everything that reads the
+strings directly must agree on what a time means, so there is one parser and
+it lives here, where models.py can import it without a cycle.
+"""
+
+
+def to_minutes(hhmm: str | None) -> int:
+    """"09:30" -> 570. Tolerant of junk, because this is fed by stored strings."""
+    if not hhmm:
+        return 0
+    try:
+        parts = str(hhmm).split(":")
+        return int(parts[0]) * 60 + (int(parts[1]) if len(parts) > 1 else 0)
+    except (ValueError, IndexError):
+        return 0
+
+
+def to_hhmm(minutes: int) -> str:
+    minutes = max(0, min(24 * 60 - 1, int(minutes)))
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
@@ -0,0 +1,189 @@
+"""
+Cached availability for the public booking page.
+
+The booking page is unauthenticated and gets crawlers and marketing traffic
+as well as patients. Every view used to resolve the clinic by code and read
+that day's bookings from the primary database, and every date click did it
+again. Here both are cached in Redis through cache_service:
+
+- the clinic's public profile (id, name, hours), for PROFILE_TTL_S;
+- a snapshot of the next PUBLIC_SNAPSHOT_DAYS days, opening hours and merged
+  busy ranges per day, for SNAPSHOT_TTL_S.
+
+The snapshot key carries the clinic's change-feed sequence number, which
+every appointment write bumps after it commits, so a booking makes the old
+snapshot unreachable at once and the TTL only has to clean up. Free start
+times for any duration are then computed from the snapshot in memory.
+
+Responses go out with ETags and public Cache-Control, so a CDN or browser
+can answer repeats without reaching us at all. Without Redis everything
+still works; it just reads the database each time, as before.
+"""
+import os
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from models import Appointment, Clinic
+from domains.infrastructure.services.cache_service import cache_service
+from domains.scheduling import change_feed
+from domains.scheduling.appointment_status import OPEN_STATUSES
+from domains.scheduling.availability import stored_minutes, to_minutes
+from domains.scheduling.slot_search import BusyIntervals, free_starts
+
+PUBLIC_SNAPSHOT_DAYS = int(os.getenv("PUBLIC_SNAPSHOT_DAYS", "14"))
+SNAPSHOT_TTL_S = int(os.getenv("PUBLIC_SNAPSHOT_TTL_S", "60"))
+PROFILE_TTL_S = 300
+SNAPSHOT_CACHE_CONTROL = "public, max-age=30, stale-while-revalidate=60"
+PROFILE_CACHE_CONTROL = "public, max-age=300"
+# The public page offers half-hour starts.
+PUBLIC_STEP_MINUTES = 30
+
+# Used when a clinic never set its hours.
+DEFAULT_TIMINGS = {
+    'monday': {'open': '08:00', 'close': '20:00', 'closed': False},
+    'tuesday': {'open': '08:00', 'close': '20:00', 'closed': False},
+    'wednesday': {'open': '08:00', 'close': '20:00', 'closed': False},
+    'thursday': {'open': '08:00', 'close': '20:00', 'closed': False},
+    'friday': {'open': '08:00', 'close': '20:00', 'closed': False},
+    'saturday': {'open': '09:00', 'close': '17:00', 'closed': False},
+    'sunday': {'open': '00:00', 'close': '00:00', 'closed': True}
+}
+
+
+def _profile_key(clinic_code: str) -> str:
+    return f"public:clinic:{clinic_code}"
+
+
+def _snapshot_key(clinic_id: int, version: int, first: date) -> str:
+    return f"public:slots:{clinic_id}:{version}:{first.isoformat()}"
+
+
+# ── Clinic ───────────────────────────────────────────────────────────────────
+
+async def public_clinic(db: Session, clinic_code: str) -> dict:
+    """The clinic behind a public booking code, as a plain dict.
+
+    Public links use clinic_code (e.g. CLN-A3X9K2B7FQ), never the sequential
+    numeric id, so the booking endpoints can't be enumerated as 1, 2, 3, ...
+    The "id" in here is for our queries; never send it to the page.
+    """
+    cached = await cache_service.get(_profile_key(clinic_code))
+    if cached:
+        return cached
+    clinic = db.query(Clinic).filter(Clinic.clinic_code == clinic_code).first()
+    if not clinic:
+        raise HTTPException(status_code=404, detail="Clinic not found")
+    profile = {
+        "id": clinic.id,
+        "clinic_code": clinic.clinic_code,
+        "name": clinic.name,
+        "address": clinic.address,
+        "phone": clinic.phone,
+        "email": clinic.email,
+        "specialization": clinic.specialization,
+        "logo_url": clinic.logo_url,
+        "timings": clinic.timings,
+    }
+    await cache_service.set(_profile_key(clinic_code), profile, PROFILE_TTL_S)
+    return profile
+
+
+async def forget_clinic(clinic_code: Optional[str]) -> None:
+    """Drop a cached profile after the clinic's details or hours change."""
+    if clinic_code:
+        await cache_service.delete(_profile_key(clinic_code))
+
+
+def hours_on(timings: Optional[dict], day: date) -> Optional[Tuple[str, str]]:
+    """(open, close) on `day`, or None when the clinic is closed."""
+    t = (timings or DEFAULT_TIMINGS).get(day.strftime("%A").lower(), {})
+    if t.get('closed', True):
+        return None
+    return t.get('open', '08:00'), t.get('close', '20:00')
+
+
+# ── Snapshot ─────────────────────────────────────────────────────────────────
+
+def build_snapshot(db: Session, clinic_id: int, timings: Optional[dict], first: date, days: int) -> dict:
+    """Hours and busy ranges for `days` days from `first`, in one query."""
+    last = first + timedelta(days=days - 1)
+    busy = defaultdict(list)
+    for appt_date, start_minute, end_minute, start_time, end_time in db.query(
+        Appointment.appointment_date, Appointment.start_minute, Appointment.end_minute,
+        Appointment.start_time, Appointment.end_time,
+    ).filter(
+        Appointment.clinic_id == clinic_id,
+        Appointment.status.in_(OPEN_STATUSES),
+        Appointment.appointment_date >= datetime.combine(first, datetime.min.time()),
+        Appointment.appointment_date <= datetime.combine(last, datetime.max.time()),
+    ):
+        busy[appt_date.date()].append(
+            (stored_minutes(start_minute, start_time), stored_minutes(end_minute, end_time))
+        )
+
+    out = []
+    for offset in range(days):
+        day = first + timedelta(days=offset)
+        hours = hours_on(timings, day)
+        if hours is None:
+            out.append({"date": day.isoformat(), "closed": True})
+            continue
+        merged = BusyIntervals(busy[day])
+        out.append({
+            "date": day.isoformat(), "closed": False, "open": hours[0], "close": hours[1],
+            "busy": [[s, e] for s, e in zip(merged.starts, merged.ends)],
+        })
+    return {"first": first.isoformat(), "days": out}
+
+
+async def _version(clinic_id: int) -> Optional[int]:
+    client = cache_service.redis_client
+    if client is None:
+        return None
+    try:
+        return int(await client.get(change_feed.seq_key(clinic_id)) or 0)
+    except Exception:
+        return None
+
+
+async def snapshot(db: Session, profile: dict, today: Optional[date] = None) -> dict:
+    """The next PUBLIC_SNAPSHOT_DAYS days from `today`, cached when Redis is up."""
+    first = today or date.today()
+    version = await _version(profile["id"])
+    key = _snapshot_key(profile["id"], version, first) if version is not None else None
+    if key:
+        cached = await cache_service.get(key)
+        if cached:
+            return cached
+    snap = build_snapshot(db, profile["id"], profile["timings"], first, PUBLIC_SNAPSHOT_DAYS)
+    if key:
+        await cache_service.set(key, snap, SNAPSHOT_TTL_S)
+    return snap
+
+
+async def days_between(db: Session, profile: dict, first: date, last: date) -> Dict[date, dict]:
+    """Snapshot entries for [first, last]: from the cache when the range falls
+    inside the next PUBLIC_SNAPSHOT_DAYS days, otherwise read directly."""
+    snap = await snapshot(db, profile)
+    start = date.fromisoformat(snap["first"])
+    if not (start <= first and last < start + timedelta(days=len(snap["days"]))):
+        snap = build_snapshot(db, profile["id"], profile["timings"], first, (last - first).days + 1)
+    return {date.fromisoformat(d["date"]): d for d in snap["days"]}
+
+
+def free_starts_on(entry: dict, duration: int, now: datetime, limit: Optional[int] = None) -> List[int]:
+    """Bookable half-hour starts for one snapshot day. On today's date the
+    first offer is the next half hour from now, and the steps run from there."""
+    if entry["closed"]:
+        return []
+    start = to_minutes(entry["open"])
+    if date.fromisoformat(entry["date"]) == now.date():
+        start = max(start, ((now.hour * 60 + now.minute + 29) // 30) * 30)
+    return free_starts(
+        [(start, to_minutes(entry["close"]))], BusyIntervals(map(tuple, entry["busy"])),
+        duration, PUBLIC_STEP_MINUTES, anchor=start, limit=limit,
+    )
@@ -4,20 +4,23 @@ What the appointment book is finally able to say about itself.
 None of this was computable before outcomes existed. The no-show rate had no
 denominator because nothing was ever marked completed, and lead time was
 meaningless because nothing distinguished a booking from an arrival.
+
+The counts come from the appointment fact cube (see appointment_facts), so
+a two-year window costs the same as a week.
 """
 from datetime import date, datetime, timedelta
 from typing import Optional
 
 from fastapi import APIRouter, Depends, Query
-from sqlalchemy import case, func
 from sqlalchemy.orm import Session
 
 from core.auth_utils import get_current_user
 from database import get_db
-from models import Appointment, DoctorAvailability, User
+from models import Appointment, AppointmentStatsFact as Fact, User
+from domains.scheduling import appointment_facts
 from domains.scheduling.appointment_status import (CANCELLED, COMPLETED,
                                                    NO_SHOW, OPEN_STATUSES)
-from domains.scheduling.availability import to_minutes, working_blocks
+from domains.scheduling.availability_engine import ClinicAvailability
 from core.roles import CLINICAL_ROLES
 
 router = APIRouter(prefix="/appointment-stats", tags=["appointment-stats"])
@@ -30,22 +33,20 @@ def appointment_stats(
     current_user: User = Depends(get_current_user),
 ):
     """Headline scheduling numbers over a trailing window."""
-    cid = current_user.clinic_id
     end = datetime.utcnow()
     start = end - timedelta(days=days)
 
-    base = db.query(Appointment).filter(
-        Appointment.clinic_id == cid,
-        Appointment.appointment_date >= start,
-        Appointment.appointment_date <= end,
-    )
+    by_status = {r.status: r for r in appointment_facts.summed(
+        db, current_user.clinic_id, start, end, group_by=[Fact.status])}
+
+    def count(*statuses):
+        return sum(by_status[s].appointments for s in statuses if s in by_status)
 
-    rows = base.all()
-    total = len(rows)
-    completed = sum(1 for a in rows if a.status == COMPLETED)
-    no_show = sum(1 for a in rows if a.status == NO_SHOW)
-    cancelled = sum(1 for a in rows if a.status == CANCELLED)
-    still_open = sum(1 for a in rows if a.status in OPEN_STATUSES)
+    total = sum(r.appointments for r in by_status.values())
+    completed = count(COMPLETED)
+    no_show = count(NO_SHOW)
+    cancelled = count(CANCELLED)
+    still_open = count(*OPEN_STATUSES)
 
     # Cancellations are excluded from the denominator on purpose: a slot called
     # off in advance can be refilled, which is a different failure from one
@@ -56,13 +57,9 @@ def appointment_stats(
     # How far ahead the clinic books. This is the honest measure of whether any
     # of this worked: production sat at 0.5 days, which is an arrivals log
     # rather than a schedule.
-    leads = [
-        (a.appointment_date.date() - a.created_at.date()).days
-        for a in rows if a.created_at and a.appointment_date
-    ]
-    leads = [d for d in leads if d >= 0]
-    avg_lead = round(sum(leads) / len(leads), 1) if leads else None
-    same_day = sum(1 for d in leads if d == 0)
+    leads = sum(r.lead_count for r in by_status.values())
+    lead_days = sum(r.lead_days for r in by_status.values())
+    same_day = sum(r.same_day for r in by_status.values())
 
     return {
         "window_days": days,
@@ -73,9 +70,9 @@ def appointment_stats(
         "still_open": still_open,
         "no_show_rate": no_show_rate,
         "attendance_base": attended_or_not,
-        "avg_lead_days": avg_lead,
-        "same_day_share": round(100.0 * same_day / len(leads), 1) if leads else None,
-        "booked_minutes": sum(a.duration or 0 for a in rows if a.status not in (CANCELLED,)),
+        "avg_lead_days": round(lead_days / leads, 1) if leads else None,
+        "same_day_share": round(100.0 * same_day / leads, 1) if leads else None,
+        "booked_minutes": sum(r.minutes for st, r in by_status.items() if st != CANCELLED),
     }
 
 
@@ -90,21 +87,19 @@ def stats_by_doctor(
     end = datetime.utcnow()
     start = end - timedelta(days=days)
 
-    rows = (
-        db.query(
-            Appointment.doctor_id,
-            func.count(Appointment.id).label("total"),
-            func.sum(case((Appointment.status == COMPLETED, 1), else_=0)).label("completed"),
-            func.sum(case((Appointment.status == NO_SHOW, 1), else_=0)).label("no_show"),
-            func.sum(case((Appointment.status == CANCELLED, 1), else_=0)).label("cancelled"),
-            func.sum(case((Appointment.status != CANCELLED, Appointment.duration), else_=0)).label("minutes"),
-        )
-        .filter(Appointment.clinic_id == cid,
-                Appointment.appointment_date >= start,
-                Appointment.appointment_date <= end)
-        .group_by(Appointment.doctor_id)
-        .all()
-    )
+    totals = {}
+    for r in appointment_facts.summed(db, cid, start, end, group_by=[Fact.doctor_id, Fact.status]):
+        t = totals.setdefault(r.doctor_id or None, {"total": 0, "completed": 0, "no_show": 0,
+                                                    "cancelled": 0, "minutes": 0})
+        t["total"] += r.appointments
+        if r.status == COMPLETED:
+            t["completed"] += r.appointments
+        elif r.status == NO_SHOW:
+            t["no_show"] += r.appointments
+        elif r.status == CANCELLED:
+            t["cancelled"] += r.appointments
+        if r.status != CANCELLED:
+            t["minutes"] += r.minutes
 
     names = {
         u.id: (u.name or u.email)
@@ -112,19 +107,19 @@ def stats_by_doctor(
     }
 
     out = []
-    for r in rows:
-        base = int(r.completed or 0) + int(r.no_show or 0)
+    for doctor_id, t in totals.items():
+        base = t["completed"] + t["no_show"]
         out.append({
-            "doctor_id": r.doctor_id,
-            "doctor_name": names.get(r.doctor_id, "Unassigned") if r.doctor_id else "Unassigned",
-            "total": int(r.total or 0),
-            "completed": int(r.completed or 0),
-            "no_show": int(r.no_show or 0),
-            "cancelled": int(r.cancelled or 0),
-            "booked_minutes": int(r.minutes or 0),
+            "doctor_id": doctor_id,
+            "doctor_name": names.get(doctor_id, "Unassigned") if doctor_id else "Unassigned",
+            "total": t["total"],
+            "completed": t["completed"],
+            "no_show": t["no_show"],
+            "cancelled": t["cancelled"],
+            "booked_minutes": t["minutes"],
             # None, not 0. A doctor with nothing to measure has no rate, and
             # showing 0% would read as a perfect record.
-            "no_show_rate": round(100.0 * int(r.no_show or 0) / base, 1) if base else None,
+            "no_show_rate": round(100.0 * t["no_show"] / base, 1) if base else None,
         })
     out.sort(key=lambda x: x["total"], reverse=True)
     return out
@@ -164,23 +159,20 @@ def utilisation(
         .all()
     )
 
+    # Hours and leave for every doctor and day in two queries; this used to be
+    # a query per doctor plus two per doctor per day.
+    avail = ClinicAvailability.for_request(db, cid, start_day, end_day, with_appointments=False)
+    grid = avail.working_grid()
+
     out = []
     for d in doctors:
-        configured = db.query(DoctorAvailability.id).filter(
-            DoctorAvailability.clinic_id == cid,
-            DoctorAvailability.doctor_id == d.id,
-        ).first() is not None
-        if not configured:
+        if not avail.has_availability(d.id):
             out.append({"doctor_id": d.id, "doctor_name": d.name or d.email,
                         "configured": False, "available_minutes": 0,
                         "booked_minutes": 0, "utilisation": None})
             continue
 
-        available = 0
-        cursor = start_day
-        while cursor <= end_day:
-            available += sum(e - s for s, e in working_blocks(db, cid, d.id, cursor))
-            cursor += timedelta(days=1)
+        available = sum(e - s for blocks in grid[d.id].values() for s, e in blocks)
 
         booked = sum(a.duration or 0 for a in appts if a.doctor_id == d.id)
         out.append({
@@ -207,20 +199,12 @@ def busiest(
     end = datetime.utcnow()
     start = end - timedelta(days=days)
 
-    rows = (
-        db.query(Appointment)
-        .filter(Appointment.clinic_id == cid,
-                Appointment.status != CANCELLED,
-                Appointment.appointment_date >= start,
-                Appointment.appointment_date <= end)
-        .all()
-    )
-
     by_hour = {h: 0 for h in range(24)}
     by_weekday = {w: 0 for w in range(7)}
-    for a in rows:
-        by_hour[to_minutes(a.start_time) // 60] += 1
-        by_weekday[a.appointment_date.weekday()] += 1
+    for r in appointment_facts.summed(db, cid, start, end, group_by=[Fact.day, Fact.hour],
+                                      where=[Fact.status != CANCELLED]):
+        by_hour[r.hour] += r.appointments
+        by_weekday[r.day.weekday()] += r.appointments
 
     labels = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
     return {
@@ -1,5 +1,6 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session, object_session
 from database import SessionLocal
 from models import Appointment, Patient, User, Clinic, CasePaper
 from sqlalchemy import and_, or_, cast, Date
@@ -8,12 +9,17 @@ from typing import List, Optional
 from core.posthog_client import track_event, EVENTS
 from core.auth_utils import get_current_user, require_doctor_or_owner
 from core.notification_dispatch import notify_event, fmt_appt_time
-from domains.scheduling.availability import check_available, find_conflict
+from core.http_cache import conditional_json
+from domains.scheduling.availability import (check_available, find_conflict, is_double_booking,
+                                             to_hhmm)
+from domains.scheduling import change_feed, public_availability, waitlist
 from domains.scheduling.appointment_status import (
     ALL_STATUSES, OPEN_STATUSES, TERMINAL_STATUSES, CANCELLED, NO_SHOW,
     COMPLETED, ARRIVED, CONFIRMED, SCHEDULED, normalize_status, is_terminal,
 )
 from pydantic import BaseModel, field_validator
+import asyncio
+import base64
 import json
 import logging
 
@@ -259,37 +265,66 @@ async def create_appointment(
         raise
     except Exception as e:
         db.rollback()
+        if is_double_booking(e):
+            raise HTTPException(status_code=409, detail=DOUBLE_BOOKED_DETAIL)
         raise HTTPException(status_code=500, detail=f"Error creating appointment: {str(e)}")
 
-def _resolve_public_clinic(db: Session, clinic_code: str) -> Clinic:
-    """Resolve a clinic for the public booking flow by its unguessable code.
-
-    Public links use clinic_code (e.g. CLN-A3X9K2B7FQ), never the sequential
-    numeric id, so the booking endpoints can't be enumerated as 1, 2, 3, ...
-    """
-    clinic = db.query(Clinic).filter(Clinic.clinic_code == clinic_code).first()
-    if not clinic:
-        raise HTTPException(status_code=404, detail="Clinic not found")
-    return clinic
+# When the database-level guard catches a clash find_conflict could not see:
+# another booking for the same slot committed between our check and our write.
+DOUBLE_BOOKED_DETAIL = "That slot was just booked by someone else. Please pick another time."
 
 
 @router.get("/public/clinic-info")
 async def get_public_clinic_info(
     clinic_code: str = Query(..., description="Clinic's public booking code"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
     db: Session = Depends(get_db)
 ):
     """Return public clinic info for the booking page"""
-    clinic = _resolve_public_clinic(db, clinic_code)
-    return {
-        "clinic_code": clinic.clinic_code,
-        "name": clinic.name,
-        "address": clinic.address,
-        "phone": clinic.phone,
-        "email": clinic.email,
-        "specialization": clinic.specialization,
-        "logo_url": clinic.logo_url,
-        "timings": clinic.timings,
+    profile = await public_availability.public_clinic(db, clinic_code)
+    return conditional_json(
+        {k: v for k, v in profile.items() if k != "id"}, if_none_match,
+        cache_control=public_availability.PROFILE_CACHE_CONTROL,
+    )
+
+
+@router.get("/public/availability")
+async def get_public_availability(
+    clinic_code: str = Query(..., description="Clinic's public booking code"),
+    date_from: Optional[str] = Query(None, description="First date (YYYY-MM-DD), default today"),
+    days: int = Query(7, ge=1, le=public_availability.PUBLIC_SNAPSHOT_DAYS),
+    duration: int = Query(30, ge=5, le=480, description="Duration in minutes"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    db: Session = Depends(get_db)
+):
+    """Bookable start times per day, for the booking page's date picker.
+
+    Served from the cached snapshot (see public_availability), so browsing
+    dates does not touch the appointments table, and sent with an ETag and
+    public Cache-Control so repeats can be answered before they reach us.
+    """
+    profile = await public_availability.public_clinic(db, clinic_code)
+    today = datetime.now().date()
+    try:
+        first = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else today
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date_from '{date_from}'. Expected YYYY-MM-DD.")
+    if first < today:
+        raise HTTPException(status_code=400, detail="date_from cannot be in the past")
+
+    entries = await public_availability.days_between(db, profile, first, first + timedelta(days=days - 1))
+    now = datetime.now()
+    payload = {
+        "clinic_code": profile["clinic_code"],
+        "duration": duration,
+        "days": [
+            {"date": on.isoformat(), "open": not entry["closed"],
+             "slots": [to_hhmm(m) for m in public_availability.free_starts_on(entry, duration, now)]}
+            for on, entry in sorted(entries.items())
+        ],
     }
+    return conditional_json(payload, if_none_match,
+                            cache_control=public_availability.SNAPSHOT_CACHE_CONTROL)
 
 @router.get("/public", response_model=List[AppointmentOut])
 async def get_public_appointments(
@@ -301,8 +336,7 @@ async def get_public_appointments(
     """Get appointments for public booking page (no auth required)"""
     try:
         # Validate clinic exists
-        clinic = _resolve_public_clinic(db, clinic_code)
-        clinic_id = clinic.id
+        clinic_id = (await public_availability.public_clinic(db, clinic_code))["id"]
 
         # Get all appointments for this clinic
         query = db.query(Appointment).filter(Appointment.clinic_id == clinic_id)
@@ -376,7 +410,7 @@ async def create_public_appointment(
     try:
         # The clinic is identified by its unguessable code in the URL, not by a
         # client-supplied numeric id in the body.
-        clinic = _resolve_public_clinic(db, clinic_code)
+        clinic = await public_availability.public_clinic(db, clinic_code)
 
         # Parse the date and time
         appointment_datetime = datetime.strptime(
@@ -386,7 +420,7 @@ async def create_public_appointment(
 
         # Create appointment for the clinic (doctor can be assigned later)
         db_appointment = Appointment(
-            clinic_id=clinic.id,  # Resolved from the public code
+            clinic_id=clinic["id"],  # Resolved from the public code
             patient_id=None,  # Public booking doesn't have patient_id yet
             patient_name=appointment.patient_name,
             patient_email=appointment.patient_email,
@@ -478,6 +512,8 @@ async def create_public_appointment(
         raise
     except Exception as e:
         db.rollback()
+        if is_double_booking(e):
+            raise HTTPException(status_code=409, detail=DOUBLE_BOOKED_DETAIL)
         raise HTTPException(status_code=500, detail=f"Error creating appointment: {str(e)}")
 
 @router.get("/public/next-slot", response_model=dict)
@@ -485,28 +521,13 @@ async def get_next_available_slot(
     clinic_code: str = Query(..., description="Clinic's public booking code"),
     date: str = Query(..., description="Date (YYYY-MM-DD)"),
     duration: int = Query(60, description="Duration in minutes"),
+    days: int = Query(1, ge=1, le=31, description="Keep looking this many days from `date`"),
     db: Session = Depends(get_db)
 ):
-    """Get the next available time slot for a clinic on a specific date"""
+    """Get the next available time slot for a clinic on a specific date, or
+    within `days` days of it"""
     try:
-        # Validate clinic
-        clinic = _resolve_public_clinic(db, clinic_code)
-        clinic_id = clinic.id
-
-        # Use clinic timings
-        clinic_timings = clinic.timings
-
-        # Default timings if no clinic timings found
-        if not clinic_timings:
-            clinic_timings = {
-                'monday': {'open': '08:00', 'close': '20:00', 'closed': False},
-                'tuesday': {'open': '08:00', 'close': '20:00', 'closed': False},
-                'wednesday': {'open': '08:00', 'close': '20:00', 'closed': False},
-                'thursday': {'open': '08:00', 'close': '20:00', 'closed': False},
-                'friday': {'open': '08:00', 'close': '20:00', 'closed': False},
-                'saturday': {'open': '09:00', 'close': '17:00', 'closed': False},
-                'sunday': {'open': '00:00', 'close': '00:00', 'closed': True}
-            }
+        profile = await public_availability.public_clinic(db, clinic_code)
 
         # Parse date
         try:
@@ -514,98 +535,53 @@ async def get_next_available_slot(
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
 
-        day_name = target_date.strftime("%A").lower()
-        day_timings = clinic_timings.get(day_name, {})
-
-        if not day_timings.get('closed', True):
-            # Clinic is open
-            open_time = day_timings.get('open', '08:00')
-            close_time = day_timings.get('close', '20:00')
-
-            # Convert to minutes since midnight
-            open_minutes = int(open_time.split(':')[0]) * 60 + int(open_time.split(':')[1])
-            close_minutes = int(close_time.split(':')[0]) * 60 + int(close_time.split(':')[1])
-
-            # Get existing appointments for this clinic on this date
-            existing_appointments = db.query(Appointment).filter(
-                Appointment.clinic_id == clinic_id,
-                Appointment.appointment_date >= datetime.combine(target_date, datetime.min.time()),
-                Appointment.appointment_date < datetime.combine(target_date, datetime.max.time())
-            ).all()
-
-            # Start time (current time if today, otherwise clinic opening)
-            start_minutes = open_minutes
-            today = datetime.now().date()
-            if target_date == today:
-                current_minutes = datetime.now().hour * 60 + datetime.now().minute
-                # Round up to next 30-minute interval
-                start_minutes = max(start_minutes, ((current_minutes + 29) // 30) * 30)
-
-            # Find next available slot
-            slot_duration = duration
-            for time_minutes in range(start_minutes, close_minutes - slot_duration + 1, 30):
-                slot_start = f"{time_minutes // 60:02d}:{time_minutes % 60:02d}"
-                slot_end_minutes = time_minutes + slot_duration
-                slot_end = f"{slot_end_minutes // 60:02d}:{slot_end_minutes % 60:02d}"
-
-                # Check for conflicts
-                conflict = False
-                for apt in existing_appointments:
-                    apt_start = apt.start_time
-                    apt_end = apt.end_time
-
-                    # Convert to minutes for comparison
-                    apt_start_min = int(apt_start.split(':')[0]) * 60 + int(apt_start.split(':')[1])
-                    apt_end_min = int(apt_end.split(':')[0]) * 60 + int(apt_end.split(':')[1])
-
-                    # Check overlap
-                    if (time_minutes < apt_end_min and slot_end_minutes > apt_start_min):
-                        conflict = True
-                        break
-
-                if not conflict:
-                    return {
-                        "next_slot": slot_start,
-                        "clinic_open": True,
-                        "clinic_hours": f"{open_time} - {close_time}"
-                    }
+        # Hours and busy ranges for the whole window, from the cached snapshot
+        # when the window is in the next fortnight, else one direct query.
+        entries = await public_availability.days_between(
+            db, profile, target_date, target_date + timedelta(days=days - 1))
+
+        now = datetime.now()
+        for offset in range(days):
+            day = target_date + timedelta(days=offset)
+            entry = entries[day]
+            found = public_availability.free_starts_on(entry, duration, now, limit=1)
+            if found:
+                return {
+                    "next_slot": to_hhmm(found[0]),
+                    "date": day.isoformat(),
+                    "clinic_open": True,
+                    "clinic_hours": f"{entry['open']} - {entry['close']}"
+                }
 
-            # No available slots found
-            return {
-                "next_slot": None,
-                "clinic_open": True,
-                "clinic_hours": f"{open_time} - {close_time}",
-                "message": "No available slots for the selected date and duration"
-            }
-        else:
+        hours = public_availability.hours_on(profile["timings"], target_date)
+        if hours is None and days == 1:
             # Clinic is closed
             return {
                 "next_slot": None,
                 "clinic_open": False,
                 "clinic_hours": "Closed",
-                "message": f"Clinic is closed on {day_name.title()}"
+                "message": f"Clinic is closed on {target_date.strftime('%A')}"
             }
 
+        # No available slots found
+        return {
+            "next_slot": None,
+            "clinic_open": hours is not None,
+            "clinic_hours": f"{hours[0]} - {hours[1]}" if hours else "Closed",
+            "message": "No available slots for the selected date and duration" if days == 1
+                       else f"No available slots in the next {days} days"
+        }
+
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error finding next slot: {str(e)}")
 
-@router.get("", response_model=List[AppointmentOut])
-async def get_appointments(
-    date_from: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
-    date_to: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
-    status: Optional[str] = Query(None, description="Filter by status"),
-    doctor_id: Optional[int] = Query(None, description="Filter by doctor"),
-    clinic_id: Optional[int] = Query(None, description="Explicitly filter by clinic branch"),
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
-):
-    """Get all appointments for the clinic with optional filters"""
-    # Parse date filters defensively: a malformed/truncated value (e.g. a
-    # half-typed "2026-07-0" from the client) is a bad request, not a server
-    # error. Do this BEFORE the try/except below so it surfaces as a clean 400
-    # instead of being swallowed into a 500 (which also pollutes error tracking).
+def _parse_date_range(date_from: Optional[str], date_to: Optional[str]):
+    """[from, to) datetimes for an inclusive YYYY-MM-DD range, either end optional.
+
+    A malformed or truncated value (a half-typed "2026-07-0" from the client)
+    is a bad request, not a server error."""
     from_date = None
     to_date = None
     if date_from:
@@ -618,37 +594,49 @@ async def get_appointments(
             to_date = datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1)
         except ValueError:
             raise HTTPException(status_code=400, detail=f"Invalid date_to '{date_to}'. Expected YYYY-MM-DD.")
+    return from_date, to_date
 
-    try:
-        final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
-        query = db.query(Appointment).filter(Appointment.clinic_id == final_clinic_id)
 
-        # Apply date range filter
-        if from_date:
-            query = query.filter(Appointment.appointment_date >= from_date)
+def _filtered(query, clinic_id, from_date, to_date, status, doctor_id):
+    query = query.filter(Appointment.clinic_id == clinic_id)
+    if from_date:
+        query = query.filter(Appointment.appointment_date >= from_date)
+    if to_date:
+        query = query.filter(Appointment.appointment_date < to_date)
+    if status:
+        query = query.filter(Appointment.status == status)
+    if doctor_id:
+        query = query.filter(Appointment.doctor_id == doctor_id)
+    return query
 
-        if to_date:
-            query = query.filter(Appointment.appointment_date < to_date)
 
-        # Apply status filter
-        if status:
-            query = query.filter(Appointment.status == status)
-        
-        # Apply doctor filter
-        if doctor_id:
-            query = query.filter(Appointment.doctor_id == doctor_id)
-        
+@router.get("", response_model=List[AppointmentOut])
+async def get_appointments(
+    date_from: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+    status: Optional[str] = Query(None, description="Filter by status"),
+    doctor_id: Optional[int] = Query(None, description="Filter by doctor"),
+    clinic_id: Optional[int] = Query(None, description="Explicitly filter by clinic branch"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Get all appointments for the clinic with optional filters"""
+    # Parsed BEFORE the try/except below so a bad date surfaces as a clean 400
+    # instead of being swallowed into a 500.
+    from_date, to_date = _parse_date_range(date_from, date_to)
+
+    try:
+        final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
+        query = _filtered(
+            # Doctor names come from the same query: looking each one up per
+            # row was a query per appointment on a month view.
+            db.query(Appointment, User.name).outerjoin(User, User.id == Appointment.doctor_id),
+            final_clinic_id, from_date, to_date, status, doctor_id,
+        )
         appointments = query.order_by(Appointment.appointment_date.asc()).all()
-        
-        # Enrich with doctor names
+
         result = []
-        for apt in appointments:
-            doctor_name = None
-            if apt.doctor_id:
-                doctor = db.query(User).filter(User.id == apt.doctor_id).first()
-                if doctor:
-                    doctor_name = doctor.name
-            
+        for apt, doctor_name in appointments:
             result.append(AppointmentOut(
                 id=apt.id,
                 clinic_id=apt.clinic_id,
@@ -683,6 +671,126 @@ async def get_appointments(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching appointments: {str(e)}")
 
+
+# What the calendar grid draws, in this order. Rows go out as arrays against
+# this header rather than as objects, so a month of bookings does not repeat
+# every key name hundreds of times.
+CALENDAR_FIELDS = (
+    "id", "patient_id", "patient_name", "patient_phone", "doctor_id", "doctor_name",
+    "treatment", "date", "start_time", "end_time", "status", "chair_number", "series_id",
+)
+CALENDAR_PAGE_MAX = 2000
+
+
+def _encode_cursor(at: datetime, appointment_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{at.isoformat()}|{appointment_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    try:
+        at, appointment_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(at), int(appointment_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/calendar")
+def get_calendar(
+    date_from: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+    status: Optional[str] = Query(None),
+    doctor_id: Optional[int] = Query(None),
+    clinic_id: Optional[int] = Query(None, description="Explicitly filter by clinic branch"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(500, ge=1, le=CALENDAR_PAGE_MAX),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """The calendar's read path: one query, only the columns it draws.
+
+    Pages run in (appointment_date, id) order; pass `next_cursor` back to get
+    the next one, which stays stable while bookings are added behind it. The
+    response carries an ETag, so a poll that sends it back as If-None-Match
+    gets an empty 304 until something in the range changes.
+    """
+    from_date, to_date = _parse_date_range(date_from, date_to)
+    final_clinic_id = clinic_id if (clinic_id and current_user.role == 'clinic_owner') else current_user.clinic_id
+
+    query = _filtered(
+        db.query(
+            Appointment.id, Appointment.patient_id, Appointment.patient_name, Appointment.patient_phone,
+            Appointment.doctor_id, User.name, Appointment.treatment, Appointment.appointment_date,
+            Appointment.start_time, Appointment.end_time, Appointment.status,
+            Appointment.chair_number, Appointment.series_id,
+        ).outerjoin(User, User.id == Appointment.doctor_id),
+        final_clinic_id, from_date, to_date, status, doctor_id,
+    )
+    if cursor:
+        after_at, after_id = _decode_cursor(cursor)
+        query = query.filter(or_(
+            Appointment.appointment_date > after_at,
+            and_(Appointment.appointment_date == after_at, Appointment.id > after_id),
+        ))
+    rows = query.order_by(Appointment.appointment_date.asc(), Appointment.id.asc()).limit(limit + 1).all()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    payload = {
+        "fields": CALENDAR_FIELDS,
+        "rows": [
+            [r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7].strftime("%Y-%m-%d"), *r[8:]]
+            for r in rows
+        ],
+        "next_cursor": _encode_cursor(rows[-1][7], rows[-1][0]) if more else None,
+    }
+    return conditional_json(payload, if_none_match)
+
+
+# A comment line this often keeps proxies from closing an idle stream.
+CHANGES_KEEPALIVE_S = 25
+
+
+@router.get("/changes")
+async def appointment_changes(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+):
+    """Server-sent events for every appointment change in the caller's clinic.
+
+    Read the calendar once, then apply these. See change_feed for the event
+    shape; on "resync" or a gap in the ids, read the calendar again.
+    """
+    clinic_id = current_user.clinic_id
+    # Authentication is done. Without this the request's session, and the
+    # pooled connection it holds, would stay checked out for as long as the
+    # stream is open.
+    object_session(current_user).close()
+
+    queue = await change_feed.hub.subscribe(clinic_id)
+
+    async def stream():
+        try:
+            yield f"retry: 5000\nevent: ready\ndata: {json.dumps({'clinic_id': clinic_id})}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=CHANGES_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield change_feed.format_sse(event)
+        finally:
+            change_feed.hub.unsubscribe(clinic_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get("/needs-outcome")
 def needs_outcome(
     limit: int = Query(50, le=200),
@@ -794,6 +902,7 @@ def set_outcome(
                     entity_type="appointment",
                     entity_id=appointment.id,
                 )
+                waitlist.offer_freed_slot(db, appointment, actor_user_id=current_user.id)
             else:
                 notify(
                     db,
@@ -900,7 +1009,8 @@ def start_visit(
 
     # Starting the visit means they are here, so the booking catches up if the
     # front desk never marked them in.
-    if normalize_status(appointment.status) in (SCHEDULED, CONFIRMED):
+    arrived = normalize_status(appointment.status) in (SCHEDULED, CONFIRMED)
+    if arrived:
         appointment.status = ARRIVED
 
     db.commit()
@@ -1265,6 +1375,8 @@ async def update_appointment(
         raise
     except Exception as e:
         db.rollback()
+        if is_double_booking(e):
+            raise HTTPException(status_code=409, detail=DOUBLE_BOOKED_DETAIL)
         raise HTTPException(status_code=500, detail=f"Error updating appointment: {str(e)}")
 
 @router.delete("/{appointment_id}")
@@ -1283,9 +1395,17 @@ async def delete_appointment(
         if not appointment:
             raise HTTPException(status_code=404, detail="Appointment not found")
         
+        # Offered before the row goes, so the offer lands in the same commit.
+        if normalize_status(appointment.status) in OPEN_STATUSES:
+            try:
+                waitlist.offer_freed_slot(db, appointment, actor_user_id=current_user.id)
+            except Exception:
+                logger.exception("waitlist offer failed for appointment %s", appointment_id)
+                db.rollback()
+
         db.delete(appointment)
         db.commit()
-        
+
         return {"message": "Appointment deleted successfully"}
     except HTTPException:
         raise
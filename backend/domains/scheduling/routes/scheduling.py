@@ -19,8 +19,11 @@ from models import (Appointment, AppointmentWaitlist, Clinic, DoctorAvailability
 from domains.scheduling.appointment_status import (CANCELLED, OPEN_STATUSES,
                                                    SCHEDULED, normalize_status)
 from domains.scheduling.availability import (SLOT_MINUTES, check_available,
-                                             find_conflict, free_slots,
-                                             to_hhmm, to_minutes, working_blocks)
+                                             find_conflict, is_double_booking,
+                                             to_hhmm, to_minutes)
+from domains.scheduling.availability_engine import ClinicAvailability
+from domains.scheduling import change_feed, waitlist
+from domains.scheduling.series_planner import ALTERNATIVE_WINDOW_DAYS, Wanted, plan_visits
 from core.roles import CLINICAL_ROLES
 
 router = APIRouter(prefix="/scheduling", tags=["scheduling"])
@@ -209,17 +212,14 @@ def day_shape(
         .all()
     )
     clinic = db.query(Clinic).filter(Clinic.id == current_user.clinic_id).first()
+    avail = ClinicAvailability.for_request(db, current_user.clinic_id, on, on, with_appointments=False)
+    grid = avail.working_grid((d.id for d in doctors), on, on)
 
     out = {}
     for d in doctors:
-        blocks = working_blocks(db, current_user.clinic_id, d.id, on)
-        configured = db.query(DoctorAvailability.id).filter(
-            DoctorAvailability.clinic_id == current_user.clinic_id,
-            DoctorAvailability.doctor_id == d.id,
-        ).first() is not None
         out[str(d.id)] = {
-            "configured": configured,
-            "blocks": [{"start": to_hhmm(s), "end": to_hhmm(e)} for s, e in blocks],
+            "configured": avail.has_availability(d.id),
+            "blocks": [{"start": to_hhmm(s), "end": to_hhmm(e)} for s, e in grid[d.id][on]],
         }
 
     return {
@@ -242,7 +242,38 @@ def get_free_slots(
         "date": on.isoformat(),
         "doctor_id": doctor_id,
         "duration": duration,
-        "slots": free_slots(db, current_user.clinic_id, doctor_id, on, duration),
+        "slots": ClinicAvailability.for_request(db, current_user.clinic_id, on, on).free_slots(doctor_id, on, duration),
+    }
+
+
+@router.get("/next-available")
+def next_available(
+    doctor_id: int,
+    duration: int = 30,
+    start: Optional[date] = None,
+    days: int = Query(14, ge=1, le=62),
+    limit: int = Query(5, ge=1, le=50),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """The first free slots for this doctor over the next `days` days.
+
+    "When can Dr Rao next fit in an hour" used to mean paging through
+    /free-slots a day at a time. Starts already past today are skipped.
+    """
+    first = start or date.today()
+    last = first + timedelta(days=days - 1)
+    avail = ClinicAvailability.for_request(db, current_user.clinic_id, first, last)
+    now = datetime.now()
+    found = avail.next_available(
+        doctor_id, duration, limit, earliest=(now.date(), now.hour * 60 + now.minute),
+    )
+    return {
+        "doctor_id": doctor_id,
+        "duration": duration,
+        "from": first.isoformat(),
+        "to": last.isoformat(),
+        "slots": [{"date": d.isoformat(), "start_time": to_hhmm(m)} for d, m in found],
     }
 
 
@@ -293,6 +324,28 @@ class SeriesPayload(BaseModel):
     duration: int = 30
     occurrences: int = 3
     interval_days: int = 7
+    # Offer the nearest free slot for each date that had to be skipped
+    suggest_alternatives: bool = False
+
+
+def _snapshot_for(db: Session, clinic_id: int, dates: List[date]) -> ClinicAvailability:
+    """One availability load covering `dates` and the alternatives around them."""
+    pad = timedelta(days=ALTERNATIVE_WINDOW_DAYS)
+    return ClinicAvailability.load(db, clinic_id, min(dates) - pad, max(dates) + pad)
+
+
+def _flush_visits(db: Session) -> None:
+    """The plan's single write. A clash the snapshot could not see (another
+    booking committed meanwhile) undoes the lot rather than half of it."""
+    try:
+        db.flush()
+    except Exception as e:
+        db.rollback()
+        if is_double_booking(e):
+            raise HTTPException(status_code=409, detail=(
+                "One of these slots was just booked by someone else. Nothing was saved; please try again."
+            ))
+        raise
 
 
 @router.post("/series")
@@ -316,49 +369,132 @@ def create_series(
     if payload.interval_days < 1:
         raise HTTPException(status_code=400, detail="Visits must be at least a day apart")
 
+    clinic_id = current_user.clinic_id
     series_id = uuid.uuid4().hex[:16]
-    end_time = to_hhmm(to_minutes(payload.start_time) + payload.duration)
-
-    created, skipped = [], []
-    for i in range(payload.occurrences):
-        on = payload.start_date + timedelta(days=payload.interval_days * i)
-
-        reason = check_available(db, current_user.clinic_id, payload.doctor_id,
-                                 on, payload.start_time, end_time)
-        clash = find_conflict(db, current_user.clinic_id, payload.doctor_id,
-                              on, payload.start_time, end_time)
-        if reason or clash:
-            skipped.append({
-                "date": on.isoformat(),
-                "reason": reason or f"Clashes with {clash.patient_name} at {clash.start_time}",
-            })
-            continue
-
-        appt = Appointment(
-            clinic_id=current_user.clinic_id,
+    wanted = [
+        Wanted(payload.doctor_id, payload.start_date + timedelta(days=payload.interval_days * i),
+               payload.start_time, payload.duration)
+        for i in range(payload.occurrences)
+    ]
+    avail = _snapshot_for(db, clinic_id, [w.on for w in wanted])
+
+    def build(i: int, w: Wanted, end_time: str) -> Appointment:
+        return Appointment(
+            clinic_id=clinic_id,
             patient_id=payload.patient_id,
             patient_name=payload.patient_name,
             patient_phone=payload.patient_phone,
-            doctor_id=payload.doctor_id,
+            doctor_id=w.doctor_id,
             treatment=payload.treatment,
-            appointment_date=datetime.combine(
-                on, datetime.strptime(payload.start_time, "%H:%M").time()
-            ),
-            start_time=payload.start_time,
+            appointment_date=datetime.combine(w.on, datetime.strptime(w.start_time, "%H:%M").time()),
+            start_time=w.start_time,
             end_time=end_time,
-            duration=payload.duration,
+            duration=w.duration,
             status=SCHEDULED,
             chair_number=payload.chair_number,
             series_id=series_id,
             visit_number=i + 1,
             created_by=current_user.id,
         )
-        db.add(appt)
-        db.flush()
-        created.append({"id": appt.id, "date": on.isoformat(), "visit_number": i + 1})
 
-    db.commit()
-    return {"series_id": series_id, "created": created, "skipped": skipped}
+    plan = plan_visits(avail, wanted, build, suggest=payload.suggest_alternatives,
+                       not_before=date.today())
+    accepted = [v for v in plan if v.ok]
+    # One flush for every visit: on Postgres the ORM sends them as a single
+    # multi-row INSERT ... RETURNING.
+    db.add_all(v.appointment for v in accepted)
+    _flush_visits(db)
+    # Taken now: after the commit every attribute would be a fresh query.
+    rows = [change_feed.appointment_row(v.appointment) for v in accepted]
+    db.commit()  # change_feed publishes the new visits on commit
+
+    return {
+        "series_id": series_id,
+        "created": [{"id": row["id"], "date": row["date"], "visit_number": v.index + 1}
+                    for v, row in zip(accepted, rows)],
+        "skipped": [v.skipped() for v in plan if not v.ok],
+    }
+
+
+class SeriesReschedulePayload(BaseModel):
+    shift_days: int = 0
+    start_time: Optional[str] = None  # a new time for every moved visit
+    from_visit: int = 1               # leave earlier visits where they are
+    suggest_alternatives: bool = False
+
+
+@router.post("/series/{series_id}/reschedule")
+def reschedule_series(
+    series_id: str,
+    payload: SeriesReschedulePayload,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Move the rest of a course of treatment in one action.
+
+    Every open visit from `from_visit` on moves by `shift_days` and/or to
+    `start_time`. It is all or nothing: if any visit would land on leave, out
+    of hours or on another booking, nothing moves and the problems come back
+    (with alternatives if asked), because a course moved by halves is worse
+    than one not moved at all.
+    """
+    if not payload.shift_days and not payload.start_time:
+        raise HTTPException(status_code=400, detail="Give shift_days, start_time or both")
+
+    visits = (
+        db.query(Appointment)
+        .filter(Appointment.clinic_id == current_user.clinic_id,
+                Appointment.series_id == series_id,
+                Appointment.status.in_(OPEN_STATUSES),
+                Appointment.visit_number >= payload.from_visit)
+        .order_by(Appointment.appointment_date)
+        .all()
+    )
+    if not visits:
+        raise HTTPException(status_code=404, detail="No open visits to move in this series")
+
+    clinic_id = current_user.clinic_id
+    shift = timedelta(days=payload.shift_days)
+    wanted = [
+        Wanted(a.doctor_id, a.appointment_date.date() + shift,
+               payload.start_time or a.start_time, a.duration or 30)
+        for a in visits
+    ]
+    avail = _snapshot_for(db, clinic_id,
+                          [w.on for w in wanted] + [a.appointment_date.date() for a in visits])
+    # Their current slots are about to be vacated, so they must not block the move.
+    for a in visits:
+        avail.discard(a)
+
+    def build(i: int, w: Wanted, end_time: str) -> Appointment:
+        a = visits[i]
+        # Stand-in for the moved visit, so later visits in the plan see it.
+        return Appointment(
+            id=a.id, clinic_id=a.clinic_id, doctor_id=w.doctor_id, patient_name=a.patient_name,
+            appointment_date=datetime.combine(w.on, datetime.strptime(w.start_time, "%H:%M").time()),
+            start_time=w.start_time, end_time=end_time, duration=w.duration,
+        )
+
+    plan = plan_visits(avail, wanted, build, suggest=payload.suggest_alternatives,
+                       not_before=date.today())
+    skipped = [v.skipped() for v in plan if not v.ok]
+    if skipped:
+        return {"series_id": series_id, "moved": [], "skipped": skipped}
+
+    for a, v in zip(visits, plan):
+        a.appointment_date = v.appointment.appointment_date
+        a.start_time = v.appointment.start_time
+        a.end_time = v.appointment.end_time
+    # One flush; the ORM groups the identical UPDATEs into one executemany.
+    _flush_visits(db)
+    rows = [change_feed.appointment_row(a) for a in visits]
+    db.commit()  # change_feed publishes the moves on commit
+
+    return {
+        "series_id": series_id,
+        "moved": [{"id": row["id"], "date": row["date"], "start_time": row["start_time"]} for row in rows],
+        "skipped": [],
+    }
 
 
 @router.get("/series/{series_id}")
@@ -461,30 +597,15 @@ def waitlist_matches(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    """Who on the list would take this freed-up slot.
+    """Who on the list would take this freed-up slot, best match first.
 
-    Called when a cancellation opens a gap. Matching is deliberately loose:
-    a waitlist entry with no preferred window or no named doctor matches
-    anything, because the point is to fill the chair, not to be clever.
+    Cancelling or deleting a booking already offers its slot to the front
+    desk; this is the same match for any gap somebody spots by hand. See
+    waitlist.match for the rules and the ranking.
     """
-    rows = (
-        db.query(AppointmentWaitlist)
-        .filter(AppointmentWaitlist.clinic_id == current_user.clinic_id,
-                AppointmentWaitlist.status == "waiting")
-        .order_by(AppointmentWaitlist.created_at)
-        .all()
-    )
-    out = []
-    for r in rows:
-        if r.preferred_from and on < r.preferred_from:
-            continue
-        if r.preferred_to and on > r.preferred_to:
-            continue
-        if r.doctor_id and doctor_id and r.doctor_id != doctor_id:
-            continue
-        if r.duration > duration:
-            continue
-        out.append({"id": r.id, "patient_name": r.patient_name,
-                    "patient_phone": r.patient_phone, "patient_id": r.patient_id,
-                    "treatment": r.treatment, "duration": r.duration})
+    rows = waitlist.match(db, current_user.clinic_id, on, duration, doctor_id)
+    out = [{"id": r.id, "patient_name": r.patient_name,
+            "patient_phone": r.patient_phone, "patient_id": r.patient_id,
+            "treatment": r.treatment, "duration": r.duration}
+           for r in rows]
     return {"date": on.isoformat(), "start_time": start_time, "matches": out}
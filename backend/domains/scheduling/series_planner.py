@@ -0,0 +1,94 @@
+"""
+Planning a run of visits against one availability snapshot.
+
+Booking a course of treatment, or moving one, is the same question asked N
+times: is the doctor working then, and is the slot free? Asked of the
+database that was N rounds of queries and a flush per visit. Here every visit
+is decided against a `ClinicAvailability` loaded once for the whole span, and
+each accepted visit is added to that snapshot straight away, so visits in the
+same plan cannot collide with each other. The caller then writes the accepted
+visits in a single flush.
+
+A skipped visit can come with the nearest free slot as a suggestion: the same
+day if anything is free, otherwise the closest day within a few days either
+side. Suggestions are not held, so two skipped visits close together may be
+offered the same slot.
+"""
+from dataclasses import dataclass
+from datetime import date
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from models import Appointment
+from domains.scheduling.availability import to_hhmm, to_minutes
+from domains.scheduling.availability_engine import ClinicAvailability
+
+# How far either side of a skipped date to look for an alternative. Callers
+# load the snapshot this much wider than the dates they ask about.
+ALTERNATIVE_WINDOW_DAYS = 3
+
+
+@dataclass
+class Wanted:
+    doctor_id: Optional[int]
+    on: date
+    start_time: str
+    duration: int
+
+
+@dataclass
+class PlannedVisit:
+    index: int
+    wanted: Wanted
+    end_time: str
+    appointment: Optional[Appointment] = None  # set when the visit fits
+    reason: Optional[str] = None
+    alternative: Optional[Tuple[date, int]] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.appointment is not None
+
+    def skipped(self) -> dict:
+        out = {"date": self.wanted.on.isoformat(), "reason": self.reason}
+        if self.alternative is not None:
+            day, minute = self.alternative
+            out["alternative"] = {
+                "date": day.isoformat(),
+                "start_time": to_hhmm(minute),
+                "end_time": to_hhmm(minute + self.wanted.duration),
+            }
+        return out
+
+
+def plan_visits(
+    avail: ClinicAvailability,
+    wanted: Sequence[Wanted],
+    build: Callable[[int, Wanted, str], Appointment],
+    suggest: bool = False,
+    not_before: Optional[date] = None,
+) -> List[PlannedVisit]:
+    """Decide each wanted visit, in order.
+
+    `build(index, wanted, end_time)` makes the Appointment for a visit that
+    fits; it is added to `avail` so later visits see it, and is not added to
+    any session. With `suggest`, a visit that does not fit gets the nearest
+    free slot for the same doctor, no earlier than `not_before`.
+    """
+    plan: List[PlannedVisit] = []
+    for i, w in enumerate(wanted):
+        end_time = to_hhmm(to_minutes(w.start_time) + w.duration)
+        visit = PlannedVisit(i, w, end_time)
+        reason = avail.check_available(w.doctor_id, w.on, w.start_time, end_time)
+        clash = None if reason else avail.find_conflict(w.doctor_id, w.on, w.start_time, end_time)
+        if reason or clash:
+            visit.reason = reason or f"Clashes with {clash.patient_name} at {clash.start_time}"
+            if suggest and w.doctor_id:
+                visit.alternative = avail.nearest_free(
+                    w.doctor_id, w.on, to_minutes(w.start_time), w.duration,
+                    ALTERNATIVE_WINDOW_DAYS, not_before=not_before,
+                )
+        else:
+            visit.appointment = build(i, w, end_time)
+            avail.add(visit.appointment)
+        plan.append(visit)
+    return plan
@@ -0,0 +1,90 @@
+"""
+Matching the waiting list to a freed slot.
+
+The waiting list used to be read whole and filtered in Python every time
+someone asked who could take a gap, and nobody asked unless they remembered
+to: a cancellation freed a slot and the list sat there. Now the match is one
+indexed query (clinic, status, doctor, window) with a limit, so its cost does
+not grow with the list, and cancelling or deleting an open booking offers the
+slot to the front desk by itself.
+
+Matching stays deliberately loose: an entry with no preferred window or no
+named doctor matches anything, because the point is to fill the chair. The
+ranking puts people who asked for this doctor by name first, then those whose
+window closes soonest, then whoever has waited longest.
+"""
+from datetime import date
+from typing import List, Optional
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from models import Appointment, AppointmentWaitlist
+from domains.scheduling.availability import stored_minutes
+
+WAITING = "waiting"
+MATCH_LIMIT = 50
+# Names listed in a freed-slot notification; the rest are one click away.
+NOTIFY_TOP = 3
+
+
+def match(
+    db: Session, clinic_id: int, on: date, duration: int,
+    doctor_id: Optional[int] = None, limit: int = MATCH_LIMIT,
+) -> List[AppointmentWaitlist]:
+    """Waiting entries that would take `duration` minutes on `on`, best first."""
+    W = AppointmentWaitlist
+    q = db.query(W).filter(
+        W.clinic_id == clinic_id,
+        W.status == WAITING,
+        or_(W.preferred_from.is_(None), W.preferred_from <= on),
+        or_(W.preferred_to.is_(None), W.preferred_to >= on),
+        W.duration <= duration,
+    )
+    order = []
+    if doctor_id:
+        q = q.filter(or_(W.doctor_id.is_(None), W.doctor_id == doctor_id))
+        order.append(W.doctor_id.is_(None))
+    order += [W.preferred_to.is_(None), W.preferred_to, W.created_at, W.id]
+    return q.order_by(*order).limit(limit).all()
+
+
+def offer_freed_slot(db: Session, appt: Appointment, actor_user_id: Optional[int] = None) -> int:
+    """Tell the front desk who on the waiting list could take `appt`'s slot.
+
+    Call it while the slot is being freed (cancelled, deleted) and before the
+    commit, like notify() itself. Past slots are not offered. Returns how many
+    matches were found, at most NOTIFY_TOP + 1.
+    """
+    on = appt.appointment_date.date()
+    if on < date.today():
+        return 0
+    start = stored_minutes(appt.start_minute, appt.start_time)
+    duration = stored_minutes(appt.end_minute, appt.end_time) - start
+    found = match(db, appt.clinic_id, on, duration or appt.duration or 0,
+                  appt.doctor_id, limit=NOTIFY_TOP + 1)
+    if not found:
+        return 0
+
+    from domains.notification.services.notification_center_service import (
+        notify, FRONT_DESK, SEVERITY_ACTION,
+    )
+    names = ", ".join(
+        f"{w.patient_name} ({w.patient_phone})" if w.patient_phone else w.patient_name
+        for w in found[:NOTIFY_TOP]
+    )
+    more = " and others" if len(found) > NOTIFY_TOP else ""
+    notify(
+        db,
+        clinic_id=appt.clinic_id,
+        event_type="waitlist_slot_freed",
+        severity=SEVERITY_ACTION,
+        audience=FRONT_DESK,
+        actor_user_id=actor_user_id,
+        title="Freed slot matches the waiting list",
+        body=f"{on.strftime('%d %b')} at {appt.start_time}: {names}{more} could take it",
+        link="/appointments",
+        entity_type="appointment",
+        entity_id=appt.id,
+    )
+    return len(found)
@@ -37,8 +37,9 @@ from core.permissions import permission_manager
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from database import get_db, engine
-from models import Base, ClinicalAsset
-from domains.infrastructure.services.r2_storage import get_presigned_url
+from models import Base, ClinicalAsset, User
+from core.auth_utils import require_clinic_owner
+from domains.infrastructure.services.r2_storage import R2_MAX_POOL_CONNECTIONS, get_presigned_url, storage_metrics
 from fastapi import Depends
 # Domain imports (using clean architecture routes)
 from domains.patient.routes import patients_clean as patients
@@ -51,8 +52,11 @@ from domains.clinic.routes import clinics, subscriptions
 from domains.finance.routes import payments_clean as payments, invoices, ledger, offers
 from domains.communication.routes import notifications, message_templates
 from domains.scheduling.routes import attendance, attendance_mobile, appointments, scheduling, appointment_stats
+from domains.scheduling.availability import DOUBLE_BOOKING_CONSTRAINT
+from domains.scheduling import appointment_facts, change_feed
 from domains.medical.routes import reports, xray, medications
-from domains.analytics.routes import dashboard, dashboard_reports, kpi_detail
+from domains.analytics.routes import dashboard, dashboard_export, dashboard_reports, kpi_detail
+from domains.analytics import geocoding
 from domains.infrastructure.routes import devices, sync, template_configs
 from domains.infrastructure.services.template_service import TemplateService
 from domains.gmail.routes import gmail_routes
@@ -64,7 +68,7 @@ from domains.inventory.routes import medications as medication_stock
 from domains.inventory.routes import transactions as inventory_transactions
 from domains.inventory.routes import medication_groups
 from domains.consent.routes import consents, consents_internal
-from domains.document.routes import documents
+from domains.document.routes import documents, direct_uploads
 from domains.clinical.routes import settings_router, case_papers_router, prescriptions_router, lab_orders_router, inventory_consumption_router, case_costs_router
 from domains.notification.routes import notification_admin, push_notifications
 from domains.notification.routes import wareach as wareach_routes
@@ -535,10 +539,109 @@ async def lifespan(app: FastAPI):
                     CONSTRAINT uq_feature_vote UNIQUE (feature_request_id, user_id)
                 )
             """))
+            # Upload-time previews (WebP). NULL means "not rendered yet"; the
+            # thumbnail endpoint then falls back to rendering on first view.
+            for _ddl in (
+                "ALTER TABLE patient_documents ADD COLUMN IF NOT EXISTS thumbnail_key VARCHAR",
+                "ALTER TABLE patient_documents ADD COLUMN IF NOT EXISTS preview_key VARCHAR",
+                "ALTER TABLE xray_images ADD COLUMN IF NOT EXISTS thumbnail_key VARCHAR",
+                "ALTER TABLE xray_images ADD COLUMN IF NOT EXISTS preview_key VARCHAR",
+            ):
+                conn.execute(text(_ddl))
+            # Appointment times as minutes from midnight (kept in sync by an ORM
+            # listener on Appointment) plus the index every clash check uses.
+            for _ddl in (
+                "ALTER TABLE appointments ADD COLUMN IF NOT EXISTS start_minute INTEGER",
+                "ALTER TABLE appointments ADD COLUMN IF NOT EXISTS end_minute INTEGER",
+                "UPDATE appointments SET start_minute = split_part(start_time, ':', 1)::int * 60 "
+                "+ split_part(start_time, ':', 2)::int "
+                "WHERE start_minute IS NULL AND start_time ~ '^[0-9]{1,2}:[0-9]{2}'",
+                "UPDATE appointments SET end_minute = split_part(end_time, ':', 1)::int * 60 "
+                "+ split_part(end_time, ':', 2)::int "
+                "WHERE end_minute IS NULL AND end_time ~ '^[0-9]{1,2}:[0-9]{2}'",
+                "CREATE INDEX IF NOT EXISTS ix_appointments_clinic_doctor_date "
+                "ON appointments (clinic_id, doctor_id, appointment_date)",
+            ):
+                conn.execute(text(_ddl))
+            # The waitlist matcher's lookup (clinic, status, doctor, window).
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_waitlist_clinic_status_doctor_window "
+                "ON appointment_waitlist (clinic_id, status, doctor_id, preferred_from, preferred_to)"
+            ))
+            # Patient map: the gazetteer entry each village resolved to.
+            for _ddl in (
+                "ALTER TABLE patients ADD COLUMN IF NOT EXISTS geocode_key VARCHAR",
+                "CREATE INDEX IF NOT EXISTS ix_patients_clinic_geocode ON patients (clinic_id, geocode_key)",
+            ):
+                conn.execute(text(_ddl))
             conn.commit()
     except Exception as e:
         print(f"⚠️  Column migration skipped: {e}")
 
+    # Database-enforced double-booking guard, opt-in. find_conflict catches
+    # clashes at request time, but two receptionists booking the same slot at
+    # the same moment both pass it; this constraint makes the second write
+    # fail. Opt-in because creation fails while any overlapping open
+    # bookings already exist, and it needs the btree_gist extension.
+    if os.getenv("APPOINTMENT_EXCLUSION_CONSTRAINT", "").lower() in ("1", "true", "yes"):
+        try:
+            with engine.connect() as conn:
+                exists = conn.execute(text(
+                    "SELECT 1 FROM pg_constraint WHERE conname = :name"
+                ), {"name": DOUBLE_BOOKING_CONSTRAINT}).first()
+                if not exists:
+                    conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+                    conn.execute(text(
+                        f"ALTER TABLE appointments ADD CONSTRAINT {DOUBLE_BOOKING_CONSTRAINT} "
+                        "EXCLUDE USING gist ("
+                        "clinic_id WITH =, doctor_id WITH =, (appointment_date::date) WITH =, "
+                        "int4range(start_minute, end_minute) WITH &&"
+                        ") WHERE (doctor_id IS NOT NULL AND end_minute > start_minute "
+                        "AND status IN ('scheduled', 'confirmed', 'arrived'))"
+                    ))
+                    conn.commit()
+                    print("✅ Appointment double-booking constraint created")
+        except Exception as e:
+            print(f"⚠️  Appointment double-booking constraint skipped: {e}")
+
+    # Appointment stats cube: fill it once on a database that predates it.
+    # After that every appointment write keeps it current; the backfill
+    # script rebuilds it on demand.
+    try:
+        from database import SessionLocal
+        from models import Appointment, AppointmentStatsFact
+        db = SessionLocal()
+        try:
+            if (db.query(AppointmentStatsFact.clinic_id).first() is None
+                    and db.query(Appointment.id).first() is not None):
+                cells = appointment_facts.rebuild(db)
+                db.commit()
+                print(f"✅ Appointment stats cube backfilled ({cells} cells)")
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"⚠️  Appointment stats backfill skipped: {e}")
+
+    # Patient map gazetteer, once: load the bundled places into an empty
+    # `geocodes` table and geocode the patients saved before villages were
+    # resolved on write. Every later boot (and every worker) finds the table
+    # filled and does nothing; reload after a gazetteer change with
+    # scripts/load_gazetteer.py.
+    try:
+        from database import SessionLocal
+        from models import Geocode
+        db = SessionLocal()
+        try:
+            if db.query(Geocode.key).first() is None:
+                places = geocoding.load(db, geocoding.bundled_rows())
+                located = geocoding.backfill(db)
+                db.commit()
+                print(f"✅ Gazetteer loaded ({places} entries), geocoded {located} patients")
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"⚠️  Patient geocoding skipped: {e}")
+
     # Seed system-wide medication catalogue (powers the prescription typeahead).
     try:
         from seed_medications import seed_system_medications
@@ -575,6 +678,7 @@ async def lifespan(app: FastAPI):
         shutdown_scheduler()
     except Exception as exc:
         print(f"APScheduler shutdown error: {exc}")
+    await change_feed.hub.close()
     await cache_service.close()
     print("Application shutdown complete")
 
@@ -695,6 +799,8 @@ app.include_router(dashboard.router, prefix="/api/v1/dashboard", tags=["dashboar
 # Same envelope as the Payments drawer, so the dashboard uses the one
 # KpiDetailDrawer the rest of the app already uses.
 app.include_router(kpi_detail.router, prefix="/api/v1/dashboard", tags=["dashboard"])
+# CSV export: streamed from one snapshot, or queued for a worker (rq).
+app.include_router(dashboard_export.router, prefix="/api/v1/dashboard", tags=["dashboard"])
 app.include_router(dashboard_reports.router, prefix="/api/v1/dashboard/reports", tags=["dashboard_reports"])
 app.include_router(devices.router, prefix="/api/v1/devices", tags=["devices"])
 app.include_router(sync.router, prefix="/api/v1/sync", tags=["sync"])
@@ -722,6 +828,7 @@ app.include_router(consents.router, prefix="/api/v1/consents", tags=["consents"]
 # X-Internal-Auth header; never call from public clients.
 app.include_router(consents_internal.router, prefix="/api/v1/internal", tags=["internal"])
 app.include_router(documents.router, prefix="/api/v1/documents", tags=["documents"])
+app.include_router(direct_uploads.router, prefix="/api/v1/direct-uploads", tags=["direct_uploads"])
 
 # Notification Admin Domain
 app.include_router(notification_admin.router, prefix="/api/v1/notification-admin", tags=["notification-admin"])
@@ -768,6 +875,12 @@ def health_check():
     """Health check endpoint for desktop app server status"""
     return {"status": "healthy", "message": "Backend is running"}
 
+@app.get("/health/storage")
+def storage_health(_: User = Depends(require_clinic_owner)):
+    """R2 call counts, failures, bytes and latency for this worker process.
+    Operational detail, so clinic owners only, unlike /health."""
+    return {"pool_size": R2_MAX_POOL_CONNECTIONS, "operations": storage_metrics.snapshot()}
+
 @app.get("/api/v1/clinical-assets")
 def get_clinical_assets(category: str = "anatomy", db: Session = Depends(get_db)):
     """Fetch all clinical assets and their secure R2 links"""
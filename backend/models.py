@@ -1,9 +1,11 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, ForeignKey, Text, JSON, Float, Table, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, ForeignKey, Text, JSON, Float, Table, UniqueConstraint, Index, event
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 import uuid
 import datetime
 
+from domains.scheduling.minutes import to_minutes
+
 Base = declarative_base()
 
 
@@ -228,6 +230,9 @@ class Patient(Base):
     date_of_birth = Column(Date, nullable=True)  # Optional; age can be derived from this
     gender = Column(String, nullable=True)
     village = Column(String, nullable=True)
+    # The `geocodes` entry `village` resolved to, set on every write by
+    # domains/analytics/geocoding.py; NULL while it matches nothing.
+    geocode_key = Column(String, nullable=True)
     phone = Column(String, nullable=False)
     email = Column(String, nullable=True)
     referred_by = Column(String, nullable=True)
@@ -263,6 +268,10 @@ class Patient(Base):
     sync_status = Column(String, default='local')  # 'local', 'synced', 'pending'
     clinic = relationship("Clinic")
 
+    __table_args__ = (
+        Index('ix_patients_clinic_geocode', 'clinic_id', 'geocode_key'),
+    )
+
 class Prescription(Base):
     """Dedicated prescription table — one record per prescription (per visit)."""
     __tablename__ = 'prescriptions'
@@ -498,6 +507,11 @@ class Appointment(Base):
     appointment_date = Column(DateTime, nullable=False)  # Date and start time combined
     start_time = Column(String, nullable=False)  # e.g., "09:00"
     end_time = Column(String, nullable=False)  # e.g., "10:30"
+    # The same two times as minutes from midnight, so clash checks compare
+    # integers in SQL instead of parsing strings in Python. Never set these
+    # directly: _sync_appointment_minutes derives them on every ORM write.
+    start_minute = Column(Integer, nullable=True)
+    end_minute = Column(Integer, nullable=True)
     duration = Column(Integer, nullable=False, default=60)  # Duration in minutes
     # See domains/scheduling/appointment_status.py for the vocabulary. Do not
     # invent values here: this comment used to claim four statuses that nothing
@@ -534,6 +548,80 @@ class Appointment(Base):
     doctor = relationship("User", foreign_keys=[doctor_id])
     creator = relationship("User", foreign_keys=[created_by])
 
+    # Clash checks, the calendar and the free-slot search all ask "this
+    # doctor, this clinic, this day".
+    __table_args__ = (
+        Index('ix_appointments_clinic_doctor_date', 'clinic_id', 'doctor_id', 'appointment_date'),
+    )
+
+
+@event.listens_for(Appointment, "before_insert")
+@event.listens_for(Appointment, "before_update")
+def _sync_appointment_minutes(mapper, connection, target):
+    # The parser every reader of the strings uses, so the columns never
+    # disagree with them and are never NULL for a row written through here.
+    target.start_minute = to_minutes(target.start_time)
+    target.end_minute = to_minutes(target.end_time)
+
+
+class AppointmentStatsFact(Base):
+    """Appointment counts per clinic, day, doctor, status and hour of day.
+
+    A summary of `appointments`, not a source of truth: every ORM write to an
+    Appointment adjusts the cells it touches, and
+    domains/scheduling/appointment_facts.py can rebuild the lot from scratch.
+    Unassigned appointments are doctor_id 0 so the key has no NULLs in it.
+    """
+    __tablename__ = 'appointment_stats_facts'
+    clinic_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    doctor_id = Column(Integer, primary_key=True, default=0)
+    status = Column(String, primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    appointments = Column(Integer, nullable=False, default=0)
+    minutes = Column(Integer, nullable=False, default=0)  # summed duration
+    # Booking lead time (appointment day minus booking day) over the rows where
+    # it is known and not negative.
+    lead_days = Column(Integer, nullable=False, default=0)
+    lead_count = Column(Integer, nullable=False, default=0)
+    same_day = Column(Integer, nullable=False, default=0)
+
+
+class ReportPeriodStat(Base):
+    """One clinic's weekly or monthly report figures for one period.
+
+    A summary, not a source of truth: written by
+    domains/notification/services/report_period_stats.py. A closed period
+    (it ended before the row was computed) is computed once from the raw
+    tables and then only read. The period still running is a tally that is
+    topped up from `computed_through` onwards and recomputed when it closes.
+    """
+    __tablename__ = 'report_period_stats'
+    clinic_id = Column(Integer, primary_key=True)
+    kind = Column(String, primary_key=True)  # 'week' | 'month'
+    period_start = Column(Date, primary_key=True)
+    period_end = Column(Date, nullable=False)  # exclusive
+    measures = Column(JSON, nullable=False)
+    closed = Column(Boolean, nullable=False, default=False)
+    computed_through = Column(DateTime, nullable=False)
+    computed_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class Geocode(Base):
+    """A place the patient map can plot, keyed by normalised name or pincode.
+
+    Filled from the offline gazetteer (config/gazetteer_in.csv, plus a GeoNames
+    postal file when one is loaded); see domains/analytics/geocoding.py.
+    Aliases of one place are separate keys with the same label and point.
+    """
+    __tablename__ = 'geocodes'
+    key = Column(String, primary_key=True)
+    label = Column(String, nullable=False)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    source = Column(String, nullable=False, default='bundled')  # 'bundled' | 'geonames'
+
+
 class Subscription(Base):
     __tablename__ = 'subscriptions'
     id = Column(Integer, primary_key=True, index=True)
@@ -866,6 +954,9 @@ class XrayImage(Base):
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     synced_at = Column(DateTime, nullable=True)
     sync_status = Column(String, default='local')  # 'local', 'synced', 'pending'
+    # WebP renders written by the upload-time preview pipeline; NULL until it runs.
+    thumbnail_key = Column(String, nullable=True)
+    preview_key = Column(String, nullable=True)
     
     # Relationships
     clinic = relationship("Clinic")
@@ -982,6 +1073,12 @@ class AppointmentWaitlist(Base):
     patient = relationship("Patient")
     doctor = relationship("User", foreign_keys=[doctor_id])
 
+    # Matching a freed slot filters on exactly these, in this order.
+    __table_args__ = (
+        Index('ix_waitlist_clinic_status_doctor_window',
+              'clinic_id', 'status', 'doctor_id', 'preferred_from', 'preferred_to'),
+    )
+
 
 class Vendor(Base):
     __tablename__ = 'vendors'
@@ -1067,6 +1164,9 @@ class PatientDocument(Base):
     file_size = Column(Integer)
     file_type = Column(String)  # pdf, dicom, png, etc.
     uploaded_by = Column(Integer, ForeignKey('users.id'))
+    # WebP renders written by the upload-time preview pipeline; NULL until it runs.
+    thumbnail_key = Column(String, nullable=True)  # list tile
+    preview_key = Column(String, nullable=True)    # viewer placeholder
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     
@@ -389,6 +389,9 @@ class XrayImageOut(BaseModel):
     updated_at: datetime
     synced_at: Optional[datetime] = None
     sync_status: str = "local"
+    # Upload-time WebP renders (served by GET /xray/{id}/preview/{size})
+    thumbnail_key: Optional[str] = None
+    preview_key: Optional[str] = None
     
     # Nested patient info
     patient_name: Optional[str] = None
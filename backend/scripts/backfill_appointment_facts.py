@@ -0,0 +1,68 @@
+"""
+Rebuild the appointment stats cube (appointment_stats_facts) from appointments.
+
+Background
+----------
+The appointment-stats endpoints and the dashboard's appointment charts read
+pre-aggregated counts that every ORM write to an Appointment keeps current
+(domains/scheduling/appointment_facts.py). Startup fills the cube once on a
+database that predates it. Run this after anything that changed appointments
+behind the ORM's back (raw SQL, a restore, a bulk delete that skipped
+`retract`), or whenever the numbers look off.
+
+Each clinic is rebuilt in its own transaction, so a long run does not hold
+the whole table.
+
+Usage
+-----
+  # Every clinic
+  python scripts/backfill_appointment_facts.py
+
+  # One clinic
+  python scripts/backfill_appointment_facts.py --clinic-id 12
+
+DATABASE_URL / local DB config is taken from the app's database.py, so run it
+with the environment pointed at whichever DB you intend to rebuild.
+"""
+import argparse
+import sys
+import time
+
+# Make the backend package importable when run as `python scripts/...`
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal  # noqa: E402
+from models import Clinic  # noqa: E402
+from domains.scheduling import appointment_facts  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clinic-id", type=int, default=None, help="Rebuild only this clinic")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.clinic_id is not None:
+            clinic_ids = [args.clinic_id]
+        else:
+            clinic_ids = [cid for (cid,) in db.query(Clinic.id).order_by(Clinic.id).all()]
+
+        total = 0
+        for cid in clinic_ids:
+            started = time.perf_counter()
+            cells = appointment_facts.rebuild(db, cid)
+            db.commit()
+            total += cells
+            print(f"clinic {cid}: {cells} cells in {time.perf_counter() - started:.2f}s")
+        print(f"Done: {len(clinic_ids)} clinic(s), {total} cells.")
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
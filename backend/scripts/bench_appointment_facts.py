@@ -0,0 +1,163 @@
+"""
+Benchmark the appointment stats cube against the raw-appointment queries it replaced.
+
+Builds a synthetic SQLite database (1,000,000 appointments by default, spread
+over a few clinics, doctors and two years), backfills the cube, then times
+each stats endpoint both ways: the old scan of raw appointments and the new
+read of appointment_stats_facts through the real route functions.
+
+Nothing touches the app's configured database; the synthetic one lives in a
+temporary file unless --db says otherwise.
+
+Usage
+-----
+  python scripts/bench_appointment_facts.py
+  python scripts/bench_appointment_facts.py --rows 200000 --clinics 5 --repeat 5
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+# Make the backend package importable when run as `python scripts/...`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import create_engine, func  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import models  # noqa: E402
+from models import Appointment  # noqa: E402
+from domains.analytics.routes.dashboard import get_appointment_trends  # noqa: E402
+from domains.scheduling import appointment_facts  # noqa: E402
+from domains.scheduling.routes.appointment_stats import (appointment_stats, busiest,  # noqa: E402
+                                                         stats_by_doctor)
+
+STATUSES = ["completed"] * 6 + ["no_show", "cancelled", "scheduled", "confirmed"]
+DOCTORS_PER_CLINIC = 6
+
+
+def populate(db, rows, clinics, seed=7):
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    conn = db.connection()
+    batch = []
+    for i in range(rows):
+        clinic_id = 1 + i % clinics
+        when = now - timedelta(days=rng.randrange(730)) + timedelta(hours=rng.randrange(8, 20) - now.hour)
+        duration = rng.choice((15, 30, 30, 45, 60))
+        start = when.hour * 60
+        batch.append({
+            "clinic_id": clinic_id,
+            "doctor_id": (clinic_id - 1) * DOCTORS_PER_CLINIC + rng.randrange(DOCTORS_PER_CLINIC) + 1,
+            "patient_name": f"Patient {i}",
+            "appointment_date": when,
+            "start_time": f"{when.hour:02d}:00",
+            "end_time": f"{(start + duration) // 60:02d}:{(start + duration) % 60:02d}",
+            "start_minute": start,
+            "end_minute": start + duration,
+            "duration": duration,
+            "status": rng.choice(STATUSES),
+            "created_at": when - timedelta(days=rng.randrange(21)),
+        })
+        if len(batch) == 50000:
+            conn.execute(Appointment.__table__.insert(), batch)
+            batch = []
+    if batch:
+        conn.execute(Appointment.__table__.insert(), batch)
+    db.commit()
+
+
+def raw_stats(db, cid, days):
+    end = datetime.utcnow()
+    rows = db.query(Appointment).filter(Appointment.clinic_id == cid,
+                                        Appointment.appointment_date >= end - timedelta(days=days),
+                                        Appointment.appointment_date <= end).all()
+    return len(rows)
+
+
+def raw_by_doctor(db, cid, days):
+    end = datetime.utcnow()
+    return db.query(Appointment.doctor_id, Appointment.status, func.count(Appointment.id)).filter(
+        Appointment.clinic_id == cid,
+        Appointment.appointment_date >= end - timedelta(days=days),
+        Appointment.appointment_date <= end,
+    ).group_by(Appointment.doctor_id, Appointment.status).all()
+
+
+def raw_busiest(db, cid, days):
+    end = datetime.utcnow()
+    return len(db.query(Appointment).filter(
+        Appointment.clinic_id == cid, Appointment.status != "cancelled",
+        Appointment.appointment_date >= end - timedelta(days=days),
+        Appointment.appointment_date <= end,
+    ).all())
+
+
+def raw_trends(db, cid):
+    end = datetime.utcnow()
+    return len(db.query(Appointment.appointment_date, Appointment.status).filter(
+        Appointment.clinic_id == cid,
+        Appointment.appointment_date >= end - timedelta(days=730),
+    ).all())
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--clinics", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--db", default=None, help="SQLite file to build (default: a temp file)")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(engine, tables=[
+        models.Clinic.__table__, models.User.__table__, models.Patient.__table__,
+        models.Appointment.__table__, models.AppointmentStatsFact.__table__,
+    ])
+    db = sessionmaker(bind=engine)()
+
+    started = time.perf_counter()
+    populate(db, args.rows, args.clinics)
+    print(f"populated {args.rows} appointments in {time.perf_counter() - started:.1f}s ({path})")
+
+    started = time.perf_counter()
+    cells = appointment_facts.rebuild(db)
+    db.commit()
+    print(f"backfilled {cells} cells in {time.perf_counter() - started:.1f}s")
+
+    user = SimpleNamespace(clinic_id=1, role="clinic_owner")
+    cases = [
+        ("appointment_stats 730d", lambda: raw_stats(db, 1, 730),
+         lambda: appointment_stats(days=730, db=db, current_user=user)),
+        ("stats_by_doctor 730d", lambda: raw_by_doctor(db, 1, 730),
+         lambda: stats_by_doctor(days=730, db=db, current_user=user)),
+        ("busiest 730d", lambda: raw_busiest(db, 1, 730),
+         lambda: busiest(days=730, db=db, current_user=user)),
+        ("appointment trends all", lambda: raw_trends(db, 1),
+         lambda: get_appointment_trends(period="all", db=db, current_user=user)),
+    ]
+    print(f"{'endpoint':<26}{'raw ms':>10}{'cube ms':>10}{'speedup':>10}")
+    for name, raw, cube in cases:
+        r, c = timed(raw, args.repeat), timed(cube, args.repeat)
+        db.expunge_all()
+        print(f"{name:<26}{r:>10.1f}{c:>10.1f}{r / c:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Load test for the dashboard cache: database round-trips per home-screen open.
+
+Builds a synthetic SQLite clinic, then replays a day at the front desk: N
+opens of the home screen (/dashboard/today plus /dashboard/metrics), with a
+booking, payment or new patient committed every --write-every opens. The
+same replay runs twice, straight from the database and through
+dashboard_cache, and prints the statements sent to the database and the
+wall time for each.
+
+The cache runs on its in-process fallback unless --redis is given, so the
+script needs nothing but the backend's own packages.
+
+Usage
+-----
+  python scripts/bench_dashboard_cache.py
+  python scripts/bench_dashboard_cache.py --opens 2000 --write-every 25
+  python scripts/bench_dashboard_cache.py --redis redis://localhost:6379/0
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+# Make the backend package importable when run as `python scripts/...`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import models  # noqa: E402
+from domains.analytics import dashboard_cache  # noqa: E402
+from domains.analytics.routes.dashboard import (dashboard_metrics, get_dashboard_metrics,  # noqa: E402
+                                                get_today_overview, today_overview)
+from domains.infrastructure.services.cache_service import cache_service  # noqa: E402
+
+OWNER = SimpleNamespace(id=1, clinic_id=1, role="clinic_owner")
+_writes = itertools.count()
+
+
+def populate(db, patients, seed=7):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    db.add(models.Clinic(id=1, name="Bench Clinic"))
+    db.flush()
+    for i in range(1, patients + 1):
+        when = now - timedelta(days=rng.randint(0, 720), hours=rng.randint(0, 23))
+        db.add(models.Patient(id=i, clinic_id=1, name=f"P{i}", phone=f"9{i:09d}", created_at=when))
+        db.add(models.Appointment(
+            clinic_id=1, patient_id=i, patient_name=f"P{i}", appointment_date=when,
+            start_time="10:00", end_time="10:30", duration=30,
+            status=rng.choice(["completed", "completed", "scheduled", "no_show", "cancelled"]),
+        ))
+        db.add(models.Payment(clinic_id=1, patient_id=i, amount=float(rng.randint(200, 5000)),
+                              payment_method="Cash", status="success", created_at=when))
+    db.commit()
+
+
+def write(db):
+    """One front-desk write, rotating between the kinds the dashboard shows."""
+    n = next(_writes)
+    now = datetime.utcnow()
+    pid = 10_000_000 + n
+    if n % 3 == 0:
+        db.add(models.Patient(id=pid, clinic_id=1, name=f"Walk-in {n}", phone=f"8{n:09d}", created_at=now))
+    elif n % 3 == 1:
+        db.add(models.Appointment(clinic_id=1, patient_name=f"Walk-in {n}", appointment_date=now,
+                                  start_time="16:00", end_time="16:30", duration=30, status="scheduled"))
+    else:
+        db.add(models.Payment(clinic_id=1, patient_id=1, amount=500.0, payment_method="UPI",
+                              status="success", created_at=now))
+    db.commit()
+
+
+def replay(db, opens, write_every, cached):
+    counting = [True]
+    statements = [0]
+
+    def _count(conn, cursor, statement, params, context, executemany):
+        statements[0] += counting[0]
+
+    event.listen(db.get_bind(), "before_cursor_execute", _count)
+    started = time.perf_counter()
+    try:
+        for i in range(opens):
+            if write_every and i and i % write_every == 0:
+                # The write's own statements aren't the dashboard's.
+                counting[0] = False
+                write(db)
+                counting[0] = True
+            if cached:
+                asyncio.run(get_today_overview(clinic_id=None, db=db, current_user=OWNER))
+                asyncio.run(get_dashboard_metrics(period="month", clinic_id=None, db=db, current_user=OWNER))
+            else:
+                today_overview(db, 1)
+                dashboard_metrics(db, 1, "month")
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", _count)
+    return statements[0], time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--opens", type=int, default=1000)
+    parser.add_argument("--write-every", type=int, default=50,
+                        help="commit one write after this many opens (0 = never)")
+    parser.add_argument("--patients", type=int, default=20_000)
+    parser.add_argument("--redis", help="Redis URL; default is the in-process fallback")
+    parser.add_argument("--db", help="SQLite file to build (default: a temporary file)")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench_dashboard.sqlite")
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    print(f"Building {args.patients:,} patients in {path} ...")
+    populate(db, args.patients)
+
+    if args.redis:
+        import redis
+        import redis.asyncio as aioredis
+        cache_service.redis_client = aioredis.from_url(args.redis)
+        dashboard_cache._client = redis.from_url(args.redis)
+    else:
+        cache_service.redis_client = None
+    dashboard_cache.reset_local()
+
+    rows = []
+    for label, cached in (("database", False), ("cached", True)):
+        statements, seconds = replay(db, args.opens, args.write_every, cached)
+        rows.append((label, statements, seconds))
+
+    print(f"\n{args.opens:,} opens, a write every {args.write_every or 'never'}\n")
+    print(f"{'':10} {'statements':>12} {'per open':>10} {'seconds':>9} {'ms/open':>9}")
+    for label, statements, seconds in rows:
+        print(f"{label:10} {statements:>12,} {statements / args.opens:>10.2f} {seconds:>9.2f} "
+              f"{seconds * 1000 / args.opens:>9.2f}")
+    print(f"\nround-trips cut by {rows[0][1] / max(rows[1][1], 1):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
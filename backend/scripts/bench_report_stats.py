@@ -0,0 +1,145 @@
+"""
+Benchmark for the stored report figures: the stats side of a weekly plus a
+monthly broadcast across many clinics.
+
+Builds a synthetic SQLite database of --clinics clinics, each with a few
+months of appointments, patients, invoices and reviews. It then times three
+ways of getting every clinic's weekly, monthly and review figures:
+
+  raw       each clinic's periods read from the raw tables one clinic at a
+            time, as report_stats_service used to do
+  first     a broadcast that finds nothing stored: one batch for all clinics
+            (prepare_*), then the per-clinic formatting reads
+  stored    a broadcast after report_period_stats_job has run: reads only
+
+For each it prints the statements sent to the database and the wall time.
+Only the stats are timed; nothing is sent.
+
+Usage
+-----
+  python scripts/bench_report_stats.py
+  python scripts/bench_report_stats.py --clinics 500 --patients 200
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Make the backend package importable when run as `python scripts/...`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import create_engine, event, insert  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import models  # noqa: E402
+from domains.notification.services import report_period_stats as stats  # noqa: E402
+from domains.notification.services import report_stats_service as service  # noqa: E402
+
+TODAY = dt.date(2026, 3, 15)  # a Sunday
+TREATMENTS = ["Scaling", "Filling", "Root canal", "Extraction", "X-ray", "Crown", "Consultation"]
+REVIEWS = [(5, "Friendly staff and a clean clinic"), (4, "Quick and painless"),
+           (2, "Long wait, slow billing"), (5, "Good doctor"), (3, "Communication could improve")]
+
+
+def populate(engine, clinics, patients, seed=7):
+    rng = random.Random(seed)
+    start = dt.datetime(2025, 12, 1)
+    span = int((dt.datetime.combine(TODAY, dt.time.min) - start).total_seconds())
+    with engine.begin() as conn:
+        conn.execute(insert(models.Clinic), [{"id": c, "name": f"Clinic {c}"} for c in range(1, clinics + 1)])
+        pid = iid = 0
+        for c in range(1, clinics + 1):
+            pts, appts, invs, items, revs = [], [], [], [], []
+            for _ in range(patients):
+                pid += 1
+                when = start + dt.timedelta(seconds=rng.randrange(span))
+                pts.append({"id": pid, "clinic_id": c, "name": f"P{pid}", "phone": "9",
+                            "payment_type": "Cash", "created_at": when})
+                for _ in range(rng.randint(1, 3)):
+                    appts.append({"clinic_id": c, "patient_id": pid, "patient_name": f"P{pid}",
+                                  "appointment_date": start + dt.timedelta(seconds=rng.randrange(span)),
+                                  "start_time": "10:00", "end_time": "10:30", "duration": 30,
+                                  "status": rng.choice(["completed", "completed", "no_show", "cancelled"])})
+                iid += 1
+                invs.append({"id": iid, "clinic_id": c, "patient_id": pid, "invoice_number": f"INV-{iid}",
+                             "status": "finalized", "total": float(rng.randint(300, 8000)),
+                             "finalized_at": when})
+                items += [{"invoice_id": iid, "description": rng.choice(TREATMENTS), "unit_price": 1.0,
+                           "amount": 1.0} for _ in range(rng.randint(1, 3))]
+            for r in range(patients // 10):
+                rating, text = rng.choice(REVIEWS)
+                revs.append({"clinic_id": c, "place_id": f"place{c}", "review_hash": f"{c}-{r}",
+                             "rating": rating, "text": text,
+                             "review_time": start + dt.timedelta(seconds=rng.randrange(span))})
+            conn.execute(insert(models.Patient), pts)
+            conn.execute(insert(models.Appointment), appts)
+            conn.execute(insert(models.Invoice), invs)
+            conn.execute(insert(models.InvoiceLineItem), items)
+            conn.execute(insert(models.GoogleReview), revs)
+
+
+def raw(db, clinic_ids):
+    weeks, months = service._weeks(TODAY), service._months(TODAY)
+    for cid in clinic_ids:
+        for period in (*weeks, *months):
+            stats.measure(db, [cid], period.kind, *period.bounds())
+
+
+def broadcast(db, clinic_ids):
+    service.prepare_weekly_stats(db, clinic_ids, TODAY)
+    service.prepare_monthly_stats(db, clinic_ids, TODAY)
+    db.commit()
+    for cid in clinic_ids:
+        service.get_weekly_stats(db, cid, TODAY)
+        service.get_monthly_stats(db, cid, TODAY)
+        service.get_review_stats(db, cid, TODAY)
+
+
+def timed(engine, fn, clinic_ids):
+    statements = [0]
+
+    def _count(conn, cursor, statement, params, context, executemany):
+        statements[0] += 1
+
+    db = sessionmaker(bind=engine)()
+    event.listen(engine, "before_cursor_execute", _count)
+    started = time.perf_counter()
+    try:
+        fn(db, clinic_ids)
+    finally:
+        seconds = time.perf_counter() - started
+        event.remove(engine, "before_cursor_execute", _count)
+        db.close()
+    return statements[0], seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clinics", type=int, default=500)
+    parser.add_argument("--patients", type=int, default=100, help="patients per clinic")
+    parser.add_argument("--db", help="SQLite file to build (default: a temporary file)")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench_report_stats.sqlite")
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(engine)
+    print(f"Building {args.clinics:,} clinics x {args.patients:,} patients in {path} ...")
+    populate(engine, args.clinics, args.patients)
+    clinic_ids = list(range(1, args.clinics + 1))
+
+    rows = [("raw", *timed(engine, raw, clinic_ids)),
+            ("first", *timed(engine, broadcast, clinic_ids)),
+            ("stored", *timed(engine, broadcast, clinic_ids))]
+
+    print(f"\nweekly + monthly + review figures for {args.clinics:,} clinics\n")
+    print(f"{'':8} {'statements':>12} {'per clinic':>11} {'seconds':>9}")
+    for label, statements, seconds in rows:
+        print(f"{label:8} {statements:>12,} {statements / args.clinics:>11.2f} {seconds:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Load the patient-map gazetteer into `geocodes` and re-geocode patients.
+
+Background
+----------
+The patient map plots patients at the place their village text resolves to
+(domains/analytics/geocoding.py). The first startup loads the places bundled
+in config/gazetteer_in.csv into an empty table; after that startup leaves
+the table alone, so run this script after editing the CSV. For pincode-level
+coverage, download the GeoNames India postal file
+(https://download.geonames.org/export/zip/IN.zip), unzip it, and load IN.txt
+with --geonames. Patients are then resolved again, so a
+patient whose address carries a pincode moves from their town's point to the
+pincode's.
+
+Usage
+-----
+  # Bundled places only, geocode patients that have no location yet
+  python scripts/load_gazetteer.py
+
+  # Add GeoNames pincodes and re-geocode everyone
+  python scripts/load_gazetteer.py --geonames /path/to/IN.txt
+
+  # One clinic
+  python scripts/load_gazetteer.py --clinic-id 12 --redo
+
+DATABASE_URL / local DB config is taken from the app's database.py, so run it
+with the environment pointed at whichever DB you intend to fill.
+"""
+import argparse
+import sys
+import time
+
+# Make the backend package importable when run as `python scripts/...`
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal  # noqa: E402
+from domains.analytics import geocoding  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--geonames", help="GeoNames postal file (IN.txt) to load as well")
+    parser.add_argument("--clinic-id", type=int, default=None, help="Geocode only this clinic's patients")
+    parser.add_argument("--redo", action="store_true",
+                        help="re-geocode every patient, not just those with no location yet "
+                             "(implied by --geonames)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        places = geocoding.load(db, geocoding.bundled_rows())
+        print(f"bundled: {places} entries")
+        if args.geonames:
+            pincodes = geocoding.load(db, geocoding.geonames_rows(args.geonames))
+            print(f"geonames: {pincodes} pincodes")
+        db.commit()
+        located = geocoding.backfill(db, args.clinic_id, redo=args.redo or bool(args.geonames))
+        db.commit()
+        print(f"Done: {located} patients geocoded in {time.perf_counter() - started:.2f}s.")
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,9 @@ import datetime
 
 from database import SessionLocal
 from models import Patient, Appointment, Invoice, InvoiceLineItem, Payment
+# Registers the session hooks that keep the appointment stats cube current,
+# for the inserts below and for `clean`'s bulk delete.
+from domains.scheduling import appointment_facts  # noqa: F401
 
 CLINIC_ID = int(os.environ.get("DEMO_CLINIC_ID", "2"))
 MARKER = "MKTDEMO"  # appears in every demo patient's notes — the cleanup key
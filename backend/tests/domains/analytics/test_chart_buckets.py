@@ -0,0 +1,151 @@
+"""SQL-side bucketing for the dashboard charts.
+
+The patient and revenue charts now group by sql_bucket (strftime on SQLite,
+date_trunc on Postgres) instead of fetching every row and placing it with
+_bucket_index. Both backends must draw exactly the chart the Python path did.
+The Postgres case runs against the test database from conftest and is
+skipped when it isn't reachable.
+"""
+from __future__ import annotations
+
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.analytics.routes import dashboard
+
+PERIODS = ("today", "yesterday", "7days", "month", "all")
+TABLES = [
+    models.Clinic.__table__,
+    models.User.__table__,
+    models.Patient.__table__,
+    models.Appointment.__table__,
+    models.AppointmentStatsFact.__table__,
+    models.Payment.__table__,
+    models.Invoice.__table__,
+]
+
+
+def _seed(session):
+    now = datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    session.add(models.Clinic(id=1, name="Clinic A"))
+    session.flush()
+    # Registrations and visits spread over hours, days and months, including
+    # ones right on a bucket boundary.
+    offsets = [timedelta(hours=h) for h in (0, 1, 9, 13, 23)] + \
+        [-timedelta(days=d, hours=h) for d in (1, 2, 6, 9, 40, 75, 400) for h in (0, 10)]
+    for i, off in enumerate(offsets, start=1):
+        when = today + off
+        session.add(models.Patient(id=i, clinic_id=1, name=f"P{i}", phone=f"9{i:09d}",
+                                   created_at=when - timedelta(days=i % 3 * 20)))
+        session.flush()
+        for visit in range(2):
+            session.add(models.Appointment(
+                clinic_id=1, patient_id=i, patient_name=f"P{i}",
+                appointment_date=when + timedelta(hours=visit), start_time="09:00", end_time="09:30",
+                duration=30, status="completed",
+            ))
+        session.add(models.Payment(clinic_id=1, patient_id=i, amount=100.0 + i, payment_method="Cash",
+                                   status="success" if i % 4 else "failed", created_at=when))
+        session.add(models.Invoice(clinic_id=1, patient_id=i, invoice_number=f"INV-{i}", total=50.5 * i,
+                                   status=("paid_verified", "finalized", "draft")[i % 3],
+                                   created_at=when, updated_at=when + timedelta(hours=2)))
+    session.commit()
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def db(request):
+    if request.param == "sqlite":
+        engine = create_engine("sqlite://")
+    else:
+        engine = create_engine(
+            f"postgresql://{os.environ.get('LOCAL_DB_USER', 'postgres')}:{os.environ.get('LOCAL_DB_PASSWORD', 'postgres')}"
+            f"@{os.environ.get('LOCAL_DB_HOST', 'localhost')}:{os.environ.get('LOCAL_DB_PORT', '5432')}"
+            f"/{os.environ.get('LOCAL_DB_NAME', 'xpress_scan_test')}"
+        )
+        try:
+            engine.connect().close()
+        except OperationalError:
+            pytest.skip("Postgres test database not reachable")
+        models.Base.metadata.drop_all(engine, tables=TABLES)
+    models.Base.metadata.create_all(engine, tables=TABLES)
+    session = sessionmaker(bind=engine)()
+    _seed(session)
+    yield session
+    session.close()
+    if request.param == "postgresql":
+        models.Base.metadata.drop_all(engine, tables=TABLES)
+
+
+# The Python path these endpoints used before, kept here as the reference.
+
+def python_patient_stats(db, period):
+    buckets = dashboard.period_buckets(period, db, 1)
+    new = [0] * len(buckets)
+    returning = [set() for _ in buckets]
+    for (created_at,) in db.query(models.Patient.created_at).filter(models.Patient.clinic_id == 1):
+        idx = dashboard._bucket_index(buckets, created_at)
+        if idx is not None:
+            new[idx] += 1
+    for appt_date, patient_id, created_at in db.query(
+        models.Appointment.appointment_date, models.Appointment.patient_id, models.Patient.created_at
+    ).join(models.Patient, models.Patient.id == models.Appointment.patient_id):
+        idx = dashboard._bucket_index(buckets, appt_date)
+        if idx is not None and created_at < buckets[idx][1]:
+            returning[idx].add(patient_id)
+    return [{"label": label, "new": new[i], "returning": len(returning[i])}
+            for i, (label, _, _) in enumerate(buckets)]
+
+
+def python_revenue(db, period):
+    buckets = dashboard.period_buckets(period, db, 1)
+    collected = [0.0] * len(buckets)
+    billed = [0.0] * len(buckets)
+    for p in db.query(models.Payment).filter(models.Payment.status == "success"):
+        idx = dashboard._bucket_index(buckets, p.created_at)
+        if idx is not None:
+            collected[idx] += p.amount
+    for inv in db.query(models.Invoice):
+        idx = dashboard._bucket_index(buckets, inv.updated_at)
+        if idx is not None and inv.status in ("paid_verified", "paid_unverified"):
+            collected[idx] += inv.total
+        idx = dashboard._bucket_index(buckets, inv.created_at)
+        if idx is not None and inv.status not in ("draft", "cancelled"):
+            billed[idx] += inv.total
+    return [(label, round(collected[i], 2), round(billed[i], 2)) for i, (label, _, _) in enumerate(buckets)]
+
+
+OWNER = SimpleNamespace(clinic_id=1, role="doctor")
+
+
+@pytest.mark.parametrize("period", PERIODS)
+def test_patient_statistics_match_the_python_path(db, period):
+    assert dashboard.get_patient_statistics(period=period, db=db, current_user=OWNER) == \
+        python_patient_stats(db, period)
+
+
+@pytest.mark.parametrize("period", PERIODS)
+def test_revenue_analytics_match_the_python_path(db, period):
+    out = dashboard.get_revenue_analytics(period=period, db=db, current_user=OWNER)
+    assert [(r["label"], r["collected"], r["billed"]) for r in out] == python_revenue(db, period)
+
+
+def test_each_series_is_one_grouped_query(db):
+    selects = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(statement)
+
+    dashboard.get_revenue_analytics(period="month", db=db, current_user=OWNER)
+    # average payment, then collected (payments, paid invoices) and billed
+    assert len(selects) == 4
+    assert all("GROUP BY" in s for s in selects[1:])
@@ -0,0 +1,93 @@
+"""Multi-clinic performance comparison.
+
+get_clinic_performance measures every clinic with one fixed set of grouped
+queries, so comparing four branches costs the same as looking at one, and
+utilisation comes from the doctors' real working hours capped by chairs.
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.analytics.routes.dashboard import get_clinic_performance
+
+TODAY = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+            models.AppointmentStatsFact.__table__,
+            models.Payment.__table__,
+            models.GooglePlaceLink.__table__,
+            models.DoctorAvailability.__table__,
+            models.DoctorTimeOff.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    for cid in range(1, 9):
+        session.add(models.Clinic(id=cid, name=f"Branch {cid}", number_of_chairs=1))
+        session.add(models.Patient(id=cid, clinic_id=cid, name=f"P{cid}", phone=f"9{cid:09d}"))
+        session.add(models.Payment(clinic_id=cid, patient_id=cid, amount=1000.0 * cid,
+                                   payment_method="Cash", status="success", created_at=TODAY))
+        # Two doctors on four-hour shifts, but one chair: 240 minutes of capacity.
+        for doctor_id in (cid * 10, cid * 10 + 1):
+            session.add(models.DoctorAvailability(clinic_id=cid, doctor_id=doctor_id, weekday=TODAY.weekday(),
+                                                  start_time="09:00", end_time="13:00"))
+        session.add(models.Appointment(
+            clinic_id=cid, doctor_id=cid * 10, patient_name=f"P{cid}", appointment_date=TODAY,
+            start_time="00:00", end_time="01:00", duration=60, status="completed",
+        ))
+    session.add(models.GooglePlaceLink(clinic_id=2, place_id="abc", current_rating=4.5))
+    session.commit()
+    return session
+
+
+def count_selects(db):
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            seen.append(statement)
+
+    return seen
+
+
+OWNER = SimpleNamespace(clinic_id=1, role="clinic_owner")
+
+
+def test_metrics_come_from_real_data(db):
+    out = get_clinic_performance(compare_clinic_ids="2, 99", db=db, current_user=OWNER)
+    current = out["current_clinic"]["metrics"]
+    assert current["name"] == "Branch 1"
+    assert current["appointments_count"] == 1
+    assert current["revenue"] == 1000.0
+    assert current["satisfaction_score"] is None
+    assert current["chair_utilization"] == 25  # 60 of 240 minutes
+
+    assert [c["id"] for c in out["comparisons"]] == [2]
+    assert out["comparisons"][0]["metrics"]["satisfaction_score"] == 90
+
+
+def test_query_count_stays_flat_as_clinics_grow(db):
+    selects = count_selects(db)
+    get_clinic_performance(db=db, current_user=OWNER)
+    one = len(selects)
+
+    selects.clear()
+    out = get_clinic_performance(compare_clinic_ids="2,3,4", db=db, current_user=OWNER)
+    assert len(out["comparisons"]) == 3
+    assert len(selects) == one == 7
@@ -0,0 +1,197 @@
+"""Per-clinic dashboard cache.
+
+/dashboard/today and /dashboard/metrics are answered from a cache keyed by a
+per-clinic version, which the session bumps when a write to anything the
+dashboard reads commits. A read must never be more than one write behind,
+repeat opens must not touch the database, and it must all work the same
+without Redis.
+"""
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.analytics import dashboard_cache
+from domains.analytics.routes.dashboard import (dashboard_metrics, get_dashboard_metrics,
+                                                get_today_overview, today_overview)
+from domains.infrastructure.services.cache_service import cache_service
+
+OWNER = SimpleNamespace(id=7, clinic_id=1, role="clinic_owner")
+NOW = datetime.utcnow()
+
+
+@pytest.fixture(params=["redis", "local"])
+def backend(request, monkeypatch):
+    dashboard_cache.reset_local()
+    monkeypatch.setattr(dashboard_cache, "_down_until", 0.0)
+    if request.param == "redis":
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(cache_service, "redis_client", fakeredis.FakeAsyncRedis(server=server))
+        monkeypatch.setattr(dashboard_cache, "_client", fakeredis.FakeRedis(server=server))
+    else:
+        monkeypatch.setattr(cache_service, "redis_client", None)
+    yield request.param
+    dashboard_cache.reset_local()
+
+
+@pytest.fixture()
+def db(tmp_path, backend):
+    # A file, not :memory:, because a cache miss computes on a worker thread.
+    engine = create_engine(f"sqlite:///{tmp_path / 'dash.sqlite'}",
+                           connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([models.Clinic(id=1, name="Clinic A"), models.Clinic(id=2, name="Clinic B")])
+    session.add(models.Patient(id=1, clinic_id=1, name="P1", phone="9000000001", created_at=NOW))
+    session.add(visit(1, 1))
+    session.commit()
+    yield session
+    session.close()
+
+
+def visit(id, patient_id, clinic_id=1, status="scheduled"):
+    return models.Appointment(
+        id=id, clinic_id=clinic_id, patient_id=patient_id, patient_name=f"P{patient_id}",
+        appointment_date=NOW.replace(hour=10, minute=0, second=0, microsecond=0),
+        start_time="10:00", end_time="10:30", duration=30, status=status,
+    )
+
+
+def count_selects(db):
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            seen.append(statement)
+
+    return seen
+
+
+def metrics(db, period="month"):
+    return asyncio.run(get_dashboard_metrics(period=period, clinic_id=None, db=db, current_user=OWNER))
+
+
+def today(db):
+    return asyncio.run(get_today_overview(clinic_id=None, db=db, current_user=OWNER))
+
+
+def test_repeat_opens_are_one_cache_hit(db):
+    metrics(db)
+    today(db)
+    selects = count_selects(db)
+    for _ in range(3):
+        assert metrics(db) == dashboard_metrics(db, 1, "month")
+        assert today(db) == today_overview(db, 1)
+        selects.clear()
+        metrics(db)
+        today(db)
+        assert selects == []
+
+
+def write_patient(db):
+    db.add(models.Patient(id=2, clinic_id=1, name="P2", phone="9000000002", created_at=NOW))
+
+
+def write_appointment(db):
+    db.add(visit(2, 2))
+
+
+def complete_appointment(db):
+    db.get(models.Appointment, 1).status = "completed"
+
+
+def write_invoice_and_part_payment(db):
+    db.add(models.Invoice(id=1, clinic_id=1, patient_id=1, invoice_number="INV-1", total=1000.0,
+                          due_amount=400.0, status="finalized", created_at=NOW))
+    db.flush()
+    db.add(models.InvoicePayment(invoice_id=1, clinic_id=1, amount=600.0, paid_on=NOW.date()))
+
+
+def write_payment(db):
+    db.add(models.Payment(clinic_id=1, patient_id=1, amount=250.0, payment_method="Cash",
+                          status="success", created_at=NOW))
+
+
+def delete_appointment(db):
+    db.delete(db.get(models.Appointment, 2))
+
+
+def bulk_cancel(db):
+    db.query(models.Appointment).filter(models.Appointment.clinic_id == 1).update(
+        {"status": "cancelled"}, synchronize_session=False)
+
+
+WRITES = [write_patient, write_appointment, complete_appointment, write_invoice_and_part_payment,
+          write_payment, delete_appointment, bulk_cancel]
+
+
+def test_every_read_after_a_commit_sees_it(db):
+    metrics(db)
+    today(db)
+    for write in WRITES:
+        before = metrics(db)
+        write(db)
+        db.commit()
+        fresh = dashboard_metrics(db, 1, "month"), today_overview(db, 1)
+        assert (metrics(db), today(db)) == fresh, write.__name__
+        assert fresh[0] != before or write is complete_appointment, write.__name__
+
+
+def test_a_read_racing_a_commit_is_at_most_that_write_behind(db):
+    stale = dashboard_metrics(db, 1, "month")
+
+    def compute_then_write():
+        value = dashboard_metrics(db, 1, "month")
+        write_patient(db)  # commits after the read, before the store
+        db.commit()
+        return value
+
+    raced = asyncio.run(dashboard_cache.cached(1, "metrics:month", compute_then_write))
+    assert raced == stale
+    assert metrics(db)["total_patients"]["value"] == stale["total_patients"]["value"] + 1
+
+
+def test_rollbacks_and_other_clinics_leave_the_cache_warm(db):
+    metrics(db)
+    versions = asyncio.run(dashboard_cache.versions(1))
+
+    write_patient(db)
+    db.flush()
+    db.rollback()
+    db.add(models.Patient(id=3, clinic_id=2, name="Q", phone="9000000003", created_at=NOW))
+    db.add(visit(3, 3, clinic_id=2))
+    db.commit()
+
+    assert asyncio.run(dashboard_cache.versions(1)) == versions
+    selects = count_selects(db)
+    metrics(db)
+    assert selects == []
+
+
+def test_another_process_sees_the_bump_through_redis(db, backend):
+    if backend != "redis":
+        pytest.skip("processes only share versions through Redis")
+    metrics(db)
+    write_patient(db)
+    db.commit()
+    dashboard_cache.reset_local()  # a process that never saw the write
+    assert metrics(db)["total_patients"]["value"] == 2
+
+
+def test_without_redis_payloads_expire(db, backend, monkeypatch):
+    if backend != "local":
+        pytest.skip("Redis expires its own keys")
+    metrics(db)
+    clock = dashboard_cache.time.monotonic() + dashboard_cache.DASHBOARD_CACHE_TTL_S + 1
+    monkeypatch.setattr(dashboard_cache.time, "monotonic", lambda: clock)
+    selects = count_selects(db)
+    metrics(db)
+    assert selects
@@ -0,0 +1,161 @@
+"""Dashboard CSV export.
+
+The file is streamed section by section from one snapshot, so writes that
+land while it is being produced never show up in half of it. Big exports go
+to an rq worker, which writes to R2; the job is then fetched by id.
+"""
+from __future__ import annotations
+
+import asyncio
+import csv
+import io
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.analytics.routes import dashboard, dashboard_export
+
+OWNER = SimpleNamespace(id=7, clinic_id=1, role="clinic_owner")
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'dash.sqlite'}")
+
+    # WAL lets a writer commit while the export's read transaction is open,
+    # which is exactly the race the snapshot has to survive.
+    @event.listens_for(engine, "connect")
+    def _wal(dbapi_conn, record):
+        dbapi_conn.execute("PRAGMA journal_mode=WAL")
+
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    now = datetime.utcnow()
+    session.add(models.Clinic(id=1, name="Smile Dental"))
+    session.add(models.Clinic(id=2, name="Branch Two"))
+    for i in range(1, 4):
+        session.add(models.Patient(id=i, clinic_id=1, name=f"P{i}", phone=f"9{i:09d}", gender="F",
+                                   created_at=now - timedelta(hours=i)))
+    session.add(models.Payment(clinic_id=1, patient_id=1, amount=500.0, payment_method="Cash",
+                               status="success", created_at=now - timedelta(hours=1)))
+    session.commit()
+    session.close()
+    return engine
+
+
+def parse(text):
+    return list(csv.reader(io.StringIO(text.lstrip("﻿"))))
+
+
+def section(rows, title):
+    start = rows.index([title]) + 2
+    end = rows.index([], start) if [] in rows[start:] else len(rows)
+    return rows[start:end]
+
+
+def test_stream_has_every_section_once(engine):
+    chunks = list(dashboard_export.stream_export(engine, "all", [1]))
+    assert chunks[0] == "﻿"
+    assert len(chunks) > 5  # one per section, not one string
+    rows = parse("".join(chunks))
+    assert rows[0] == ["Smile Dental — dashboard export"]
+    for title in ("Summary", "New vs returning patients", "Patients by gender", "Revenue",
+                  "Appointment outcomes"):
+        assert rows.count([title]) == 1
+    assert ["Female", "3"] in section(rows, "Patients by gender")
+
+
+def test_all_sections_come_from_one_snapshot(engine):
+    stream = dashboard_export.stream_export(engine, "all", [1])
+    next(stream), next(stream)  # BOM, then the title block: the snapshot is open
+
+    writer = sessionmaker(bind=engine)()
+    writer.add(models.Patient(id=9, clinic_id=1, name="Late", phone="9000000009", gender="M",
+                              created_at=datetime.utcnow()))
+    writer.commit()
+    writer.close()
+
+    rows = parse("".join(stream))
+    assert section(rows, "Summary")[2][:2] == ["Total patients", "3"]
+    assert sum(int(r[1]) for r in section(rows, "New vs returning patients")) == 3
+    assert ["Male", "0"] in section(rows, "Patients by gender")
+
+    # A fresh export sees the new patient.
+    rows = parse("".join(dashboard_export.stream_export(engine, "all", [1])))
+    assert sum(int(r[1]) for r in section(rows, "New vs returning patients")) == 4
+    assert ["Male", "1"] in section(rows, "Patients by gender")
+
+
+def test_snapshot_queries_all_time_buckets_once(engine):
+    with dashboard_export.snapshot_session(engine) as snap:
+        first = dashboard.period_buckets("all", snap, 1)
+        assert dashboard.period_buckets("all", snap, 1) is first
+
+
+def test_route_streams_an_attachment(engine):
+    db = sessionmaker(bind=engine)()
+    resp = dashboard_export.export_dashboard(period="month", clinic_id=None, db=db, current_user=OWNER)
+    assert isinstance(resp, StreamingResponse)
+    assert resp.headers["content-disposition"].startswith('attachment; filename="smile-dental-dashboard-month-')
+
+    async def body():
+        return b"".join([chunk async for chunk in resp.body_iterator])
+
+    assert parse(asyncio.run(body()).decode("utf-8"))[0] == ["Smile Dental — dashboard export"]
+
+
+# ── Background exports ───────────────────────────────────────────────────────
+
+def test_job_writes_one_file_for_several_clinics_to_r2(engine, monkeypatch):
+    import database
+    uploads = {}
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(dashboard_export, "put_fileobj_to_key",
+                        lambda key, f, content_type: uploads.setdefault(key, f.read()) is not None)
+
+    key = dashboard_export.run_export_job("all", [1, 2], 1)
+    assert key.startswith("clinics/1/exports/clinics-dashboard-all-")
+    rows = parse(uploads[key].decode("utf-8"))
+    assert ["Smile Dental — dashboard export"] in rows
+    assert ["Branch Two — dashboard export"] in rows
+
+
+class FakeJob:
+    def __init__(self, id, meta, status="queued", result=None):
+        self.id, self.meta, self._status, self.result = id, meta, status, result
+
+    def get_status(self):
+        return self._status
+
+
+def test_enqueue_and_fetch_by_job_id(monkeypatch):
+    jobs = {}
+
+    class FakeQueue:
+        def enqueue(self, fn, *args, **kwargs):
+            assert fn is dashboard_export.run_export_job
+            jobs["j1"] = FakeJob("j1", kwargs["meta"])
+            return jobs["j1"]
+
+    monkeypatch.setattr(dashboard_export, "_queue", lambda: FakeQueue())
+    monkeypatch.setattr(dashboard_export, "_fetch_job", lambda job_id: jobs.get(job_id))
+    monkeypatch.setattr(dashboard_export, "get_presigned_url", lambda key, expires_in: f"https://r2/{key}")
+
+    out = dashboard_export.enqueue_export(period="all", clinic_ids="1, 2,2", db=None, current_user=OWNER)
+    assert out == {"job_id": "j1", "status": "queued"}
+    assert jobs["j1"].meta["clinic_ids"] == [1, 2]
+
+    assert "url" not in dashboard_export.export_job_status("j1", current_user=OWNER)
+    jobs["j1"]._status, jobs["j1"].result = "finished", "clinics/1/exports/x.csv"
+    assert dashboard_export.export_job_status("j1", current_user=OWNER)["url"] == "https://r2/clinics/1/exports/x.csv"
+
+    stranger = SimpleNamespace(id=8, clinic_id=1, role="clinic_owner")
+    with pytest.raises(HTTPException) as exc:
+        dashboard_export.export_job_status("j1", current_user=stranger)
+    assert exc.value.status_code == 404
@@ -0,0 +1,228 @@
+"""Coalesced dashboard report generation.
+
+Asking for a report that is already generating, or that completed a few
+minutes ago, must hand back that same report rather than start another
+Nexus job, and the status endpoint must show how far the job has got.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import models
+from domains.analytics.routes import dashboard_reports
+from domains.analytics.routes.dashboard_reports import (ReportGenerateRequest, generate_dashboard_report,
+                                                        get_report_status)
+
+ALICE = SimpleNamespace(id=1, clinic_id=1, first_name="Alice", last_name="A", role="clinic_owner")
+BOB = SimpleNamespace(id=2, clinic_id=1, first_name="Bob", last_name="B", role="doctor")
+
+
+@pytest.fixture()
+def redis_server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(dashboard_reports, "_redis", lambda: fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(dashboard_reports, "_down_until", 0.0)
+    return fakeredis.FakeRedis(server=server)
+
+
+@pytest.fixture()
+def sessions():
+    # One shared in-memory database for every session, like separate requests.
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    models.Base.metadata.create_all(
+        engine, tables=[models.Clinic.__table__, models.User.__table__, models.DashboardReport.__table__])
+    factory = sessionmaker(bind=engine)
+    session = factory()
+    session.add(models.Clinic(id=1, name="Smile Dental"))
+    session.commit()
+    session.close()
+    return factory
+
+
+@pytest.fixture()
+def nexus(monkeypatch):
+    sent = []
+
+    async def fake_send(report, request, clinic_name):
+        assert clinic_name == "Smile Dental"
+        sent.append(report.id)
+        await asyncio.sleep(0.05)  # the HTTP round-trip a second click lands in
+
+    monkeypatch.setattr(dashboard_reports, "send_to_nexus", fake_send)
+    return sent
+
+
+def request(start="2026-09-01", end="2026-09-30", report_type="monthly_revenue"):
+    return ReportGenerateRequest(report_type=report_type, report_category="Financial",
+                                 title="September revenue", start_date=start, end_date=end)
+
+
+def generate(sessions, user, req):
+    return generate_dashboard_report(request=req, db=sessions(), current_user=user)
+
+
+def test_double_click_and_a_colleague_share_one_job(sessions, redis_server, nexus):
+    async def clicks():
+        return await asyncio.gather(
+            generate(sessions, ALICE, request()),
+            generate(sessions, ALICE, request()),
+            generate(sessions, BOB, request(start="2026-09-01T00:00:00Z")),
+        )
+
+    reports = asyncio.run(clicks())
+    assert {r.id for r in reports} == {1}
+    assert nexus == [1]
+    assert sessions().query(models.DashboardReport).count() == 1
+
+
+def test_a_request_waits_for_a_claim_held_elsewhere(sessions, redis_server, nexus):
+    key = dashboard_reports.idempotency_key(1, request())
+    redis_server.set(f"dashboard_report:claim:{key}", "1")
+
+    async def other_process_creates_it():
+        await asyncio.sleep(0.3)
+        db = sessions()
+        db.add(models.DashboardReport(
+            id=41, clinic_id=1, report_category="Financial", report_type="monthly_revenue",
+            title="September revenue", status="generating", parameters={"idempotency_key": key}))
+        db.commit()
+        redis_server.delete(f"dashboard_report:claim:{key}")
+
+    async def both():
+        return await asyncio.gather(generate(sessions, ALICE, request()), other_process_creates_it())
+
+    report, _ = asyncio.run(both())
+    assert report.id == 41
+    assert nexus == []
+
+
+@pytest.mark.parametrize("status, age, reused", [
+    ("completed", timedelta(minutes=5), True),
+    ("completed", timedelta(hours=2), False),
+    ("generating", timedelta(minutes=10), True),
+    ("generating", timedelta(hours=2), False),  # the job died
+    ("failed", timedelta(minutes=1), False),
+])
+def test_which_earlier_reports_are_reused(sessions, redis_server, nexus, status, age, reused):
+    db = sessions()
+    db.add(models.DashboardReport(
+        id=7, clinic_id=1, report_category="Financial", report_type="monthly_revenue", title="Earlier",
+        status=status, created_at=datetime.utcnow() - age,
+        parameters={"idempotency_key": dashboard_reports.idempotency_key(1, request())}))
+    db.commit()
+
+    report = asyncio.run(generate(sessions, ALICE, request()))
+    assert (report.id == 7) is reused
+    assert nexus == ([] if reused else [report.id])
+
+
+def test_different_reports_are_not_coalesced(sessions, redis_server, nexus):
+    ids = {asyncio.run(generate(sessions, ALICE, r)).id for r in (
+        request(), request(end="2026-09-15"), request(report_type="patient_flow"))}
+    assert len(ids) == 3 and len(nexus) == 3
+
+
+def test_status_shows_each_stage(sessions, redis_server, nexus):
+    report = asyncio.run(generate(sessions, ALICE, request()))
+    key = dashboard_reports.progress_key(report.id)
+    redis_server.hset(key, "data", json.dumps({"state": "done", "seconds": 0.4}))
+    redis_server.hset(key, "analysis", json.dumps({"state": "running", "seconds": None}))
+
+    out = get_report_status(report_id=report.id, db=sessions(), current_user=ALICE)
+    assert out.status == "generating"
+    assert [(p["stage"], p["state"]) for p in out.progress] == [
+        ("data", "done"), ("analysis", "running"), ("charts", "pending"), ("pdf", "pending"),
+        ("upload", "pending")]
+    assert out.progress[0]["seconds"] == 0.4
+
+    db = sessions()
+    db.get(models.DashboardReport, report.id).status = "failed"
+    db.commit()
+    out = get_report_status(report_id=report.id, db=sessions(), current_user=ALICE)
+    assert out.progress[1]["state"] == "failed"
+
+
+def test_works_without_redis_and_backs_off(sessions, nexus, monkeypatch):
+    attempts = []
+
+    def down():
+        attempts.append(1)
+        raise ConnectionError("redis is down")
+
+    monkeypatch.setattr(dashboard_reports, "_redis", down)
+    monkeypatch.setattr(dashboard_reports, "_down_until", 0.0)
+    first = asyncio.run(generate(sessions, ALICE, request()))
+    again = asyncio.run(generate(sessions, BOB, request()))
+    assert first.id == again.id and nexus == [first.id]
+    assert [p["state"] for p in first.progress] == ["pending"] * 5
+    assert len(attempts) == 1  # not a timeout per claim, release and status read
+
+
+def test_a_refused_job_is_marked_failed_without_touching_the_db_on_the_loop(sessions, redis_server, monkeypatch):
+    async def refuse(report, request, clinic_name):
+        raise HTTPException(status_code=500, detail="Nexus service error: 503")
+
+    monkeypatch.setattr(dashboard_reports, "send_to_nexus", refuse)
+    loop_threads, db_threads = [], []
+    event.listen(sessions.kw["bind"], "before_cursor_execute",
+                 lambda *a: db_threads.append(threading.get_ident()))
+
+    async def click():
+        loop_threads.append(threading.get_ident())
+        with pytest.raises(HTTPException):
+            await generate(sessions, ALICE, request())
+
+    asyncio.run(click())
+    assert db_threads and loop_threads[0] not in db_threads
+    assert [r.status for r in sessions().query(models.DashboardReport)] == ["failed"]
+
+
+def test_one_redis_client_per_process(monkeypatch):
+    monkeypatch.setattr(dashboard_reports, "_client", None)
+    assert dashboard_reports._redis() is dashboard_reports._redis()
+
+
+def test_a_download_closes_the_r2_body_when_the_client_leaves(sessions, monkeypatch):
+    class Body:
+        closed = False
+
+        def iter_chunks(self, size):
+            yield b"%PDF-1.7 "
+            yield b"rest"
+
+        def close(self):
+            self.closed = True
+
+    body = Body()
+
+    async def open_stream(key):
+        assert key == "clinics/1/reports/dashboard/r.pdf"
+        return body
+
+    monkeypatch.setattr(dashboard_reports, "open_r2_stream_async", open_stream)
+    db = sessions()
+    db.add(models.DashboardReport(
+        id=9, clinic_id=1, report_category="Financial", report_type="monthly_revenue", title="Sept",
+        status="completed", parameters={}, file_url="https://pub-x.r2.dev/clinics/1/reports/dashboard/r.pdf"))
+    db.commit()
+
+    async def start_then_disconnect():
+        response = await dashboard_reports.download_report(report_id=9, db=sessions(), current_user=ALICE)
+        chunks = response.body_iterator
+        first = await chunks.__anext__()
+        await chunks.aclose()
+        return first
+
+    assert asyncio.run(start_then_disconnect()) == b"%PDF-1.7 "
+    assert body.closed
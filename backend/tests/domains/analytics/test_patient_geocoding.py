@@ -0,0 +1,124 @@
+"""Patient map from the offline gazetteer.
+
+A patient's village is resolved to a `geocodes` entry when they are saved;
+/dashboard/patient-locations is a grouped count over those keys. Aliases
+land on the same point, unknown places are not plotted, and the
+number of queries does not grow with the number of patients. Unknown places
+stay in the counts, as one unlocated entry without coordinates.
+"""
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.analytics import geocoding
+from domains.analytics.routes.dashboard import get_patient_locations
+
+OWNER = SimpleNamespace(id=7, clinic_id=1, role="clinic_owner")
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([models.Clinic(id=1, name="Clinic A"), models.Clinic(id=2, name="Clinic B")])
+    geocoding.load(session, geocoding.bundled_rows())
+    geocoding.load(session, [("400703", "Thane", 19.0771, 73.0087, "geonames")])
+    session.commit()
+    yield session
+    session.close()
+
+
+def patient(db, village, clinic_id=1, name="P"):
+    p = models.Patient(clinic_id=clinic_id, name=name, phone="9000000000", village=village)
+    db.add(p)
+    db.commit()
+    return p
+
+
+def locations(db, clinic_id=None):
+    return get_patient_locations(clinic_id=clinic_id, db=db, current_user=OWNER)
+
+
+@pytest.mark.parametrize("village, key", [
+    ("Mumbai", "mumbai"),
+    ("  BOMBAY ", "bombay"),
+    ("Flat 4, Sector 17, Vashi, Navi Mumbai", "navi mumbai"),
+    ("Plot 9, Vashi 400703, Navi Mumbai", "400703"),
+    ("Kalyan-Dombivli", "kalyan dombivli"),
+    ("Hubballi", "hubballi"),
+    ("Somewhere Unmapped", None),
+    ("", None),
+])
+def test_a_village_resolves_to_its_most_specific_entry(db, village, key):
+    assert patient(db, village).geocode_key == key
+
+
+def test_an_edit_re_resolves_and_other_edits_leave_the_key(db):
+    p = patient(db, "Pune")
+    p.village = "Poona"
+    db.commit()
+    assert p.geocode_key == "poona"
+    p.name = "Renamed"
+    db.commit()
+    assert p.geocode_key == "poona"
+    p.village = None
+    db.commit()
+    assert p.geocode_key is None
+
+
+def test_counts_per_place_with_aliases_merged_and_unknowns_unlocated(db):
+    for v in ["Bangalore", "Bengaluru", "bangalore", "Mysore", "Nowhere Town", "Elsewhere", "  "]:
+        patient(db, v)
+    patient(db, "Mysuru", clinic_id=2)
+
+    result = locations(db)
+    assert [(r["location"], r["count"], r["located"]) for r in result] == [
+        ("Bangalore", 3, True), ("Mysore", 1, True), ("Unlocated", 2, False)]
+    assert (result[-1]["latitude"], result[-1]["longitude"]) == (None, None)
+    assert [p["name"] for p in result[-1]["patients"]] == ["P", "P"]
+    assert (result[0]["latitude"], result[0]["longitude"]) == (12.9716, 77.5946)
+    assert len(result[0]["patients"]) == 3
+    assert locations(db, clinic_id=2)[0]["count"] == 1
+
+
+def test_two_queries_whatever_the_number_of_patients(db):
+    for i in range(40):
+        patient(db, ["Chennai", "Madras", "Pune", "Nagpur"][i % 4], name=f"P{i}")
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        seen.append(statement)
+
+    result = locations(db)
+    assert len(seen) == 2
+    assert {r["location"]: r["count"] for r in result} == {"Chennai": 20, "Pune": 10, "Nagpur": 10}
+    assert all(len(r["patients"]) == min(r["count"], 5) for r in result)
+
+
+def test_backfill_geocodes_rows_written_behind_the_orm(db):
+    db.execute(text("INSERT INTO patients (clinic_id, name, phone, village, payment_type) "
+                    "VALUES (1, 'Raw', '9', 'Trivandrum', 'Cash'), (1, 'Raw2', '9', 'Atlantis', 'Cash')"))
+    db.commit()
+    assert [(r["location"], r["count"]) for r in locations(db)] == [("Unlocated", 2)]
+    assert geocoding.backfill(db) == 1
+    db.commit()
+    assert [(r["location"], r["count"]) for r in locations(db)] == [("Thiruvananthapuram", 1), ("Unlocated", 1)]
+
+
+def test_geonames_pincodes_are_placed_at_their_centroid(tmp_path):
+    dump = tmp_path / "IN.txt"
+    dump.write_text(
+        "IN\t560001\tBangalore GPO\tKarnataka\t19\tBangalore\t583\t\t\t12.98\t77.58\t4\n"
+        "IN\t560001\tVidhana Soudha\tKarnataka\t19\tBangalore\t583\t\t\t12.96\t77.60\t4\n"
+        "IN\tABC\tbroken\n"
+    )
+    assert list(geocoding.geonames_rows(str(dump))) == [
+        ("560001", "Bangalore", 12.97, 77.59, "geonames"),
+    ]
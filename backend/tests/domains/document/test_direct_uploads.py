@@ -0,0 +1,209 @@
+"""Direct-to-R2 multipart uploads.
+
+The API only signs part URLs and registers the result, so what matters is the
+brokering: parts are sized within R2's limits, keys stay inside the caller's
+patient folder, and complete registers the right row and queues its previews.
+R2 is an in-memory fake here.
+"""
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from core.dtos import DirectUploadAbortDTO, DirectUploadCompleteDTO, DirectUploadInitiateDTO
+from domains.document.routes import direct_uploads
+from domains.document.routes.direct_uploads import (
+    MAX_PARTS,
+    MIN_PART_BYTES,
+    abort_direct_upload,
+    complete_direct_upload,
+    initiate_direct_upload,
+    plan_parts,
+)
+
+MiB = 1024 * 1024
+
+
+class FakeR2:
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+
+    def create(self, key, content_type):
+        upload_id = f"up-{len(self.uploads) + 1}"
+        self.uploads[upload_id] = key
+        return upload_id
+
+    def sign(self, key, upload_id, part_number, expires_in=3600):
+        return f"https://r2/{key}?uploadId={upload_id}&partNumber={part_number}"
+
+    def complete(self, key, upload_id, parts):
+        if self.uploads.pop(upload_id, None) != key:
+            return False
+        self.objects[key] = {"size": 42 * MiB, "content_type": "application/dicom", "parts": parts}
+        return True
+
+    def abort(self, key, upload_id):
+        return self.uploads.pop(upload_id, None) is not None
+
+    def head(self, key):
+        return self.objects.get(key)
+
+
+@pytest.fixture()
+def r2(monkeypatch):
+    fake = FakeR2()
+    monkeypatch.setattr(direct_uploads, "create_multipart_upload", fake.create)
+    monkeypatch.setattr(direct_uploads, "presign_upload_part", fake.sign)
+    monkeypatch.setattr(direct_uploads, "complete_multipart_upload", fake.complete)
+    monkeypatch.setattr(direct_uploads, "abort_multipart_upload", fake.abort)
+    monkeypatch.setattr(direct_uploads, "head_r2_object", fake.head)
+    return fake
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.Patient.__table__,
+            models.User.__table__,
+            models.Appointment.__table__,
+            models.PatientDocument.__table__,
+            models.XrayImage.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add_all([
+        models.Clinic(id=1, name="Clinic A"),
+        models.Clinic(id=2, name="Clinic B"),
+        models.Patient(id=10, clinic_id=1, name="A Patient",
+                       phone="9000000001", treatment_type="General"),
+        models.Patient(id=20, clinic_id=2, name="B Patient",
+                       phone="9000000002", treatment_type="General"),
+        models.User(id=1, clinic_id=1, email="u1@x.com",
+                    first_name="A", last_name="Doctor", name="A Doctor"),
+    ])
+    session.commit()
+    return session
+
+
+@pytest.fixture()
+def user(db):
+    return db.get(models.User, 1)
+
+
+def initiate(db, user, **kw):
+    req = DirectUploadInitiateDTO(**{"file_name": "scan.dcm", "file_size": 42 * MiB, **kw})
+    return asyncio.run(initiate_direct_upload(10, req, db=db, current_user=user))
+
+
+def complete(db, user, started, tasks=None, **kw):
+    req = DirectUploadCompleteDTO(**{
+        "key": started.key,
+        "upload_id": started.upload_id,
+        # Out of order on purpose: clients finish parts concurrently.
+        "parts": [{"part_number": p.part_number, "etag": f'"e{p.part_number}"'} for p in reversed(started.parts)],
+        "file_name": "scan.dcm",
+        **kw,
+    })
+    return asyncio.run(complete_direct_upload(
+        10, req, background_tasks=tasks or BackgroundTasks(), db=db, current_user=user,
+    ))
+
+
+# ── Part planning ────────────────────────────────────────────────────────────
+
+@pytest.mark.parametrize("size", [1, 42 * MiB, 200 * 1024 * MiB])
+def test_parts_cover_the_file_within_r2_limits(size):
+    part_size, count = plan_parts(size)
+    assert part_size >= MIN_PART_BYTES
+    assert count <= MAX_PARTS
+    assert (count - 1) * part_size < size <= count * part_size
+
+
+# ── Initiate ─────────────────────────────────────────────────────────────────
+
+def test_initiate_signs_every_part_under_the_patient_folder(db, user, r2):
+    started = initiate(db, user)
+    assert started.key.startswith("clinics/1/patients/10/documents/")
+    assert started.key.endswith("_scan.dcm")
+    assert [p.part_number for p in started.parts] == list(range(1, len(started.parts) + 1))
+    assert len(started.parts) == plan_parts(42 * MiB)[1]
+
+
+def test_initiate_rejects_other_clinics_patients(db, user, r2):
+    req = DirectUploadInitiateDTO(file_name="scan.dcm", file_size=MiB)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(initiate_direct_upload(20, req, db=db, current_user=user))
+    assert exc.value.status_code == 404
+    assert r2.uploads == {}
+
+
+def test_xrays_must_be_dicom(db, user, r2):
+    with pytest.raises(HTTPException) as exc:
+        initiate(db, user, kind="xray", file_name="photo.jpg")
+    assert exc.value.status_code == 400
+
+
+# ── Complete ─────────────────────────────────────────────────────────────────
+
+def test_complete_registers_document_and_queues_previews(db, user, r2):
+    started = initiate(db, user)
+    tasks = BackgroundTasks()
+
+    doc = complete(db, user, started, tasks)
+
+    assert doc.file_path == started.key
+    assert doc.file_size == 42 * MiB
+    assert doc.file_type == "dcm"
+    assert db.get(models.PatientDocument, doc.id).uploaded_by == 1
+    parts = r2.objects[started.key]["parts"]
+    assert [p["PartNumber"] for p in parts] == sorted(p["PartNumber"] for p in parts)
+    assert len(tasks.tasks) == 1
+
+
+def test_complete_registers_xray(db, user, r2):
+    started = initiate(db, user, kind="xray")
+    assert "/xrays/" in started.key
+    tasks = BackgroundTasks()
+
+    xray = complete(db, user, started, tasks, kind="xray", image_type="opg")
+
+    assert xray.file_path == started.key
+    assert xray.created_by == 1
+    assert xray.patient_name == "A Patient"
+    assert tasks.tasks[0].func is direct_uploads.build_xray_previews
+
+
+def test_complete_refuses_keys_outside_the_patient_folder(db, user, r2):
+    started = initiate(db, user)
+    started.key = "clinics/2/patients/20/documents/abc_scan.dcm"
+    with pytest.raises(HTTPException) as exc:
+        complete(db, user, started)
+    assert exc.value.status_code == 400
+    assert db.query(models.PatientDocument).count() == 0
+
+
+def test_failed_completion_registers_nothing(db, user, r2):
+    started = initiate(db, user)
+    started.upload_id = "up-unknown"
+    with pytest.raises(HTTPException):
+        complete(db, user, started)
+    assert db.query(models.PatientDocument).count() == 0
+
+
+# ── Abort ────────────────────────────────────────────────────────────────────
+
+def test_abort_discards_the_upload(db, user, r2):
+    started = initiate(db, user)
+    req = DirectUploadAbortDTO(key=started.key, upload_id=started.upload_id)
+    asyncio.run(abort_direct_upload(10, req, db=db, current_user=user))
+    assert r2.uploads == {}
@@ -0,0 +1,86 @@
+"""Query cost of the patient file list.
+
+`list_documents` used to look up the uploader once per document, so a patient
+with hundreds of radiographs cost hundreds of queries per page load. The
+number of `users` lookups must now be one, however many documents and
+uploaders there are.
+"""
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.document.routes import documents
+from domains.document.routes.documents import list_documents
+
+
+def make_db(n_docs: int):
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.Patient.__table__,
+            models.User.__table__,
+            models.PatientDocument.__table__,
+            models.Report.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add_all([
+        models.Clinic(id=1, name="Clinic A"),
+        models.Patient(id=10, clinic_id=1, name="A Patient",
+                       phone="9000000001", treatment_type="General"),
+    ])
+    session.add_all([
+        models.User(id=uid, clinic_id=1, email=f"u{uid}@x.com",
+                    first_name=f"Dr{uid}", last_name="Smith", name=f"Dr{uid} Smith")
+        for uid in (1, 2, 3)
+    ])
+    session.add_all([
+        models.PatientDocument(
+            id=100 + i, patient_id=10, clinic_id=1,
+            file_name=f"x{i}.dcm", file_path=f"clinics/1/x{i}.dcm", file_type="dcm",
+            # Uploaders 1-3, plus system uploads and a since-deleted user.
+            uploaded_by=(None, 1, 2, 3, 99)[i % 5],
+        )
+        for i in range(n_docs)
+    ])
+    session.commit()
+    return engine, session
+
+
+def count_user_selects(engine):
+    seen = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM users" in statement:
+            seen.append(statement)
+
+    return seen
+
+
+@pytest.fixture(autouse=True)
+def no_storage(monkeypatch):
+    monkeypatch.setattr(documents, "get_presigned_url", lambda key: f"https://signed/{key}")
+
+
+@pytest.mark.parametrize("n_docs", [5, 50, 200])
+def test_uploaders_are_resolved_in_one_query(n_docs):
+    engine, db = make_db(n_docs)
+    user_selects = count_user_selects(engine)
+    owner = models.User(id=1, clinic_id=1, email="u1@x.com")
+
+    result = asyncio.run(list_documents(10, db=db, current_user=owner))
+
+    assert len(result) == n_docs
+    assert len(user_selects) == 1
+    names = {r.id: r.uploader_name for r in result}
+    assert names[100] == "System"
+    assert names[101] == "Dr1 Smith"
+    assert names[104] == "Unknown"
@@ -0,0 +1,223 @@
+"""Upload-time preview pipeline.
+
+Previews are rendered once, written next to the source as WebP in every size,
+and their keys recorded on the row so the list endpoint can hand them out
+without touching the renderer. R2 is an in-memory dict here.
+"""
+from __future__ import annotations
+
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import models
+from domains.document.routes import documents
+from domains.document.services import previews
+from domains.document.services.previews import (
+    PREVIEW_SIZES,
+    build_document_previews,
+    build_xray_previews,
+    preview_key,
+    render_previews,
+)
+
+
+def png_bytes(width=2400, height=1200) -> bytes:
+    buf = io.BytesIO()
+    Image.new("L", (width, height), color=128).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def dicom_bytes(photometric="MONOCHROME2") -> bytes:
+    import numpy as np
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.1.1"
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.Rows, ds.Columns = 64, 128
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    # Left half dark, right half bright.
+    arr = np.zeros((64, 128), dtype=np.uint16)
+    arr[:, 64:] = 4000
+    ds.PixelData = arr.tobytes()
+    buf = io.BytesIO()
+    ds.save_as(buf, enforce_file_format=True)
+    return buf.getvalue()
+
+
+def decode(webp: bytes) -> Image.Image:
+    img = Image.open(io.BytesIO(webp))
+    assert img.format == "WEBP"
+    return img
+
+
+# ── Rendering ────────────────────────────────────────────────────────────────
+
+def test_every_size_is_webp_bounded_by_its_edge():
+    out = render_previews(png_bytes(), "png")
+    assert set(out) == set(PREVIEW_SIZES)
+    for size, edge in PREVIEW_SIZES.items():
+        assert max(decode(out[size]).size) == edge
+
+
+def test_small_sources_are_not_upscaled():
+    out = render_previews(png_bytes(200, 100), "png")
+    assert decode(out["preview"]).size == (200, 100)
+
+
+def test_dicom_renders_and_monochrome1_is_inverted():
+    normal = decode(render_previews(dicom_bytes(), "dcm")["thumb"]).convert("L")
+    inverted = decode(render_previews(dicom_bytes("MONOCHROME1"), "dcm")["thumb"]).convert("L")
+    w, h = normal.size
+    left, right = (w // 4, h // 2), (3 * w // 4, h // 2)
+    assert normal.getpixel(left) < normal.getpixel(right)
+    assert inverted.getpixel(left) > inverted.getpixel(right)
+
+
+@pytest.mark.parametrize("raw, file_type", [
+    (b"not a dicom", "dcm"),
+    (b"%PDF-garbage", "pdf"),
+    (b"plain text", "txt"),
+])
+def test_unrenderable_sources_yield_nothing(raw, file_type):
+    assert render_previews(raw, file_type) == {}
+
+
+# ── Pipeline ─────────────────────────────────────────────────────────────────
+
+@pytest.fixture()
+def session_factory():
+    # One shared connection: the thumbnail endpoint renders in a worker thread.
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool,
+    )
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.Patient.__table__,
+            models.User.__table__,
+            models.Appointment.__table__,
+            models.PatientDocument.__table__,
+            models.XrayImage.__table__,
+        ],
+    )
+    factory = sessionmaker(bind=engine)
+    session = factory()
+    session.add_all([
+        models.Clinic(id=1, name="Clinic A"),
+        models.Patient(id=10, clinic_id=1, name="A Patient",
+                       phone="9000000001", treatment_type="General"),
+        models.User(id=1000, clinic_id=1, email="u1@x.com", first_name="A", last_name="Doctor", name="A Doctor"),
+        models.PatientDocument(
+            id=100, patient_id=10, clinic_id=1,
+            file_name="opg.png", file_path="clinics/1/opg.png", file_type="png",
+        ),
+        models.PatientDocument(
+            id=101, patient_id=10, clinic_id=1,
+            file_name="notes.txt", file_path="clinics/1/notes.txt", file_type="txt",
+        ),
+    ])
+    session.commit()
+    session.close()
+    return factory
+
+
+@pytest.fixture()
+def bucket(monkeypatch):
+    objects = {"clinics/1/opg.png": png_bytes()}
+    monkeypatch.setattr(previews, "download_bytes_from_r2", objects.get)
+    monkeypatch.setattr(
+        previews, "put_bytes_to_key",
+        lambda key, data, content_type: objects.__setitem__(key, data) or True,
+    )
+    return objects
+
+
+def test_document_previews_are_stored_and_recorded(session_factory, bucket):
+    keys = build_document_previews(100, session_factory=session_factory)
+
+    assert keys == {size: preview_key("clinics/1/opg.png", size) for size in PREVIEW_SIZES}
+    for key in keys.values():
+        decode(bucket[key])
+    doc = session_factory().get(models.PatientDocument, 100)
+    assert doc.thumbnail_key == keys["thumb"]
+    assert doc.preview_key == keys["preview"]
+
+
+def test_unpreviewable_document_is_left_alone(session_factory, bucket):
+    assert build_document_previews(101, session_factory=session_factory) == {}
+    assert session_factory().get(models.PatientDocument, 101).thumbnail_key is None
+
+
+def test_storage_failure_leaves_keys_null(session_factory, monkeypatch):
+    monkeypatch.setattr(previews, "download_bytes_from_r2", lambda key: None)
+    assert build_document_previews(100, session_factory=session_factory) == {}
+    assert session_factory().get(models.PatientDocument, 100).thumbnail_key is None
+
+
+def test_xray_previews_are_written_beside_the_file(session_factory, tmp_path):
+    source = tmp_path / "xray_1.dcm"
+    source.write_bytes(dicom_bytes())
+    session = session_factory()
+    session.add(models.XrayImage(
+        id=5, clinic_id=1, patient_id=10, file_path=str(source), file_name="xray_1.dcm",
+        file_size=source.stat().st_size, image_type="periapical",
+        capture_date=models.datetime.datetime(2026, 1, 1), created_by=1000,
+    ))
+    session.commit()
+    session.close()
+
+    keys = build_xray_previews(5, session_factory=session_factory)
+
+    assert keys["thumb"] == f"{source}.thumb.webp"
+    decode((tmp_path / "xray_1.dcm.preview.webp").read_bytes())
+    assert session_factory().get(models.XrayImage, 5).preview_key == keys["preview"]
+
+
+# ── Thumbnail endpoint ───────────────────────────────────────────────────────
+
+def test_thumbnail_endpoint_backfills_old_rows_once(session_factory, bucket, monkeypatch):
+    monkeypatch.setattr(documents, "download_bytes_from_r2", bucket.get)
+    db = session_factory()
+    token = documents.thumbnail_token(100)
+
+    first = asyncio.run(documents.get_document_thumbnail(100, t=token, db=db))
+    assert first.media_type == "image/webp"
+    assert db.get(models.PatientDocument, 100).thumbnail_key is not None
+
+    def no_render(*args):
+        raise AssertionError("rendered again")
+    monkeypatch.setattr(documents, "generate_document_previews", no_render)
+    second = asyncio.run(documents.get_document_thumbnail(100, t=token, db=db))
+    assert second.body == first.body
+
+
+def test_direct_uploaded_xray_previews_go_to_r2(session_factory, bucket):
+    bucket["clinics/1/patients/10/xrays/abc_opg.dcm"] = dicom_bytes()
+    session = session_factory()
+    session.add(models.XrayImage(
+        id=6, clinic_id=1, patient_id=10, file_path="clinics/1/patients/10/xrays/abc_opg.dcm",
+        file_name="opg.dcm", file_size=1, image_type="opg",
+        capture_date=models.datetime.datetime(2026, 1, 1), created_by=1000,
+    ))
+    session.commit()
+    session.close()
+
+    keys = build_xray_previews(6, session_factory=session_factory)
+
+    assert keys["thumb"] == "clinics/1/patients/10/xrays/abc_opg.dcm.thumb.webp"
+    decode(bucket[keys["preview"]])
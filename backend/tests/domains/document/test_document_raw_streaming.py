@@ -0,0 +1,211 @@
+"""Streaming and byte ranges on `/documents/{id}/raw`.
+
+The DICOM viewer fetches frames of large studies through this proxy. It must
+stream rather than buffer, answer single ranges with 206, and hand back its
+large-transfer slot however the response ends, including a client that
+leaves before the first chunk and a request cancelled while R2 is opening. R2 is replaced with an
+in-memory object; the route and the range logic are real.
+"""
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.document.routes import documents
+from domains.document.routes.documents import _parse_range, get_document_raw
+
+PAYLOAD = bytes(range(256)) * 4  # 1 KiB, every offset distinguishable
+
+
+class FakeBody:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.closed = False
+
+    def iter_chunks(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.Patient.__table__,
+            models.User.__table__,
+            models.PatientDocument.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add_all([
+        models.Clinic(id=1, name="Clinic A"),
+        models.Patient(id=10, clinic_id=1, name="A Patient",
+                       phone="9000000001", treatment_type="General"),
+        models.PatientDocument(
+            id=100, patient_id=10, clinic_id=1,
+            file_name="cbct.dcm", file_path="clinics/1/cbct.dcm", file_type="dcm",
+        ),
+    ])
+    session.commit()
+    yield session
+    session.close()
+
+
+@pytest.fixture()
+def storage(monkeypatch):
+    """Record every body handed out so tests can check it was closed."""
+    opened = []
+
+    def fake_head(key):
+        return {"size": len(PAYLOAD), "content_type": "application/dicom"}
+
+    def fake_open(key, start=None, end=None):
+        body = FakeBody(PAYLOAD if start is None else PAYLOAD[start:end + 1])
+        opened.append(body)
+        return body
+
+    monkeypatch.setattr(documents, "head_r2_object", fake_head)
+    monkeypatch.setattr(documents, "open_r2_stream", fake_open)
+    monkeypatch.setattr(documents, "_STREAM_CHUNK_BYTES", 100)
+    return opened
+
+
+def owner() -> models.User:
+    return models.User(id=1000, clinic_id=1, email="u1@x.com")
+
+
+def fetch(db, range_header=None):
+    async def run():
+        resp = await get_document_raw(100, range_header=range_header, db=db, current_user=owner())
+        body = b"".join([chunk async for chunk in resp.body_iterator])
+        return resp, body
+    return asyncio.run(run())
+
+
+# ── Range parsing ────────────────────────────────────────────────────────────
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 1023)),
+    ("bytes=-24", (1000, 1023)),
+    ("bytes=-5000", (0, 1023)),      # suffix longer than the object
+    ("bytes=1000-9999", (1000, 1023)),  # end clamped to the last byte
+    ("bytes=0-9,20-29", None),       # multi-range: serve everything instead
+    ("items=0-9", None),
+    ("bytes=9-0", None),             # malformed, so ignored
+    ("bytes=abc-", None),
+])
+def test_parse_range(header, expected):
+    assert _parse_range(header, 1024) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1024-", "bytes=5000-6000", "bytes=-0"])
+def test_unsatisfiable_range_is_416_with_the_size(header):
+    with pytest.raises(HTTPException) as exc:
+        _parse_range(header, 1024)
+    assert exc.value.status_code == 416
+    assert exc.value.headers["Content-Range"] == "bytes */1024"
+
+
+# ── Route ────────────────────────────────────────────────────────────────────
+
+def test_full_fetch_streams_whole_object(db, storage):
+    resp, body = fetch(db)
+    assert resp.status_code == 200
+    assert body == PAYLOAD
+    assert resp.headers["content-length"] == str(len(PAYLOAD))
+    assert resp.headers["accept-ranges"] == "bytes"
+    assert resp.media_type == "application/dicom"
+    assert storage[0].closed
+
+
+def test_range_fetch_is_206_with_only_the_slice(db, storage):
+    resp, body = fetch(db, "bytes=200-499")
+    assert resp.status_code == 206
+    assert body == PAYLOAD[200:500]
+    assert resp.headers["content-range"] == "bytes 200-499/1024"
+    assert resp.headers["content-length"] == "300"
+
+
+def test_large_transfer_releases_its_slot(db, storage, monkeypatch):
+    monkeypatch.setattr(documents, "_LARGE_TRANSFER_BYTES", 1)
+    monkeypatch.setattr(documents, "_large_transfers", asyncio.Semaphore(1))
+    for _ in range(3):  # would block on the second pass if the slot leaked
+        resp, body = fetch(db)
+        assert body == PAYLOAD
+    assert not documents._large_transfers.locked()
+
+
+@pytest.fixture()
+def one_slot(monkeypatch):
+    monkeypatch.setattr(documents, "_LARGE_TRANSFER_BYTES", 1)
+    monkeypatch.setattr(documents, "_large_transfers", asyncio.Semaphore(1))
+
+
+def test_slot_comes_back_when_the_client_leaves_before_the_body(db, storage, one_slot):
+    async def run():
+        resp = await get_document_raw(100, range_header=None, db=db, current_user=owner())
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            await asyncio.sleep(0)
+
+        await resp({"type": "http", "asgi": {"spec_version": "2.0"}}, receive, send)
+
+    asyncio.run(run())
+    assert not documents._large_transfers.locked()
+    assert storage[0].closed
+
+
+def test_slot_comes_back_when_the_request_is_cancelled_opening_r2(db, one_slot, monkeypatch):
+    monkeypatch.setattr(documents, "head_r2_object", lambda key: {"size": len(PAYLOAD)})
+    opening = asyncio.Event()
+
+    async def threadpool(fn, *args):
+        if fn is documents.open_r2_stream:
+            opening.set()
+            await asyncio.sleep(10)
+        return fn(*args)
+
+    monkeypatch.setattr(documents, "run_in_threadpool", threadpool)
+
+    async def run():
+        task = asyncio.create_task(get_document_raw(100, range_header=None, db=db, current_user=owner()))
+        await opening.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert not documents._large_transfers.locked()
+
+
+def test_large_transfer_is_503_when_slots_are_exhausted(db, storage, monkeypatch):
+    monkeypatch.setattr(documents, "_LARGE_TRANSFER_BYTES", 1)
+    monkeypatch.setattr(documents, "_LARGE_TRANSFER_WAIT_S", 0.01)
+    monkeypatch.setattr(documents, "_large_transfers", asyncio.Semaphore(0))
+    with pytest.raises(HTTPException) as exc:
+        fetch(db)
+    assert exc.value.status_code == 503
+    assert storage == []  # never touched storage
+
+
+def test_missing_object_is_404(db, monkeypatch):
+    monkeypatch.setattr(documents, "head_r2_object", lambda key: None)
+    with pytest.raises(HTTPException) as exc:
+        fetch(db)
+    assert exc.value.status_code == 404
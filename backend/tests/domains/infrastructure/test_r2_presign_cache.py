@@ -0,0 +1,91 @@
+"""Presigned-URL reuse.
+
+List endpoints sign every file on every page load. Signatures are now reused
+within a reuse window, which also keeps the URL stable so the browser cache
+works. What must hold: the same key inside one window is signed once, a new
+window signs afresh, and nothing handed out has less than three quarters of
+the requested lifetime left.
+"""
+from __future__ import annotations
+
+import pytest
+
+from domains.infrastructure.services import r2_storage
+from domains.infrastructure.services.r2_storage import (
+    PRESIGN_REUSE_FRACTION,
+    get_presigned_url,
+    presign_bucket,
+)
+
+WEEK = 604800
+
+
+class FakeClient:
+    def __init__(self):
+        self.signed = []
+
+    def generate_presigned_url(self, op, Params, ExpiresIn):
+        self.signed.append((Params["Key"], ExpiresIn))
+        return f"https://acct.r2.cloudflarestorage.com/b/{Params['Key']}?sig={len(self.signed)}"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    fake = FakeClient()
+    monkeypatch.setenv("R2_BUCKET_NAME", "b")
+    monkeypatch.delenv("R2_PUBLIC_URL", raising=False)
+    monkeypatch.setattr(r2_storage, "_get_r2_client", lambda: fake)
+    r2_storage._signed_get_url.cache_clear()
+    yield fake
+    r2_storage._signed_get_url.cache_clear()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_800_000_000.0]
+    monkeypatch.setattr(r2_storage.time, "time", lambda: now[0])
+    return now
+
+
+def test_same_key_in_one_window_is_signed_once(client, clock):
+    urls = {get_presigned_url("clinics/1/a.dcm") for _ in range(50)}
+    assert len(urls) == 1
+    assert client.signed == [("clinics/1/a.dcm", WEEK)]
+
+
+def test_distinct_keys_and_lifetimes_are_signed_separately(client, clock):
+    get_presigned_url("clinics/1/a.dcm")
+    get_presigned_url("clinics/1/b.dcm")
+    get_presigned_url("clinics/1/a.dcm", expires_in=3600)
+    assert len(client.signed) == 3
+
+
+def test_a_new_window_signs_afresh(client, clock):
+    first = get_presigned_url("clinics/1/a.dcm")
+    clock[0] += WEEK // PRESIGN_REUSE_FRACTION
+    assert get_presigned_url("clinics/1/a.dcm") != first
+    assert len(client.signed) == 2
+
+
+def test_stored_signed_urls_share_the_keys_entry(client, clock):
+    """An expired signed URL in the DB and the bare key are the same object."""
+    stale = "https://acct.r2.cloudflarestorage.com/b/clinics/1/a.dcm?X-Amz-Signature=dead"
+    assert get_presigned_url(stale) == get_presigned_url("clinics/1/a.dcm")
+    assert len(client.signed) == 1
+
+
+@pytest.mark.parametrize("expires_in", [60, 3600, WEEK])
+def test_a_window_spans_a_quarter_of_the_lifetime(expires_in):
+    """A signature made at the start of a window is still handed out at its
+    end, so the window length is the most validity a caller can lose."""
+    window = expires_in // PRESIGN_REUSE_FRACTION
+    start = 1_000 * window
+    assert presign_bucket(expires_in, start) == presign_bucket(expires_in, start + window - 1)
+    assert presign_bucket(expires_in, start + window) == presign_bucket(expires_in, start) + 1
+    assert expires_in - window >= expires_in * 3 / 4
+
+
+def test_public_bucket_urls_bypass_signing(client, monkeypatch):
+    monkeypatch.setenv("R2_PUBLIC_URL", "https://cdn.example.com")
+    assert get_presigned_url("clinics/1/a.png") == "https://cdn.example.com/clinics/1/a.png"
+    assert client.signed == []
@@ -0,0 +1,133 @@
+"""Shared R2 client, metrics and async facade.
+
+Every caller must get the same pooled client, however many threads ask for it
+at once; each call must land in the metrics with its bytes and outcome; and
+the async functions must go through the same path as the sync ones. A
+streamed body is closed however its reader stops.
+"""
+from __future__ import annotations
+
+import asyncio
+import io
+import threading
+
+import pytest
+
+from domains.infrastructure.services import r2_storage
+from domains.infrastructure.services.r2_storage import (
+    R2_MAX_ATTEMPTS,
+    R2_MAX_POOL_CONNECTIONS,
+    download_bytes_from_r2,
+    download_bytes_from_r2_async,
+    iter_r2_body,
+    put_bytes_to_key,
+    put_bytes_to_key_async,
+    put_fileobj_to_key,
+    r2_client_config,
+    storage_metrics,
+)
+
+
+class FakeClient:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[Key] = Body
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.objects[Key] = b"".join(iter(lambda: Fileobj.read(64), b""))
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise KeyError(Key)
+        return {"Body": io.BytesIO(self.objects[Key]), "ContentLength": len(self.objects[Key])}
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    storage_metrics.reset()
+    yield
+    storage_metrics.reset()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    fake = FakeClient()
+    monkeypatch.setattr(r2_storage, "_get_r2_client", lambda: fake)
+    return fake
+
+
+def test_client_config_pools_and_retries():
+    config = r2_client_config()
+    assert config.max_pool_connections == R2_MAX_POOL_CONNECTIONS
+    assert config.retries == {"max_attempts": R2_MAX_ATTEMPTS, "mode": "standard"}
+
+
+def test_client_is_built_once_across_threads(monkeypatch):
+    for var in ("R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME", "R2_ENDPOINT_URL"):
+        monkeypatch.setenv(var, "x")
+    monkeypatch.setattr(r2_storage, "_r2_client", None)
+    built = []
+    monkeypatch.setattr(r2_storage.boto3, "client", lambda *a, **kw: built.append(kw) or object())
+
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(r2_storage._get_r2_client())) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(built) == 1
+    assert len({id(c) for c in clients}) == 1
+
+
+def test_uploads_and_downloads_record_bytes(client):
+    assert put_bytes_to_key("clinics/1/a.bin", b"x" * 300)
+    assert download_bytes_from_r2("clinics/1/a.bin") == b"x" * 300
+
+    snap = storage_metrics.snapshot()
+    assert snap["upload"]["count"] == 1 and snap["upload"]["bytes"] == 300
+    assert snap["download"]["bytes"] == 300
+    assert snap["download"]["errors"] == 0
+
+
+def test_a_file_is_streamed_from_its_position(client):
+    f = io.BytesIO(b"skip" + b"y" * 500)
+    f.seek(4)
+    assert put_fileobj_to_key("clinics/1/export.csv", f, "text/csv")
+    assert client.objects["clinics/1/export.csv"] == b"y" * 500
+    assert storage_metrics.snapshot()["upload"]["bytes"] == 500
+
+
+def test_failures_are_counted(client):
+    assert download_bytes_from_r2("clinics/1/missing.bin") is None
+    stat = storage_metrics.snapshot()["download"]
+    assert (stat["count"], stat["errors"], stat["bytes"]) == (1, 1, 0)
+
+
+def test_async_facade_shares_client_and_metrics(client):
+    async def roundtrip():
+        await put_bytes_to_key_async("clinics/1/b.bin", b"abc")
+        return await download_bytes_from_r2_async("clinics/1/b.bin")
+
+    assert asyncio.run(roundtrip()) == b"abc"
+    assert client.objects["clinics/1/b.bin"] == b"abc"
+    assert storage_metrics.snapshot()["upload"]["bytes"] == 3
+
+
+def test_a_streamed_body_is_closed_when_the_reader_stops_early():
+    class Body(io.BytesIO):
+        def iter_chunks(self, size):
+            return iter(lambda: self.read(size), b"")
+
+    body, closed = Body(b"0123456789"), []
+
+    async def first_chunk():
+        chunks = iter_r2_body(body, 4, on_close=lambda: closed.append(True))
+        first = await chunks.__anext__()
+        await chunks.aclose()
+        return first
+
+    assert asyncio.run(first_chunk()) == b"0123"
+    assert body.closed and closed == [True]
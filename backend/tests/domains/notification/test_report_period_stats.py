@@ -0,0 +1,232 @@
+"""Stored weekly/monthly report figures.
+
+The broadcasts read per-period rows instead of recomputing from raw tables.
+A closed period is computed once, in batch, and then only read; the period
+still running is topped up with what is new and recomputed in full when it
+closes.
+"""
+from __future__ import annotations
+
+import datetime as dt
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.notification.services import report_period_stats as stats
+from domains.notification.services.report_stats_service import (
+    get_monthly_stats, get_review_stats, get_weekly_stats, prepare_monthly_stats, prepare_weekly_stats,
+)
+
+TODAY = dt.date(2026, 3, 15)  # a Sunday, when the weekly broadcast runs
+LAST_WEEK = dt.datetime(2026, 3, 10, 11)  # inside [Mar 8, Mar 15)
+WEEK_BEFORE = dt.datetime(2026, 3, 3, 11)
+FEB = dt.datetime(2026, 2, 12, 11)
+JAN = dt.datetime(2026, 1, 20, 11)
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    for cid in (1, 2, 3):
+        session.add(models.Clinic(id=cid, name=f"Clinic {cid}"))
+    session.commit()
+    yield session
+    session.close()
+
+
+_ids = iter(range(1, 10_000))
+
+
+def visit(db, clinic_id, when, status="completed", patient_id=None):
+    db.add(models.Appointment(clinic_id=clinic_id, patient_id=patient_id, patient_name="P",
+                              appointment_date=when, start_time="11:00", end_time="11:30",
+                              duration=30, status=status))
+
+
+def new_patient(db, clinic_id, when):
+    pid = next(_ids)
+    db.add(models.Patient(id=pid, clinic_id=clinic_id, name=f"P{pid}", phone="9", created_at=when))
+    return pid
+
+
+def invoice(db, clinic_id, patient_id, when, total, items=()):
+    inv = models.Invoice(clinic_id=clinic_id, patient_id=patient_id, invoice_number=f"INV-{next(_ids)}",
+                         status="finalized", total=total, finalized_at=when)
+    inv.line_items = [models.InvoiceLineItem(description=d, unit_price=1.0, amount=1.0) for d in items]
+    db.add(inv)
+
+
+def review(db, clinic_id, when, rating, text):
+    db.add(models.GoogleReview(clinic_id=clinic_id, place_id="p", review_hash=f"h{next(_ids)}",
+                               rating=rating, text=text, review_time=when))
+
+
+def selects(db):
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            seen.append(statement)
+
+    return seen
+
+
+def test_weekly_figures(db):
+    p = new_patient(db, 1, LAST_WEEK)
+    visit(db, 1, LAST_WEEK, patient_id=p)
+    visit(db, 1, LAST_WEEK, status="no_show")
+    visit(db, 1, LAST_WEEK, status="cancelled")
+    visit(db, 1, WEEK_BEFORE)
+    invoice(db, 1, p, LAST_WEEK, 1500.0)
+    invoice(db, 1, p, WEEK_BEFORE, 1000.0)
+    db.commit()
+
+    assert get_weekly_stats(db, 1, TODAY) == {
+        "week_date": "08 Mar 2026", "appointments": "2", "appt_change": "▲100%",
+        "new_patients": "1", "patients_change": "—", "revenue": "1,500",
+        "revenue_change": "▲50%", "noshows": "1", "insight": "Great week! Keep it up.",
+    }
+
+
+def test_monthly_and_review_figures(db):
+    a, b = new_patient(db, 1, FEB), new_patient(db, 1, JAN)
+    for pid in (a, a, b):
+        visit(db, 1, FEB, patient_id=pid)
+    visit(db, 1, FEB, status="no_show", patient_id=b)
+    invoice(db, 1, a, FEB, 3000.0, ["Scaling", "Filling", "Scaling", "X-ray", "Scaling", "Filling"])
+    invoice(db, 1, a, JAN, 2000.0)
+    review(db, 1, FEB, 5, "Very friendly team and a clean clinic")
+    review(db, 1, FEB, 2, "Long wait")
+    review(db, 1, JAN, 5, "Good")
+    db.add(models.GooglePlaceLink(clinic_id=1, place_id="p", current_rating=4.6))
+    db.commit()
+
+    assert get_monthly_stats(db, 1, TODAY) == {
+        "month": "February 2026", "total_patients": "2", "new_patients": "1",
+        "returning_patients": "1", "total_revenue": "3,000", "avg_revenue": "1,500",
+        "change": "▲50%", "top_treatments": "Scaling, Filling, X-ray", "noshows": "1",
+        "noshows_pct": "25",
+    }
+    assert get_review_stats(db, 1, TODAY) == {
+        "month": "February 2026", "rating": "4.6", "new_reviews": "2", "change": "▲1 vs last month",
+        "loved1": "Friendly staff", "loved2": "Clean clinic", "area_to_watch": "Waiting time",
+    }
+
+
+def test_a_broadcast_reads_stored_rows_after_one_batch(db):
+    for cid in (1, 2, 3):
+        visit(db, cid, LAST_WEEK)
+        visit(db, cid, FEB)
+    db.commit()
+
+    seen = selects(db)
+    prepare_weekly_stats(db, [1, 2, 3], TODAY)
+    prepare_monthly_stats(db, [1, 2, 3], TODAY)
+    batch = len(seen)
+    for cid in (1, 2, 3):
+        get_weekly_stats(db, cid, TODAY)
+        get_monthly_stats(db, cid, TODAY)
+    assert len(seen) == batch
+    assert batch < 30  # grouped over clinics, not per clinic
+
+    db.commit()
+    seen.clear()
+    prepare_weekly_stats(db, [1, 2, 3], TODAY)
+    assert len(seen) == 2  # both weeks already stored: one read per period
+
+
+def test_closed_periods_are_kept_until_deleted(db):
+    visit(db, 1, LAST_WEEK)
+    db.commit()
+    assert get_weekly_stats(db, 1, TODAY)["appointments"] == "1"
+
+    visit(db, 1, LAST_WEEK)  # back-dated after the week was stored
+    db.commit()
+    assert get_weekly_stats(db, 1, TODAY)["appointments"] == "1"
+
+    db.query(models.ReportPeriodStat).delete()
+    db.commit()
+    fresh = sessionmaker(bind=db.get_bind())()  # the next broadcast's session
+    assert get_weekly_stats(fresh, 1, TODAY)["appointments"] == "2"
+    fresh.close()
+
+
+def test_the_open_period_is_topped_up_then_recomputed_when_it_closes(db):
+    period = stats.month(dt.date(2026, 3, 1))
+    a = new_patient(db, 1, dt.datetime(2026, 3, 2, 9))
+    visit(db, 1, dt.datetime(2026, 3, 2, 10), patient_id=a)
+    invoice(db, 1, a, dt.datetime(2026, 3, 2, 10), 500.0, ["Scaling"])
+    review(db, 1, dt.datetime(2026, 3, 2, 10), 5, "Friendly staff")
+    db.commit()
+
+    row = stats.ensure(db, [1], [period], dt.datetime(2026, 3, 5))[(1, "month", period.start)]
+    assert (row.closed, row.measures["appointments"], row.measures["revenue"]) == (False, 1, 500.0)
+
+    visit(db, 1, dt.datetime(2026, 3, 9, 10), patient_id=a)
+    invoice(db, 1, a, dt.datetime(2026, 3, 9, 10), 700.0, ["Scaling", "Filling"])
+    review(db, 1, dt.datetime(2026, 3, 9, 10), 5, "So clean")
+    visit(db, 1, dt.datetime(2026, 3, 3, 10), status="no_show")  # before computed_through
+    db.commit()
+
+    row = stats.ensure(db, [1], [period], dt.datetime(2026, 3, 10))[(1, "month", period.start)]
+    m = row.measures
+    assert not row.closed and row.computed_through == dt.datetime(2026, 3, 10)
+    assert (m["appointments"], m["noshows"], m["revenue"], m["new_reviews"]) == (2, 0, 1200.0, 2)
+    assert m["visited_patients"] == 1
+    assert m["treatments"] == [["Scaling", 2], ["Filling", 1]]
+    assert m["loved"] == ["Friendly staff", "Clean clinic"]
+
+    row = stats.ensure(db, [1], [period], dt.datetime(2026, 4, 1, 0, 30))[(1, "month", period.start)]
+    assert row.closed
+    assert (row.measures["appointments"], row.measures["noshows"]) == (3, 1)
+    assert row.measures == stats.measure(db, [1], "month", *period.bounds())[1]
+
+
+def test_the_nightly_job_does_not_close_a_week_before_utc_reaches_its_end(db, monkeypatch):
+    import asyncio
+
+    import database
+    from core import scheduled_jobs
+
+    early = new_patient(db, 1, dt.datetime(2026, 3, 14, 12))
+    invoice(db, 1, early, dt.datetime(2026, 3, 14, 12), 400.0)
+    db.commit()
+
+    # 00:30 IST on Sunday is still 19:00 UTC on Saturday.
+    monkeypatch.setattr(database, "SessionLocal", lambda: db)
+    monkeypatch.setattr(scheduled_jobs, "_utc_now", lambda: dt.datetime(2026, 3, 14, 19))
+    asyncio.run(scheduled_jobs.report_period_stats_job())
+    row = db.get(models.ReportPeriodStat, (1, "week", dt.date(2026, 3, 8)))
+    assert not row.closed and row.computed_through == dt.datetime(2026, 3, 14, 19)
+
+    # Stamped with utcnow after the job ran, still inside the week in UTC.
+    late = new_patient(db, 1, dt.datetime(2026, 3, 14, 21))
+    invoice(db, 1, late, dt.datetime(2026, 3, 14, 23, 30), 600.0)
+    db.commit()
+
+    fresh = sessionmaker(bind=db.get_bind())()
+    prepare_weekly_stats(fresh, [1], TODAY)
+    figures = get_weekly_stats(fresh, 1, TODAY)
+    assert (figures["new_patients"], figures["revenue"]) == ("2", "1,000")
+    fresh.close()
+
+
+def test_a_top_up_counts_rows_stamped_after_the_previous_one(db):
+    period = stats.week(dt.date(2026, 3, 8))
+    stats.ensure(db, [1], [period], dt.datetime(2026, 3, 10, 6))
+    new_patient(db, 1, dt.datetime(2026, 3, 10, 7))  # an hour after the watermark
+    db.commit()
+    row = stats.ensure(db, [1], [period], dt.datetime(2026, 3, 11, 6))[(1, "week", period.start)]
+    assert row.measures["new_patients"] == 1
+
+    upcoming = stats.week(dt.date(2026, 3, 15))
+    new_patient(db, 1, dt.datetime(2026, 3, 14, 22))  # the week before it
+    db.commit()
+    stats.ensure(db, [1], [upcoming], dt.datetime(2026, 3, 14, 19))
+    row = stats.ensure(db, [1], [upcoming], dt.datetime(2026, 3, 16))[(1, "week", upcoming.start)]
+    assert row.measures["new_patients"] == 0
@@ -0,0 +1,164 @@
+"""Appointment stats cube.
+
+Whatever happens to appointments through the ORM, the cube must hold exactly
+what a rebuild from the raw rows would, and the stats endpoints reading it
+must answer as the raw scans did, in one query.
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, delete, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.scheduling import appointment_facts
+from domains.scheduling.routes.appointment_stats import (appointment_stats, busiest,
+                                                         stats_by_doctor)
+
+NOW = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+
+def appt(id, doctor_id, days_ago, hour, status="completed", duration=30, booked_days_before=2):
+    when = NOW - timedelta(days=days_ago) - timedelta(hours=NOW.hour) + timedelta(hours=hour)
+    return models.Appointment(
+        id=id, clinic_id=1, doctor_id=doctor_id, patient_id=None, patient_name=f"P{id}",
+        appointment_date=when, start_time=f"{hour:02d}:00",
+        end_time=f"{hour:02d}:{duration if duration < 60 else 59:02d}",
+        duration=duration, status=status, created_at=when - timedelta(days=booked_days_before),
+    )
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+            models.AppointmentStatsFact.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add(models.Clinic(id=1, name="Clinic A"))
+    session.add_all([
+        models.User(id=d, clinic_id=1, email=f"d{d}@x.com", first_name=f"D{d}",
+                    last_name="Doc", name=f"D{d} Doc", role="doctor", is_active=True)
+        for d in (1, 2)
+    ])
+    session.add_all([
+        appt(1, 1, 3, 9),
+        appt(2, 1, 3, 10, status="no_show"),
+        appt(3, 2, 5, 9, status="cancelled", duration=45),
+        appt(4, 2, 10, 14, booked_days_before=0),
+        appt(5, None, 1, 11, status="scheduled"),
+    ])
+    session.commit()
+    return session
+
+
+def cube(db):
+    F = models.AppointmentStatsFact
+    return {
+        tuple(getattr(r, k) for k in appointment_facts.KEY): tuple(getattr(r, m) for m in appointment_facts.MEASURES)
+        for r in db.query(F).all() if r.appointments
+    }
+
+
+def rebuilt(db):
+    appointment_facts.rebuild(db)
+    return cube(db)
+
+
+def test_writes_keep_the_cube_equal_to_a_rebuild(db):
+    a = db.get(models.Appointment, 1)
+    a.status = "cancelled"
+    db.get(models.Appointment, 4).appointment_date -= timedelta(days=1)
+    db.get(models.Appointment, 5).doctor_id = 2
+    db.delete(db.get(models.Appointment, 2))
+    db.add(appt(6, 1, 0, 8, status="scheduled"))
+    db.commit()
+
+    incremental = cube(db)
+    assert incremental == rebuilt(db)
+    assert sum(v[0] for v in incremental.values()) == 5
+
+
+def test_an_edit_from_a_stale_session_counts_the_stored_row(db):
+    other = sessionmaker(bind=db.get_bind())()
+    stale = other.get(models.Appointment, 1)  # loaded before the edit below
+    db.get(models.Appointment, 1).status = "no_show"
+    db.commit()
+
+    stale.doctor_id = 2  # this session still believes status is "completed"
+    other.commit()
+    other.close()
+
+    assert cube(db) == rebuilt(db)
+
+
+def test_unrelated_edits_and_rollbacks_leave_the_cube_alone(db):
+    before = cube(db)
+    db.get(models.Appointment, 1).notes = "bring x-rays"
+    db.commit()
+    db.get(models.Appointment, 1).status = "no_show"
+    db.flush()
+    db.rollback()
+    assert cube(db) == before
+
+
+def test_bulk_deletes_and_updates_keep_the_cube_equal_to_a_rebuild(db):
+    db.query(models.Appointment).filter(models.Appointment.doctor_id == 1).delete(synchronize_session=False)
+    db.query(models.Appointment).filter(models.Appointment.doctor_id == 2).update(
+        {models.Appointment.status: "no_show", models.Appointment.doctor_id: None},
+        synchronize_session=False)
+    db.execute(delete(models.Appointment).where(models.Appointment.id == 5))
+    db.commit()
+
+    incremental = cube(db)
+    assert incremental == rebuilt(db)
+    assert sum(v[0] for v in incremental.values()) == 2
+
+
+def test_writes_still_work_without_the_table():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine, tables=[
+        models.Clinic.__table__, models.User.__table__, models.Patient.__table__,
+        models.Appointment.__table__,
+    ])
+    session = sessionmaker(bind=engine)()
+    session.add(appt(1, None, 0, 9))
+    session.commit()
+    assert session.get(models.Appointment, 1).status == "completed"
+
+
+def test_stats_endpoints_read_the_cube_in_one_query(db):
+    owner = db.get(models.User, 1)
+    selects = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(statement)
+
+    stats = appointment_stats(days=30, db=db, current_user=owner)
+    assert len(selects) == 1
+    assert (stats["total"], stats["completed"], stats["no_show"], stats["cancelled"],
+            stats["still_open"]) == (5, 2, 1, 1, 1)
+    assert stats["no_show_rate"] == 33.3
+    assert stats["avg_lead_days"] == 1.6
+    assert stats["same_day_share"] == 20.0
+    assert stats["booked_minutes"] == 120
+
+    by_doctor = {d["doctor_id"]: d for d in stats_by_doctor(days=30, db=db, current_user=owner)}
+    assert by_doctor[1]["no_show_rate"] == 50.0
+    assert by_doctor[2]["booked_minutes"] == 30
+    assert by_doctor[None]["doctor_name"] == "Unassigned"
+
+    shape = busiest(days=30, db=db, current_user=owner)
+    assert {h["hour"]: h["count"] for h in shape["by_hour"]}[9] == 1
+    assert sum(w["count"] for w in shape["by_weekday"]) == 4
@@ -0,0 +1,112 @@
+"""Appointment times as minutes.
+
+The start_minute/end_minute columns are derived from the HH:MM strings on
+every ORM write with the same parser that reads the strings, the clash check
+runs on them in SQL, and a write refused by the Postgres exclusion constraint
+comes back as a 409 rather than a 500. Old rows whose columns are still NULL
+are checked on their strings instead of slipping past.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.scheduling import availability, public_availability
+
+MONDAY = date(2026, 3, 2)
+
+
+def appt(id, doctor_id, start, end, status="scheduled"):
+    return models.Appointment(
+        id=id, clinic_id=1, doctor_id=doctor_id, patient_name=f"P{id}",
+        appointment_date=datetime.combine(MONDAY, datetime.strptime(start, "%H:%M").time()),
+        start_time=start, end_time=end, duration=30, status=status,
+    )
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add(models.Clinic(id=1, name="Clinic A"))
+    session.add_all([
+        appt(1, 1, "09:00", "09:30"),
+        appt(2, 1, "10:00", "11:00"),
+        appt(3, 1, "11:00", "11:30", status="cancelled"),
+        appt(4, 2, "09:15", "09:45"),
+    ])
+    session.commit()
+    return session
+
+
+def test_minutes_follow_the_strings(db):
+    a = db.get(models.Appointment, 2)
+    assert (a.start_minute, a.end_minute) == (600, 660)
+    a.start_time, a.end_time = "14:15", "14:45"
+    db.commit()
+    assert (a.start_minute, a.end_minute) == (855, 885)
+
+
+@pytest.mark.parametrize("start,end,expected", [
+    ("09:30", "10:00", None),   # back to back on both sides
+    ("09:15", "09:45", 1),
+    ("10:30", "12:00", 2),
+    ("08:00", "12:00", 1),      # spans both; earliest wins
+    ("11:00", "11:30", None),   # only a cancelled booking there
+])
+def test_find_conflict_in_sql(db, start, end, expected):
+    hit = availability.find_conflict(db, 1, 1, MONDAY, start, end)
+    assert (hit.id if hit else None) == expected
+
+
+def test_minutes_use_the_same_parser_as_the_strings(db):
+    db.add(appt(5, 3, "09:00", "10:00"))
+    a = db.get(models.Appointment, 5)
+    a.start_time, a.end_time = "9", "10"
+    db.commit()
+    assert (a.start_minute, a.end_minute) == (540, 600)
+    assert availability.find_conflict(db, 1, 3, MONDAY, "09:30", "09:45").id == 5
+
+
+def test_rows_without_minutes_still_clash(db):
+    # As left by the startup backfill for a string it could not parse.
+    db.execute(update(models.Appointment).where(models.Appointment.id == 2)
+               .values(start_time="10", start_minute=None, end_minute=None))
+    db.commit()
+    assert availability.find_conflict(db, 1, 1, MONDAY, "10:30", "10:45").id == 2
+    assert availability.find_conflict(db, 1, 1, MONDAY, "12:00", "12:30") is None
+
+    day = public_availability.build_snapshot(db, 1, None, MONDAY, 1)["days"][0]
+    assert [600, 660] in day["busy"]
+
+
+def test_find_conflict_skips_the_appointment_being_moved(db):
+    assert availability.find_conflict(db, 1, 1, MONDAY, "09:00", "09:30", exclude_id=1) is None
+
+
+def test_composite_index_is_declared():
+    indexes = {ix.name: [c.name for c in ix.columns] for ix in models.Appointment.__table__.indexes}
+    assert indexes["ix_appointments_clinic_doctor_date"] == ["clinic_id", "doctor_id", "appointment_date"]
+
+
+def test_constraint_violation_is_recognised():
+    refused = IntegrityError(
+        "INSERT INTO appointments ...", {},
+        Exception('conflicting key value violates exclusion constraint "ex_appointments_doctor_overlap"'),
+    )
+    assert availability.is_double_booking(refused)
+    assert not availability.is_double_booking(IntegrityError("INSERT", {}, Exception("not null")))
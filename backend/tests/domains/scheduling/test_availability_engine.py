@@ -0,0 +1,202 @@
+"""In-memory availability engine.
+
+`ClinicAvailability` must give exactly the answers the single-shot functions
+in `availability` give, for every doctor on every day of the range, while the
+routes built on it run a fixed number of queries however many doctors and
+days they cover.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.scheduling import availability
+from domains.scheduling.availability_engine import ClinicAvailability
+from domains.scheduling.routes.appointment_stats import utilisation
+from domains.scheduling.routes.scheduling import SeriesPayload, create_series, day_shape
+
+MONDAY = date(2026, 3, 2)
+DOCTORS = (1, 2, 3, 4)  # 4 has no hours configured
+
+
+def appt(id, doctor_id, on, start, end, status="scheduled"):
+    return models.Appointment(
+        id=id, clinic_id=1, doctor_id=doctor_id, patient_name=f"P{id}",
+        appointment_date=datetime.combine(on, datetime.strptime(start, "%H:%M").time()),
+        start_time=start, end_time=end,
+        duration=availability.to_minutes(end) - availability.to_minutes(start),
+        status=status,
+    )
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+            models.DoctorAvailability.__table__,
+            models.DoctorTimeOff.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add(models.Clinic(id=1, name="Clinic A"))
+    session.add_all([
+        models.User(id=d, clinic_id=1, email=f"d{d}@x.com", first_name=f"D{d}",
+                    last_name="Doc", name=f"D{d} Doc", role="doctor", is_active=True)
+        for d in DOCTORS
+    ])
+    for d in (1, 2, 3):
+        for weekday in range(6):
+            session.add(models.DoctorAvailability(
+                clinic_id=1, doctor_id=d, weekday=weekday, start_time="09:00", end_time="13:00"))
+            if d != 3:
+                session.add(models.DoctorAvailability(
+                    clinic_id=1, doctor_id=d, weekday=weekday, start_time="14:00", end_time="18:00"))
+    session.add_all([
+        # A week off and an afternoon off.
+        models.DoctorTimeOff(clinic_id=1, doctor_id=1, start_date=MONDAY + timedelta(days=7),
+                             end_date=MONDAY + timedelta(days=11)),
+        models.DoctorTimeOff(clinic_id=1, doctor_id=2, start_date=MONDAY + timedelta(days=2),
+                             end_date=MONDAY + timedelta(days=2), start_time="15:00", end_time="18:00"),
+    ])
+    session.add_all([
+        appt(1, 1, MONDAY, "09:00", "09:30"),
+        appt(2, 1, MONDAY, "10:00", "11:00"),
+        appt(3, 2, MONDAY + timedelta(days=1), "14:30", "15:15"),
+        appt(4, 1, MONDAY + timedelta(days=2), "09:00", "13:00", status="cancelled"),
+        appt(5, None, MONDAY, "11:00", "11:30"),
+        appt(6, 3, MONDAY + timedelta(days=3), "12:00", "12:45"),
+    ])
+    session.commit()
+    return session
+
+
+def days(n=14):
+    return [MONDAY + timedelta(days=i) for i in range(n)]
+
+
+def count_selects(db):
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            seen.append(statement)
+
+    return seen
+
+
+# ── Same answers ─────────────────────────────────────────────────────────────
+
+def test_matches_single_shot_functions_everywhere(db):
+    avail = ClinicAvailability.load(db, 1, MONDAY, MONDAY + timedelta(days=13))
+    for on in days():
+        for d in DOCTORS:
+            assert avail.working_blocks(d, on) == availability.working_blocks(db, 1, d, on)
+            assert avail.free_slots(d, on, 30) == availability.free_slots(db, 1, d, on, 30)
+            for start, end in (("09:00", "09:30"), ("10:30", "11:15"), ("12:30", "14:30"), ("15:00", "16:00")):
+                assert avail.check_available(d, on, start, end) == \
+                    availability.check_available(db, 1, d, on, start, end)
+                assert avail.find_conflict(d, on, start, end) == \
+                    availability.find_conflict(db, 1, d, on, start, end)
+        assert avail.find_conflict(None, on, "11:00", "11:15") == \
+            availability.find_conflict(db, 1, None, on, "11:00", "11:15")
+
+
+def test_three_queries_for_the_whole_range(db):
+    selects = count_selects(db)
+    avail = ClinicAvailability.load(db, 1, MONDAY, MONDAY + timedelta(days=13))
+    for on in days():
+        for d in DOCTORS:
+            avail.free_slots(d, on, 30)
+            avail.check_available(d, on, "09:00", "09:30")
+    assert len(selects) == 3
+
+
+def test_bookings_added_after_load_block_later_checks(db):
+    avail = ClinicAvailability.load(db, 1, MONDAY, MONDAY)
+    assert avail.find_conflict(2, MONDAY, "09:00", "09:30") is None
+    avail.add(appt(99, 2, MONDAY, "09:00", "09:30"))
+    assert avail.find_conflict(2, MONDAY, "09:15", "09:45").id == 99
+    assert avail.find_conflict(2, MONDAY, "09:15", "09:45", exclude_id=99) is None
+
+
+def test_dates_outside_the_loaded_range_are_refused(db):
+    avail = ClinicAvailability.load(db, 1, MONDAY, MONDAY)
+    with pytest.raises(ValueError):
+        avail.find_conflict(1, MONDAY + timedelta(days=1), "09:00", "09:30")
+
+
+def test_working_grid_matches_single_shot_blocks(db):
+    avail = ClinicAvailability.load(db, 1, MONDAY, MONDAY + timedelta(days=13), with_appointments=False)
+    grid = avail.working_grid()
+    assert sorted(grid) == [1, 2, 3]
+    for d in (1, 2, 3):
+        assert sorted(grid[d]) == days()
+        for on in days():
+            assert grid[d][on] == availability.working_blocks(db, 1, d, on)
+    assert avail.working_grid([4], MONDAY, MONDAY) == {4: {MONDAY: []}}
+
+
+def test_request_memo_reuses_a_covering_snapshot_until_commit(db):
+    selects = count_selects(db)
+    wide = ClinicAvailability.for_request(db, 1, MONDAY, MONDAY + timedelta(days=13))
+    assert len(selects) == 3
+    assert ClinicAvailability.for_request(db, 1, MONDAY + timedelta(days=2), MONDAY + timedelta(days=3)) is wide
+    assert ClinicAvailability.for_request(db, 1, MONDAY, MONDAY, with_appointments=False) is wide
+    assert len(selects) == 3
+
+    db.commit()
+    assert ClinicAvailability.for_request(db, 1, MONDAY, MONDAY) is not wide
+    assert len(selects) == 6
+
+
+# ── Routes ───────────────────────────────────────────────────────────────────
+
+def test_day_shape_query_count_does_not_grow_with_doctors(db):
+    owner = db.get(models.User, 1)
+    selects = count_selects(db)
+    shape = day_shape(MONDAY + timedelta(days=7), db=db, current_user=owner)
+    assert shape["doctors"]["1"] == {"configured": True, "blocks": []}
+    assert shape["doctors"]["4"]["configured"] is False
+    # doctors, clinic, hours, leave
+    assert len(selects) == 4
+
+
+def test_utilisation_query_count_does_not_grow_with_days(db):
+    owner = db.get(models.User, 1)
+    selects = count_selects(db)
+    out = utilisation(on=MONDAY + timedelta(days=13), days=14, db=db, current_user=owner)
+    by_id = {d["doctor_id"]: d for d in out["doctors"]}
+    # Twelve working days of eight hours, minus the week of leave.
+    assert by_id[1]["available_minutes"] == 12 * 480 - 5 * 480
+    assert by_id[4]["configured"] is False
+    # doctors, appointments, hours, leave
+    assert len(selects) == 4
+
+    # Asked again in the same request, hours and leave come from the memo.
+    utilisation(on=MONDAY + timedelta(days=13), days=7, db=db, current_user=owner)
+    assert len(selects) == 6
+
+
+def test_series_skips_clashes_and_leave(db):
+    owner = db.get(models.User, 1)
+    payload = SeriesPayload(
+        patient_name="Series Patient", doctor_id=1, start_date=MONDAY,
+        start_time="10:30", duration=30, occurrences=3, interval_days=7,
+    )
+    out = create_series(payload, db=db, current_user=owner)
+    assert [c["date"] for c in out["created"]] == [(MONDAY + timedelta(days=14)).isoformat()]
+    assert [s["reason"] for s in out["skipped"]] == [
+        "Clashes with P2 at 10:00",
+        "That doctor is away on this date",
+    ]
@@ -0,0 +1,124 @@
+"""Calendar read path.
+
+`GET /appointments` and `GET /appointments/calendar` must resolve doctor
+names in the same query as the rows, the calendar must page without skipping
+or repeating rows, and a poll with the ETag it was given must get a 304 until
+the range changes.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+from datetime import date, datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.scheduling.routes.appointments import get_appointments, get_calendar
+
+MONDAY = date(2026, 3, 2)
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add_all([models.Clinic(id=1, name="Clinic A"), models.Clinic(id=2, name="Clinic B")])
+    session.add_all([
+        models.User(id=d, clinic_id=1, email=f"d{d}@x.com", first_name=f"D{d}",
+                    last_name="Doc", name=f"Dr {d}", role="doctor")
+        for d in (1, 2, 3)
+    ])
+    for i in range(30):
+        at = datetime.combine(MONDAY + timedelta(days=i % 5), datetime.min.time()) + timedelta(hours=9)
+        session.add(models.Appointment(
+            id=i + 1, clinic_id=1, doctor_id=(i % 4) or None, patient_name=f"P{i}",
+            # Several rows share a timestamp, which is what the id tiebreak is for.
+            appointment_date=at, start_time="09:00", end_time="09:30", duration=30, status="scheduled",
+        ))
+    session.add(models.Appointment(
+        id=99, clinic_id=2, doctor_id=None, patient_name="Elsewhere",
+        appointment_date=datetime.combine(MONDAY, datetime.min.time()),
+        start_time="09:00", end_time="09:30", duration=30, status="scheduled",
+    ))
+    session.commit()
+    return session
+
+
+def count_selects(db):
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            seen.append(statement)
+
+    return seen
+
+
+def calendar(db, user=None, **kw):
+    args = dict(date_from=None, date_to=None, status=None, doctor_id=None, clinic_id=None,
+                cursor=None, limit=500, if_none_match=None)
+    args.update(kw)
+    return get_calendar(**args, db=db, current_user=user or db.get(models.User, 1))
+
+
+def test_list_is_one_query_with_doctor_names(db):
+    owner = db.get(models.User, 1)
+    selects = count_selects(db)
+    out = asyncio.run(get_appointments(date_from=None, date_to=None, status=None, doctor_id=None,
+                                       clinic_id=None, db=db, current_user=owner))
+    assert len(out) == 30
+    assert {a.doctor_name for a in out} == {None, "Dr 1", "Dr 2", "Dr 3"}
+    assert len(selects) == 1
+
+
+def test_calendar_pages_cover_every_row_once(db):
+    owner = db.get(models.User, 1)
+    seen, cursor, selects = [], None, count_selects(db)
+    while True:
+        page = json.loads(calendar(db, owner, limit=7, cursor=cursor).body)
+        ids = page["fields"].index("id")
+        seen += [r[ids] for r in page["rows"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert sorted(seen) == list(range(1, 31)) and len(seen) == 30
+    assert len(selects) == 5
+
+
+def test_calendar_rows_follow_the_header(db):
+    page = json.loads(calendar(db, date_from=MONDAY.isoformat(), date_to=MONDAY.isoformat(),
+                               doctor_id=1).body)
+    rows = [dict(zip(page["fields"], r)) for r in page["rows"]]
+    assert rows and all(r["doctor_name"] == "Dr 1" and r["date"] == MONDAY.isoformat() for r in rows)
+
+
+def test_calendar_revalidates_with_etag(db):
+    first = calendar(db)
+    etag = first.headers["etag"]
+    assert calendar(db, if_none_match=etag).status_code == 304
+    assert calendar(db, if_none_match=f"W/{etag}").status_code == 304
+
+    db.get(models.Appointment, 5).status = "cancelled"
+    db.commit()
+    changed = calendar(db, if_none_match=etag)
+    assert changed.status_code == 200 and changed.headers["etag"] != etag
+
+
+def test_bad_cursor_is_a_400(db):
+    with pytest.raises(HTTPException) as exc:
+        calendar(db, cursor="not-a-cursor")
+    assert exc.value.status_code == 400
@@ -0,0 +1,220 @@
+"""Calendar change feed.
+
+An appointment write has to reach every subscriber of its clinic, and no one
+else, whether it goes through Redis or, with Redis down, straight to this
+process. A subscriber that falls behind is told to resync rather than left
+with a silently incomplete calendar.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+from datetime import datetime
+
+import fakeredis
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.scheduling import change_feed
+from domains.scheduling.routes.appointments import (OutcomePayload, appointment_changes,
+                                                    delete_appointment, set_outcome)
+
+
+def down_redis():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    return fakeredis.FakeRedis(server=server)
+
+
+def broken_factory():
+    raise ConnectionError("connection refused")
+
+
+@pytest.fixture()
+def feed(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(change_feed, "_client", fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(change_feed, "_down_until", 0.0)
+    hub = change_feed.ChangeFeedHub(lambda: fakeredis.FakeAsyncRedis(server=server))
+    monkeypatch.setattr(change_feed, "hub", hub)
+    return hub
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add(models.Clinic(id=1, name="Clinic A"))
+    session.add(models.User(id=1, clinic_id=1, email="o@x.com", first_name="O",
+                            last_name="Owner", name="O Owner", role="clinic_owner"))
+    session.add_all([
+        models.Appointment(
+            id=i, clinic_id=1, patient_name=f"P{i}", appointment_date=datetime(2026, 3, 2, 9),
+            start_time="09:00", end_time="09:30", duration=30, status="scheduled",
+        )
+        for i in (1, 2)
+    ])
+    session.commit()
+    return session
+
+
+def test_events_reach_only_their_clinic(feed):
+    async def run():
+        mine, other = await feed.subscribe(1), await feed.subscribe(2)
+        await asyncio.wait_for(feed.ready.wait(), 2)
+        change_feed.publish(1, change_feed.CREATED, 42, {"id": 42})
+        change_feed.publish(1, change_feed.DELETED, 42)
+        got = [await asyncio.wait_for(mine.get(), 2) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert other.empty()
+        await feed.close()
+        return got
+
+    created, deleted = asyncio.run(run())
+    assert (created["type"], created["row"], created["seq"]) == ("created", {"id": 42}, 1)
+    assert (deleted["type"], deleted["row"], deleted["seq"]) == ("deleted", None, 2)
+
+
+def test_redis_down_delivers_locally_and_backs_off(monkeypatch):
+    monkeypatch.setattr(change_feed, "_client", down_redis())
+    monkeypatch.setattr(change_feed, "_down_until", 0.0)
+    hub = change_feed.ChangeFeedHub(broken_factory)
+    monkeypatch.setattr(change_feed, "hub", hub)
+
+    async def run():
+        queue = await hub.subscribe(1)
+        # Published from a worker thread, like a sync route handler.
+        await asyncio.to_thread(change_feed.publish, 1, change_feed.UPDATED, 7, {"id": 7})
+        event = await asyncio.wait_for(queue.get(), 2)
+        await hub.close()
+        return event
+
+    event = asyncio.run(run())
+    assert event["id"] == 7 and event["seq"] is None
+    assert change_feed._down_until > 0
+
+
+def test_slow_subscriber_is_told_to_resync(monkeypatch):
+    monkeypatch.setattr(change_feed, "QUEUE_SIZE", 2)
+    hub = change_feed.ChangeFeedHub(broken_factory)
+
+    async def run():
+        queue = await hub.subscribe(1)
+        for i in range(3):
+            hub._fan_out(1, {"type": "updated", "id": i})
+        await hub.close()
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    assert asyncio.run(run()) == [{"type": "resync", "clinic_id": 1}]
+
+
+@pytest.fixture()
+def sent(monkeypatch):
+    """The changes each commit hands to the publisher thread."""
+    out = []
+    monkeypatch.setattr(change_feed.publisher, "submit", out.extend)
+    return out
+
+
+def test_writes_publish(db, sent):
+    owner = db.get(models.User, 1)
+
+    set_outcome(1, OutcomePayload(status="completed"), db=db, current_user=owner)
+    asyncio.run(delete_appointment(2, db=db, current_user=owner))
+
+    assert [(c, k, i) for c, k, i, _ in sent] == [(1, "updated", 1), (1, "deleted", 2)]
+    assert sent[0][3]["status"] == "completed" and sent[0][3]["date"] == "2026-03-02"
+    assert sent[1][3] is None
+
+
+def test_a_commit_is_sent_off_the_committing_thread_in_one_round_trip(db, feed, monkeypatch):
+    calls = []
+    real = change_feed._client
+
+    class Counting:
+        def pipeline(self, transaction=True):
+            pipe = real.pipeline(transaction=transaction)
+            execute = pipe.execute
+            pipe.execute = lambda: calls.append(threading.get_ident()) or execute()
+            return pipe
+
+    monkeypatch.setattr(change_feed, "_client", Counting())
+    db.get(models.Appointment, 1).status = "completed"
+    db.get(models.Appointment, 2).status = "cancelled"
+    db.commit()
+    change_feed.publisher.join()
+
+    assert len(calls) == 1 and calls[0] != threading.get_ident()
+    assert real.get(change_feed.seq_key(1)) == b"2"
+
+
+def test_sse_stream(db, feed):
+    owner = db.get(models.User, 1)
+
+    async def run():
+        response = await appointment_changes(request=None, current_user=owner)
+        chunks = response.body_iterator
+        ready = await chunks.__anext__()
+        await asyncio.wait_for(feed.ready.wait(), 2)
+        change_feed.publish(1, change_feed.UPDATED, 1, {"id": 1})
+        event = await asyncio.wait_for(chunks.__anext__(), 2)
+        await chunks.aclose()
+        assert feed.subscriber_count(1) == 0
+        await feed.close()
+        return response, ready, event
+
+    response, ready, event = asyncio.run(run())
+    assert response.media_type == "text/event-stream"
+    assert "event: ready" in ready
+    lines = event.strip().split("\n")
+    assert lines[:2] == ["id: 1", "event: updated"]
+    assert json.loads(lines[2].removeprefix("data: "))["row"] == {"id": 1}
+
+
+def test_a_treatment_plan_booking_is_published_on_commit(db, sent):
+    from domains.patient.services.treatment_plan_service import TreatmentPlanService
+
+    db.add(models.Patient(id=5, clinic_id=1, name="Asha", phone="9000000000"))
+    db.commit()
+    sent.clear()
+    plan = TreatmentPlanService(db).create_treatment_plan(
+        5, 1, {"procedure": "Filling", "date": "2026-03-04", "time": "11:00"}, create_appointment=True)
+
+    assert [(c, k, i) for c, k, i, _ in sent] == [(1, "created", plan["appointment_id"])]
+    assert sent[0][3]["start_time"] == "11:00" and sent[0][3]["date"] == "2026-03-04"
+
+
+def test_created_then_edited_in_one_transaction_is_one_created(db, sent):
+    appt = models.Appointment(clinic_id=1, patient_name="New", appointment_date=datetime(2026, 3, 3, 9),
+                              start_time="09:00", end_time="09:30", duration=30, status="scheduled")
+    db.add(appt)
+    db.flush()
+    appt.start_time = "10:00"
+    assert sent == []  # nothing before the commit
+    db.commit()
+    assert [(k, row["start_time"]) for _, k, _, row in sent] == [("created", "10:00")]
+
+
+def test_bulk_writes_are_published_and_a_rollback_is_not(db, sent):
+    db.query(models.Appointment).filter(models.Appointment.id == 1).update(
+        {models.Appointment.notes: "x"}, synchronize_session=False)
+    db.query(models.Appointment).filter(models.Appointment.id == 2).delete(synchronize_session=False)
+    db.commit()
+    assert [(c, k, i) for c, k, i, _ in sent] == [(1, "resync", None), (1, "deleted", 2)]
+
+    sent.clear()
+    db.query(models.Appointment).delete(synchronize_session=False)
+    db.rollback()
+    assert sent == []
@@ -0,0 +1,119 @@
+"""Public booking availability snapshots.
+
+Browsing the booking page must be answered from Redis once the snapshot is
+warm, a booking must make the next read see it at once, repeats must be
+answerable with a 304, and the page must still work with no Redis at all.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+from datetime import date, datetime, timedelta
+
+import fakeredis
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.infrastructure.services.cache_service import cache_service
+from domains.scheduling import change_feed
+from domains.scheduling.routes.appointments import (get_next_available_slot, get_public_availability,
+                                                    get_public_clinic_info)
+
+TOMORROW = date.today() + timedelta(days=1)
+DAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+@pytest.fixture()
+def redis_up(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(cache_service, "redis_client", fakeredis.FakeAsyncRedis(server=server))
+    monkeypatch.setattr(change_feed, "_client", fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(change_feed, "_down_until", 0.0)
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[models.Clinic.__table__, models.User.__table__,
+                models.Patient.__table__, models.Appointment.__table__],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add(models.Clinic(
+        id=1, name="Clinic A", clinic_code="CLN-PUBLIC",
+        timings={d: {"open": "09:00", "close": "11:00", "closed": False} for d in DAYS},
+    ))
+    session.add(booking(1, TOMORROW, "09:00", "10:00"))
+    session.commit()
+    return session
+
+
+def booking(id, on, start, end):
+    return models.Appointment(
+        id=id, clinic_id=1, patient_name=f"P{id}", start_time=start, end_time=end, duration=60,
+        appointment_date=datetime.combine(on, datetime.strptime(start, "%H:%M").time()), status="scheduled",
+    )
+
+
+def count_selects(db):
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            seen.append(statement)
+
+    return seen
+
+
+def availability(db, if_none_match=None):
+    return asyncio.run(get_public_availability(
+        clinic_code="CLN-PUBLIC", date_from=TOMORROW.isoformat(), days=2, duration=30,
+        if_none_match=if_none_match, db=db))
+
+
+def slots(response):
+    return {d["date"]: d["slots"] for d in json.loads(response.body)["days"]}
+
+
+def test_warm_snapshot_needs_no_queries(db, redis_up):
+    first = availability(db)
+    assert slots(first)[TOMORROW.isoformat()] == ["10:00", "10:30"]
+    assert slots(first)[(TOMORROW + timedelta(days=1)).isoformat()] == ["09:00", "09:30", "10:00", "10:30"]
+    assert first.headers["cache-control"].startswith("public")
+
+    selects = count_selects(db)
+    assert slots(availability(db)) == slots(first)
+    asyncio.run(get_next_available_slot(clinic_code="CLN-PUBLIC", date=TOMORROW.isoformat(),
+                                        duration=60, days=1, db=db))
+    assert selects == []
+
+
+def test_a_booking_invalidates_the_snapshot(db, redis_up):
+    availability(db)
+    db.add(booking(2, TOMORROW, "10:00", "10:30"))
+    db.commit()
+    change_feed.publish(1, change_feed.CREATED, 2)
+    assert slots(availability(db))[TOMORROW.isoformat()] == ["10:30"]
+
+
+def test_repeat_with_etag_is_a_304(db, redis_up):
+    etag = availability(db).headers["etag"]
+    assert availability(db, if_none_match=etag).status_code == 304
+
+
+def test_works_without_redis(db, monkeypatch):
+    monkeypatch.setattr(cache_service, "redis_client", None)
+    assert slots(availability(db))[TOMORROW.isoformat()] == ["10:00", "10:30"]
+    out = asyncio.run(get_next_available_slot(clinic_code="CLN-PUBLIC", date=TOMORROW.isoformat(),
+                                              duration=60, days=1, db=db))
+    assert out["next_slot"] == "10:00"
+
+
+def test_clinic_info_hides_the_numeric_id(db, redis_up):
+    info = json.loads(asyncio.run(get_public_clinic_info(
+        clinic_code="CLN-PUBLIC", if_none_match=None, db=db)).body)
+    assert info["name"] == "Clinic A" and "id" not in info
@@ -0,0 +1,148 @@
+"""Series planner.
+
+Booking or moving a course of treatment must cost one availability load and
+one write however many visits it has, must not let visits in the same plan
+collide with each other, and must offer the nearest free slot for any visit
+it cannot place.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.scheduling import change_feed
+from domains.scheduling.availability_engine import ClinicAvailability
+from domains.scheduling.routes.scheduling import (SeriesPayload, SeriesReschedulePayload,
+                                                  create_series, reschedule_series)
+
+MONDAY = date(2031, 3, 3)
+
+
+@pytest.fixture(autouse=True)
+def no_feed(monkeypatch):
+    monkeypatch.setattr(change_feed, "publish", lambda *a, **kw: None)
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+            models.DoctorAvailability.__table__,
+            models.DoctorTimeOff.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add(models.Clinic(id=1, name="Clinic A"))
+    session.add(models.User(id=1, clinic_id=1, email="d@x.com", first_name="D",
+                            last_name="Doc", name="D Doc", role="doctor"))
+    for weekday in range(6):
+        session.add(models.DoctorAvailability(
+            clinic_id=1, doctor_id=1, weekday=weekday, start_time="09:00", end_time="13:00"))
+    # Week three: Monday is leave. Week two: 10:00 is taken.
+    session.add(models.DoctorTimeOff(clinic_id=1, doctor_id=1, start_date=MONDAY + timedelta(days=14),
+                                     end_date=MONDAY + timedelta(days=14)))
+    session.add(models.Appointment(
+        id=500, clinic_id=1, doctor_id=1, patient_name="Other",
+        appointment_date=datetime.combine(MONDAY + timedelta(days=7), datetime.min.time()) + timedelta(hours=10),
+        start_time="10:00", end_time="11:00", duration=60, status="scheduled",
+    ))
+    session.commit()
+    return session
+
+
+def count_statements(db):
+    seen = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def _record(conn, cursor, statement, params, context, executemany):
+        seen.append(statement.lstrip().split()[0].upper())
+
+    return seen
+
+
+def series(db, **kw):
+    args = dict(patient_name="Series Patient", doctor_id=1, start_date=MONDAY,
+                start_time="10:00", duration=30, occurrences=4, interval_days=7)
+    args.update(kw)
+    return create_series(SeriesPayload(**args), db=db, current_user=db.get(models.User, 1))
+
+
+def test_series_is_one_load_and_one_flush(db):
+    owner = db.get(models.User, 1)
+    seen, flushes = count_statements(db), []
+    event.listen(db, "after_flush", lambda session, ctx: flushes.append(1))
+    out = create_series(SeriesPayload(patient_name="S", doctor_id=1, start_date=MONDAY, start_time="11:00",
+                                      duration=30, occurrences=7, interval_days=1),
+                        db=db, current_user=owner)
+    assert len(out["created"]) == 6  # Sunday is not a working day
+    assert seen.count("SELECT") == 3
+    # One flush. SQLite gets a row at a time within it; Postgres gets one
+    # multi-row statement.
+    assert len(flushes) == 1 and seen.count("INSERT") == 6
+
+
+def test_skipped_dates_get_the_nearest_free_slot(db):
+    out = series(db, suggest_alternatives=True)
+    assert [c["date"] for c in out["created"]] == [MONDAY.isoformat(), (MONDAY + timedelta(days=21)).isoformat()]
+    clash, leave = out["skipped"]
+    assert clash["reason"] == "Clashes with Other at 10:00"
+    assert clash["alternative"] == {"date": (MONDAY + timedelta(days=7)).isoformat(),
+                                    "start_time": "09:30", "end_time": "10:00"}
+    # Nothing that Monday, so the next day at the same time.
+    assert leave["alternative"] == {"date": (MONDAY + timedelta(days=15)).isoformat(),
+                                    "start_time": "10:00", "end_time": "10:30"}
+
+
+def test_no_alternatives_unless_asked(db):
+    assert all("alternative" not in s for s in series(db)["skipped"])
+
+
+def test_reschedule_moves_every_visit_in_one_update(db):
+    out = series(db, occurrences=2, start_date=MONDAY + timedelta(days=1))
+    seen = count_statements(db)
+    moved = reschedule_series(out["series_id"], SeriesReschedulePayload(shift_days=1, start_time="12:00"),
+                              db=db, current_user=db.get(models.User, 1))
+    assert [(m["date"], m["start_time"]) for m in moved["moved"]] == [
+        ((MONDAY + timedelta(days=2)).isoformat(), "12:00"),
+        ((MONDAY + timedelta(days=9)).isoformat(), "12:00"),
+    ]
+    assert seen.count("UPDATE") == 1
+    stored = db.query(models.Appointment).filter_by(series_id=out["series_id"]).all()
+    assert {(a.start_time, a.end_time, a.start_minute) for a in stored} == {("12:00", "12:30", 720)}
+
+
+def test_reschedule_is_all_or_nothing(db):
+    out = series(db, occurrences=2, start_date=MONDAY + timedelta(days=4), interval_days=1)
+    moved = reschedule_series(out["series_id"], SeriesReschedulePayload(shift_days=3, suggest_alternatives=True),
+                              db=db, current_user=db.get(models.User, 1))
+    assert moved["moved"] == []
+    assert moved["skipped"][0]["reason"] == "Clashes with Other at 10:00"
+    assert moved["skipped"][0]["alternative"]["start_time"] == "09:30"
+    stored = db.query(models.Appointment).filter_by(series_id=out["series_id"]).order_by("id").all()
+    assert [a.appointment_date.date() for a in stored] == [MONDAY + timedelta(days=4), MONDAY + timedelta(days=5)]
+
+
+def test_a_visit_may_move_into_its_siblings_old_slot(db):
+    out = series(db, occurrences=3, start_date=MONDAY + timedelta(days=1), interval_days=1, start_time="09:00")
+    moved = reschedule_series(out["series_id"], SeriesReschedulePayload(shift_days=1),
+                              db=db, current_user=db.get(models.User, 1))
+    assert len(moved["moved"]) == 3
+
+
+def test_nearest_free_prefers_same_day_then_later(db):
+    avail = ClinicAvailability.load(db, 1, MONDAY, MONDAY + timedelta(days=20))
+    on = MONDAY + timedelta(days=7)
+    assert avail.nearest_free(1, on, 600, 60, 3) == (on, 540)
+    assert avail.nearest_free(1, MONDAY + timedelta(days=14), 600, 30, 3) == (MONDAY + timedelta(days=15), 600)
+    assert avail.nearest_free(1, MONDAY, 600, 30, 3, not_before=MONDAY + timedelta(days=2)) == \
+        (MONDAY + timedelta(days=2), 600)
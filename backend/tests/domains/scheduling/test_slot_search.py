@@ -0,0 +1,137 @@
+"""Slot search.
+
+The jumping search must find exactly the starts a brute-force walk of the
+lattice finds, for any mix of working blocks and bookings. The multi-day
+search has to stop at the first N slots it finds, and both callers (staff
+next-available and the public booking page) have to look past a full day.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.scheduling.availability import overlaps
+from domains.scheduling.availability_engine import ClinicAvailability
+from domains.scheduling.routes.appointments import get_next_available_slot
+from domains.scheduling.slot_search import BusyIntervals, free_starts, search_days
+
+FUTURE_MONDAY = date(2031, 3, 3)
+
+
+def brute_force(blocks, taken, duration, step, anchor=0):
+    out = []
+    for bs, be in blocks:
+        cursor = anchor + -(-(bs - anchor) // step) * step
+        while cursor + duration <= be:
+            if not any(overlaps(cursor, cursor + duration, ts, te) for ts, te in taken):
+                out.append(cursor)
+            cursor += step
+    return out
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_brute_force(seed):
+    rng = random.Random(seed)
+    blocks = sorted({(s, s + rng.randrange(30, 300)) for s in rng.sample(range(0, 1200, 5), 3)})
+    blocks = [b for i, b in enumerate(blocks) if i == 0 or b[0] >= blocks[i - 1][1]]
+    taken = [(s, s + rng.randrange(5, 120)) for s in rng.sample(range(0, 1400, 5), rng.randrange(0, 25))]
+    duration = rng.choice((10, 15, 30, 45, 60, 90))
+    step = rng.choice((5, 15, 30))
+    anchor = rng.choice((0, 5, 10))
+
+    assert free_starts(blocks, BusyIntervals(taken), duration, step, anchor=anchor) == \
+        brute_force(blocks, taken, duration, step, anchor)
+
+
+def test_back_to_back_bookings_leave_no_gap():
+    busy = BusyIntervals([(540, 600), (600, 660)])
+    assert len(busy) == 1
+    assert busy.is_free(480, 540) and busy.is_free(660, 690)
+    assert not busy.is_free(599, 601)
+
+
+def test_limit_and_earliest():
+    busy = BusyIntervals([(540, 600)])
+    assert free_starts([(480, 720)], busy, 30, 15, limit=2) == [480, 495]
+    assert free_starts([(480, 720)], busy, 30, 15, earliest=530, limit=1) == [600]
+
+
+def test_search_days_stops_once_it_has_enough():
+    asked = []
+
+    def starts_on(day, remaining):
+        asked.append(day)
+        return [540, 600, 660][:remaining] if day.weekday() != 0 else []
+
+    found = search_days(FUTURE_MONDAY, 14, starts_on, 4)
+    assert [d for d, _ in found] == [FUTURE_MONDAY + timedelta(days=1)] * 3 + [FUTURE_MONDAY + timedelta(days=2)]
+    assert len(asked) == 3
+
+
+# ── Callers ──────────────────────────────────────────────────────────────────
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+            models.DoctorAvailability.__table__,
+            models.DoctorTimeOff.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add(models.Clinic(
+        id=1, name="Clinic A", clinic_code="CLN-TEST",
+        timings={day: {"open": "09:00", "close": "11:00", "closed": day == "sunday"}
+                 for day in ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")},
+    ))
+    session.add(models.User(id=1, clinic_id=1, email="d@x.com", first_name="D",
+                            last_name="Doc", name="D Doc", role="doctor"))
+    for weekday in range(7):
+        session.add(models.DoctorAvailability(
+            clinic_id=1, doctor_id=1, weekday=weekday, start_time="09:00", end_time="11:00"))
+    # Monday is fully booked; a cancelled Tuesday booking must not count.
+    session.add_all([
+        models.Appointment(
+            clinic_id=1, doctor_id=1, patient_name=f"P{i}", start_time=s, end_time=e, duration=60,
+            appointment_date=datetime.combine(on, datetime.strptime(s, "%H:%M").time()), status=status,
+        )
+        for i, (on, s, e, status) in enumerate([
+            (FUTURE_MONDAY, "09:00", "10:00", "scheduled"),
+            (FUTURE_MONDAY, "10:00", "11:00", "confirmed"),
+            (FUTURE_MONDAY + timedelta(days=1), "09:00", "10:00", "cancelled"),
+        ])
+    ])
+    session.commit()
+    return session
+
+
+def test_engine_next_available_spans_days(db):
+    avail = ClinicAvailability.load(db, 1, FUTURE_MONDAY, FUTURE_MONDAY + timedelta(days=13))
+    found = avail.next_available(1, 60, limit=2)
+    assert found == [(FUTURE_MONDAY + timedelta(days=1), 540), (FUTURE_MONDAY + timedelta(days=1), 555)]
+
+
+def test_public_next_slot_single_day_is_unchanged(db):
+    out = asyncio.run(get_next_available_slot(
+        clinic_code="CLN-TEST", date=FUTURE_MONDAY.isoformat(), duration=60, days=1, db=db))
+    assert out["next_slot"] is None
+    assert out["message"] == "No available slots for the selected date and duration"
+
+
+def test_public_next_slot_looks_ahead(db):
+    out = asyncio.run(get_next_available_slot(
+        clinic_code="CLN-TEST", date=FUTURE_MONDAY.isoformat(), duration=60, days=7, db=db))
+    assert out["next_slot"] == "09:00"
+    assert out["date"] == (FUTURE_MONDAY + timedelta(days=1)).isoformat()
@@ -0,0 +1,115 @@
+"""Waitlist matching.
+
+The match must keep the old loose rules (no window or no doctor matches
+anything), rank the best candidates first, run as one indexed query, and be
+offered to the front desk by itself when a booking is cancelled or deleted.
+"""
+from __future__ import annotations
+
+import asyncio
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+import models
+from domains.notification.services import notification_center_service
+from domains.scheduling import change_feed, waitlist
+from domains.scheduling.routes.appointments import OutcomePayload, delete_appointment, set_outcome
+
+SOON = date.today() + timedelta(days=10)
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(change_feed, "publish", lambda *a, **kw: None)
+
+
+@pytest.fixture()
+def offers(monkeypatch):
+    sent = []
+    monkeypatch.setattr(notification_center_service, "notify", lambda db, **kw: sent.append(kw) or 1)
+    return sent
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(
+        engine,
+        tables=[
+            models.Clinic.__table__,
+            models.User.__table__,
+            models.Patient.__table__,
+            models.Appointment.__table__,
+            models.AppointmentWaitlist.__table__,
+        ],
+    )
+    session = sessionmaker(bind=engine)()
+    session.add_all([models.Clinic(id=1, name="Clinic A"), models.Clinic(id=2, name="Clinic B")])
+    session.add(models.User(id=1, clinic_id=1, email="o@x.com", first_name="O",
+                            last_name="Owner", name="O Owner", role="clinic_owner"))
+    base = datetime(2026, 1, 1)
+    session.add_all([
+        # (id, clinic, doctor, duration, from, to, status)
+        models.AppointmentWaitlist(id=i, clinic_id=c, patient_name=f"W{i}", doctor_id=d, duration=dur,
+                                   preferred_from=f, preferred_to=t, status=st,
+                                   created_at=base + timedelta(hours=i))
+        for i, c, d, dur, f, t, st in [
+            (1, 1, None, 30, None, None, "waiting"),
+            (2, 1, 1, 30, None, None, "waiting"),                              # asked for doctor 1
+            (3, 1, 2, 30, None, None, "waiting"),                              # another doctor
+            (4, 1, None, 90, None, None, "waiting"),                           # needs longer
+            (5, 1, None, 30, SOON + timedelta(days=1), None, "waiting"),       # not yet
+            (6, 1, None, 30, None, SOON - timedelta(days=1), "waiting"),       # too late
+            (7, 1, None, 30, None, SOON + timedelta(days=3), "waiting"),       # window closing
+            (8, 1, None, 30, None, None, "booked"),
+            (9, 2, None, 30, None, None, "waiting"),                           # other clinic
+        ]
+    ])
+    session.add_all([
+        models.Appointment(id=i, clinic_id=1, doctor_id=1, patient_name=f"P{i}", status=st,
+                           appointment_date=datetime.combine(SOON, datetime.min.time()) + timedelta(hours=10),
+                           start_time="10:00", end_time="10:30", duration=30)
+        for i, st in ((1, "scheduled"), (2, "scheduled"), (3, "completed"))
+    ])
+    session.commit()
+    return session
+
+
+def test_match_rules_and_ranking(db):
+    assert [w.id for w in waitlist.match(db, 1, SOON, 30, doctor_id=1)] == [2, 7, 1]
+    assert [w.id for w in waitlist.match(db, 1, SOON, 30)] == [7, 1, 2, 3]
+    assert [w.id for w in waitlist.match(db, 1, SOON, 90, limit=2)] == [7, 1]
+
+
+def test_match_uses_the_index(db):
+    plan = db.execute(text(
+        "EXPLAIN QUERY PLAN SELECT id FROM appointment_waitlist "
+        "WHERE clinic_id = 1 AND status = 'waiting' AND doctor_id = 1"
+    )).fetchall()
+    assert "ix_waitlist_clinic_status_doctor_window" in " ".join(str(r) for r in plan)
+
+
+def test_cancelling_offers_the_slot(db, offers):
+    set_outcome(1, OutcomePayload(status="cancelled"), db=db, current_user=db.get(models.User, 1))
+    freed = [o for o in offers if o["event_type"] == "waitlist_slot_freed"]
+    assert len(freed) == 1
+    assert freed[0]["entity_id"] == 1
+    assert freed[0]["body"].endswith("W2, W7, W1 could take it")
+
+
+def test_deleting_an_open_booking_offers_the_slot(db, offers):
+    owner = db.get(models.User, 1)
+    asyncio.run(delete_appointment(2, db=db, current_user=owner))
+    asyncio.run(delete_appointment(3, db=db, current_user=owner))  # already done: nothing freed
+    assert [o["entity_id"] for o in offers] == [2]
+    assert db.get(models.Appointment, 2) is None
+
+
+def test_past_slots_are_not_offered(db, offers):
+    appt = db.get(models.Appointment, 1)
+    appt.appointment_date = datetime(2020, 1, 1, 10)
+    assert waitlist.offer_freed_slot(db, appt) == 0
+    assert offers == []
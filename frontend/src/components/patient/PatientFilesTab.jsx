@@ -138,6 +138,9 @@ const ThumbnailImg = ({ src, alt }) => {
 // thumbnail (DICOM/PDF documents), or a fallback icon.
 const FilePreview = ({ file }) => {
     const src = fileUrl(file);
+    // Rendered at upload time (WebP, a few KB) — preferred over the original
+    // even for plain images, which can be full-resolution camera files.
+    if (file.thumbnail_url) return <ThumbnailImg src={file.thumbnail_url} alt={file.file_name} />;
     if (isImage(file) && src) return <ThumbnailImg src={src} alt={file.file_name} />;
     // DICOM/PDF previews are rendered server-side and cached — cheap and avoids
     // downloading large (e.g. ~15 MB) files just to show a thumbnail.
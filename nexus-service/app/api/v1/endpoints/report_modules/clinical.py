@@ -90,6 +90,8 @@ def process_clinical_metrics(data: dict):
         if report_record:
             report_record.status = "failed"
             db.commit()
+    finally:
+        job.close()
 
 @router.post("/treatment")
 async def generate_treatment(request: ReportRequest):
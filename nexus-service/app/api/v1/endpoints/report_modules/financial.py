@@ -99,6 +99,8 @@ def process_revenue_report(data: dict):
         if report_record:
             report_record.status = "failed"
             db.commit()
+    finally:
+        job.close()
 
 @router.post("/revenue")
 async def generate_revenue(request: ReportRequest):
@@ -102,6 +102,8 @@ def process_operational_flow(data: dict):
         if report_record:
             report_record.status = "failed"
             db.commit()
+    finally:
+        job.close()
 
 @router.post("/flow")
 async def generate_flow(request: ReportRequest):
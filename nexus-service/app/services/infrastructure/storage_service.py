@@ -1,47 +1,118 @@
+import asyncio
 import os
+import threading
+import time
 import boto3
 from botocore.config import Config
+from contextlib import contextmanager
 from typing import Optional
 
+# Same client policy as the backend's r2_storage (the two ship as separate
+# images, so it is mirrored rather than imported): one pooled client per
+# process, built once. It used to be rebuilt on every upload, paying a fresh
+# credentials resolution, connection pool and TLS handshake each time.
+R2_MAX_POOL_CONNECTIONS = int(os.getenv("R2_MAX_POOL_CONNECTIONS", "50"))
+R2_MAX_ATTEMPTS = int(os.getenv("R2_MAX_ATTEMPTS", "5"))
+R2_CONNECT_TIMEOUT_S = float(os.getenv("R2_CONNECT_TIMEOUT_S", "5"))
+R2_READ_TIMEOUT_S = float(os.getenv("R2_READ_TIMEOUT_S", "60"))
+
+
 class StorageService:
+    _client = None
+    _client_lock = threading.Lock()
+    # op -> {"count", "errors", "bytes", "seconds", "max_seconds"}
+    _metrics = {}
+    _metrics_lock = threading.Lock()
+
     @staticmethod
     def _get_client():
+        if StorageService._client is not None:
+            return StorageService._client
+
         access_key_id = os.getenv("R2_ACCESS_KEY_ID")
         secret_access_key = os.getenv("R2_SECRET_ACCESS_KEY")
         endpoint_url = os.getenv("R2_ENDPOINT_URL")
-        
+
         if not all([access_key_id, secret_access_key, endpoint_url]):
             return None
-            
-        return boto3.client(
-            's3',
-            endpoint_url=endpoint_url,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key,
-            region_name='auto',
-            config=Config(signature_version='s3v4')
-        )
+
+        with StorageService._client_lock:
+            if StorageService._client is None:
+                StorageService._client = boto3.client(
+                    's3',
+                    endpoint_url=endpoint_url,
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_access_key,
+                    region_name='auto',
+                    config=Config(
+                        signature_version='s3v4',
+                        max_pool_connections=R2_MAX_POOL_CONNECTIONS,
+                        retries={'max_attempts': R2_MAX_ATTEMPTS, 'mode': 'standard'},
+                        connect_timeout=R2_CONNECT_TIMEOUT_S,
+                        read_timeout=R2_READ_TIMEOUT_S,
+                    )
+                )
+        return StorageService._client
+
+    @staticmethod
+    @contextmanager
+    def _timed(op: str, nbytes: int = 0):
+        """Record one storage call's bytes, latency and outcome."""
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            seconds = time.perf_counter() - started
+            with StorageService._metrics_lock:
+                stat = StorageService._metrics.setdefault(
+                    op, {"count": 0, "errors": 0, "bytes": 0, "seconds": 0.0, "max_seconds": 0.0}
+                )
+                stat["count"] += 1
+                stat["errors"] += 0 if ok else 1
+                stat["bytes"] += nbytes
+                stat["seconds"] += seconds
+                stat["max_seconds"] = max(stat["max_seconds"], seconds)
+
+    @staticmethod
+    def metrics() -> dict:
+        """Per-operation counts, failures, bytes and latency for this process."""
+        with StorageService._metrics_lock:
+            return {
+                op: {
+                    "count": s["count"],
+                    "errors": s["errors"],
+                    "bytes": s["bytes"],
+                    "avg_ms": round(s["seconds"] * 1000 / s["count"], 2),
+                    "max_ms": round(s["max_seconds"] * 1000, 2),
+                }
+                for op, s in StorageService._metrics.items()
+            }
+
+    @staticmethod
+    def _upload_pdf(file_path: str, storage_path: str) -> None:
+        client = StorageService._get_client()
+        with open(file_path, 'rb') as data, StorageService._timed("upload", os.path.getsize(file_path)):
+            client.put_object(
+                Bucket=os.getenv("R2_BUCKET_NAME"),
+                Key=storage_path,
+                Body=data,
+                ContentType='application/pdf'
+            )
 
     @staticmethod
     def upload_consent_pdf(file_path: str, filename: str, clinic_id: int, patient_id: int) -> Optional[str]:
         """
         Uploads a consent PDF to R2 and returns the key.
         """
-        client = StorageService._get_client()
-        if not client:
+        if not StorageService._get_client():
             return None
-            
-        bucket_name = os.getenv("R2_BUCKET_NAME")
+
         storage_path = f"clinics/{clinic_id}/patients/{patient_id}/consents/{filename}"
-        
+
         try:
-            with open(file_path, 'rb') as data:
-                client.put_object(
-                    Bucket=bucket_name,
-                    Key=storage_path,
-                    Body=data,
-                    ContentType='application/pdf'
-                )
+            StorageService._upload_pdf(file_path, storage_path)
             return storage_path
         except Exception as e:
             print(f"Nexus Storage Error: {str(e)}")
@@ -52,22 +123,24 @@ class StorageService:
         """
         Uploads a dashboard report PDF to R2 and returns the key.
         """
-        client = StorageService._get_client()
-        if not client:
+        if not StorageService._get_client():
             return None
-            
-        bucket_name = os.getenv("R2_BUCKET_NAME")
+
         storage_path = f"clinics/{clinic_id}/reports/dashboard/{filename}"
-        
+
         try:
-            with open(file_path, 'rb') as data:
-                client.put_object(
-                    Bucket=bucket_name,
-                    Key=storage_path,
-                    Body=data,
-                    ContentType='application/pdf'
-                )
+            StorageService._upload_pdf(file_path, storage_path)
             return storage_path
         except Exception as e:
             print(f"Nexus Report Storage Error: {str(e)}")
             return None
+
+    # Async variants for use from the FastAPI side: boto3 blocks, so these run
+    # the sync upload on a worker thread with the same client and metrics.
+    @staticmethod
+    async def upload_consent_pdf_async(file_path: str, filename: str, clinic_id: int, patient_id: int) -> Optional[str]:
+        return await asyncio.to_thread(StorageService.upload_consent_pdf, file_path, filename, clinic_id, patient_id)
+
+    @staticmethod
+    async def upload_report_pdf_async(file_path: str, filename: str, clinic_id: int) -> Optional[str]:
+        return await asyncio.to_thread(StorageService.upload_report_pdf, file_path, filename, clinic_id)
@@ -0,0 +1,139 @@
+"""
+AI analysis for the report jobs: cached, and with a provider that needs no network.
+
+Every report job sent its metrics to OpenAI, even when they were byte for
+byte what an earlier run sent (someone re-downloading last month's report),
+paying seconds and money for the same answer, and making the report path
+impossible to run offline. Now:
+
+- the prompt inputs (provider, model, category, clinic, focus, metrics) are
+  serialised canonically and hashed; that hash is the cache key;
+- answers are kept in Redis for NEXUS_AI_CACHE_TTL_S (30 days by default,
+  0 turns the cache off). Redis being down only means no cache;
+- the provider is pluggable (NEXUS_AI_PROVIDER). "openai" is the real one;
+  "stub" writes a deterministic analysis from the metrics alone, so the
+  whole report path can be run and timed with no network at all.
+"""
+import hashlib
+import json
+import os
+from typing import Callable, Dict, Optional
+
+from redis import Redis
+
+AI_PROVIDER = os.getenv("NEXUS_AI_PROVIDER", "openai")
+AI_MODEL = os.getenv("NEXUS_AI_MODEL", "gpt-4o")
+AI_CACHE_TTL_S = int(os.getenv("NEXUS_AI_CACHE_TTL_S", str(30 * 24 * 3600)))
+CACHE_PREFIX = "nexus:ai-analysis:"
+# Bump when the prompt wording changes, so old answers stop matching.
+PROMPT_VERSION = 1
+
+_redis: Optional[Redis] = None
+
+
+def _cache() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+                                socket_connect_timeout=1, socket_timeout=1)
+    return _redis
+
+
+def canonical_inputs(provider: str, category: str, clinic_name: str, focus: str, raw_data: dict) -> str:
+    """The prompt inputs as one stable string: same inputs, same bytes."""
+    return json.dumps({
+        "v": PROMPT_VERSION, "provider": provider, "model": AI_MODEL,
+        "category": category, "clinic": clinic_name, "focus": focus, "data": raw_data,
+    }, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def analysis_key(canonical: str) -> str:
+    return CACHE_PREFIX + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# ── Providers ────────────────────────────────────────────────────────────────
+
+def build_prompt(category: str, clinic_name: str, focus: str, raw_data: dict) -> str:
+    return f"""
+        Role: Senior Dental Clinic Strategist
+        Task: Analyze {category} data for {clinic_name}.
+        Focus: {focus}
+
+        Data to Analyze:
+        {json.dumps(raw_data)}
+
+        Requirements:
+        1. Professional, data-driven tone.
+        2. Format output as a JSON object with:
+           "summary": A high-level overview (2-3 sentences).
+           "insights": 4 specific, actionable data insights.
+           "recommendations": 3 clear next steps to improve performance (e.g. increase staffing, audit billing).
+           "sentiment": "positive", "neutral", or "needs_attention".
+        """
+
+
+def openai_analysis(category: str, clinic_name: str, focus: str, raw_data: dict) -> dict:
+    """Invoke OpenAI to analyze clinical/financial data"""
+    import openai
+    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    response = client.chat.completions.create(
+        model=AI_MODEL,
+        messages=[{"role": "system", "content": "You are a professional dental clinic consultant."},
+                  {"role": "user", "content": build_prompt(category, clinic_name, focus, raw_data)}],
+        response_format={ "type": "json_object" }
+    )
+    return json.loads(response.choices[0].message.content)
+
+
+def stub_analysis(category: str, clinic_name: str, focus: str, raw_data: dict) -> dict:
+    """A deterministic analysis written from the metrics alone, no network."""
+    figures = [(k, v) for k, v in sorted(raw_data.items()) if isinstance(v, (int, float, str))]
+    insights = [f"{k.replace('_', ' ').capitalize()}: {v}." for k, v in figures[:4]]
+    while len(insights) < 4:
+        insights.append(f"No further {category or 'report'} figures for this period.")
+    return {
+        "summary": f"{category or 'Report'} for {clinic_name or 'the clinic'}, focused on {focus}. "
+                   f"{len(figures)} figures were reviewed for this period.",
+        "insights": insights,
+        "recommendations": [
+            f"Review {focus} with the team.",
+            "Compare these figures against the previous period.",
+            "Follow up on any figure that moved sharply.",
+        ],
+        "sentiment": "neutral",
+    }
+
+
+PROVIDERS: Dict[str, Callable[[str, str, str, dict], dict]] = {
+    "openai": openai_analysis,
+    "stub": stub_analysis,
+}
+
+
+# ── Entry point ──────────────────────────────────────────────────────────────
+
+def get_analysis(category: str, clinic_name: str, focus: str, raw_data: dict,
+                 provider: Optional[str] = None) -> dict:
+    """The analysis for these inputs: from the cache when an identical run
+    already asked, otherwise from the provider (and then cached)."""
+    provider = provider or AI_PROVIDER
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown AI provider {provider!r}; expected one of {sorted(PROVIDERS)}")
+    key = analysis_key(canonical_inputs(provider, category, clinic_name, focus, raw_data))
+
+    if AI_CACHE_TTL_S > 0:
+        try:
+            hit = _cache().get(key)
+            if hit:
+                return json.loads(hit)
+        except Exception as e:
+            print(f"⚠️ AI analysis cache unavailable: {e}")
+
+    analysis = PROVIDERS[provider](category, clinic_name, focus, raw_data)
+
+    if AI_CACHE_TTL_S > 0:
+        try:
+            _cache().setex(key, AI_CACHE_TTL_S, json.dumps(analysis))
+        except Exception as e:
+            print(f"⚠️ AI analysis cache unavailable: {e}")
+    return analysis
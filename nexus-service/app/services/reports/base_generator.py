@@ -1,10 +1,7 @@
 import os
-import json
 import io
-import openai
-import matplotlib.pyplot as plt
-import matplotlib
-import numpy as np
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, PageBreak
@@ -12,14 +9,22 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import inch
 from app.services.infrastructure.storage_service import StorageService
+from app.services.reports import progress
+from app.services.reports.analysis import get_analysis
+from app.services.reports.charts import ChartImage, ChartSpec, maybe_sweep_cache, resolve_all, shutdown_pool
 from app.database import get_db
 
-# Use non-interactive backend for Matplotlib
-matplotlib.use('Agg')
-
 class BaseReportJob:
     def __init__(self, report_data: dict):
         self.report_data = report_data
+        self._started = time.perf_counter()
+        # stage name -> seconds, in the order the stages first ran
+        self.timings = {}
+        self._charts = []
+        # The job fetches its data between constructing this and the first
+        # stage() below, so "data" runs from here until that stage starts.
+        self._data_open = True
+        progress.record(self.report_data.get('report_db_id'), "data", "running")
         self.db = next(get_db())
         self.styles = getSampleStyleSheet()
         self.colors = {
@@ -102,115 +107,97 @@ class BaseReportJob:
         canvas.drawRightString(555, 805, self.report_data.get('title', 'Clinic Report'))
         canvas.restoreState()
 
+    @contextmanager
+    def stage(self, name):
+        """Time the block into self.timings[name] and report it as progress."""
+        report_id = self.report_data.get('report_db_id')
+        if self._data_open:
+            self._data_open = False
+            self.timings["data"] = time.perf_counter() - self._started
+            progress.record(report_id, "data", "done", self.timings["data"])
+        progress.record(report_id, name, "running")
+        started = time.perf_counter()
+        state = "failed"
+        try:
+            yield
+            state = "done"
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+            progress.record(report_id, name, state, self.timings[name])
+
     def get_ai_analysis(self, raw_data: dict, prompt_focus: str):
-        """Invoke OpenAI to analyze clinical/financial data"""
-        openai_key = os.getenv("OPENAI_API_KEY")
-        client = openai.OpenAI(api_key=openai_key)
-        
-        prompt = f"""
-        Role: Senior Dental Clinic Strategist
-        Task: Analyze {self.report_data.get('report_category')} data for {self.report_data.get('clinic_name')}.
-        Focus: {prompt_focus}
-        
-        Data to Analyze:
-        {json.dumps(raw_data)}
-        
-        Requirements:
-        1. Professional, data-driven tone.
-        2. Format output as a JSON object with:
-           "summary": A high-level overview (2-3 sentences).
-           "insights": 4 specific, actionable data insights.
-           "recommendations": 3 clear next steps to improve performance (e.g. increase staffing, audit billing).
-           "sentiment": "positive", "neutral", or "needs_attention".
+        """AI analysis of clinical/financial data, cached by its exact inputs.
+
+        The provider is NEXUS_AI_PROVIDER ("openai", or "stub" to run offline);
+        see app/services/reports/analysis.py.
         """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": "You are a professional dental clinic consultant."},
-                      {"role": "user", "content": prompt}],
-            response_format={ "type": "json_object" }
-        )
-        return json.loads(response.choices[0].message.content)
+        with self.stage("analysis"):
+            return get_analysis(self.report_data.get('report_category'), self.report_data.get('clinic_name'),
+                                prompt_focus, raw_data)
+
+    # Charts come back as ChartImage flowables at once; the PNGs are drawn in
+    # the chart pool (or read from its cache) while the story is assembled,
+    # and create_pdf waits for them in its "charts" stage.
+
+    def _chart(self, kind, data, labels, title, width, height):
+        spec = ChartSpec(kind=kind, data=tuple(float(x) for x in data),
+                         labels=tuple(str(l) for l in labels), title=title, colors=dict(self.colors))
+        chart = ChartImage(spec, width, height)
+        self._charts.append(chart)
+        return chart
 
     def generate_modern_bar_chart(self, data, labels, title="Comparison"):
         """High-fidelity bar chart with data labels"""
-        plt.figure(figsize=(7, 4))
-        bars = plt.bar(labels, data, color=self.colors['navy'], alpha=0.9, width=0.6)
-        
-        plt.title(title, fontsize=14, pad=15, color=self.colors['navy'], fontweight='bold')
-        plt.gca().spines['top'].set_visible(False)
-        plt.gca().spines['right'].set_visible(False)
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        
-        # Add data labels
-        for bar in bars:
-            yval = bar.get_height()
-            plt.text(bar.get_x() + bar.get_width()/2, yval + (yval*0.02), f'{int(yval):,}', 
-                     ha='center', va='bottom', fontsize=10, fontweight='bold', color=self.colors['navy'])
-
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png', dpi=200, bbox_inches='tight', transparent=True)
-        plt.close()
-        img_buffer.seek(0)
-        return Image(img_buffer, width=4*inch, height=2.3*inch)
+        return self._chart("bar", data, labels, title, 4*inch, 2.3*inch)
 
     def generate_modern_donut_chart(self, data, labels, title="Distribution"):
         """High-fidelity donut chart with labels"""
-        plt.figure(figsize=(6, 6))
-        colors_list = [self.colors['navy'], self.colors['green'], self.colors['gray'], '#c7d2fe']
-        
-        wedges, texts, autotexts = plt.pie(
-            data, labels=labels, autopct='%1.1f%%', startangle=140, 
-            colors=colors_list[:len(data)], pctdistance=0.85,
-            textprops={'fontsize': 10, 'fontweight': 'bold'}
-        )
-        
-        # Draw center circle for donut
-        centre_circle = plt.Circle((0,0), 0.70, fc='white')
-        plt.gca().add_artist(centre_circle)
-        
-        plt.title(title, fontsize=14, pad=15, color=self.colors['navy'], fontweight='bold')
-        plt.axis('equal')  
-
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png', dpi=200, bbox_inches='tight', transparent=True)
-        plt.close()
-        img_buffer.seek(0)
-        return Image(img_buffer, width=3.5*inch, height=3.5*inch)
+        return self._chart("donut", data, labels, title, 3.5*inch, 3.5*inch)
 
     def generate_modern_line_chart(self, data, labels, title="Trends"):
         """High-fidelity line chart for trends"""
-        plt.figure(figsize=(7, 4))
-        plt.plot(labels, data, marker='o', linewidth=3, color=self.colors['green'], markerfacecolor=self.colors['navy'])
-        
-        plt.fill_between(labels, data, color=self.colors['green'], alpha=0.1)
-        plt.title(title, fontsize=14, pad=15, color=self.colors['navy'], fontweight='bold')
-        plt.gca().spines['top'].set_visible(False)
-        plt.gca().spines['right'].set_visible(False)
-        plt.grid(linestyle='--', alpha=0.5)
-        
-        # Labels
-        for i, txt in enumerate(data):
-            plt.annotate(f'{int(txt)}', (labels[i], data[i]), textcoords="offset points", xytext=(0,10), ha='center', fontsize=9, fontweight='bold')
-
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png', dpi=200, bbox_inches='tight', transparent=True)
-        plt.close()
-        img_buffer.seek(0)
-        return Image(img_buffer, width=4*inch, height=2.3*inch)
+        return self._chart("line", data, labels, title, 4*inch, 2.3*inch)
 
     def create_pdf(self, elements, filename):
         """Build the final PDF and upload to R2"""
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=40, leftMargin=40, topMargin=100, bottomMargin=50)
-        doc.build(elements, onFirstPage=self.draw_molarplus_header, onLaterPages=self.draw_molarplus_header)
-        
-        temp_path = f"/tmp/{filename}"
-        with open(temp_path, "wb") as f:
-            f.write(buffer.getvalue())
+        try:
+            with self.stage("charts"):
+                resolve_all(self._charts)
+        finally:
+            # Every PNG is in hand (or the job is failing): the pool is done.
+            self.close()
+        with self.stage("pdf"):
+            buffer = io.BytesIO()
+            doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=40, leftMargin=40, topMargin=100, bottomMargin=50)
+            doc.build(elements, onFirstPage=self.draw_molarplus_header, onLaterPages=self.draw_molarplus_header)
+        
+        with self.stage("upload"):
+            temp_path = f"/tmp/{filename}"
+            with open(temp_path, "wb") as f:
+                f.write(buffer.getvalue())
+                
+            storage_key = StorageService.upload_report_pdf(temp_path, filename, self.report_data['clinic_id'])
+            file_url = f"{os.getenv('R2_PUBLIC_URL', 'https://pub-8d19e4189ab25d9511db91eb129362b5.r2.dev')}/{storage_key}"
             
-        storage_key = StorageService.upload_report_pdf(temp_path, filename, self.report_data['clinic_id'])
-        file_url = f"{os.getenv('R2_PUBLIC_URL', 'https://pub-8d19e4189ab25d9511db91eb129362b5.r2.dev')}/{storage_key}"
-        
-        os.remove(temp_path)
+            os.remove(temp_path)
+        self.log_timings(filename)
         return file_url
+
+    def close(self):
+        """Release the chart pool and sweep the chart cache. Safe to call
+        twice; the report modules call it when the job ends either way."""
+        shutdown_pool()
+        maybe_sweep_cache()
+
+    def log_timings(self, label):
+        """One line per report: seconds per stage, how the charts were got,
+        and this worker's R2 upload totals so far (StorageService.metrics)."""
+        hits = sum(1 for c in self._charts if c.cache_hit)
+        drawn = sum(c.render_seconds for c in self._charts)
+        stages = ", ".join(f"{name} {secs:.2f}s" for name, secs in self.timings.items())
+        upload = StorageService.metrics().get("upload")
+        storage = (f"{upload['count']} uploads, {upload['errors']} failed, avg {upload['avg_ms']}ms, "
+                   f"max {upload['max_ms']}ms" if upload else "no uploads")
+        print(f"⏱️ {label}: {stages} | charts {len(self._charts)} ({hits} cached, "
+              f"{drawn:.2f}s of drawing) | total {time.perf_counter() - self._started:.2f}s"
+              f" | R2 {storage}")
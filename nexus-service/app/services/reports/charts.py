@@ -0,0 +1,302 @@
+"""
+Chart rendering for the report jobs: in parallel, and cached.
+
+Every chart used to be drawn with pyplot, one after another, inside the rq
+job, and most of a multi-clinic report's wall time went there, redrawing
+figures that were often identical to last month's. Now:
+
+- a chart is described by a plain ChartSpec (kind, series, labels, title,
+  style), and asking for one returns a ChartImage flowable straight away;
+- the PNG is drawn in a process pool on the Agg backend, so charts render
+  while the job keeps assembling the document and each other;
+- finished PNGs are cached on disk under a hash of the spec, so a chart with
+  the same inputs and style is never drawn twice. The cache is a directory
+  (NEXUS_CHART_CACHE_DIR) so every worker on the host shares it. A hit
+  refreshes the file's mtime; files unused for NEXUS_CHART_CACHE_TTL_S are
+  swept, and the oldest go first once the directory passes
+  NEXUS_CHART_CACHE_MAX_MB. A sweep runs at most hourly per host, at the
+  end of a job.
+
+The pool belongs to one job: rq's work horse leaves through os._exit, which
+skips atexit, so the job must call shutdown_pool() (BaseReportJob.close
+does) or the pool's processes outlive it.
+
+Set NEXUS_CHART_WORKERS=0 to draw inline, in the calling process.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.patches import Circle
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Flowable
+
+CHART_WORKERS = int(os.getenv("NEXUS_CHART_WORKERS", str(min(4, os.cpu_count() or 1))))
+CHART_CACHE_DIR = os.getenv("NEXUS_CHART_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nexus-chart-cache"))
+CHART_CACHE_TTL_S = int(os.getenv("NEXUS_CHART_CACHE_TTL_S", str(30 * 24 * 3600)))
+CHART_CACHE_MAX_MB = int(os.getenv("NEXUS_CHART_CACHE_MAX_MB", "512"))
+SWEEP_EVERY_S = 3600
+# Bump when a drawing routine changes, so old PNGs stop matching.
+RENDER_VERSION = 1
+DPI = 200
+
+
+@dataclass(frozen=True)
+class ChartSpec:
+    kind: str  # "bar" | "donut" | "line"
+    data: Tuple[float, ...]
+    labels: Tuple[str, ...]
+    title: str
+    colors: Dict[str, str] = field(default_factory=dict)
+
+    def cache_key(self) -> str:
+        body = json.dumps({"v": RENDER_VERSION, "dpi": DPI, **asdict(self)}, sort_keys=True, default=str)
+        return hashlib.sha256(body.encode()).hexdigest()
+
+
+# ── Drawing (runs in the pool) ───────────────────────────────────────────────
+
+def _finish(fig: Figure) -> bytes:
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=DPI, bbox_inches='tight', transparent=True)
+    return buf.getvalue()
+
+
+def _bar(spec: ChartSpec, c: Dict[str, str]) -> bytes:
+    fig = Figure(figsize=(7, 4))
+    ax = fig.add_subplot()
+    bars = ax.bar(spec.labels, spec.data, color=c['navy'], alpha=0.9, width=0.6)
+    ax.set_title(spec.title, fontsize=14, pad=15, color=c['navy'], fontweight='bold')
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+    for bar in bars:
+        yval = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2, yval + (yval*0.02), f'{int(yval):,}',
+                ha='center', va='bottom', fontsize=10, fontweight='bold', color=c['navy'])
+    return _finish(fig)
+
+
+def _donut(spec: ChartSpec, c: Dict[str, str]) -> bytes:
+    fig = Figure(figsize=(6, 6))
+    ax = fig.add_subplot()
+    colors_list = [c['navy'], c['green'], c['gray'], '#c7d2fe']
+    ax.pie(
+        spec.data, labels=spec.labels, autopct='%1.1f%%', startangle=140,
+        colors=colors_list[:len(spec.data)], pctdistance=0.85,
+        textprops={'fontsize': 10, 'fontweight': 'bold'}
+    )
+    ax.add_artist(Circle((0, 0), 0.70, fc='white'))
+    ax.set_title(spec.title, fontsize=14, pad=15, color=c['navy'], fontweight='bold')
+    ax.axis('equal')
+    return _finish(fig)
+
+
+def _line(spec: ChartSpec, c: Dict[str, str]) -> bytes:
+    fig = Figure(figsize=(7, 4))
+    ax = fig.add_subplot()
+    ax.plot(spec.labels, spec.data, marker='o', linewidth=3, color=c['green'], markerfacecolor=c['navy'])
+    ax.fill_between(spec.labels, spec.data, color=c['green'], alpha=0.1)
+    ax.set_title(spec.title, fontsize=14, pad=15, color=c['navy'], fontweight='bold')
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.grid(linestyle='--', alpha=0.5)
+    for i, txt in enumerate(spec.data):
+        ax.annotate(f'{int(txt)}', (spec.labels[i], spec.data[i]), textcoords="offset points",
+                    xytext=(0, 10), ha='center', fontsize=9, fontweight='bold')
+    return _finish(fig)
+
+
+_DRAW = {"bar": _bar, "donut": _donut, "line": _line}
+
+
+def render_png(spec: ChartSpec) -> Tuple[bytes, float]:
+    """Draw one chart; returns the PNG and the seconds it took."""
+    started = time.perf_counter()
+    png = _DRAW[spec.kind](spec, spec.colors)
+    return png, time.perf_counter() - started
+
+
+# ── Cache ────────────────────────────────────────────────────────────────────
+
+def _cache_path(key: str) -> str:
+    return os.path.join(CHART_CACHE_DIR, key[:2], f"{key}.png")
+
+
+def cached_png(key: str) -> Optional[bytes]:
+    path = _cache_path(key)
+    try:
+        with open(path, "rb") as f:
+            png = f.read()
+    except OSError:
+        return None
+    try:
+        os.utime(path)  # recently used: the sweep keeps it
+    except OSError:
+        pass
+    return png
+
+
+def store_png(key: str, png: bytes) -> None:
+    path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so another worker never reads half a file.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"⚠️ Chart cache write failed: {e}")
+
+
+def sweep_cache(now: Optional[float] = None) -> int:
+    """Remove cached PNGs unused for CHART_CACHE_TTL_S, then the least
+    recently used until the cache fits CHART_CACHE_MAX_MB. Returns how many
+    files went."""
+    now = time.time() if now is None else now
+    entries = []
+    for root, _, files in os.walk(CHART_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            # Leftover .part files are from writers that died mid-write.
+            if name.endswith(".part") and now - st.st_mtime > SWEEP_EVERY_S:
+                entries.append((0.0, 0, path))
+            elif name.endswith(".png"):
+                entries.append((st.st_mtime, st.st_size, path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    budget = CHART_CACHE_MAX_MB * 1024 * 1024
+    removed = 0
+    for mtime, size, path in entries:
+        if now - mtime <= CHART_CACHE_TTL_S and total <= budget:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
+
+
+def maybe_sweep_cache() -> None:
+    """sweep_cache(), unless any worker on the host swept in the last hour."""
+    marker = os.path.join(CHART_CACHE_DIR, ".last-sweep")
+    try:
+        if time.time() - os.path.getmtime(marker) < SWEEP_EVERY_S:
+            return
+    except OSError:
+        pass
+    try:
+        os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+        with open(marker, "w"):
+            pass
+        sweep_cache()
+    except OSError as e:
+        print(f"⚠️ Chart cache sweep failed: {e}")
+
+
+# ── Pool ─────────────────────────────────────────────────────────────────────
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    """This process's pool. rq forks a work horse per job, so a pool made in
+    the parent would belong to a process that isn't rendering; keyed by pid."""
+    global _pool, _pool_pid
+    if CHART_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            try:
+                _pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+                _pool_pid = os.getpid()
+            except (OSError, NotImplementedError) as e:
+                print(f"⚠️ Chart pool unavailable, rendering inline: {e}")
+                return None
+        return _pool
+
+
+def shutdown_pool() -> None:
+    """Stop this process's pool and wait for its workers to exit. Renders
+    nobody has waited for yet are cancelled (the job is over)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+# ── Flowable ─────────────────────────────────────────────────────────────────
+
+class ChartImage(Flowable):
+    """A chart in the story, drawn (or fetched from the cache) in the background.
+
+    Stands in for the reportlab Image the generate_* methods used to return:
+    same size, centred, and the PNG is only needed when the page is drawn.
+    """
+
+    def __init__(self, spec: ChartSpec, width: float, height: float):
+        super().__init__()
+        self.spec = spec
+        self.key = spec.cache_key()
+        self.drawWidth, self.drawHeight = width, height
+        self.hAlign = 'CENTER'
+        self.cache_hit = False
+        self.render_seconds = 0.0
+        self._png: Optional[bytes] = cached_png(self.key)
+        self._future: Optional[Future] = None
+        if self._png is not None:
+            self.cache_hit = True
+            return
+        pool = _get_pool()
+        if pool is not None:
+            try:
+                self._future = pool.submit(render_png, spec)
+            except RuntimeError:  # pool shut down or broken
+                self._future = None
+
+    def png(self) -> bytes:
+        """The PNG, waiting for the pool (or drawing inline) if need be."""
+        if self._png is None:
+            if self._future is not None:
+                try:
+                    self._png, self.render_seconds = self._future.result()
+                except Exception as e:
+                    print(f"⚠️ Chart render in pool failed, drawing inline: {e}")
+            if self._png is None:
+                self._png, self.render_seconds = render_png(self.spec)
+            self._future = None
+            store_png(self.key, self._png)
+        return self._png
+
+    def wrap(self, availWidth, availHeight):
+        return self.drawWidth, self.drawHeight
+
+    def draw(self):
+        self.canv.drawImage(ImageReader(io.BytesIO(self.png())), 0, 0,
+                            self.drawWidth, self.drawHeight, mask='auto')
+
+
+def resolve_all(charts: List[ChartImage]) -> None:
+    for chart in charts:
+        chart.png()
@@ -0,0 +1,57 @@
+"""
+Per-stage progress of a dashboard report job, for the backend's status endpoint.
+
+Each stage (data, analysis, charts, pdf, upload) is written to a Redis hash
+as it starts and ends, keyed by the backend's DashboardReport id:
+
+    dashboard_report:{report_db_id}:progress
+        data     -> {"state": "done", "seconds": 0.41}
+        analysis -> {"state": "running", "seconds": null}
+
+The backend reads it in GET /dashboard/reports/{id}
+(backend/domains/analytics/routes/dashboard_reports.py mirrors the key and
+the stage names). Progress is best effort: if Redis is unreachable the job
+carries on and the status endpoint just shows fewer stages done.
+"""
+import json
+import os
+import time
+from typing import Optional
+
+from redis import Redis
+
+STAGES = ("data", "analysis", "charts", "pdf", "upload")
+PROGRESS_TTL_S = 24 * 3600
+# How long to stop trying after Redis failed once, so a job doesn't wait on
+# a timeout at every stage.
+REDIS_BACKOFF_S = 30
+
+_redis: Optional[Redis] = None
+_down_until = 0.0
+
+
+def _client() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+                                socket_connect_timeout=1, socket_timeout=1)
+    return _redis
+
+
+def progress_key(report_id: int) -> str:
+    return f"dashboard_report:{report_id}:progress"
+
+
+def record(report_id: Optional[int], stage: str, state: str, seconds: Optional[float] = None) -> None:
+    global _down_until
+    if report_id is None or time.monotonic() < _down_until:
+        return
+    try:
+        pipe = _client().pipeline(transaction=False)
+        pipe.hset(progress_key(report_id), stage, json.dumps(
+            {"state": state, "seconds": round(seconds, 3) if seconds is not None else None}))
+        pipe.expire(progress_key(report_id), PROGRESS_TTL_S)
+        pipe.execute()
+    except Exception as e:
+        _down_until = time.monotonic() + REDIS_BACKOFF_S
+        print(f"⚠️ Report progress not recorded ({stage} {state}): {e}")
@@ -0,0 +1,14 @@
+"""
+Test configuration: offline by default.
+
+The report path runs against the stub AI provider, an in-memory database URL
+and a chart cache under pytest's tmp dir; tests swap Redis for fakeredis and
+the R2 upload for a no-op.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("NEXUS_AI_PROVIDER", "stub")
+os.environ.setdefault("NEXUS_CHART_WORKERS", "2")
@@ -0,0 +1,138 @@
+"""The report path offline: stub analysis, fakeredis, no upload.
+
+A report must run end to end with no network, record how long each stage
+took, and a second identical run must come from the caches: the analysis
+from Redis, the charts from the PNG directory.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import fakeredis
+import pytest
+from reportlab.platypus import Paragraph
+
+from app.services.infrastructure.storage_service import StorageService
+from app.services.reports import analysis, charts, progress
+from app.services.reports.base_generator import BaseReportJob
+from app.services.reports.charts import ChartSpec
+
+DATA = {
+    "report_db_id": 31, "clinic_id": 4, "clinic_name": "Smile Dental", "title": "March revenue",
+    "report_category": "Financial", "start_date": "2026-03-01", "end_date": "2026-03-31",
+}
+RAW = {"revenue": 182500, "invoices": 212, "collection_rate": "91%"}
+
+
+@pytest.fixture()
+def offline(monkeypatch, tmp_path):
+    server = fakeredis.FakeServer()
+    redis = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(analysis, "_redis", redis)
+    monkeypatch.setattr(progress, "_redis", redis)
+    monkeypatch.setattr(progress, "_down_until", 0.0)
+    monkeypatch.setattr(charts, "CHART_CACHE_DIR", str(tmp_path / "charts"))
+    uploads = []
+    monkeypatch.setattr(StorageService, "upload_report_pdf", staticmethod(
+        lambda path, filename, clinic_id: uploads.append((filename, open(path, "rb").read()))
+        or f"clinics/{clinic_id}/reports/dashboard/{filename}"))
+    calls = []
+    stub = analysis.PROVIDERS["stub"]
+    monkeypatch.setitem(analysis.PROVIDERS, "stub", lambda *a: calls.append(a) or stub(*a))
+    return {"redis": redis, "uploads": uploads, "ai_calls": calls}
+
+
+def run_report():
+    job = BaseReportJob(dict(DATA))
+    try:
+        result = job.get_ai_analysis(RAW, "revenue and collections")
+        elements = [
+            Paragraph(DATA["title"], job.styles["ReportTitle"]),
+            Paragraph(result["summary"], job.styles["SummaryText"]),
+            job.generate_modern_bar_chart([120, 150, 182], ["Jan", "Feb", "Mar"], "Revenue"),
+            job.generate_modern_donut_chart([60, 30, 10], ["Cash", "UPI", "Card"], "Payment mix"),
+        ]
+        url = job.create_pdf(elements, f"fin_rpt_{DATA['report_db_id']}.pdf")
+    finally:
+        job.close()
+    return job, url
+
+
+def test_a_report_runs_offline_and_records_its_timings(offline):
+    started = time.perf_counter()
+    job, url = run_report()
+    elapsed = time.perf_counter() - started
+
+    assert url.endswith("/clinics/4/reports/dashboard/fin_rpt_31.pdf")
+    [(filename, pdf)] = offline["uploads"]
+    assert pdf.startswith(b"%PDF")
+    assert len(offline["ai_calls"]) == 1
+
+    assert list(job.timings) == ["data", "analysis", "charts", "pdf", "upload"]
+    assert all(0 <= s <= elapsed for s in job.timings.values())
+    recorded = {k.decode(): json.loads(v) for k, v in
+                offline["redis"].hgetall(progress.progress_key(DATA["report_db_id"])).items()}
+    assert {stage: r["state"] for stage, r in recorded.items()} == dict.fromkeys(progress.STAGES, "done")
+    assert charts._pool is None  # released with the job
+
+
+def test_the_report_log_line_carries_the_r2_upload_totals(offline, monkeypatch, capsys):
+    monkeypatch.setattr(StorageService, "_metrics", {})
+    with StorageService._timed("upload", 2048):
+        pass
+    run_report()
+    assert "| R2 1 uploads, 0 failed" in capsys.readouterr().out
+
+
+def test_a_second_identical_run_is_served_from_the_caches(offline):
+    first, _ = run_report()
+    second, _ = run_report()
+
+    assert len(offline["ai_calls"]) == 1
+    assert not any(c.cache_hit for c in first._charts)
+    assert all(c.cache_hit for c in second._charts)
+    assert sum(c.render_seconds for c in second._charts) == 0
+    assert offline["uploads"][0][1][:4] == offline["uploads"][1][1][:4] == b"%PDF"
+
+
+def spec(**changes):
+    fields = dict(kind="bar", data=(1.0, 2.0), labels=("a", "b"), title="T",
+                  colors={"navy": "#2a276e", "green": "#10b981", "gray": "#6b7280"})
+    fields.update(changes)
+    return ChartSpec(**fields)
+
+
+def test_chart_cache_key_is_stable():
+    key = spec().cache_key()
+    assert spec().cache_key() == key
+    assert spec(colors={"gray": "#6b7280", "green": "#10b981", "navy": "#2a276e"}).cache_key() == key
+    assert spec(data=(1.0, 3.0)).cache_key() != key
+    assert spec(title="U").cache_key() != key
+    assert spec(kind="line").cache_key() != key
+
+    # Same key in another interpreter, whatever its hash seed: workers share the cache.
+    other = subprocess.run(
+        [sys.executable, "-c",
+         "from app.services.reports.charts import ChartSpec; print(ChartSpec(kind='bar', data=(1.0, 2.0), "
+         "labels=('a', 'b'), title='T', colors={'navy': '#2a276e', 'green': '#10b981', "
+         "'gray': '#6b7280'}).cache_key())"],
+        capture_output=True, text=True, check=True, env={**os.environ, "PYTHONHASHSEED": "123"},
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    assert other.stdout.strip() == key
+
+
+def test_the_chart_cache_sweep_drops_old_and_oversized_entries(monkeypatch, tmp_path):
+    monkeypatch.setattr(charts, "CHART_CACHE_DIR", str(tmp_path))
+    now = time.time()
+    for i, age_days in enumerate([40, 3, 2, 1]):
+        key = f"{i:02d}" + "0" * 62
+        charts.store_png(key, b"x" * 1024)
+        stamp = now - age_days * 86400
+        os.utime(charts._cache_path(key), (stamp, stamp))
+
+    assert charts.sweep_cache(now) == 1  # older than the 30 day TTL
+    monkeypatch.setattr(charts, "CHART_CACHE_MAX_MB", 0)
+    assert charts.sweep_cache(now) == 3
@@ -1,9 +1,11 @@
+import base64
 import datetime
+import json
 import logging
 import os
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func, text
+from sqlalchemy import and_, func, or_, text
 from pydantic import BaseModel
 from typing import Optional
 from database import get_db
@@ -57,6 +59,31 @@ def _delete_firebase_user(uid: str) -> bool:
 router = APIRouter()
 
 
+PAID_STATUSES = ["paid_verified", "paid_unverified", "partially_paid"]
+CLINIC_SORTS = ("created_at", "name", "patient_count", "total_revenue")
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _encode_cursor(sort: str, order: str, value, clinic_id: int) -> str:
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, order, value, clinic_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str, sort: str, order: str):
+    """(sort value, clinic id) of the last row the previous page served."""
+    try:
+        c_sort, c_order, value, clinic_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if (c_sort, c_order) != (sort, order):
+        raise HTTPException(status_code=400, detail="Cursor belongs to a different sort order")
+    if sort == "created_at":
+        value = datetime.datetime.fromisoformat(value)
+    return value, int(clinic_id)
+
+
 @router.get("")
 def list_clinics(
     q: str = "",
@@ -65,29 +92,81 @@ def list_clinics(
     country: str = "",
     page: int = 1,
     limit: int = 20,
+    sort: str = "created_at",
+    order: str = "desc",
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     _=Depends(get_current_admin),
 ):
-    query = db.query(Clinic)
+    """Clinics with their patient count and paid revenue.
+
+    Sortable on created_at, name, patient_count and total_revenue. The counts
+    come from grouped queries, so a page costs the same four queries however
+    many clinics there are. Pass `next_cursor` back as `cursor` to get the
+    following page by keyset. `page` still works for jumping, at offset cost.
+    """
+    if sort not in CLINIC_SORTS or order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(CLINIC_SORTS)}; order asc or desc")
+    limit = max(1, limit)
+
+    filters = []
     if q:
-        query = query.filter(Clinic.name.ilike(f"%{q}%"))
+        filters.append(Clinic.name.ilike(f"%{q}%"))
     if status:
-        query = query.filter(Clinic.status == status)
+        filters.append(Clinic.status == status)
     if plan:
-        query = query.filter(Clinic.subscription_plan == plan)
+        filters.append(Clinic.subscription_plan == plan)
     if country:
-        query = query.filter(Clinic.country == country.upper())
-
-    total = query.count()
-    clinics = query.order_by(Clinic.created_at.desc()).offset((page - 1) * limit).limit(limit).all()
+        filters.append(Clinic.country == country.upper())
+
+    total = db.query(func.count(Clinic.id)).filter(*filters).scalar() or 0
+
+    patients = db.query(Patient.clinic_id, func.count(Patient.id).label("n")).group_by(Patient.clinic_id)
+    revenue = db.query(Invoice.clinic_id, func.sum(Invoice.paid_amount).label("amount")).filter(
+        Invoice.status.in_(PAID_STATUSES)
+    ).group_by(Invoice.clinic_id)
+
+    computed = sort in ("patient_count", "total_revenue")
+    if computed:
+        # Sorting on a count needs every clinic's count: join the grouped
+        # totals once rather than counting per clinic.
+        p, r = patients.subquery(), revenue.subquery()
+        patient_count = func.coalesce(p.c.n, 0)
+        total_revenue = func.coalesce(r.c.amount, 0)
+        query = (
+            db.query(Clinic, patient_count, total_revenue)
+            .outerjoin(p, p.c.clinic_id == Clinic.id)
+            .outerjoin(r, r.c.clinic_id == Clinic.id)
+        )
+        key = patient_count if sort == "patient_count" else total_revenue
+    else:
+        query = db.query(Clinic)
+        key = func.coalesce(Clinic.created_at, _EPOCH) if sort == "created_at" else func.coalesce(Clinic.name, "")
+    query = query.filter(*filters)
+
+    descending = order == "desc"
+    if cursor:
+        value, last_id = _decode_cursor(cursor, sort, order)
+        if descending:
+            query = query.filter(or_(key < value, and_(key == value, Clinic.id < last_id)))
+        else:
+            query = query.filter(or_(key > value, and_(key == value, Clinic.id > last_id)))
+    ordering = (key.desc(), Clinic.id.desc()) if descending else (key.asc(), Clinic.id.asc())
+    query = query.order_by(*ordering)
+    if not cursor:
+        query = query.offset((page - 1) * limit)
+    rows = query.limit(limit).all()
+
+    if computed:
+        page_rows = rows
+    else:
+        ids = [c.id for c in rows]
+        counts = dict(patients.filter(Patient.clinic_id.in_(ids)).all()) if ids else {}
+        amounts = dict(revenue.filter(Invoice.clinic_id.in_(ids)).all()) if ids else {}
+        page_rows = [(c, counts.get(c.id, 0), amounts.get(c.id) or 0) for c in rows]
 
     result = []
-    for c in clinics:
-        patient_count = db.query(func.count(Patient.id)).filter(Patient.clinic_id == c.id).scalar() or 0
-        revenue = db.query(func.coalesce(func.sum(Invoice.paid_amount), 0)).filter(
-            Invoice.clinic_id == c.id,
-            Invoice.status.in_(["paid_verified", "paid_unverified", "partially_paid"])
-        ).scalar() or 0
+    for c, patient_count, revenue_total in page_rows:
         result.append({
             "id": c.id,
             "clinic_code": c.clinic_code,
@@ -99,11 +178,23 @@ def list_clinics(
             "country": c.country,
             "currency_symbol": c.currency_symbol,
             "patient_count": patient_count,
-            "total_revenue": round(float(revenue), 2),
+            "total_revenue": round(float(revenue_total), 2),
             "created_at": c.created_at.isoformat() if c.created_at else None,
         })
 
-    return {"clinics": result, "total": total, "page": page, "limit": limit}
+    next_cursor = None
+    if len(rows) == limit:
+        last, patient_count, revenue_total = page_rows[-1]
+        value = {
+            "created_at": last.created_at or _EPOCH,
+            "name": last.name or "",
+            "patient_count": patient_count,
+            "total_revenue": float(revenue_total),
+        }[sort]
+        next_cursor = _encode_cursor(sort, order, value, last.id)
+
+    return {"clinics": result, "total": total, "page": page, "limit": limit,
+            "sort": sort, "order": order, "next_cursor": next_cursor}
 
 
 @router.get("/{clinic_id}")
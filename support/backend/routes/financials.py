@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func, extract
+from sqlalchemy import case, extract, func
 from database import get_db
 from models import Invoice, Clinic
 from routes.auth import get_current_admin
@@ -10,14 +10,14 @@ router = APIRouter()
 
 @router.get("/summary")
 def summary(db: Session = Depends(get_db), _=Depends(get_current_admin)):
-    total_revenue = db.query(func.coalesce(func.sum(Invoice.paid_amount), 0)).scalar()
-    total_invoices = db.query(func.count(Invoice.id)).scalar()
-    paid_invoices = db.query(func.count(Invoice.id)).filter(
-        Invoice.status.in_(["paid_verified", "paid_unverified"])
-    ).scalar()
-    pending_amount = db.query(func.coalesce(func.sum(Invoice.due_amount), 0)).filter(
-        Invoice.status.in_(["finalized", "partially_paid"])
-    ).scalar()
+    # One pass over invoices, each figure conditional on status.
+    total_revenue, total_invoices, paid_invoices, pending_amount = db.query(
+        func.coalesce(func.sum(Invoice.paid_amount), 0),
+        func.count(Invoice.id),
+        func.coalesce(func.sum(case((Invoice.status.in_(["paid_verified", "paid_unverified"]), 1), else_=0)), 0),
+        func.coalesce(func.sum(case((Invoice.status.in_(["finalized", "partially_paid"]), Invoice.due_amount),
+                                    else_=0)), 0),
+    ).one()
     avg_invoice = (total_revenue / paid_invoices) if paid_invoices else 0
 
     payment_methods = (
@@ -1,41 +1,57 @@
 import datetime
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy import and_, case, func
 from database import get_db
-from models import Clinic, User, Patient, Appointment, Invoice, SupportTicket
+from models import Clinic, Patient, Appointment, Invoice, SupportTicket
 from routes.auth import get_current_admin
 
 router = APIRouter()
 
 
+PAID_STATUSES = ["paid_verified", "paid_unverified", "partially_paid"]
+
+
+def _count_if(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+def _day(value) -> str:
+    """A func.date() result as YYYY-MM-DD: a date on Postgres, a string on SQLite."""
+    return str(value)[:10]
+
+
 @router.get("/overview")
 def overview(db: Session = Depends(get_db), _=Depends(get_current_admin)):
-    total_clinics = db.query(func.count(Clinic.id)).scalar() or 0
-    active_clinics = db.query(func.count(Clinic.id)).filter(Clinic.status == "active").scalar() or 0
-    suspended_clinics = db.query(func.count(Clinic.id)).filter(Clinic.status == "suspended").scalar() or 0
-    free_clinics = db.query(func.count(Clinic.id)).filter(Clinic.subscription_plan == "free").scalar() or 0
-    paid_clinics = db.query(func.count(Clinic.id)).filter(Clinic.subscription_plan != "free").scalar() or 0
-
     now = datetime.datetime.utcnow()
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    new_this_month = db.query(func.count(Clinic.id)).filter(Clinic.created_at >= month_start).scalar() or 0
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # One pass per table, every figure a conditional count over it.
+    clinics = db.query(
+        func.count(Clinic.id),
+        _count_if(Clinic.status == "active"),
+        _count_if(Clinic.status == "suspended"),
+        _count_if(Clinic.subscription_plan == "free"),
+        _count_if(Clinic.subscription_plan != "free"),
+        _count_if(Clinic.created_at >= month_start),
+    ).one()
+    total_clinics, active_clinics, suspended_clinics, free_clinics, paid_clinics, new_this_month = clinics
 
     total_patients = db.query(func.count(Patient.id)).scalar() or 0
     total_appointments = db.query(func.count(Appointment.id)).scalar() or 0
 
-    total_invoices = db.query(func.count(Invoice.id)).scalar() or 0
-    total_revenue = db.query(func.coalesce(func.sum(Invoice.paid_amount), 0)).filter(
-        Invoice.status.in_(["paid_verified", "paid_unverified", "partially_paid"])
-    ).scalar() or 0
+    total_invoices, total_revenue = db.query(
+        func.count(Invoice.id),
+        func.coalesce(func.sum(case((Invoice.status.in_(PAID_STATUSES), Invoice.paid_amount), else_=0)), 0),
+    ).one()
 
-    open_tickets = db.query(func.count(SupportTicket.id)).filter(SupportTicket.status == "open").scalar() or 0
-    in_progress_tickets = db.query(func.count(SupportTicket.id)).filter(SupportTicket.status == "in_progress").scalar() or 0
-    resolved_today = db.query(func.count(SupportTicket.id)).filter(
-        SupportTicket.status == "resolved",
-        SupportTicket.updated_at >= now.replace(hour=0, minute=0, second=0, microsecond=0)
-    ).scalar() or 0
-    total_tickets = db.query(func.count(SupportTicket.id)).scalar() or 0
+    total_tickets, open_tickets, in_progress_tickets, resolved_today = db.query(
+        func.count(SupportTicket.id),
+        _count_if(SupportTicket.status == "open"),
+        _count_if(SupportTicket.status == "in_progress"),
+        _count_if(and_(SupportTicket.status == "resolved", SupportTicket.updated_at >= day_start)),
+    ).one()
 
     return {
         "clinics": {
@@ -48,7 +64,7 @@ def overview(db: Session = Depends(get_db), _=Depends(get_current_admin)):
         },
         "patients": {"total": total_patients},
         "appointments": {"total": total_appointments},
-        "invoices": {"total": total_invoices, "total_revenue": round(float(total_revenue), 2)},
+        "invoices": {"total": total_invoices, "total_revenue": round(float(total_revenue or 0), 2)},
         "tickets": {
             "total": total_tickets,
             "open": open_tickets,
@@ -61,16 +77,21 @@ def overview(db: Session = Depends(get_db), _=Depends(get_current_admin)):
 @router.get("/growth")
 def growth(db: Session = Depends(get_db), _=Depends(get_current_admin)):
     now = datetime.datetime.utcnow()
+    since = now - datetime.timedelta(weeks=8)
+    # Eight weeks of sign-ups is a handful of rows: fetch them once and
+    # bucket here instead of counting each week separately.
+    counts = [0] * 8
+    for (created_at,) in db.query(Clinic.created_at).filter(
+        and_(Clinic.created_at >= since, Clinic.created_at < now)
+    ):
+        weeks_ago = min(int((now - created_at) / datetime.timedelta(weeks=1)), 7)
+        counts[7 - weeks_ago] += 1
     weeks = []
     for i in range(7, -1, -1):
         week_start = now - datetime.timedelta(weeks=i+1)
-        week_end = now - datetime.timedelta(weeks=i)
-        count = db.query(func.count(Clinic.id)).filter(
-            and_(Clinic.created_at >= week_start, Clinic.created_at < week_end)
-        ).scalar() or 0
         weeks.append({
             "label": week_start.strftime("W%W %b"),
-            "new_clinics": count,
+            "new_clinics": counts[7 - i],
         })
     return {"weekly": weeks}
 
@@ -78,20 +99,23 @@ def growth(db: Session = Depends(get_db), _=Depends(get_current_admin)):
 @router.get("/activity")
 def activity(db: Session = Depends(get_db), _=Depends(get_current_admin)):
     now = datetime.datetime.utcnow()
+    since = (now - datetime.timedelta(days=29)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def per_day(model):
+        day = func.date(model.created_at)
+        return {
+            _day(d): n for d, n in
+            db.query(day, func.count(model.id)).filter(model.created_at >= since).group_by(day)
+        }
+
+    appts, invs = per_day(Appointment), per_day(Invoice)
     days = []
     for i in range(29, -1, -1):
         day = now - datetime.timedelta(days=i)
-        day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_end = day_start + datetime.timedelta(days=1)
-        appts = db.query(func.count(Appointment.id)).filter(
-            and_(Appointment.created_at >= day_start, Appointment.created_at < day_end)
-        ).scalar() or 0
-        invs = db.query(func.count(Invoice.id)).filter(
-            and_(Invoice.created_at >= day_start, Invoice.created_at < day_end)
-        ).scalar() or 0
+        key = day.strftime("%Y-%m-%d")
         days.append({
             "date": day.strftime("%d %b"),
-            "appointments": appts,
-            "invoices": invs,
+            "appointments": appts.get(key, 0),
+            "invoices": invs.get(key, 0),
         })
     return {"daily": days}
@@ -0,0 +1,118 @@
+"""Support console list and metrics pages: grouped queries, constant cost.
+
+The clinic list used to count patients and revenue per clinic on the page,
+and the metrics pages counted per day or per week. Each page must now cost
+the same number of queries whatever the number of clinics, and walking the
+clinic list by cursor must visit every clinic once, in order.
+"""
+import datetime
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from routes import clinics, financials, metrics
+
+NOW = datetime.datetime.utcnow()
+
+
+def build(n_clinics):
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    for c in range(1, n_clinics + 1):
+        db.add(models.Clinic(id=c, name=f"Clinic {c % 7}", status="active", subscription_plan="free",
+                             created_at=NOW - datetime.timedelta(days=c % 40)))
+        for p in range(c % 5):
+            db.add(models.Patient(clinic_id=c, name=f"P{p}", created_at=NOW - datetime.timedelta(days=p)))
+            db.add(models.Appointment(clinic_id=c, status="completed", created_at=NOW - datetime.timedelta(days=p)))
+        db.add(models.Invoice(clinic_id=c, status="paid_verified", paid_amount=float(c % 3 * 100),
+                              due_amount=0.0, created_at=NOW - datetime.timedelta(days=c % 10)))
+    db.add(models.SupportTicket(clinic_id=1, title="Help", status="open", created_at=NOW, updated_at=NOW))
+    db.commit()
+    return db
+
+
+def count_queries(db, fn):
+    seen = []
+
+    def _record(conn, cursor, statement, params, context, executemany):
+        seen.append(statement)
+
+    event.listen(db.get_bind(), "before_cursor_execute", _record)
+    try:
+        fn()
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", _record)
+    return len(seen)
+
+
+def list_page(db, **kw):
+    args = dict(q="", status="", plan="", country="", page=1, limit=20, sort="created_at",
+                order="desc", cursor=None)
+    args.update(kw)
+    return clinics.list_clinics(db=db, _=None, **args)
+
+
+PAGES = [
+    lambda db: list_page(db),
+    lambda db: list_page(db, sort="patient_count"),
+    lambda db: list_page(db, sort="total_revenue", order="asc"),
+    lambda db: list_page(db, sort="name", cursor=list_page(db, sort="name", limit=5)["next_cursor"]),
+    lambda db: metrics.overview(db=db, _=None),
+    lambda db: metrics.growth(db=db, _=None),
+    lambda db: metrics.activity(db=db, _=None),
+    lambda db: financials.summary(db=db, _=None),
+]
+
+
+@pytest.mark.parametrize("page", range(len(PAGES)))
+def test_query_count_does_not_grow_with_clinics(page):
+    small, large = build(8), build(120)
+    assert count_queries(small, lambda: PAGES[page](small)) == count_queries(large, lambda: PAGES[page](large))
+
+
+@pytest.mark.parametrize("sort", clinics.CLINIC_SORTS)
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_cursor_walk_visits_every_clinic_once_in_order(sort, order):
+    db = build(45)
+    walked, cursor = [], None
+    while True:
+        res = list_page(db, sort=sort, order=order, limit=7, cursor=cursor)
+        walked += res["clinics"]
+        cursor = res["next_cursor"]
+        if cursor is None:
+            break
+
+    expected = sorted(list_page(db, limit=100)["clinics"], key=lambda c: (c[sort], c["id"]),
+                      reverse=order == "desc")
+    assert [c["id"] for c in walked] == [c["id"] for c in expected]
+
+
+def test_counts_are_per_clinic():
+    db = build(12)
+    rows = {c["id"]: c for c in list_page(db, sort="patient_count", limit=100)["clinics"]}
+    assert all(rows[c]["patient_count"] == c % 5 for c in rows)
+    assert all(rows[c]["total_revenue"] == c % 3 * 100 for c in rows)
+    assert list_page(db, q="Clinic 3", limit=100)["total"] == 2  # clinics 3 and 10
+
+
+def test_metrics_figures():
+    db = build(12)
+    overview = metrics.overview(db=db, _=None)
+    assert overview["clinics"]["total"] == 12 and overview["clinics"]["free"] == 12
+    assert overview["tickets"]["open"] == 1
+    daily = metrics.activity(db=db, _=None)["daily"]
+    assert daily[-1]["appointments"] == sum(1 for c in range(1, 13) if c % 5 >= 1)
+    assert sum(w["new_clinics"] for w in metrics.growth(db=db, _=None)["weekly"]) == 12
+
+
+def test_a_cursor_for_another_sort_is_rejected():
+    db = build(10)
+    cursor = list_page(db, limit=3)["next_cursor"]
+    with pytest.raises(clinics.HTTPException):
+        list_page(db, sort="name", cursor=cursor)